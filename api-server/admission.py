@@ -0,0 +1,361 @@
+"""
+准入控制与过载降级
+
+每个worker同时进行的生成（上游模型调用）数有上限，超出的请求进入有界的等待队列：
+- 等待队列按优先级出队：interactive（交互式聊天）> code_assist（代码助手）> batch（批量任务）> health（健康测试）
+- 每个请求有排队截止时间（ADMISSION_QUEUE_TIMEOUT，请求可用 X-Queue-Timeout 缩短），到期仍未轮到则拒绝
+- 队列已满时，若新请求的优先级高于队列中最低的优先级，丢弃最低优先级中最晚加入的请求，否则拒绝新请求
+- 被拒绝的HTTP请求立即返回503 + Retry-After（而不是排队到超时），WebSocket上的轮次收到带 retryAfter 的错误消息
+
+HTTP生成端点由 AdmissionMiddleware 在ASGI层统一处理（端点与优先级见 ENDPOINT_PRIORITIES，
+请求可用 X-Priority 头降低自己的优先级，不能提高）；WebSocket轮次、群聊各模型的调用与多路复用流
+用 admission_controller.slot() 包住一次生成。可续传的后台生成在客户端断开后继续占用名额，直到生成结束。
+
+使用方法:
+    app.add_middleware(AdmissionMiddleware, controller=admission_controller)
+
+    async with admission_controller.slot(PRIORITY_INTERACTIVE):
+        ...  # 一次上游调用
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+from config import config
+from lifecycle import DrainController
+
+logger = logging.getLogger(__name__)
+
+# 优先级（从高到低）
+PRIORITY_INTERACTIVE = 'interactive'
+PRIORITY_CODE_ASSIST = 'code_assist'
+PRIORITY_BATCH = 'batch'
+PRIORITY_HEALTH = 'health'
+PRIORITY_CLASSES: Tuple[str, ...] = (PRIORITY_INTERACTIVE, PRIORITY_CODE_ASSIST, PRIORITY_BATCH, PRIORITY_HEALTH)
+_RANK: Dict[str, int] = {priority: rank for rank, priority in enumerate(PRIORITY_CLASSES)}
+
+# 生成端点的默认优先级（路径前缀），未列出的生成端点为 interactive
+ENDPOINT_PRIORITIES: Tuple[Tuple[str, str], ...] = (
+    ('/api/cline/', PRIORITY_CODE_ASSIST),
+    ('/api/diagnostics/', PRIORITY_HEALTH),
+)
+
+# 拒绝原因
+REJECT_QUEUE_FULL = 'queue_full'
+REJECT_TIMEOUT = 'timeout'
+REJECT_SHED = 'shed'
+
+_REJECT_MESSAGES = {
+    REJECT_QUEUE_FULL: '服务繁忙，等待队列已满',
+    REJECT_TIMEOUT: '服务繁忙，排队超时',
+    REJECT_SHED: '服务繁忙，已让位于更高优先级的请求'
+}
+
+
+class AdmissionRejected(Exception):
+    """请求未被准入（队列已满、排队超时或被更高优先级的请求挤出）"""
+
+    def __init__(self, reason: str, priority: str, retry_after: int):
+        self.reason = reason
+        self.priority = priority
+        self.retry_after = retry_after
+        super().__init__(f"{_REJECT_MESSAGES[reason]}，请 {retry_after} 秒后重试")
+
+
+def normalize_priority(value: Optional[str], default: str = PRIORITY_INTERACTIVE) -> str:
+    """解析优先级名称，未知的名称使用默认值"""
+    if value:
+        value = value.strip().lower().replace('-', '_')
+        if value in _RANK:
+            return value
+    return default
+
+
+def lower_priority(requested: Optional[str], default: str) -> str:
+    """客户端只能降低优先级：取请求的优先级与端点默认优先级中较低的一个"""
+    requested = normalize_priority(requested, default)
+    return requested if _RANK[requested] > _RANK[default] else default
+
+
+class Ticket:
+    """一个准入名额：引用计数归零时释放（可续传的后台生成持有额外的引用）"""
+
+    def __init__(self, controller: 'AdmissionController', priority: str):
+        self.controller = controller
+        self.priority = priority
+        self.refs = 1
+
+    def retain(self) -> 'Ticket':
+        self.refs += 1
+        return self
+
+    def release(self):
+        if self.refs <= 0:
+            return
+        self.refs -= 1
+        if self.refs == 0:
+            self.controller._release(self.priority)
+
+
+class _Waiter:
+    __slots__ = ('priority', 'future', 'enqueued_at')
+
+    def __init__(self, priority: str, future: asyncio.Future):
+        self.priority = priority
+        self.future = future
+        self.enqueued_at = time.monotonic()
+
+
+# 当前任务持有的名额（由中间件或 slot() 设置，可续传生成据此接管名额）
+_current_ticket: contextvars.ContextVar[Optional[Ticket]] = contextvars.ContextVar('admission_ticket', default=None)
+
+
+class AdmissionController:
+    """限制同时进行的生成数，超出的请求按优先级排队"""
+
+    def __init__(self, max_inflight: int = 0, queue_size: int = 100, queue_timeout: float = 10.0,
+                 retry_after: int = 2, wait_samples: int = 1000):
+        """
+        Args:
+            max_inflight: 同时进行的生成数上限，0表示不限制
+            queue_size: 等待队列长度上限，0表示不排队（名额用完时直接拒绝）
+            queue_timeout: 排队的最长秒数
+        """
+        self.max_inflight = max_inflight
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.inflight = 0
+        self.queues: Dict[str, Deque[_Waiter]] = {priority: deque() for priority in PRIORITY_CLASSES}
+        self.waiting = 0
+        self.max_waiting = 0
+        # 最近准入请求的排队秒数（计算分位数）
+        self.wait_times: Deque[float] = deque(maxlen=wait_samples)
+        self.metrics: Dict[str, Dict[str, int]] = {
+            priority: {'admitted': 0, 'queued': 0, 'inflight': 0, REJECT_QUEUE_FULL: 0, REJECT_TIMEOUT: 0, REJECT_SHED: 0}
+            for priority in PRIORITY_CLASSES
+        }
+        self.total_wait = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_inflight > 0
+
+    async def acquire(self, priority: str = PRIORITY_INTERACTIVE, timeout: Optional[float] = None) -> Ticket:
+        """
+        获取一个名额（名额用完时排队等待）
+
+        Args:
+            timeout: 本请求的排队截止秒数（不超过 queue_timeout）
+
+        Raises:
+            AdmissionRejected: 队列已满、排队超时或被更高优先级的请求挤出
+        """
+        priority = normalize_priority(priority)
+        if not self.enabled or (self.inflight < self.max_inflight and self.waiting == 0):
+            self._admit(priority, 0.0)
+            return Ticket(self, priority)
+
+        if self.waiting >= self.queue_size:
+            victim = self._lowest_waiter()
+            if victim is None or _RANK[victim.priority] <= _RANK[priority]:
+                raise self._reject(REJECT_QUEUE_FULL, priority)
+            self._remove(victim)
+            victim.future.set_exception(self._reject(REJECT_SHED, victim.priority))
+
+        waiter = _Waiter(priority, asyncio.get_running_loop().create_future())
+        self.queues[priority].append(waiter)
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        self.metrics[priority]['queued'] += 1
+        timeout = self.queue_timeout if timeout is None else max(0.0, min(timeout, self.queue_timeout))
+        try:
+            # shield：超时或取消时先检查名额是否恰好已经转交给本请求
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except asyncio.TimeoutError:
+            if not waiter.future.done():
+                self._remove(waiter)
+                waiter.future.cancel()
+                raise self._reject(REJECT_TIMEOUT, priority)
+            waiter.future.result()
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled() and waiter.future.exception() is None:
+                self._release(priority)
+            elif not waiter.future.done():
+                self._remove(waiter)
+                waiter.future.cancel()
+            raise
+        return Ticket(self, priority)
+
+    @asynccontextmanager
+    async def slot(self, priority: str = PRIORITY_INTERACTIVE, timeout: Optional[float] = None):
+        """在一次生成期间持有名额"""
+        ticket = await self.acquire(priority, timeout)
+        token = _current_ticket.set(ticket)
+        try:
+            yield ticket
+        finally:
+            _current_ticket.reset(token)
+            ticket.release()
+
+    @staticmethod
+    def retain_current() -> Optional[Ticket]:
+        """后台任务接管当前请求的名额（任务结束时调用 release）"""
+        ticket = _current_ticket.get()
+        return ticket.retain() if ticket else None
+
+    def _admit(self, priority: str, waited: float):
+        self.inflight += 1
+        self.metrics[priority]['admitted'] += 1
+        self.metrics[priority]['inflight'] += 1
+        self.wait_times.append(waited)
+        self.total_wait += waited
+
+    def _release(self, priority: str):
+        self.inflight -= 1
+        self.metrics[priority]['inflight'] -= 1
+        # 名额直接转交给优先级最高的等待者
+        while self.inflight < self.max_inflight or not self.enabled:
+            waiter = self._next_waiter()
+            if waiter is None:
+                return
+            self._remove(waiter)
+            if waiter.future.done():
+                continue
+            self._admit(waiter.priority, time.monotonic() - waiter.enqueued_at)
+            waiter.future.set_result(None)
+
+    def _next_waiter(self) -> Optional[_Waiter]:
+        for priority in PRIORITY_CLASSES:
+            if self.queues[priority]:
+                return self.queues[priority][0]
+        return None
+
+    def _lowest_waiter(self) -> Optional[_Waiter]:
+        for priority in reversed(PRIORITY_CLASSES):
+            if self.queues[priority]:
+                return self.queues[priority][-1]
+        return None
+
+    def _remove(self, waiter: _Waiter):
+        try:
+            self.queues[waiter.priority].remove(waiter)
+            self.waiting -= 1
+        except ValueError:
+            pass
+
+    def _reject(self, reason: str, priority: str) -> AdmissionRejected:
+        self.metrics[priority][reason] += 1
+        return AdmissionRejected(reason, priority, self.retry_after)
+
+    def get_stats(self) -> Dict[str, Any]:
+        waits = sorted(self.wait_times)
+
+        def percentile(p: float) -> float:
+            return round(waits[min(len(waits) - 1, int(len(waits) * p))] * 1000, 1) if waits else 0.0
+
+        admitted = sum(metrics['admitted'] for metrics in self.metrics.values())
+        return {
+            'enabled': self.enabled,
+            'max_inflight': self.max_inflight,
+            'queue_size': self.queue_size,
+            'queue_timeout': self.queue_timeout,
+            'inflight': self.inflight,
+            'queue_depth': self.waiting,
+            'max_queue_depth': self.max_waiting,
+            'queue_depth_by_priority': {priority: len(queue) for priority, queue in self.queues.items()},
+            'wait_ms': {
+                'avg': round(self.total_wait / admitted * 1000, 1) if admitted else 0.0,
+                'p50': percentile(0.5),
+                'p95': percentile(0.95),
+                'p99': percentile(0.99),
+                'max': round(waits[-1] * 1000, 1) if waits else 0.0,
+                'samples': len(waits)
+            },
+            'by_priority': {priority: dict(metrics) for priority, metrics in self.metrics.items()}
+        }
+
+
+class AdmissionMiddleware:
+    """
+    ASGI中间件：HTTP生成请求在调用端点前获取名额，未准入时返回503 + Retry-After
+
+    exempt(headers) 为真的请求（如续传、幂等重放，不调用上游）不占用名额
+    """
+
+    def __init__(self, app, controller: 'AdmissionController',
+                 exempt: Optional[Callable[[Dict[str, str]], bool]] = None):
+        self.app = app
+        self.controller = controller
+        self.exempt = exempt
+
+    @staticmethod
+    def classify(path: str, headers: Dict[str, str]) -> str:
+        default = next((priority for prefix, priority in ENDPOINT_PRIORITIES if path.startswith(prefix)),
+                       PRIORITY_INTERACTIVE)
+        return lower_priority(headers.get('x-priority'), default)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not self.controller.enabled \
+                or not DrainController.is_generation(scope['method'], scope['path']):
+            await self.app(scope, receive, send)
+            return
+
+        headers = {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope['headers']}
+        if self.exempt and self.exempt(headers):
+            await self.app(scope, receive, send)
+            return
+        priority = self.classify(scope['path'], headers)
+        timeout = None
+        try:
+            if headers.get('x-queue-timeout'):
+                timeout = float(headers['x-queue-timeout'])
+        except ValueError:
+            pass
+        try:
+            ticket = await self.controller.acquire(priority, timeout)
+        except AdmissionRejected as e:
+            await self._reject_http(send, e)
+            return
+        token = _current_ticket.set(ticket)
+        try:
+            # StreamingResponse 在响应体发送完毕后才返回，名额覆盖整个流
+            await self.app(scope, receive, send)
+        finally:
+            _current_ticket.reset(token)
+            ticket.release()
+
+    @staticmethod
+    async def _reject_http(send, error: AdmissionRejected):
+        body = json.dumps({
+            'success': False,
+            'error': str(error),
+            'reason': error.reason,
+            'priority': error.priority,
+            'retry_after': error.retry_after
+        }, ensure_ascii=False).encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': 503,
+            'headers': [
+                (b'content-type', b'application/json; charset=utf-8'),
+                (b'retry-after', str(error.retry_after).encode()),
+                (b'content-length', str(len(body)).encode()),
+            ]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+
+# 全局准入控制器实例
+admission_controller = AdmissionController(
+    max_inflight=config.admission_max_inflight,
+    queue_size=config.admission_queue_size,
+    queue_timeout=config.admission_queue_timeout,
+    retry_after=config.admission_retry_after
+)
@@ -0,0 +1,17 @@
+"""
+准入控制API端点
+"""
+from fastapi import APIRouter
+from admission import admission_controller, PRIORITY_CLASSES, ENDPOINT_PRIORITIES
+
+router = APIRouter()
+
+@router.get("/api/admission/stats", tags=["准入控制"], summary="获取准入控制指标")
+async def get_admission_stats():
+    """进行中的生成数、各优先级的队列深度、排队耗时分位数与拒绝次数"""
+    return {
+        "success": True,
+        "priorities": list(PRIORITY_CLASSES),
+        "endpoint_priorities": {prefix: priority for prefix, priority in ENDPOINT_PRIORITIES},
+        "stats": admission_controller.get_stats()
+    }
@@ -0,0 +1,302 @@
+"""
+有界队列与背压
+
+上游读取（模型流、群聊各模型的回答）与下游发送（SSE响应、WebSocket连接）之间
+通过 BoundedChannel 解耦，每个消费者一个有界队列。消费者跟不上时按策略处理：
+- block：队列满时生产者等待，背压传递到上游（上游读取暂停）
+- coalesce：队列满时尝试把新消息合并进队列中已有的消息（如相邻的内容块拼接、
+  状态消息只保留最新一条），无法合并时退化为 block
+- drop：队列满时丢弃该消费者（关闭队列，由发送方断开连接，客户端可稍后续传）
+
+每个队列的深度、合并、阻塞与丢弃次数记录在 channel_registry 中，
+用于观察少数慢客户端造成的内存增长与队头阻塞。
+
+使用方法:
+    writer = ConnectionWriter(name, websocket.send_text, maxsize=256, policy='coalesce', send_timeout=10)
+    writer.start()
+    await writer.send(text)       # 只入队，发送由writer的后台任务完成
+    writer.send_nowait(text)      # 广播：从不等待，队列满且无法合并时丢弃该连接
+    writer.close()
+"""
+
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+POLICY_BLOCK = 'block'
+POLICY_COALESCE = 'coalesce'
+POLICY_DROP = 'drop'
+POLICIES = (POLICY_BLOCK, POLICY_COALESCE, POLICY_DROP)
+
+# 关闭原因
+CLOSE_OVERFLOW = 'overflow'
+CLOSE_FINISHED = 'finished'
+CLOSE_DISCONNECTED = 'disconnected'
+CLOSE_TIMEOUT = 'timeout'
+CLOSE_ERROR = 'error'
+# 服务排空：发完队列中已有的消息后关闭（见 lifecycle.py）
+CLOSE_DRAINING = 'draining'
+
+# WebSocket关闭码：连接因过慢或发送超时被断开，客户端应稍后重连
+WS_CLOSE_TRY_AGAIN_LATER = 1013
+
+# 合并函数：尝试把 item 合并进队列（可修改队列），成功返回True
+Coalescer = Callable[[Deque[Any], Any], bool]
+
+
+class ChannelClosed(Exception):
+    """队列已关闭（生产结束、消费者被丢弃或连接断开）"""
+
+
+class BoundedChannel:
+    """单个生产者与单个消费者之间的有界队列"""
+
+    def __init__(self, name: str, maxsize: int = 256, policy: str = POLICY_BLOCK,
+                 coalesce: Optional[Coalescer] = None):
+        if policy not in POLICIES:
+            logger.warning(f"未知的背压策略 {policy}，使用 {POLICY_BLOCK}")
+            policy = POLICY_BLOCK
+        self.name = name
+        self.maxsize = max(1, maxsize)
+        self.policy = policy
+        self.coalesce = coalesce
+        self.items: Deque[Any] = deque()
+        self.closed = False
+        self.close_reason: Optional[str] = None
+        self.created_at = time.time()
+        self._readable = asyncio.Event()
+        self._writable = asyncio.Event()
+        self._writable.set()
+        self.stats = {
+            'enqueued': 0,
+            'delivered': 0,
+            'coalesced': 0,
+            'blocked': 0,
+            'blocked_seconds': 0.0,
+            'max_depth': 0
+        }
+        channel_registry.register(self)
+
+    @property
+    def depth(self) -> int:
+        return len(self.items)
+
+    async def put(self, item: Any) -> bool:
+        """
+        放入一条消息（按策略处理队列已满的情况）
+
+        Returns:
+            是否被接收（队列已关闭或消费者因过慢被丢弃时为False）
+        """
+        if self.closed:
+            return False
+        if len(self.items) >= self.maxsize:
+            if self._try_coalesce(item):
+                return True
+            if self.policy == POLICY_DROP:
+                self._overflow()
+                return False
+            await self._wait_writable()
+            if self.closed:
+                return False
+        self._append(item)
+        return True
+
+    def put_nowait(self, item: Any) -> bool:
+        """
+        放入一条消息但从不等待（用于广播）：队列已满且无法合并时，无论策略如何都丢弃该消费者
+
+        Returns:
+            是否被接收
+        """
+        if self.closed:
+            return False
+        if len(self.items) >= self.maxsize:
+            if self._try_coalesce(item):
+                return True
+            self._overflow()
+            return False
+        self._append(item)
+        return True
+
+    def _try_coalesce(self, item: Any) -> bool:
+        if self.policy == POLICY_COALESCE and self.coalesce and self.coalesce(self.items, item):
+            self.stats['coalesced'] += 1
+            self._readable.set()
+            return True
+        return False
+
+    def drop(self):
+        """因过慢丢弃该消费者（清空队列并以 overflow 关闭，唤醒阻塞的生产者）"""
+        self._overflow()
+
+    def _overflow(self):
+        logger.warning(f"消费者过慢，丢弃 {self.name}（队列深度 {len(self.items)}）")
+        self.items.clear()
+        self.close(CLOSE_OVERFLOW)
+
+    def _append(self, item: Any):
+        self.items.append(item)
+        self.stats['enqueued'] += 1
+        if len(self.items) > self.stats['max_depth']:
+            self.stats['max_depth'] = len(self.items)
+        if len(self.items) >= self.maxsize:
+            self._writable.clear()
+        self._readable.set()
+
+    async def _wait_writable(self):
+        self.stats['blocked'] += 1
+        started = time.perf_counter()
+        while len(self.items) >= self.maxsize and not self.closed:
+            self._writable.clear()
+            await self._writable.wait()
+        self.stats['blocked_seconds'] += time.perf_counter() - started
+
+    async def get(self) -> Any:
+        """取出一条消息，队列为空时等待；已关闭且取完时抛出 ChannelClosed"""
+        while not self.items:
+            if self.closed:
+                raise ChannelClosed(self.close_reason)
+            self._readable.clear()
+            await self._readable.wait()
+        item = self.items.popleft()
+        self.stats['delivered'] += 1
+        if len(self.items) < self.maxsize:
+            self._writable.set()
+        return item
+
+    def close(self, reason: str = CLOSE_FINISHED):
+        """关闭队列：已入队的消息仍可取出（因过慢被丢弃时已清空）"""
+        if self.closed:
+            return
+        self.closed = True
+        self.close_reason = reason
+        self._readable.set()
+        self._writable.set()
+        channel_registry.unregister(self)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'policy': self.policy,
+            'depth': len(self.items),
+            'maxsize': self.maxsize,
+            'age_seconds': round(time.time() - self.created_at, 1),
+            **self.stats,
+            'blocked_seconds': round(self.stats['blocked_seconds'], 3)
+        }
+
+
+class ConnectionWriter:
+    """
+    单个连接的发送任务：发送方只把消息放入有界队列，由后台任务逐条发送
+
+    单条消息发送超过 send_timeout 秒（对端卡死、TCP窗口长期为零）时结束发送任务，
+    由 on_close 回调移除并关闭该连接
+    """
+
+    def __init__(self, name: str, send: Callable[[Any], Awaitable[Any]], maxsize: int = 256,
+                 policy: str = POLICY_BLOCK, coalesce: Optional[Coalescer] = None,
+                 on_close: Optional[Callable[[str], Awaitable[Any]]] = None,
+                 send_timeout: Optional[float] = None):
+        self.channel = BoundedChannel(name, maxsize, policy, coalesce)
+        self._send = send
+        self._on_close = on_close
+        self.send_timeout = send_timeout
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run(), name=f"writer-{self.channel.name}")
+
+    async def send(self, item: Any) -> bool:
+        return await self.channel.put(item)
+
+    def send_nowait(self, item: Any) -> bool:
+        return self.channel.put_nowait(item)
+
+    async def _run(self):
+        reason = CLOSE_FINISHED
+        try:
+            while True:
+                item = await self.channel.get()
+                if self.send_timeout:
+                    await asyncio.wait_for(self._send(item), self.send_timeout)
+                else:
+                    await self._send(item)
+        except ChannelClosed as e:
+            reason = str(e) if e.args and e.args[0] else CLOSE_FINISHED
+        except asyncio.TimeoutError:
+            logger.warning(f"{self.channel.name} 发送超过 {self.send_timeout} 秒，移除该连接")
+            reason = CLOSE_TIMEOUT
+        except asyncio.CancelledError:
+            reason = CLOSE_DISCONNECTED
+        except Exception as e:
+            logger.error(f"{self.channel.name} 发送失败: {e}")
+            reason = CLOSE_ERROR
+        finally:
+            self.channel.close(reason)
+        if self._on_close:
+            try:
+                await self._on_close(reason)
+            except Exception as e:
+                logger.debug(f"{self.channel.name} 关闭回调失败: {e}")
+
+    def close(self, reason: str = CLOSE_DISCONNECTED):
+        """停止发送，丢弃尚未发送的消息"""
+        self.channel.items.clear()
+        self.channel.close(reason)
+        if self._task and not self._task.done() and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+
+class ChannelRegistry:
+    """记录所有存活的队列，汇总队列深度与背压指标"""
+
+    def __init__(self):
+        self.channels: Dict[int, BoundedChannel] = {}
+        # 已关闭队列的累计指标
+        self.totals = {'closed': 0, 'dropped_consumers': 0, 'send_timeouts': 0, 'coalesced': 0, 'blocked': 0}
+
+    def register(self, channel: BoundedChannel):
+        self.channels[id(channel)] = channel
+
+    def unregister(self, channel: BoundedChannel):
+        if self.channels.pop(id(channel), None) is None:
+            return
+        self.totals['closed'] += 1
+        self.totals['coalesced'] += channel.stats['coalesced']
+        self.totals['blocked'] += channel.stats['blocked']
+        if channel.close_reason == CLOSE_OVERFLOW:
+            self.totals['dropped_consumers'] += 1
+        elif channel.close_reason == CLOSE_TIMEOUT:
+            self.totals['send_timeouts'] += 1
+
+    def get_stats(self, top: int = 0) -> Dict[str, Any]:
+        """
+        汇总指标
+
+        Args:
+            top: 同时返回队列深度最大的前 top 个连接
+        """
+        channels = list(self.channels.values())
+        depths = [channel.depth for channel in channels]
+        stats: Dict[str, Any] = {
+            'open': len(channels),
+            'queued_items': sum(depths),
+            'max_depth': max(depths, default=0),
+            'full': sum(1 for channel in channels if channel.depth >= channel.maxsize),
+            'blocked_now': sum(1 for channel in channels if not channel._writable.is_set()),
+            **self.totals
+        }
+        if top:
+            deepest: List[BoundedChannel] = sorted(channels, key=lambda channel: channel.depth, reverse=True)
+            stats['connections'] = [channel.get_stats() for channel in deepest[:top]]
+        return stats
+
+
+# 全局队列指标实例
+channel_registry = ChannelRegistry()
@@ -0,0 +1,20 @@
+"""
+背压与发送队列API端点
+"""
+from fastapi import APIRouter, Query
+from backpressure import channel_registry
+from config import config
+
+router = APIRouter()
+
+@router.get("/api/backpressure/stats", tags=["背压"], summary="获取发送队列指标")
+async def get_backpressure_stats(top: int = Query(20, ge=0, le=500)):
+    """所有连接发送队列的汇总指标，以及队列深度最大的前 top 个连接"""
+    return {
+        "success": True,
+        "policies": {
+            "stream": {"policy": config.stream_backpressure_policy, "queue_size": config.stream_queue_size},
+            "websocket": {"policy": config.ws_backpressure_policy, "queue_size": config.ws_queue_size}
+        },
+        "stats": channel_registry.get_stats(top=top)
+    }
@@ -0,0 +1,92 @@
+"""
+离线批量任务API端点
+"""
+import json
+import os
+from fastapi import APIRouter, File, Form, HTTPException, UploadFile
+from fastapi.responses import FileResponse, StreamingResponse
+from backpressure import CLOSE_OVERFLOW
+from batch_jobs import BatchInputError, get_batch_runner
+from resumable_stream import SSE_HEADERS
+from stream_hub import HubFull
+import logging
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+def _get_job(job_id: str):
+    job = get_batch_runner().get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="批量任务不存在")
+    return job
+
+@router.post("/api/batch/jobs", tags=["批量任务"], summary="提交批量任务")
+async def submit_batch_job(
+    file: UploadFile = File(..., description="JSONL文件，每行 {\"id\", \"prompt\" 或 \"messages\", 可选 provider/model}"),
+    targets: str = Form("", description="目标模型：JSON数组或 \"provider:model,provider:model\""),
+    name: str = Form("", description="任务名称")
+):
+    """上传JSONL并开始运行，结果逐条写入 results.jsonl"""
+    try:
+        job = await get_batch_runner().submit(await file.read(), targets, name or file.filename or '')
+    except (BatchInputError, json.JSONDecodeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return {"success": True, "job": job.to_dict()}
+
+@router.get("/api/batch/jobs", tags=["批量任务"], summary="列出批量任务")
+async def list_batch_jobs():
+    runner = get_batch_runner()
+    return {"success": True, "jobs": [job.to_dict() for job in runner.list_jobs()], "stats": runner.get_stats()}
+
+@router.get("/api/batch/jobs/{job_id}", tags=["批量任务"], summary="获取批量任务状态")
+async def get_batch_job(job_id: str):
+    job = _get_job(job_id)
+    return {"success": True, "job": job.to_dict(), "progress": job.progress()}
+
+@router.get("/api/batch/jobs/{job_id}/events", tags=["批量任务"], summary="订阅批量任务进度（SSE）")
+async def batch_job_events(job_id: str):
+    """先发送当前进度，运行中的任务之后推送每条结果（item）与进度（progress），结束时发送 done"""
+    runner = get_batch_runner()
+    job = _get_job(job_id)
+    subscription = None
+    if job.running:
+        try:
+            subscription = runner.subscribe(job)
+        except HubFull as e:
+            raise HTTPException(status_code=503, detail=str(e))
+
+    async def generate():
+        yield f"data: {json.dumps(job.progress(), ensure_ascii=False)}\n\n"
+        if subscription is None:
+            yield f"data: {json.dumps({'type': 'done', **job.to_dict()}, ensure_ascii=False)}\n\n"
+            return
+        async for _, payload in subscription:
+            yield f"data: {payload}\n\n"
+            if json.loads(payload).get('type') == 'done':
+                return
+        if subscription.close_reason == CLOSE_OVERFLOW:
+            yield f"data: {json.dumps({'type': 'slow_consumer', 'reconnect': True})}\n\n"
+
+    return StreamingResponse(generate(), media_type='text/event-stream', headers=SSE_HEADERS)
+
+@router.get("/api/batch/jobs/{job_id}/results", tags=["批量任务"], summary="下载批量任务结果")
+async def download_batch_results(job_id: str):
+    """results.jsonl：每个调用一行，同一调用重试或续传后以最后一行为准"""
+    job = _get_job(job_id)
+    if not os.path.exists(job.results_path):
+        raise HTTPException(status_code=404, detail="任务尚无结果")
+    return FileResponse(job.results_path, media_type='application/x-ndjson', filename=f"{job_id}_results.jsonl")
+
+@router.post("/api/batch/jobs/{job_id}/resume", tags=["批量任务"], summary="续传批量任务")
+async def resume_batch_job(job_id: str):
+    """跳过已成功的调用，重新执行未完成与失败的调用"""
+    _get_job(job_id)
+    job = await get_batch_runner().resume(job_id)
+    return {"success": True, "job": job.to_dict()}
+
+@router.post("/api/batch/jobs/{job_id}/cancel", tags=["批量任务"], summary="取消批量任务")
+async def cancel_batch_job(job_id: str):
+    _get_job(job_id)
+    job = get_batch_runner().cancel(job_id)
+    return {"success": True, "job": job.to_dict()}
@@ -0,0 +1,525 @@
+"""
+离线批量任务
+
+一次提交数百条提示词、对多个模型逐条调用（代替 test_new_free_models.py 等脚本的逐条串行请求）：
+- 上传JSONL，每行一条：{"id": "q1", "prompt": "..."} 或 {"id": "q1", "messages": [...]}，
+  可带 provider、model、temperature、max_tokens；未指定 provider 的条目对任务的每个目标
+  （targets，如 [{"provider": "openrouter", "model": "..."}]）各调用一次
+- 经提供商层调用，每个提供商有全局并发上限（BATCH_PROVIDER_CONCURRENCY，所有任务共享），
+  每次调用以 batch 优先级获取准入名额（见 admission.py），交互式请求优先
+- 失败按指数退避重试（认证失败、模型不存在等不会因重试成功的错误不重试）
+- 结果先缓冲在内存中，每2秒在线程中批量追加到 results.jsonl 并写入任务状态（job.json）检查点，
+  进程崩溃时最多丢失最近2秒的结果（续传时重新执行）
+- 续传时从 results.jsonl 读取已成功的条目并跳过，只执行未完成与失败的条目
+- 进度通过 StreamHub 推送（GET /api/batch/jobs/{job_id}/events）
+
+任务目录: {BATCH_JOBS_DIR}/{job_id}/ 下的 input.jsonl、results.jsonl、job.json。
+任务在接收提交的worker上运行，进程退出时运行中的任务标记为 interrupted，可调用续传接口继续。
+
+使用方法:
+    runner = get_batch_runner(provider_manager)
+    job = await runner.submit(data, targets=[{'provider': 'openrouter', 'model': 'deepseek/deepseek-chat'}])
+    await runner.resume(job.job_id)
+"""
+
+import asyncio
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from admission import AdmissionRejected, PRIORITY_BATCH, admission_controller
+from config import config
+from providers import ProviderManager
+from providers.base import ProviderAuthenticationError, ProviderModelNotFoundError
+from stream_hub import StreamHub, Subscription
+from tokenizer_service import tokenizer_service
+from websocket_handler import coalesce_status_messages
+
+logger = logging.getLogger(__name__)
+
+# 任务状态
+STATUS_PENDING = 'pending'
+STATUS_RUNNING = 'running'
+STATUS_COMPLETED = 'completed'
+STATUS_FAILED = 'failed'
+STATUS_CANCELLED = 'cancelled'
+STATUS_INTERRUPTED = 'interrupted'
+
+# 重试不会成功的错误
+NON_RETRYABLE_ERRORS = (ProviderAuthenticationError, ProviderModelNotFoundError, ValueError)
+
+# 条目可以覆盖的调用参数
+ITEM_PARAMS = ('temperature', 'max_tokens', 'top_p')
+
+# 工作单元：(单元键, 条目, 目标)
+Unit = Tuple[str, Dict[str, Any], Dict[str, Optional[str]]]
+
+
+class BatchInputError(ValueError):
+    """上传的JSONL无效"""
+
+
+def parse_targets(value: Any) -> List[Dict[str, Optional[str]]]:
+    """
+    解析任务目标：JSON数组 [{"provider": ..., "model": ...}]，或 "provider:model,provider" 格式的字符串
+    """
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.strip()
+        if value.startswith('['):
+            value = json.loads(value)
+        else:
+            value = [
+                {'provider': spec.split(':', 1)[0].strip(), 'model': spec.split(':', 1)[1].strip() if ':' in spec else None}
+                for spec in value.split(',') if spec.strip()
+            ]
+    targets = []
+    for target in value:
+        if not isinstance(target, dict) or not target.get('provider'):
+            raise BatchInputError(f"无效的目标: {target}")
+        targets.append({'provider': target['provider'], 'model': target.get('model') or None})
+    return targets
+
+
+def parse_items(data: bytes, max_items: int) -> List[Dict[str, Any]]:
+    """解析JSONL，校验每条都有 prompt 或 messages 且 id 不重复"""
+    try:
+        text = data.decode('utf-8-sig')
+    except UnicodeDecodeError as e:
+        raise BatchInputError(f"文件不是UTF-8编码: {e}")
+    items, seen = [], set()
+    for line_no, line in enumerate(text.splitlines(), 1):
+        if not line.strip():
+            continue
+        try:
+            item = json.loads(line)
+        except json.JSONDecodeError as e:
+            raise BatchInputError(f"第 {line_no} 行不是有效的JSON: {e}")
+        if not isinstance(item, dict) or not (item.get('prompt') or item.get('messages')):
+            raise BatchInputError(f"第 {line_no} 行缺少 prompt 或 messages")
+        item['id'] = str(item.get('id', line_no))
+        if item['id'] in seen:
+            raise BatchInputError(f"第 {line_no} 行的 id 重复: {item['id']}")
+        seen.add(item['id'])
+        items.append(item)
+        if len(items) > max_items:
+            raise BatchInputError(f"条目数超过上限 {max_items}")
+    if not items:
+        raise BatchInputError("没有任何条目")
+    return items
+
+
+class BatchJob:
+    """一个批量任务：条目 × 目标展开为工作单元，结果按单元键记录"""
+
+    def __init__(self, job_id: str, directory: str, name: str, targets: List[Dict[str, Optional[str]]],
+                 created_at: Optional[float] = None):
+        self.job_id = job_id
+        self.directory = directory
+        self.name = name
+        self.targets = targets
+        self.status = STATUS_PENDING
+        self.created_at = created_at or time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.total = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.retries = 0
+        self.tokens = 0
+        self.runs = 0
+        self.task: Optional[asyncio.Task] = None
+        # 尚未写入 results.jsonl 的结果行，由 flush 批量写入
+        self._pending_results: List[str] = []
+        self._write_lock = threading.Lock()
+
+    @property
+    def input_path(self) -> str:
+        return os.path.join(self.directory, 'input.jsonl')
+
+    @property
+    def results_path(self) -> str:
+        return os.path.join(self.directory, 'results.jsonl')
+
+    @property
+    def state_path(self) -> str:
+        return os.path.join(self.directory, 'job.json')
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+    def units(self, items: List[Dict[str, Any]]) -> List[Unit]:
+        """展开为 (单元键, 条目, 目标)：条目自带 provider 时只调用该提供商"""
+        units = []
+        for item in items:
+            if item.get('provider'):
+                targets = [{'provider': item['provider'], 'model': item.get('model')}]
+            else:
+                targets = [{'provider': t['provider'], 'model': item.get('model') or t['model']} for t in self.targets]
+            for target in targets:
+                units.append((f"{item['id']}|{target['provider']}|{target['model'] or ''}", item, target))
+        return units
+
+    def load_items(self) -> List[Dict[str, Any]]:
+        with open(self.input_path, 'rb') as f:
+            return parse_items(f.read(), max_items=10 ** 9)
+
+    def load_results(self) -> Dict[str, Dict[str, Any]]:
+        """读取已写入的结果（同一单元以最后一条为准），截掉进程中断时写了一半的末行"""
+        results: Dict[str, Dict[str, Any]] = {}
+        if not os.path.exists(self.results_path):
+            return results
+        with open(self.results_path, 'rb+') as f:
+            data = f.read()
+            end = data.rfind(b'\n') + 1
+            if end < len(data):
+                f.truncate(end)
+        for line in data[:end].decode('utf-8').splitlines():
+            try:
+                record = json.loads(line)
+                results[record['key']] = record
+            except (json.JSONDecodeError, KeyError):
+                continue
+        return results
+
+    def append_result(self, record: Dict[str, Any]):
+        """记录一条结果（只放入缓冲，不做文件IO，见 flush）"""
+        self._pending_results.append(json.dumps(record, ensure_ascii=False) + '\n')
+
+    def checkpoint(self):
+        """原子写入任务状态"""
+        with self._write_lock:
+            temp_path = self.state_path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, self.state_path)
+
+    def flush(self):
+        """把缓冲的结果一次性追加到 results.jsonl，再写入检查点（阻塞IO，在事件循环中经 asyncio.to_thread 调用）"""
+        with self._write_lock:
+            lines, self._pending_results = self._pending_results, []
+            if lines:
+                with open(self.results_path, 'a', encoding='utf-8') as f:
+                    f.write(''.join(lines))
+        self.checkpoint()
+
+    @classmethod
+    def load(cls, directory: str) -> 'BatchJob':
+        with open(os.path.join(directory, 'job.json'), encoding='utf-8') as f:
+            state = json.load(f)
+        job = cls(state['job_id'], directory, state.get('name', ''), state.get('targets', []), state.get('created_at'))
+        for field in ('status', 'started_at', 'finished_at', 'total', 'succeeded', 'failed', 'retries', 'tokens', 'runs'):
+            if field in state:
+                setattr(job, field, state[field])
+        if job.status in (STATUS_RUNNING, STATUS_PENDING):
+            # 上次运行的进程已退出
+            job.status = STATUS_INTERRUPTED
+        return job
+
+    def progress(self) -> Dict[str, Any]:
+        done = self.succeeded + self.failed
+        return {
+            'type': 'progress',
+            'job_id': self.job_id,
+            'status': self.status,
+            'total': self.total,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'pending': max(0, self.total - done),
+            'retries': self.retries,
+            'tokens': self.tokens,
+            'percent': round(done / self.total * 100, 1) if self.total else 0.0
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'job_id': self.job_id,
+            'name': self.name,
+            'targets': self.targets,
+            'status': self.status,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'total': self.total,
+            'succeeded': self.succeeded,
+            'failed': self.failed,
+            'retries': self.retries,
+            'tokens': self.tokens,
+            'runs': self.runs
+        }
+
+
+class BatchRunner:
+    """运行批量任务：按提供商限制并发，重试、写检查点并推送进度"""
+
+    def __init__(self, provider_manager: ProviderManager, directory: str = 'cache/batch_jobs',
+                 concurrency: Optional[Dict[str, int]] = None, max_retries: int = 3,
+                 retry_base_delay: float = 1.0, item_timeout: float = 120.0, max_items: int = 10000):
+        self.provider_manager = provider_manager
+        self.directory = directory
+        self.concurrency = concurrency or {'default': 2}
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.item_timeout = item_timeout
+        self.max_items = max_items
+        self.jobs: Dict[str, BatchJob] = {}
+        # 提供商 -> 并发信号量（所有任务共享）
+        self._semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.hub = StreamHub(maxsize=256, max_subscribers=50, coalesce=coalesce_status_messages)
+        os.makedirs(directory, exist_ok=True)
+
+    def _semaphore(self, provider: str) -> asyncio.Semaphore:
+        if provider not in self._semaphores:
+            self._semaphores[provider] = asyncio.Semaphore(self._limit(provider))
+        return self._semaphores[provider]
+
+    def _limit(self, provider: str) -> int:
+        return max(1, int(self.concurrency.get(provider, self.concurrency.get('default', 2))))
+
+    async def submit(self, data: bytes, targets: Any = None, name: str = '') -> BatchJob:
+        """
+        保存上传的JSONL并开始运行
+
+        Raises:
+            BatchInputError: JSONL或目标无效
+        """
+        items = parse_items(data, self.max_items)
+        targets = parse_targets(targets)
+        if not targets and any(not item.get('provider') for item in items):
+            raise BatchInputError("未指定 provider 的条目需要任务目标（targets）")
+        job_id = uuid.uuid4().hex[:12]
+        job = BatchJob(job_id, os.path.join(self.directory, job_id), name, targets)
+        os.makedirs(job.directory, exist_ok=True)
+        with open(job.input_path, 'wb') as f:
+            f.write(data)
+        job.total = len(job.units(items))
+        job.checkpoint()
+        self.jobs[job_id] = job
+        logger.info(f"批量任务 {job_id} 已提交: {len(items)} 条提示词，{job.total} 个调用")
+        self._start(job, items)
+        return job
+
+    def get(self, job_id: str) -> Optional[BatchJob]:
+        """内存中没有时从任务目录加载（其他进程或重启前提交的任务）"""
+        job = self.jobs.get(job_id)
+        if job is None and job_id.isalnum() and os.path.exists(os.path.join(self.directory, job_id, 'job.json')):
+            job = self.jobs[job_id] = BatchJob.load(os.path.join(self.directory, job_id))
+        return job
+
+    def list_jobs(self) -> List[BatchJob]:
+        for entry in sorted(os.listdir(self.directory)):
+            self.get(entry)
+        return sorted(self.jobs.values(), key=lambda job: job.created_at, reverse=True)
+
+    async def resume(self, job_id: str) -> Optional[BatchJob]:
+        """续传：跳过已成功的单元，重新执行其余单元（包括失败的）"""
+        job = self.get(job_id)
+        if job is None or job.running:
+            return job
+        self._start(job, job.load_items())
+        return job
+
+    def cancel(self, job_id: str) -> Optional[BatchJob]:
+        job = self.get(job_id)
+        if job and job.running:
+            job.task.cancel()
+        return job
+
+    def subscribe(self, job: BatchJob) -> Subscription:
+        """
+        订阅任务进度
+
+        Raises:
+            HubFull: 订阅者已达上限
+        """
+        return self.hub.subscribe(job.job_id)
+
+    def _start(self, job: BatchJob, items: List[Dict[str, Any]]):
+        job.status = STATUS_RUNNING
+        job.runs += 1
+        job.task = asyncio.create_task(self._run(job, items), name=f"batch-{job.job_id}")
+
+    def _publish(self, job: BatchJob, event: Dict[str, Any], key: Any = None):
+        self.hub.publish(job.job_id, None, json.dumps(event, ensure_ascii=False), key)
+
+    async def _run(self, job: BatchJob, items: List[Dict[str, Any]]):
+        units = job.units(items)
+        results = job.load_results()
+        pending: Dict[str, Deque[Unit]] = {}
+        job.total, job.succeeded, job.failed = len(units), 0, 0
+        for unit in units:
+            if results.get(unit[0], {}).get('status') == 'success':
+                job.succeeded += 1
+            else:
+                pending.setdefault(unit[2]['provider'], deque()).append(unit)
+        job.started_at = job.started_at or time.time()
+        job.finished_at = None
+        await asyncio.to_thread(job.checkpoint)
+        skipped = job.succeeded
+        logger.info(f"批量任务 {job.job_id} 开始第 {job.runs} 次运行: 跳过已完成的 {skipped} 个，待执行 "
+                    f"{sum(len(queue) for queue in pending.values())} 个")
+        self._publish(job, job.progress(), 'progress')
+
+        checkpointer = asyncio.create_task(self._checkpoint_loop(job))
+        workers: List[asyncio.Task] = []
+        try:
+            # 每个提供商启动与其并发上限相同数量的工作协程，提供商之间互不阻塞
+            for provider, queue in pending.items():
+                for _ in range(min(self._limit(provider), len(queue))):
+                    workers.append(asyncio.create_task(self._worker(job, provider, queue)))
+            await asyncio.gather(*workers)
+            job.status = STATUS_FAILED if job.failed else STATUS_COMPLETED
+        except asyncio.CancelledError:
+            for worker in workers:
+                worker.cancel()
+            if job.status != STATUS_INTERRUPTED:
+                job.status = STATUS_CANCELLED
+            logger.info(f"批量任务 {job.job_id} 已{'中断' if job.status == STATUS_INTERRUPTED else '取消'}")
+        except Exception as e:
+            logger.error(f"批量任务 {job.job_id} 失败: {e}")
+            job.status = STATUS_FAILED
+        finally:
+            checkpointer.cancel()
+            job.finished_at = time.time()
+            await asyncio.to_thread(job.flush)
+            self._publish(job, job.progress(), 'progress')
+            self._publish(job, {'type': 'done', **job.to_dict()})
+            logger.info(f"批量任务 {job.job_id} 结束: {job.status}，成功 {job.succeeded}，失败 {job.failed}")
+
+    async def _worker(self, job: BatchJob, provider: str, queue: Deque[Unit]):
+        while queue:
+            key, item, target = queue.popleft()
+            async with self._semaphore(provider):
+                record = await self._run_unit(job, key, item, target)
+            job.append_result(record)
+            if record['status'] == 'success':
+                job.succeeded += 1
+                job.tokens += record['tokens']['total']
+            else:
+                job.failed += 1
+            self._publish(job, {'type': 'item', **{k: v for k, v in record.items() if k != 'content'}})
+            self._publish(job, job.progress(), 'progress')
+
+    async def _run_unit(self, job: BatchJob, key: str, item: Dict[str, Any],
+                        target: Dict[str, Optional[str]]) -> Dict[str, Any]:
+        """调用一次（带重试），返回结果记录"""
+        messages = item.get('messages') or [{'role': 'user', 'content': item['prompt']}]
+        params = {name: item[name] for name in ITEM_PARAMS if item.get(name) is not None}
+        record: Dict[str, Any] = {
+            'key': key, 'id': item['id'], 'provider': target['provider'], 'model': target['model']
+        }
+        started = time.time()
+        error = None
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with admission_controller.slot(PRIORITY_BATCH):
+                    content, usage, model = await asyncio.wait_for(
+                        self._call(target['provider'], target['model'], messages, params), self.item_timeout
+                    )
+                input_tokens = usage.get('prompt_tokens') if usage else tokenizer_service.count_messages(messages, model)
+                output_tokens = usage.get('completion_tokens') if usage else tokenizer_service.count_text(content, model)
+                record.update({
+                    'status': 'success',
+                    'model': model,
+                    'content': content,
+                    'attempts': attempt + 1,
+                    'response_time': round(time.time() - started, 3),
+                    'tokens': {
+                        'input': input_tokens,
+                        'output': output_tokens,
+                        'total': input_tokens + output_tokens,
+                        'source': 'provider' if usage else 'estimate'
+                    },
+                    'finished_at': time.time()
+                })
+                return record
+            except NON_RETRYABLE_ERRORS as e:
+                error = str(e)
+                break
+            except Exception as e:
+                error = str(e) or type(e).__name__
+                if attempt >= self.max_retries:
+                    break
+                job.retries += 1
+                # 未获准入时按建议的间隔重试，其他错误指数退避加随机抖动
+                delay = e.retry_after if isinstance(e, AdmissionRejected) else \
+                    self.retry_base_delay * (2 ** attempt) * (0.5 + random.random())
+                logger.warning(f"批量任务 {job.job_id} 的 {key} 第 {attempt + 1} 次调用失败: {error}，{delay:.1f} 秒后重试")
+                await asyncio.sleep(delay)
+        record.update({
+            'status': 'error',
+            'error': error,
+            'attempts': attempt + 1,
+            'response_time': round(time.time() - started, 3),
+            'finished_at': time.time()
+        })
+        return record
+
+    async def _call(self, provider_name: str, model: Optional[str], messages: List[Dict[str, str]],
+                    params: Dict[str, Any]) -> Tuple[str, Optional[Dict[str, int]], str]:
+        provider = self.provider_manager.get_provider(provider_name)
+        if not provider:
+            raise ValueError(f"提供商 {provider_name} 不存在或未启用")
+        model = model or provider.config.default_model
+        content, usage = '', None
+        async for chunk in provider.chat_completion(messages=messages, model=model, stream=False, **params):
+            if chunk.content:
+                content += chunk.content
+            if chunk.usage:
+                usage = chunk.usage
+        return content, usage, model
+
+    async def _checkpoint_loop(self, job: BatchJob):
+        """每2秒在线程中写入缓冲的结果与检查点，结果不逐条落盘"""
+        while True:
+            await asyncio.sleep(2)
+            await asyncio.to_thread(job.flush)
+
+    async def close(self):
+        """进程退出：中断运行中的任务并写入检查点（之后可续传）"""
+        for job in list(self.jobs.values()):
+            if job.running:
+                job.status = STATUS_INTERRUPTED
+                job.task.cancel()
+                try:
+                    await job.task
+                except (asyncio.CancelledError, Exception):
+                    pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        running = [job for job in self.jobs.values() if job.running]
+        return {
+            'jobs': len(self.jobs),
+            'running': len(running),
+            'pending_calls': sum(job.total - job.succeeded - job.failed for job in running),
+            'concurrency': self.concurrency,
+            'progress_subscribers': self.hub.get_stats()['subscribers']
+        }
+
+
+# 全局批量任务运行器实例
+batch_runner: Optional[BatchRunner] = None
+
+
+def get_batch_runner(provider_manager: Optional[ProviderManager] = None) -> BatchRunner:
+    """获取批量任务运行器实例"""
+    global batch_runner
+    if batch_runner is None:
+        batch_runner = BatchRunner(
+            provider_manager or ProviderManager(),
+            directory=config.batch_jobs_dir,
+            concurrency=config.batch_provider_concurrency,
+            max_retries=config.batch_max_retries,
+            retry_base_delay=config.batch_retry_base_delay,
+            item_timeout=config.batch_item_timeout,
+            max_items=config.batch_max_items
+        )
+    return batch_runner
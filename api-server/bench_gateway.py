@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+网关负载测试：大量并发SSE与WebSocket客户端经 fastapi_stream 访问模拟上游（mock_upstream.py）
+
+启动模拟上游与网关（start_production.py，关闭配额、放开准入上限、关闭响应缓存），按逐级增加的客户端数量，
+对每种传输方式同时发起 N 个流式单聊并统计：
+- direct：客户端直连模拟上游（基线，不经过网关）
+- sse：POST /api/chat/stream
+- ws：/ws/mux 上打开 chat 流
+
+每级报告首token延迟（TTFT）与逐token间隔（ITL）的分位数、完成/失败数、网关进程（含worker）的CPU时间，
+并与同级 direct 基线比较，得出网关增加的TTFT、每个token增加的延迟与每个token消耗的CPU（微秒）。
+CPU时间读取 /proc（仅Linux）；模拟上游与压测客户端运行在同一台机器上时会分走CPU，数值偏保守。
+
+数千并发需要足够的文件描述符（脚本会把软限制提到硬限制），必要时先执行 ulimit -n 65536。
+
+使用方法:
+    python bench_gateway.py --clients 100,500,1000,2000 --workers 2
+    python bench_gateway.py --transports sse,ws --ttft-ms 100 --tokens-per-sec 100 --output-tokens 100 \\
+        --output bench_gateway.json
+    python bench_gateway.py --gateway-url http://127.0.0.1:8008 --gateway-pid 12345   # 测试已运行的网关
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+import websockets
+
+from bench_launch import BASE_DIR, percentile
+
+TRANSPORTS = ('direct', 'sse', 'ws')
+
+
+def process_cpu_seconds(pid: int) -> Optional[float]:
+    """进程及其所有子进程（worker）累计的用户态+内核态CPU秒数（读取 /proc，非Linux返回None）"""
+    if not os.path.exists(f"/proc/{pid}/stat"):
+        return None
+    ticks = os.sysconf("SC_CLK_TCK")
+    stats = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                # comm 可能包含空格，从最后一个 ')' 之后开始解析
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        stats[int(entry)] = (int(fields[1]), int(fields[11]) + int(fields[12]))
+    tree, total = [pid], 0
+    while tree:
+        current = tree.pop()
+        if current in stats:
+            total += stats[current][1]
+        tree.extend(child for child, (parent, _) in stats.items() if parent == current)
+    return total / ticks
+
+
+async def wait_url(url: str, timeout: float = 60) -> bool:
+    deadline = time.time() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.time() < deadline:
+            try:
+                if (await client.get(url)).status_code == 200:
+                    return True
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.5)
+    return False
+
+
+def chat_body(args: argparse.Namespace) -> Dict[str, Any]:
+    """网关单聊请求体：上游指向模拟服务"""
+    prefix = "/api/v1" if args.provider == "openrouter" else "/v1"
+    return {
+        "query": "load test",
+        "provider": args.provider,
+        "use_cache": False,
+        "config": {
+            "api_key": "sk-or-mock" if args.provider == "openrouter" else "sk-mock",
+            "base_url": args.mock_url + prefix,
+            "default_model": args.model,
+            "max_tokens": args.output_tokens
+        }
+    }
+
+
+class ClientTiming:
+    """单个客户端：请求开始、首个内容与之后每个内容到达的时间"""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.first: Optional[float] = None
+        self.last: Optional[float] = None
+        self.tokens = 0
+        self.ok = False
+        self.error: Optional[str] = None
+
+    def content(self):
+        now = time.perf_counter()
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.tokens += 1
+
+
+async def client_direct(client: httpx.AsyncClient, args: argparse.Namespace) -> ClientTiming:
+    timing = ClientTiming()
+    payload = {"model": args.model, "stream": True, "max_tokens": args.output_tokens,
+               "messages": [{"role": "user", "content": "load test"}]}
+    async with client.stream("POST", args.mock_url + "/v1/chat/completions", json=payload) as response:
+        if response.status_code != 200:
+            timing.error = f"HTTP {response.status_code}"
+            return timing
+        async for line in response.aiter_lines():
+            if line == "data: [DONE]":
+                timing.ok = True
+            elif line.startswith("data: "):
+                choices = json.loads(line[6:]).get("choices")
+                if choices and choices[0]["delta"].get("content"):
+                    timing.content()
+    return timing
+
+
+async def client_sse(client: httpx.AsyncClient, args: argparse.Namespace) -> ClientTiming:
+    timing = ClientTiming()
+    async with client.stream("POST", args.gateway_url + "/api/chat/stream", json=chat_body(args)) as response:
+        if response.status_code != 200:
+            timing.error = f"HTTP {response.status_code}"
+            return timing
+        async for line in response.aiter_lines():
+            if not line.startswith("data: "):
+                continue
+            event = json.loads(line[6:])
+            if event.get("type") == "content":
+                timing.content()
+            elif event.get("type") == "error":
+                timing.error = str(event.get("error"))
+            elif event.get("type") == "end":
+                timing.ok = timing.error is None
+    return timing
+
+
+async def client_ws(args: argparse.Namespace) -> ClientTiming:
+    timing = ClientTiming()
+    url = args.gateway_url.replace("http", "ws", 1) + "/ws/mux"
+    async with websockets.connect(url, open_timeout=60, max_size=None) as ws:
+        await ws.send(json.dumps({"op": "open", "stream": 1, "kind": "chat", "params": chat_body(args),
+                                  "credit": args.output_tokens * 4}))
+        async for message in ws:
+            frame = json.loads(message)
+            if frame.get("op") == "ping":
+                await ws.send(json.dumps({"op": "pong"}))
+            elif frame.get("op") == "data" and isinstance(frame.get("data"), dict):
+                if frame["data"].get("type") == "content":
+                    timing.content()
+                elif frame["data"].get("type") == "error":
+                    timing.error = str(frame["data"].get("error"))
+            elif frame.get("op") == "close":
+                timing.ok = frame.get("reason") == "end" and timing.error is None
+                if not timing.ok and timing.error is None:
+                    timing.error = frame.get("error") or frame.get("reason")
+                break
+    return timing
+
+
+async def run_level(transport: str, clients: int, args: argparse.Namespace) -> Dict[str, Any]:
+    """同时发起 clients 个流并等待全部结束"""
+    limits = httpx.Limits(max_connections=clients, max_keepalive_connections=0)
+    cpu_pid = args.gateway_pid if transport != "direct" else None
+    async with httpx.AsyncClient(limits=limits, timeout=httpx.Timeout(args.timeout, connect=60)) as client:
+        async def one() -> ClientTiming:
+            try:
+                if transport == "ws":
+                    return await client_ws(args)
+                if transport == "sse":
+                    return await client_sse(client, args)
+                return await client_direct(client, args)
+            except Exception as e:
+                timing = ClientTiming()
+                timing.error = f"{type(e).__name__}: {e}"
+                return timing
+
+        cpu_before = process_cpu_seconds(cpu_pid) if cpu_pid else None
+        started = time.perf_counter()
+        timings = await asyncio.gather(*(one() for _ in range(clients)))
+        elapsed = time.perf_counter() - started
+        cpu_after = process_cpu_seconds(cpu_pid) if cpu_pid else None
+
+    completed = [t for t in timings if t.ok and t.first is not None]
+    ttft = [(t.first - t.start) * 1000 for t in completed]
+    itl = [(t.last - t.first) * 1000 / (t.tokens - 1) for t in completed if t.tokens > 1]
+    tokens = sum(t.tokens for t in timings)
+    errors: Dict[str, int] = {}
+    for t in timings:
+        if not t.ok:
+            key = (t.error or "incomplete")[:80]
+            errors[key] = errors.get(key, 0) + 1
+    result = {
+        "transport": transport,
+        "clients": clients,
+        "completed": len(completed),
+        "failed": clients - len(completed),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 2),
+        "tokens": tokens,
+        "tokens_per_sec": round(tokens / elapsed, 1),
+        "ttft_p50_ms": round(percentile(ttft, 0.5), 1),
+        "ttft_p95_ms": round(percentile(ttft, 0.95), 1),
+        "ttft_p99_ms": round(percentile(ttft, 0.99), 1),
+        "itl_p50_ms": round(percentile(itl, 0.5), 2),
+        "itl_p99_ms": round(percentile(itl, 0.99), 2),
+    }
+    if cpu_before is not None and cpu_after is not None:
+        cpu = cpu_after - cpu_before
+        result["gateway_cpu_s"] = round(cpu, 2)
+        result["gateway_cpu_percent"] = round(cpu / elapsed * 100, 1)
+        result["gateway_cpu_us_per_token"] = round(cpu / tokens * 1e6, 1) if tokens else None
+    return result
+
+
+def overhead(result: Dict[str, Any], baseline: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """网关相对直连基线增加的延迟"""
+    if not baseline:
+        return {}
+    return {
+        "added_ttft_p50_ms": round(result["ttft_p50_ms"] - baseline["ttft_p50_ms"], 1),
+        "added_ttft_p99_ms": round(result["ttft_p99_ms"] - baseline["ttft_p99_ms"], 1),
+        "added_itl_p50_ms": round(result["itl_p50_ms"] - baseline["itl_p50_ms"], 2),
+        "added_itl_p99_ms": round(result["itl_p99_ms"] - baseline["itl_p99_ms"], 2),
+    }
+
+
+def start_mock(args: argparse.Namespace) -> subprocess.Popen:
+    command = [sys.executable, "mock_upstream.py", "--port", str(args.mock_port),
+               "--ttft-ms", str(args.ttft_ms), "--tokens-per-sec", str(args.tokens_per_sec),
+               "--output-tokens", str(args.output_tokens), "--jitter", "0"]
+    return subprocess.Popen(command, cwd=BASE_DIR, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def start_gateway(args: argparse.Namespace, state_dir: str) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        DIAGNOSTICS_ENABLED="true",
+        QUOTA_ENABLED="false",
+        RESPONSE_CACHE_ENABLED="false",
+        ADMISSION_MAX_INFLIGHT=str(args.max_inflight),
+        ADMISSION_QUEUE_SIZE=str(args.max_inflight),
+        SESSION_STORE_DB=os.path.join(state_dir, "sessions.db"),
+        SHARED_STATE_PATH=os.path.join(state_dir, "shared_state.db"),
+    )
+    command = [sys.executable, "start_production.py", "--host", "127.0.0.1", "--port", str(args.gateway_port),
+               "--workers", str(args.workers), "--backlog", "8192", "--log-level", "warning"]
+    return subprocess.Popen(command, cwd=BASE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def stop(process: Optional[subprocess.Popen]):
+    if process is None:
+        return
+    process.terminate()
+    try:
+        process.wait(30)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+async def bench(args: argparse.Namespace) -> Dict[str, Any]:
+    results: List[Dict[str, Any]] = []
+    for clients in args.clients:
+        baseline = None
+        for transport in args.transports:
+            result = await run_level(transport, clients, args)
+            if transport == "direct":
+                baseline = result
+            else:
+                result.update(overhead(result, baseline))
+            results.append(result)
+            print(f"[{transport} x{clients}] {result}")
+            await asyncio.sleep(1)
+    return {
+        "settings": {key: getattr(args, key) for key in (
+            "provider", "model", "workers", "ttft_ms", "tokens_per_sec", "output_tokens")},
+        "results": results
+    }
+
+
+def print_summary(report: Dict[str, Any]):
+    print("\n传输   客户端  完成/失败    TTFT p50/p99(ms)   ITL p50/p99(ms)  +TTFT p50  +ITL p50  CPU(us/token)")
+    for r in report["results"]:
+        print(f"{r['transport']:<6} {r['clients']:<7} {r['completed']:>5}/{r['failed']:<6} "
+              f"{r['ttft_p50_ms']:>8}/{r['ttft_p99_ms']:<9} {r['itl_p50_ms']:>7}/{r['itl_p99_ms']:<8} "
+              f"{r.get('added_ttft_p50_ms', '-'):<10} {r.get('added_itl_p50_ms', '-'):<9} "
+              f"{r.get('gateway_cpu_us_per_token', '-')}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="网关负载测试（模拟上游）")
+    parser.add_argument("--clients", default="100,500,1000", help="逐级测试的并发客户端数")
+    parser.add_argument("--transports", default=",".join(TRANSPORTS), help="direct、sse、ws 的组合")
+    parser.add_argument("--provider", default="openrouter", choices=["openrouter", "openai"],
+                        help="网关使用的提供商实现（决定上游客户端是aiohttp还是AsyncOpenAI）")
+    parser.add_argument("--model", default="mock/fast")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--max-inflight", type=int, default=100000, help="网关准入上限（ADMISSION_MAX_INFLIGHT）")
+    parser.add_argument("--ttft-ms", type=float, default=200)
+    parser.add_argument("--tokens-per-sec", type=float, default=50)
+    parser.add_argument("--output-tokens", type=int, default=100)
+    parser.add_argument("--timeout", type=float, default=300, help="单个客户端的读取超时秒数")
+    parser.add_argument("--mock-port", type=int, default=18200)
+    parser.add_argument("--gateway-port", type=int, default=18201)
+    parser.add_argument("--mock-url", help="使用已运行的模拟上游（不再启动）")
+    parser.add_argument("--gateway-url", help="使用已运行的网关（不再启动）")
+    parser.add_argument("--gateway-pid", type=int, help="已运行网关的主进程PID（用于统计CPU）")
+    parser.add_argument("--output", help="结果写入JSON文件")
+    args = parser.parse_args(argv)
+    args.clients = [int(value) for value in args.clients.split(",") if value]
+    args.transports = [value for value in args.transports.split(",") if value in TRANSPORTS]
+
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+    mock = gateway = None
+    state_dir = tempfile.mkdtemp(prefix="bench_gateway_")
+    try:
+        if not args.mock_url:
+            args.mock_url = f"http://127.0.0.1:{args.mock_port}"
+            mock = start_mock(args)
+        if not args.gateway_url:
+            args.gateway_url = f"http://127.0.0.1:{args.gateway_port}"
+            gateway = start_gateway(args, state_dir)
+            args.gateway_pid = gateway.pid
+        if not asyncio.run(wait_url(args.mock_url + "/mock/stats")):
+            sys.exit("模拟上游未能启动")
+        if not asyncio.run(wait_url(args.gateway_url + "/health")):
+            sys.exit("网关未能启动")
+        report = asyncio.run(bench(args))
+    finally:
+        stop(gateway)
+        stop(mock)
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+    print_summary(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
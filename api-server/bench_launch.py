@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+启动模式压测：开发模式（start_server.py 的设置）对比生产模式（start_production.py）
+
+分别启动两种模式的服务（开启诊断端点，不调用上游模型），测量：
+- 请求吞吐：固定并发下 /api/diagnostics/ping 的 requests/sec 与延迟分位数
+- 并发流容量：逐级增加同时打开的合成SSE流，直到失败率超过1%或首字节延迟p99超过阈值
+
+使用方法:
+    python bench_launch.py --workers 4 --duration 10 --concurrency 64
+    python bench_launch.py --modes prod --streams 200,500,1000,2000 --output bench_launch.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def server_command(mode: str, port: int, workers: int) -> List[str]:
+    if mode == "dev":
+        # 与 start_server.py 相同：reload、debug日志、单进程
+        return [sys.executable, "-m", "uvicorn", "fastapi_stream:app", "--host", "127.0.0.1",
+                "--port", str(port), "--reload", "--log-level", "debug", "--timeout-keep-alive", "120"]
+    return [sys.executable, "start_production.py", "--host", "127.0.0.1", "--port", str(port),
+            "--workers", str(workers), "--log-level", "warning"]
+
+
+async def wait_ready(base_url: str, timeout: float = 60) -> bool:
+    deadline = time.time() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.time() < deadline:
+            try:
+                if (await client.get(f"{base_url}/api/diagnostics/ping")).status_code == 200:
+                    return True
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.5)
+    return False
+
+
+async def bench_requests(base_url: str, concurrency: int, duration: float) -> Dict[str, Any]:
+    """固定并发持续请求最小端点"""
+    latencies: List[float] = []
+    errors = 0
+    deadline = time.perf_counter() + duration
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=10) as client:
+        async def loop():
+            nonlocal errors
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    response = await client.get("/api/diagnostics/ping")
+                    if response.status_code != 200:
+                        errors += 1
+                        continue
+                    latencies.append(time.perf_counter() - start)
+                except httpx.HTTPError:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(loop() for _ in range(concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "rps": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+    }
+
+
+async def bench_streams(base_url: str, streams: int, chunks: int, interval_ms: int) -> Dict[str, Any]:
+    """同时打开 streams 个合成SSE流，统计完成数与首字节延迟"""
+    ttfb: List[float] = []
+    completed = 0
+    failed = 0
+    limits = httpx.Limits(max_connections=streams, max_keepalive_connections=0)
+    url = f"/api/diagnostics/stream?chunks={chunks}&interval_ms={interval_ms}"
+    expected = chunks + 2
+
+    async with httpx.AsyncClient(base_url=base_url, limits=limits, timeout=60) as client:
+        async def one():
+            nonlocal completed, failed
+            start = time.perf_counter()
+            events = 0
+            try:
+                async with client.stream("GET", url) as response:
+                    if response.status_code != 200:
+                        failed += 1
+                        return
+                    async for line in response.aiter_lines():
+                        if line.startswith("data:"):
+                            if events == 0:
+                                ttfb.append(time.perf_counter() - start)
+                            events += 1
+                if events == expected:
+                    completed += 1
+                else:
+                    failed += 1
+            except httpx.HTTPError:
+                failed += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(streams)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "streams": streams,
+        "completed": completed,
+        "failed": failed,
+        "elapsed_s": round(elapsed, 2),
+        "ttfb_p50_ms": round(percentile(ttfb, 0.5) * 1000, 1),
+        "ttfb_p99_ms": round(percentile(ttfb, 0.99) * 1000, 1),
+    }
+
+
+async def bench_mode(mode: str, args: argparse.Namespace) -> Dict[str, Any]:
+    port = args.port + (0 if mode == "dev" else 1)
+    base_url = f"http://127.0.0.1:{port}"
+    env = dict(os.environ, DIAGNOSTICS_ENABLED="true")
+    process = subprocess.Popen(
+        server_command(mode, port, args.workers), cwd=BASE_DIR, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    result: Dict[str, Any] = {"mode": mode, "workers": 1 if mode == "dev" else args.workers}
+    try:
+        if not await wait_ready(base_url):
+            result["error"] = "服务未能启动"
+            return result
+        # 预热
+        await bench_requests(base_url, min(8, args.concurrency), 1)
+        result["requests"] = await bench_requests(base_url, args.concurrency, args.duration)
+        print(f"[{mode}] 请求吞吐: {result['requests']}")
+
+        result["streams"] = []
+        capacity = 0
+        for streams in args.streams:
+            stats = await bench_streams(base_url, streams, args.stream_chunks, args.stream_interval_ms)
+            result["streams"].append(stats)
+            print(f"[{mode}] 并发流: {stats}")
+            if stats["failed"] > streams * 0.01 or stats["ttfb_p99_ms"] > args.ttfb_limit_ms:
+                break
+            capacity = streams
+        result["stream_capacity"] = capacity
+        return result
+    finally:
+        process.terminate()
+        try:
+            process.wait(30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def print_summary(results: List[Dict[str, Any]]):
+    print("\n模式   workers  req/s     p50(ms)  p99(ms)  并发流容量")
+    for result in results:
+        if "error" in result:
+            print(f"{result['mode']:<6} {result['workers']:<8} {result['error']}")
+            continue
+        requests = result["requests"]
+        print(f"{result['mode']:<6} {result['workers']:<8} {requests['rps']:<9} {requests['p50_ms']:<8} "
+              f"{requests['p99_ms']:<8} {result['stream_capacity']}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="开发模式与生产模式启动压测")
+    parser.add_argument("--modes", default="dev,prod")
+    parser.add_argument("--port", type=int, default=18100)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--streams", default="100,250,500,1000,2000",
+                        help="逐级测试的并发流数量")
+    parser.add_argument("--stream-chunks", type=int, default=40)
+    parser.add_argument("--stream-interval-ms", type=int, default=50)
+    parser.add_argument("--ttfb-limit-ms", type=float, default=1000,
+                        help="首字节延迟p99超过该值视为达到容量上限")
+    parser.add_argument("--output", help="结果写入JSON文件")
+    args = parser.parse_args(argv)
+    args.streams = [int(value) for value in args.streams.split(",") if value]
+
+    results = [asyncio.run(bench_mode(mode, args)) for mode in args.modes.split(",") if mode]
+    print_summary(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
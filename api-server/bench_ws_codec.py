@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+WebSocket消息编码压测：JSON对比MessagePack（字段id），各自开启与不开启permessage-deflate
+
+按各端点实际发送的消息构造流量（不启动服务、不调用上游模型），测量：
+- 每帧与每token的线上字节数（含WebSocket帧头，服务端到客户端不加掩码）
+- 服务端每帧的编码（含压缩）CPU时间，客户端每帧的解码（含解压）CPU时间
+
+场景:
+- single：/ws/{user_id} 的 chat_chunk，每个上游内容块一帧
+- mux：/ws/mux 上单聊流的数据帧（带 "{stream_id}:{seq}" id）
+- group：/ws/group-chat 一轮群聊（各模型的 model_status、model_response、context_update）
+
+permessage-deflate 按协商后的默认参数模拟：保留压缩上下文（context takeover），
+每帧 Z_SYNC_FLUSH 并去掉末尾的 00 00 ff ff。
+
+使用方法:
+    python bench_ws_codec.py
+    python bench_ws_codec.py --scenarios mux,group --tokens 4000 --repeat 20 --output bench_ws_codec.json
+"""
+
+import argparse
+import json
+import random
+import time
+import uuid
+import zlib
+from typing import Any, Dict, List, Optional, Tuple
+
+from tokenizer_service import tokenizer_service
+from ws_codec import CODECS, WireCodec
+
+SAMPLE_TEXT = (
+    "关于这个问题，我们可以从几个角度来分析。首先，系统的吞吐量取决于最慢的环节；"
+    "其次，连接数量本身也会带来内存与调度开销。In practice, batching small writes and "
+    "reusing connections usually matters more than micro-optimizing the serializer. "
+    "因此建议先测量，再决定优化的方向，并在上线前用真实流量验证效果。"
+)
+
+MODELS = [
+    {'id': 'gpt-4', 'name': 'GPT-4'},
+    {'id': 'claude-3-sonnet', 'name': 'Claude 3 Sonnet'},
+    {'id': 'deepseek-chat', 'name': 'DeepSeek'},
+    {'id': 'qwen-turbo', 'name': '通义千问'}
+]
+
+
+def sample_text(tokens: int, seed: int = 0) -> str:
+    """从示例文本的词汇中随机取词组成内容（整段重复会让压缩率虚高）"""
+    rng = random.Random(seed)
+    vocabulary = sorted(set(content_chunks(SAMPLE_TEXT)))
+    words: List[str] = []
+    while tokenizer_service.count_text(''.join(words), 'gpt-4') < tokens:
+        words.extend(rng.choices(vocabulary, k=200))
+    return ''.join(words)
+
+
+def content_chunks(text: str) -> List[str]:
+    """近似上游的流式内容块：中文约两个字一块，英文约一个词一块"""
+    chunks, current = [], ''
+    for char in text:
+        current += char
+        if char == ' ' or (not char.isascii() and len(current) >= 2):
+            chunks.append(current)
+            current = ''
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def build_frames(scenario: str, tokens: int) -> Tuple[List[Any], int]:
+    """构造一个场景的消息序列，返回 (消息列表, 内容token数)"""
+    text = sample_text(tokens)
+    if scenario == 'single':
+        frames = [{'type': 'chat_chunk', 'data': {'type': 'content', 'content': chunk}}
+                  for chunk in content_chunks(text)]
+        return frames, tokenizer_service.count_text(text, 'gpt-4')
+    if scenario == 'mux':
+        stream_id = uuid.uuid4().hex
+        frames = [
+            {'op': 'data', 'stream': 1, 'id': f'{stream_id}:{seq}', 'data': {'type': 'content', 'content': chunk}}
+            for seq, chunk in enumerate(content_chunks(text), 1)
+        ]
+        return frames, tokenizer_service.count_text(text, 'gpt-4')
+    if scenario == 'group':
+        frames, seq, total = [], int(time.time() * 1000), 0
+        # 每个模型回答整段内容的一部分，直到达到token数
+        answer = text[:max(1, len(text) // len(MODELS))]
+        while total < tokens:
+            for model in MODELS:
+                seq += 1
+                frames.append({'type': 'model_status', 'modelId': model['id'], 'status': 'thinking',
+                               'usedContext': 1200 + total, 'maxContext': 128000, 'seq': seq})
+                seq += 1
+                frames.append({'type': 'model_response', 'content': answer, 'modelId': model['id'],
+                               'modelName': model['name'], 'timestamp': '2025-01-01T12:00:00.000000', 'seq': seq})
+                seq += 1
+                frames.append({'type': 'context_update', 'contextSize': 1200 + total, 'messageCount': len(frames),
+                               'summarizedMessages': 0, 'seq': seq})
+                seq += 1
+                frames.append({'type': 'model_status', 'modelId': model['id'], 'status': 'active',
+                               'usedContext': 1200 + total, 'maxContext': 128000, 'seq': seq})
+                total += tokenizer_service.count_text(answer, 'gpt-4')
+        return frames, total
+    raise ValueError(f"未知场景: {scenario}")
+
+
+def ws_header_size(length: int) -> int:
+    """服务端发送的WebSocket帧头长度"""
+    if length < 126:
+        return 2
+    return 4 if length < 65536 else 10
+
+
+def bench_codec(codec: WireCodec, deflate: bool, frames: List[Any], tokens: int, repeat: int) -> Dict[str, Any]:
+    # 服务端：编码、压缩
+    started = time.process_time()
+    for _ in range(repeat):
+        compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15) if deflate else None
+        wire_bytes = 0
+        encoded = []
+        for frame in frames:
+            data = codec.encode(frame)
+            if isinstance(data, str):
+                data = data.encode('utf-8')
+            if compressor:
+                data = (compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+            wire_bytes += len(data) + ws_header_size(len(data))
+            encoded.append(data)
+    encode_cpu = time.process_time() - started
+
+    # 客户端：解压、解码
+    started = time.process_time()
+    for _ in range(repeat):
+        decompressor = zlib.decompressobj(-15) if deflate else None
+        for data in encoded:
+            if decompressor:
+                data = decompressor.decompress(data + b'\x00\x00\xff\xff')
+            codec.decode(data if codec.binary else data.decode('utf-8'))
+    decode_cpu = time.process_time() - started
+
+    count = len(frames) * repeat
+    return {
+        'codec': codec.name,
+        'deflate': deflate,
+        'frames': len(frames),
+        'tokens': tokens,
+        'wire_bytes': wire_bytes,
+        'bytes_per_frame': round(wire_bytes / len(frames), 1),
+        'bytes_per_token': round(wire_bytes / max(1, tokens), 2),
+        'encode_us_per_frame': round(encode_cpu / count * 1e6, 2),
+        'decode_us_per_frame': round(decode_cpu / count * 1e6, 2)
+    }
+
+
+def print_summary(results: List[Dict[str, Any]]):
+    print("\n场景    编码     压缩  帧数    字节/帧  字节/token  编码(µs/帧)  解码(µs/帧)")
+    for result in results:
+        print(f"{result['scenario']:<7} {result['codec']:<8} {'on' if result['deflate'] else 'off':<5} "
+              f"{result['frames']:<7} {result['bytes_per_frame']:<8} {result['bytes_per_token']:<11} "
+              f"{result['encode_us_per_frame']:<12} {result['decode_us_per_frame']}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="WebSocket消息编码与帧压缩压测")
+    parser.add_argument("--scenarios", default="single,mux,group")
+    parser.add_argument("--tokens", type=int, default=2000, help="每个场景的内容token数")
+    parser.add_argument("--repeat", type=int, default=10, help="重复次数（CPU时间取平均）")
+    parser.add_argument("--output", help="结果写入JSON文件")
+    args = parser.parse_args(argv)
+
+    codecs = list(CODECS.values())
+    if len(codecs) == 1:
+        print("未安装 msgpack，只测量JSON")
+    results = []
+    for scenario in [value for value in args.scenarios.split(",") if value]:
+        frames, tokens = build_frames(scenario, args.tokens)
+        for codec in codecs:
+            for deflate in (False, True):
+                result = bench_codec(codec, deflate, frames, tokens, args.repeat)
+                results.append({'scenario': scenario, **result})
+    print_summary(results)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+模型基准测试API端点
+"""
+import json
+import os
+from typing import Any, Dict, List, Optional
+from fastapi import APIRouter, HTTPException
+from fastapi.responses import FileResponse
+from pydantic import BaseModel
+from batch_jobs import BatchInputError, parse_items
+from config import config
+from model_benchmark import get_model_benchmark
+import logging
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+class BenchmarkRequest(BaseModel):
+    targets: Any
+    prompts: Optional[List[Dict[str, Any]]] = None
+    repeat: int = 1
+    concurrency: int = 1
+    timeout: Optional[float] = None
+    name: str = ""
+
+@router.post("/api/benchmark/runs", tags=["基准测试"], summary="开始基准测试")
+async def start_benchmark(request: BenchmarkRequest):
+    """
+    对目标模型运行提示词集（未提供时使用内置提示词集），在后台执行，完成后报告保存为JSON与CSV
+    """
+    benchmark = get_model_benchmark()
+    try:
+        prompts = None
+        if request.prompts is not None:
+            data = "\n".join(json.dumps(item, ensure_ascii=False) for item in request.prompts).encode('utf-8')
+            prompts = parse_items(data, config.benchmark_max_calls)
+        run = benchmark.create(request.targets, prompts, request.repeat, request.concurrency,
+                               request.name, request.timeout)
+    except (BatchInputError, json.JSONDecodeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    await benchmark.start(run)
+    return {"success": True, "run": run.to_dict()}
+
+@router.get("/api/benchmark/runs", tags=["基准测试"], summary="列出基准测试")
+async def list_benchmarks():
+    """列出运行中与已保存的基准测试（含各目标汇总，不含逐次样本）"""
+    return {"success": True, "runs": get_model_benchmark().list_runs()}
+
+@router.get("/api/benchmark/runs/{run_id}", tags=["基准测试"], summary="获取基准测试报告")
+async def get_benchmark(run_id: str, samples: bool = True):
+    report = get_model_benchmark().get_report(run_id)
+    if report is None:
+        raise HTTPException(status_code=404, detail="基准测试不存在")
+    if not samples:
+        report = {key: value for key, value in report.items() if key != 'samples'}
+    return {"success": True, "report": report}
+
+@router.get("/api/benchmark/runs/{run_id}/csv", tags=["基准测试"], summary="下载基准测试汇总CSV")
+async def download_benchmark_csv(run_id: str):
+    path = get_model_benchmark().csv_path(os.path.basename(run_id))
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail="基准测试不存在或尚未完成")
+    return FileResponse(path, media_type="text/csv", filename=f"benchmark-{os.path.basename(run_id)}.csv")
@@ -0,0 +1,47 @@
+"""
+响应缓存API端点
+"""
+from fastapi import APIRouter, HTTPException
+from response_cache import response_cache
+from near_duplicate_cache import near_duplicate_cache
+import logging
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+@router.get("/api/cache/stats", tags=["缓存"], summary="获取响应缓存统计")
+async def get_cache_stats():
+    """获取响应缓存命中率、容量与节省的token/费用"""
+    try:
+        return {
+            "success": True,
+            "exact": await response_cache.get_stats(),
+            "near_duplicate": near_duplicate_cache.get_stats()
+        }
+    except Exception as e:
+        logger.error(f"获取缓存统计失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取缓存统计失败: {str(e)}")
+
+@router.post("/api/cache/clear", tags=["缓存"], summary="清空响应缓存")
+async def clear_cache():
+    """清空内存与磁盘响应缓存"""
+    try:
+        await response_cache.clear()
+        near_duplicate_cache.clear()
+        return {"success": True, "message": "响应缓存已清空"}
+    except Exception as e:
+        logger.error(f"清空缓存失败: {e}")
+        raise HTTPException(status_code=500, detail=f"清空缓存失败: {str(e)}")
+
+@router.post("/api/cache/near-duplicate/feedback", tags=["缓存"], summary="反馈近似缓存错误命中")
+async def report_near_duplicate_false_hit(request: dict):
+    """客户端发现近似命中的回答不符合问题时调用，计入错误命中并移除该条目"""
+    entry_id = request.get("entry_id")
+    if not entry_id:
+        raise HTTPException(status_code=400, detail="缺少entry_id参数")
+    removed = near_duplicate_cache.report_false_hit(entry_id)
+    return {
+        "success": removed,
+        "message": "已记录错误命中并移除缓存条目" if removed else "缓存条目不存在或已过期"
+    }
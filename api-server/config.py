@@ -13,11 +13,165 @@ class Config:
         
         # 其他配置
         self.debug = os.getenv('DEBUG', 'False').lower() == 'true'
-        
+
+        # 响应缓存配置（内存LRU + SQLite磁盘层）
+        self.response_cache_enabled = os.getenv('RESPONSE_CACHE_ENABLED', 'true').lower() == 'true'
+        self.response_cache_ttl = int(os.getenv('RESPONSE_CACHE_TTL', 3600))
+        self.response_cache_max_entries = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', 2000))
+        self.response_cache_max_bytes = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+        self.response_cache_db = os.getenv('RESPONSE_CACHE_DB', 'cache/response_cache.db')
+        self.response_cache_disk_max_entries = int(os.getenv('RESPONSE_CACHE_DISK_MAX_ENTRIES', 50000))
+
+        # 近似重复提示词缓存配置（按端点开启，例如 "chat_stream,chat_message"）
+        self.near_dup_cache_endpoints = [
+            name.strip() for name in os.getenv('NEAR_DUP_CACHE_ENDPOINTS', '').split(',') if name.strip()
+        ]
+        self.near_dup_cache_max_hamming = int(os.getenv('NEAR_DUP_CACHE_MAX_HAMMING', 16))
+        self.near_dup_cache_max_entries = int(os.getenv('NEAR_DUP_CACHE_MAX_ENTRIES', 5000))
+        self.near_dup_cache_ttl = int(os.getenv('NEAR_DUP_CACHE_TTL', 3600))
+        # 各模型的相似度阈值（MinHash估计的Jaccard相似度），JSON格式，"default"为默认值
+        self.near_dup_cache_thresholds = self._load_json_env('NEAR_DUP_CACHE_THRESHOLDS', {'default': 0.8})
+
+        # Token估算校准配置（根据提供商返回的真实usage在线拟合估算系数）
+        self.token_calibration_enabled = os.getenv('TOKEN_CALIBRATION_ENABLED', 'true').lower() == 'true'
+        self.token_calibration_file = os.getenv('TOKEN_CALIBRATION_FILE', 'cache/token_calibration.json')
+        self.token_calibration_window = int(os.getenv('TOKEN_CALIBRATION_WINDOW', 500))
+        self.token_calibration_min_samples = int(os.getenv('TOKEN_CALIBRATION_MIN_SAMPLES', 20))
+        # 每采纳多少个新样本重新拟合一次（系数变化超过2%才更新估算器，避免频繁使计数缓存失效）
+        self.token_calibration_refit_every = int(os.getenv('TOKEN_CALIBRATION_REFIT_EVERY', 20))
+
+        # 群聊上下文后台压缩配置（需指定低成本的摘要提供商与模型才会启用）
+        self.context_compaction_provider = os.getenv('CONTEXT_COMPACTION_PROVIDER', '')
+        self.context_compaction_model = os.getenv('CONTEXT_COMPACTION_MODEL', '')
+        self.context_compaction_enabled = (
+            os.getenv('CONTEXT_COMPACTION_ENABLED', 'true').lower() == 'true'
+            and bool(self.context_compaction_provider and self.context_compaction_model)
+        )
+        self.context_compaction_trigger_tokens = int(os.getenv('CONTEXT_COMPACTION_TRIGGER_TOKENS', 3000))
+        self.context_compaction_keep_recent = int(os.getenv('CONTEXT_COMPACTION_KEEP_RECENT', 6))
+        self.context_compaction_max_span = int(os.getenv('CONTEXT_COMPACTION_MAX_SPAN', 40))
+        self.context_compaction_summary_max_tokens = int(os.getenv('CONTEXT_COMPACTION_SUMMARY_MAX_TOKENS', 500))
+
+        # 讨论模式中每位参与者的发言在后续提示词中最多占用的token数
+        self.discussion_answer_max_tokens = int(os.getenv('DISCUSSION_ANSWER_MAX_TOKENS', 800))
+
+        # 单聊服务端会话配置
+        self.conversation_max_entries = int(os.getenv('CONVERSATION_MAX_ENTRIES', 1000))
+        self.conversation_ttl = int(os.getenv('CONVERSATION_TTL', 86400))
+        self.conversation_max_context_tokens = int(os.getenv('CONVERSATION_MAX_CONTEXT_TOKENS', 12000))
+
+        # 群聊会话持久化配置（SQLite WAL + 后台批量写入）
+        self.session_store_enabled = os.getenv('SESSION_STORE_ENABLED', 'true').lower() == 'true'
+        # 默认放在 cache/ 下（Docker中为持久化卷），旧版本的 chat_history.db 首次启动时复制过来
+        self.session_store_db = os.getenv('SESSION_STORE_DB', 'cache/chat_history.db')
+        self.session_store_legacy_db = os.getenv('SESSION_STORE_LEGACY_DB', 'chat_history.db')
+        self.session_store_flush_ms = int(os.getenv('SESSION_STORE_FLUSH_MS', 200))
+        self.session_store_batch_size = int(os.getenv('SESSION_STORE_BATCH_SIZE', 500))
+        # 内存中最多保留的群聊会话数（超出时淘汰最久未使用且未连接的会话）
+        self.session_memory_max = int(os.getenv('SESSION_MEMORY_MAX', 200))
+
+        # 跨进程共享状态配置（memory / sqlite / shm / redis，多worker运行时不能使用memory）
+        self.shared_state_backend = os.getenv('SHARED_STATE_BACKEND', 'memory')
+        self.shared_state_path = os.getenv('SHARED_STATE_PATH', 'cache/shared_state.db')
+        self.shared_state_redis_url = os.getenv('SHARED_STATE_REDIS_URL', 'redis://127.0.0.1:6379/0')
+        self.shared_state_namespace = os.getenv('SHARED_STATE_NAMESPACE', 'avatar')
+        self.shared_state_poll_ms = int(os.getenv('SHARED_STATE_POLL_MS', 50))
+
+        # 排空配置：退出前等待进行中的流完成的最长秒数、建议客户端重试的间隔秒数
+        self.drain_timeout = int(os.getenv('DRAIN_TIMEOUT', 60))
+        self.drain_retry_after = int(os.getenv('DRAIN_RETRY_AFTER', 2))
+        # 手动排空/取消排空接口的共享密钥（请求头 X-Drain-Token），未设置时只允许本机直连调用
+        self.drain_token = os.getenv('DRAIN_TOKEN', '')
+
+        # 准入控制：每个worker同时进行的生成数上限（0表示不限制）、等待队列长度、排队最长秒数、
+        # 拒绝时建议客户端重试的间隔秒数
+        self.admission_max_inflight = int(os.getenv('ADMISSION_MAX_INFLIGHT', 64))
+        self.admission_queue_size = int(os.getenv('ADMISSION_QUEUE_SIZE', 256))
+        self.admission_queue_timeout = float(os.getenv('ADMISSION_QUEUE_TIMEOUT', 10))
+        self.admission_retry_after = int(os.getenv('ADMISSION_RETRY_AFTER', 2))
+
+        # 用户与租户配额（滑动窗口，窗口秒数默认60），QUOTA_LIMITS为JSON：
+        # {"user": {"requests_per_min": 60, "tokens_per_min": 200000}, "tenant": {...}, "user:admin": {...}}，0表示不限制
+        self.quota_enabled = os.getenv('QUOTA_ENABLED', 'true').lower() == 'true'
+        self.quota_limits = self._load_json_env('QUOTA_LIMITS', {
+            'user': {'requests_per_min': 60, 'tokens_per_min': 200000},
+            'tenant': {'requests_per_min': 600, 'tokens_per_min': 2000000}
+        })
+        # 用户名 -> 租户（JSON），未列出的用户属于 default 租户
+        self.quota_user_tenants = self._load_json_env('QUOTA_USER_TENANTS', {})
+        self.quota_window = float(os.getenv('QUOTA_WINDOW', 60))
+        # 计数写入共享状态，多个worker合计一个配额（SHARED_STATE_BACKEND=sqlite/shm/redis）
+        self.quota_sync = os.getenv('QUOTA_SYNC', 'false').lower() == 'true'
+        # 登录token的有效秒数
+        self.auth_token_ttl = int(os.getenv('AUTH_TOKEN_TTL', 86400))
+
+        # 可续传流：断线后生成继续，重放缓冲保留的秒数与上限
+        self.stream_replay_grace = float(os.getenv('STREAM_REPLAY_GRACE', 30))
+        self.stream_replay_max_events = int(os.getenv('STREAM_REPLAY_MAX_EVENTS', 2000))
+        self.stream_replay_max_bytes = int(os.getenv('STREAM_REPLAY_MAX_BYTES', 1024 * 1024))
+        self.stream_replay_max_streams = int(os.getenv('STREAM_REPLAY_MAX_STREAMS', 1000))
+        # 群聊WebSocket每个会话保留的重放消息条数
+        self.ws_replay_max_messages = int(os.getenv('WS_REPLAY_MAX_MESSAGES', 200))
+
+        # 上游与慢客户端之间的有界队列：队列长度与队列满时的策略（block / coalesce / drop）
+        self.stream_queue_size = int(os.getenv('STREAM_QUEUE_SIZE', 64))
+        self.stream_backpressure_policy = os.getenv('STREAM_BACKPRESSURE_POLICY', 'coalesce')
+        self.ws_queue_size = int(os.getenv('WS_QUEUE_SIZE', 256))
+        self.ws_backpressure_policy = os.getenv('WS_BACKPRESSURE_POLICY', 'coalesce')
+        # WebSocket单条消息发送超时（秒），超时的连接被移除
+        self.ws_send_timeout = float(os.getenv('WS_SEND_TIMEOUT', 10))
+
+        # WebSocket心跳：无消息超过间隔时发送ping，超时未回复则回收连接（间隔为0表示关闭）；
+        # 空闲超时（秒，0表示不限）内没有业务消息的连接也被关闭
+        self.ws_heartbeat_interval = float(os.getenv('WS_HEARTBEAT_INTERVAL', 25))
+        self.ws_heartbeat_timeout = float(os.getenv('WS_HEARTBEAT_TIMEOUT', 20))
+        self.ws_idle_timeout = float(os.getenv('WS_IDLE_TIMEOUT', 0))
+        # 没有连接的群聊会话在内存中保留的秒数（0表示只按数量上限淘汰），淘汰前是否先写入持久化存储
+        self.session_idle_ttl = float(os.getenv('SESSION_IDLE_TTL', 1800))
+        self.session_persist_on_evict = os.getenv('SESSION_PERSIST_ON_EVICT', 'true').lower() == 'true'
+        # 群聊观看者：每个观看者的队列长度（满时合并状态消息，仍放不下则断开该观看者），每个会话的观看者上限
+        self.stream_hub_queue_size = int(os.getenv('STREAM_HUB_QUEUE_SIZE', 256))
+        self.stream_hub_max_subscribers = int(os.getenv('STREAM_HUB_MAX_SUBSCRIBERS', 100))
+        # WebSocket可协商的消息编码（按子协议选择，未协商时为JSON；msgpack需要安装 msgpack 包）
+        self.ws_codecs = [name.strip() for name in os.getenv('WS_CODECS', 'msgpack,json').split(',') if name.strip()]
+        # 多路复用WebSocket（/ws/mux）：每个连接最多同时打开的流数，打开流时未指定credit的初始值
+        self.mux_max_streams = int(os.getenv('MUX_MAX_STREAMS', 32))
+        self.mux_initial_credit = int(os.getenv('MUX_INITIAL_CREDIT', 64))
+
+        # 离线批量任务：任务目录、各提供商的并发上限（JSON，"default"为默认值）、重试次数、
+        # 首次重试的等待秒数（之后指数增长）、单次调用超时秒数、每个任务的最大条目数
+        self.batch_jobs_dir = os.getenv('BATCH_JOBS_DIR', 'cache/batch_jobs')
+        self.batch_provider_concurrency = self._load_json_env('BATCH_PROVIDER_CONCURRENCY', {'default': 2})
+        self.batch_max_retries = int(os.getenv('BATCH_MAX_RETRIES', 3))
+        self.batch_retry_base_delay = float(os.getenv('BATCH_RETRY_BASE_DELAY', 1))
+        self.batch_item_timeout = float(os.getenv('BATCH_ITEM_TIMEOUT', 120))
+        self.batch_max_items = int(os.getenv('BATCH_MAX_ITEMS', 10000))
+
+        # 模型基准测试：报告目录、单次运行的最大并发与最大调用次数（目标×提示词×重复次数）、单次调用超时秒数
+        self.benchmark_dir = os.getenv('BENCHMARK_DIR', 'cache/benchmarks')
+        self.benchmark_max_concurrency = int(os.getenv('BENCHMARK_MAX_CONCURRENCY', 16))
+        self.benchmark_max_calls = int(os.getenv('BENCHMARK_MAX_CALLS', 2000))
+        self.benchmark_timeout = float(os.getenv('BENCHMARK_TIMEOUT', 120))
+
+        # 诊断端点（合成流，仅压测时开启）
+        self.diagnostics_enabled = os.getenv('DIAGNOSTICS_ENABLED', 'false').lower() == 'true'
+
         # 模型提供商配置
         self.providers_config_file = 'providers_config.json'
         self.load_providers_config()
     
+    @staticmethod
+    def _load_json_env(name: str, default: Any) -> Any:
+        """读取JSON格式的环境变量，解析失败时使用默认值"""
+        raw = os.getenv(name)
+        if not raw:
+            return default
+        try:
+            return json.loads(raw)
+        except json.JSONDecodeError as e:
+            print(f"环境变量 {name} 不是有效的JSON: {e}")
+            return default
+
     def load_providers_config(self):
         """加载提供商配置"""
         try:
@@ -15,6 +15,9 @@ logger = logging.getLogger(__name__)
 class ConfigManager:
     """配置管理器"""
     
+    # 配置变更通知频道（多worker时其他进程收到后重新加载配置文件）
+    CHANGED_CHANNEL = 'config_changed'
+    
     def __init__(self, config_file: str = "provider_configs.json"):
         """
         初始化配置管理器
@@ -46,9 +49,20 @@ class ConfigManager:
             with open(self.config_file, 'w', encoding='utf-8') as f:
                 json.dump(self.configs, f, indent=2, ensure_ascii=False)
             logger.info(f"配置已保存到: {self.config_file}")
+            self._notify_changed()
         except Exception as e:
             logger.error(f"保存配置文件失败: {e}")
     
+    def _notify_changed(self):
+        """通知其他worker配置已变更"""
+        from shared_state import shared_state
+        if shared_state.shared:
+            shared_state.spawn(shared_state.publish(self.CHANGED_CHANNEL, {'file': str(self.config_file)}))
+    
+    def reload(self, _message: Any = None):
+        """重新加载配置文件（可直接作为配置变更通知的订阅回调）"""
+        self._load_configs()
+    
     def get_provider_config(self, provider_name: str) -> Optional[Dict[str, Any]]:
         """获取指定提供商的配置"""
         return self.configs.get("providers", {}).get(provider_name)
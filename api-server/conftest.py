@@ -0,0 +1,40 @@
+"""
+pytest 配置
+
+- 测试使用临时目录中的数据库与缓存文件，不读写 chat_history.db、cache/ 等运行时数据
+  （环境变量须在导入 config 之前设置）
+- 目录下其他 test_*.py 是调用真实API的连通性脚本（需要密钥与网络），不作为单元测试收集
+"""
+
+import atexit
+import os
+import shutil
+import tempfile
+
+_TEST_DIR = tempfile.mkdtemp(prefix='api-server-tests-')
+atexit.register(shutil.rmtree, _TEST_DIR, ignore_errors=True)
+
+for _name, _value in {
+    'SESSION_STORE_DB': os.path.join(_TEST_DIR, 'chat_history.db'),
+    'SESSION_STORE_LEGACY_DB': '',
+    'SHARED_STATE_BACKEND': 'memory',
+    'SHARED_STATE_PATH': os.path.join(_TEST_DIR, 'shared_state.db'),
+    'RESPONSE_CACHE_DB': os.path.join(_TEST_DIR, 'response_cache.db'),
+    'TOKEN_CALIBRATION_FILE': os.path.join(_TEST_DIR, 'token_calibration.json'),
+    'BATCH_JOBS_DIR': os.path.join(_TEST_DIR, 'batch_jobs'),
+    'BENCHMARK_DIR': os.path.join(_TEST_DIR, 'benchmarks'),
+}.items():
+    os.environ[_name] = _value
+
+# 连通性脚本（模块级代码直接发起网络请求）
+collect_ignore = [
+    'test_deepseek.py',
+    'test_glm.py',
+    'test_json.py',
+    'test_new_free_models.py',
+    'test_openrouter_chat.py',
+    'test_openrouter_dual_mode.py',
+    'test_openrouter_gpt.py',
+    'test_openrouter_integration.py',
+    'test_thinking_response.py',
+]
@@ -0,0 +1,181 @@
+"""
+群聊上下文后台压缩（滚动摘要）
+
+会话中尚未被摘要覆盖的消息超过token阈值时，在后台用配置的低成本模型
+把最早的一段消息与已有摘要合并成新的摘要，摘要按片段哈希缓存。
+ContextService 在构建模型上下文时以摘要替代被覆盖的旧消息，
+每轮请求的提示词规模保持有界；压缩不在用户请求路径上执行。
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+from typing import Any, Dict, List, Optional
+
+from config import config
+from tokenizer_service import tokenizer_service
+from utils.lru_cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_SYSTEM_PROMPT = (
+    "你负责压缩多模型群聊的对话历史。请把已有摘要与新的对话片段合并成一份简洁的摘要，"
+    "保留关键事实、结论、用户的要求与偏好、尚未解决的问题以及各模型的主要观点，"
+    "不要编造内容，不要逐条复述。摘要不超过{max_chars}字。"
+)
+
+# 提示词中的字数上限只用token预算的这一比例，留出余量，避免摘要被 max_tokens 截断
+SUMMARY_BUDGET_FILL = 0.8
+
+
+def span_key(model: str, previous_summary: str, records: List[Dict[str, Any]]) -> str:
+    """根据摘要模型、已有摘要和片段内容计算缓存键"""
+    payload = json.dumps(
+        [model, previous_summary, [(r.get('role'), r.get('name'), r.get('content')) for r in records]],
+        ensure_ascii=False, separators=(',', ':')
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def format_span(records: List[Dict[str, Any]]) -> str:
+    """把对话片段格式化为摘要模型的输入"""
+    lines = []
+    for record in records:
+        speaker = '用户' if record.get('role') == 'user' else (record.get('name') or '助手')
+        lines.append(f"[{speaker}] {record.get('content', '')}")
+    return '\n'.join(lines)
+
+
+class ContextCompactor:
+    """后台滚动摘要压缩器"""
+
+    def __init__(
+        self,
+        provider_manager=None,
+        provider_name: str = '',
+        model: str = '',
+        trigger_tokens: int = 3000,
+        keep_recent: int = 6,
+        max_span_messages: int = 40,
+        summary_max_tokens: int = 500,
+        cache_entries: int = 1000
+    ):
+        self.provider_manager = provider_manager
+        self.provider_name = provider_name
+        self.model = model
+        self.trigger_tokens = trigger_tokens
+        self.keep_recent = keep_recent
+        self.max_span_messages = max_span_messages
+        self.summary_max_tokens = summary_max_tokens
+        self._cache = LRUCache(max_entries=cache_entries)
+        self._running: Dict[str, asyncio.Task] = {}
+        self.metrics = {
+            'compactions': 0,
+            'cache_hits': 0,
+            'failures': 0,
+            'summarized_messages': 0
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.provider_manager is not None and bool(self.provider_name and self.model)
+
+    def schedule(self, session_id: str, ledger) -> Optional[asyncio.Task]:
+        """未覆盖的消息超过阈值时启动后台压缩（同一会话同时只运行一个）"""
+        if not self.enabled or session_id in self._running:
+            return None
+        if ledger.uncovered_tokens() <= self.trigger_tokens:
+            return None
+        task = asyncio.create_task(self._compact(session_id, ledger))
+        self._running[session_id] = task
+        task.add_done_callback(lambda _: self._running.pop(session_id, None))
+        return task
+
+    async def _compact(self, session_id: str, ledger):
+        """逐段压缩，直到未覆盖的消息回到阈值以内"""
+        try:
+            while ledger.uncovered_tokens() > self.trigger_tokens:
+                start, records = ledger.compaction_span(self.keep_recent, self.max_span_messages)
+                if not records:
+                    break
+                previous_summary = ledger.summary_text
+                key = span_key(self.model, previous_summary, records)
+                summary = self._cache.get(key)
+                if summary is None:
+                    summary = await self.summarize(previous_summary, records)
+                    if not summary:
+                        break
+                    self._cache.set(key, summary)
+                else:
+                    self.metrics['cache_hits'] += 1
+                if not ledger.set_summary(summary, start, start + len(records)):
+                    # 压缩期间上下文被清空或已被其他摘要覆盖
+                    break
+                self.metrics['compactions'] += 1
+                self.metrics['summarized_messages'] += len(records)
+                logger.info(f"会话 {session_id} 已压缩 {len(records)} 条消息为摘要")
+        except Exception as e:
+            self.metrics['failures'] += 1
+            logger.error(f"会话 {session_id} 上下文压缩失败: {e}")
+
+    def summary_max_chars(self) -> int:
+        """把摘要的token预算换算成提示词中的字数上限（按摘要模型每个汉字的token数）"""
+        sample = '字' * 100
+        tokens_per_char = max(tokenizer_service.count_text(sample, self.model) / len(sample), 0.1)
+        return max(1, int(self.summary_max_tokens * SUMMARY_BUDGET_FILL / tokens_per_char))
+
+    async def summarize(self, previous_summary: str, records: List[Dict[str, Any]]) -> str:
+        """调用摘要模型合并已有摘要与新片段"""
+        provider = self.provider_manager.get_provider(self.provider_name)
+        if not provider:
+            raise RuntimeError(f"找不到摘要提供商: {self.provider_name}")
+        user_content = ''
+        if previous_summary:
+            user_content += f"已有摘要：\n{previous_summary}\n\n"
+        user_content += f"新的对话片段：\n{format_span(records)}"
+        messages = [
+            {'role': 'system', 'content': SUMMARY_SYSTEM_PROMPT.format(max_chars=self.summary_max_chars())},
+            {'role': 'user', 'content': user_content}
+        ]
+        summary = ''
+        async for chunk in provider.chat_completion(
+            messages=messages,
+            model=self.model,
+            stream=False,
+            temperature=0.3,
+            max_tokens=self.summary_max_tokens
+        ):
+            summary += chunk.content or ''
+        return summary.strip()
+
+    async def wait(self, session_id: str):
+        """等待会话正在进行的压缩完成"""
+        task = self._running.get(session_id)
+        if task:
+            await task
+
+    def get_stats(self) -> Dict[str, Any]:
+        """压缩统计"""
+        return {
+            'enabled': self.enabled,
+            'provider': self.provider_name,
+            'model': self.model,
+            'trigger_tokens': self.trigger_tokens,
+            'running': len(self._running),
+            'cache': self._cache.stats(),
+            **self.metrics
+        }
+
+
+def create_context_compactor(provider_manager) -> ContextCompactor:
+    """按配置创建压缩器（未配置摘要模型时不启用）"""
+    return ContextCompactor(
+        provider_manager=provider_manager if config.context_compaction_enabled else None,
+        provider_name=config.context_compaction_provider,
+        model=config.context_compaction_model,
+        trigger_tokens=config.context_compaction_trigger_tokens,
+        keep_recent=config.context_compaction_keep_recent,
+        max_span_messages=config.context_compaction_max_span,
+        summary_max_tokens=config.context_compaction_summary_max_tokens
+    )
@@ -0,0 +1,35 @@
+"""
+单聊会话API端点
+"""
+from fastapi import APIRouter, HTTPException, Request
+from conversation_store import conversation_store
+from quota import identify
+import logging
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+@router.get("/api/conversations/stats", tags=["会话"], summary="获取会话存储统计")
+async def get_conversation_stats():
+    """获取服务端会话数量与命中统计"""
+    return {"success": True, "stats": conversation_store.get_stats()}
+
+@router.get("/api/conversations/{conversation_id}", tags=["会话"], summary="获取会话历史")
+async def get_conversation(conversation_id: str, http_request: Request):
+    """获取当前用户会话的消息历史及每条消息的token数"""
+    identity = await identify(http_request.scope)
+    conversation = await conversation_store.get(conversation_id, identity.user_id)
+    if conversation is None:
+        raise HTTPException(status_code=404, detail="会话不存在或已过期")
+    return {"success": True, "conversation": conversation.to_dict()}
+
+@router.delete("/api/conversations/{conversation_id}", tags=["会话"], summary="删除会话")
+async def delete_conversation(conversation_id: str, http_request: Request):
+    """删除当前用户在服务端保存的会话历史"""
+    identity = await identify(http_request.scope)
+    removed = await conversation_store.delete(conversation_id, identity.user_id)
+    return {
+        "success": removed,
+        "message": "会话已删除" if removed else "会话不存在或已过期"
+    }
@@ -0,0 +1,255 @@
+"""
+单聊会话的服务端状态
+
+客户端在 /api/chat/stream 请求中携带 conversation_id，只上传新的一轮用户消息，
+服务端保存完整消息历史及每条消息的token数：
+- 上传体积不随对话变长而增长
+- 历史消息只追加不改写，消息前缀保持字节稳定，上游提示词缓存可以命中
+- 超出上下文预算时一次性丢弃较早的若干轮（带回差），避免每轮都改变前缀
+- 多worker运行时，每轮结束后把会话写入共享状态，请求落到其他worker时从共享状态加载
+- 会话属于创建它的用户（登录用户ID，未登录时为客户端IP），其他用户按不存在处理
+"""
+
+import asyncio
+import time
+import uuid
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional
+
+from config import config
+from shared_state import SharedStateBackend, shared_state
+from tokenizer_service import tokenizer_service, REPLY_PRIMING_TOKENS
+from utils.lru_cache import LRUCache
+
+
+class ConversationNotFound(LookupError):
+    """会话不存在、已过期或属于其他用户"""
+
+
+class ConversationConflict(ValueError):
+    """请求与已有会话不一致（如后续轮次修改系统提示词）"""
+
+
+@dataclass
+class Conversation:
+    """单个会话的消息历史与token账本"""
+    conversation_id: str
+    provider: str
+    model: str
+    system_prompt: str = ''
+    # 创建会话的用户（quota.Identity.user_id）
+    owner: str = ''
+    messages: List[Dict[str, str]] = field(default_factory=list)
+    token_counts: List[int] = field(default_factory=list)
+    total_tokens: int = 0
+    # 因超出预算而丢弃的消息数
+    dropped_messages: int = 0
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock, repr=False, compare=False)
+
+    def __post_init__(self):
+        if self.system_prompt and not self.messages:
+            self._append({'role': 'system', 'content': self.system_prompt})
+
+    def _append(self, message: Dict[str, str]):
+        count = tokenizer_service.count_each_message([message], self.model)[0]
+        self.messages.append(message)
+        self.token_counts.append(count)
+        self.total_tokens += count
+
+    def set_model(self, model: str):
+        """切换模型时按新模型重新统计token"""
+        if model == self.model:
+            return
+        self.model = model
+        self.token_counts = tokenizer_service.count_each_message(self.messages, model)
+        self.total_tokens = sum(self.token_counts)
+
+    def build_messages(self, user_content: str) -> List[Dict[str, str]]:
+        """历史消息 + 本轮用户消息（历史列表本身不修改）"""
+        return self.messages + [{'role': 'user', 'content': user_content}]
+
+    def append_turn(self, user_content: str, assistant_content: str):
+        """一轮成功完成后写入历史"""
+        self._append({'role': 'user', 'content': user_content})
+        self._append({'role': 'assistant', 'content': assistant_content})
+        self.updated_at = time.time()
+
+    def enforce_budget(self, max_tokens: int, low_watermark: float = 0.75) -> int:
+        """
+        超出预算时从最早的轮次开始丢弃，直到降到预算的 low_watermark 以下
+
+        一次多丢一些，之后若干轮的前缀保持不变；系统提示词始终保留。
+        返回丢弃的消息数。
+        """
+        if max_tokens <= 0 or self.total_tokens <= max_tokens:
+            return 0
+        keep_from = 1 if self.messages and self.messages[0]['role'] == 'system' else 0
+        target = max_tokens * low_watermark
+        drop_until = keep_from
+        remaining = self.total_tokens
+        # 至少保留最近一轮（用户+助手）
+        while drop_until < len(self.messages) - 2 and remaining > target:
+            remaining -= self.token_counts[drop_until]
+            drop_until += 1
+        # 不从一轮中间截断：保留部分以用户消息开头
+        while drop_until < len(self.messages) - 2 and self.messages[drop_until]['role'] != 'user':
+            remaining -= self.token_counts[drop_until]
+            drop_until += 1
+        dropped = drop_until - keep_from
+        if dropped:
+            del self.messages[keep_from:drop_until]
+            del self.token_counts[keep_from:drop_until]
+            self.total_tokens = remaining
+            self.dropped_messages += dropped
+        return dropped
+
+    def context_tokens(self) -> int:
+        """下一轮请求中历史部分的token数"""
+        return self.total_tokens + REPLY_PRIMING_TOKENS if self.messages else 0
+
+    def to_state(self) -> Dict[str, Any]:
+        """写入共享状态的内容（token数在加载时按模型重新统计）"""
+        return {
+            'conversation_id': self.conversation_id,
+            'provider': self.provider,
+            'model': self.model,
+            'system_prompt': self.system_prompt,
+            'owner': self.owner,
+            'messages': self.messages,
+            'dropped_messages': self.dropped_messages,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
+        }
+    
+    @classmethod
+    def from_state(cls, data: Dict[str, Any]) -> 'Conversation':
+        conversation = cls(
+            conversation_id=data['conversation_id'],
+            provider=data['provider'],
+            model=data['model'],
+            system_prompt=data.get('system_prompt', ''),
+            owner=data.get('owner', ''),
+            messages=list(data.get('messages', [])),
+            dropped_messages=data.get('dropped_messages', 0),
+            created_at=data.get('created_at', time.time()),
+            updated_at=data.get('updated_at', time.time())
+        )
+        conversation.token_counts = tokenizer_service.count_each_message(conversation.messages, conversation.model)
+        conversation.total_tokens = sum(conversation.token_counts)
+        return conversation
+    
+    def to_dict(self, include_messages: bool = True) -> Dict[str, Any]:
+        data = {
+            'conversation_id': self.conversation_id,
+            'provider': self.provider,
+            'model': self.model,
+            'message_count': len(self.messages),
+            'context_tokens': self.context_tokens(),
+            'dropped_messages': self.dropped_messages,
+            'created_at': self.created_at,
+            'updated_at': self.updated_at
+        }
+        if include_messages:
+            data['messages'] = [
+                dict(message, tokens=count) for message, count in zip(self.messages, self.token_counts)
+            ]
+        return data
+
+
+class ConversationStore:
+    """会话存储（内存LRU，闲置超时的会话自动淘汰；共享状态可跨进程时同时写入共享状态）"""
+
+    def __init__(self, max_conversations: int = 1000, ttl: int = 86400, max_context_tokens: int = 12000,
+                 state: Optional[SharedStateBackend] = None):
+        self.max_context_tokens = max_context_tokens
+        self.ttl = ttl
+        self._conversations = LRUCache(max_entries=max_conversations, ttl=ttl)
+        # 只有跨进程共享的后端才需要同步
+        self.state = state if state and state.shared else None
+
+    @staticmethod
+    def new_id() -> str:
+        return uuid.uuid4().hex
+
+    @staticmethod
+    def _state_key(conversation_id: str) -> str:
+        return f'conversation:{conversation_id}'
+
+    async def _load(self, conversation_id: str) -> Optional[Conversation]:
+        """先查本进程，未命中时从共享状态加载（上一轮可能在其他worker处理）"""
+        conversation = self._conversations.get(conversation_id)
+        if conversation is None and self.state:
+            data = await self.state.get(self._state_key(conversation_id))
+            if data:
+                conversation = Conversation.from_state(data)
+                self._conversations.set(conversation_id, conversation)
+        return conversation
+
+    async def get(self, conversation_id: str, owner: str) -> Optional[Conversation]:
+        """获取 owner 的会话，不存在或属于其他用户时返回None"""
+        conversation = await self._load(conversation_id)
+        return conversation if conversation is not None and conversation.owner == owner else None
+
+    async def get_or_create(self, conversation_id: Optional[str], provider: str, model: str,
+                            owner: str, system_prompt: str = '') -> Conversation:
+        """
+        获取会话，不存在（或已过期）时以该ID新建
+
+        Raises:
+            ConversationNotFound: 该ID的会话属于其他用户
+            ConversationConflict: 后续轮次带了与会话不同的系统提示词（系统提示词只在新建时生效）
+        """
+        conversation = await self._load(conversation_id) if conversation_id else None
+        if conversation is None:
+            conversation = Conversation(
+                conversation_id=conversation_id or self.new_id(),
+                provider=provider,
+                model=model,
+                system_prompt=system_prompt,
+                owner=owner
+            )
+            self._conversations.set(conversation.conversation_id, conversation)
+            return conversation
+        if conversation.owner != owner:
+            raise ConversationNotFound(f"会话不存在: {conversation_id}")
+        if system_prompt and system_prompt != conversation.system_prompt:
+            raise ConversationConflict("系统提示词只能在新建会话时设置，修改请新建会话")
+        conversation.provider = provider
+        conversation.set_model(model)
+        return conversation
+
+    def save(self, conversation: Conversation):
+        """一轮结束后调用：裁剪到预算并刷新过期时间"""
+        conversation.enforce_budget(self.max_context_tokens)
+        self._conversations.set(conversation.conversation_id, conversation)
+        if self.state:
+            self.state.spawn(self.state.set(
+                self._state_key(conversation.conversation_id), conversation.to_state(), ttl=self.ttl
+            ))
+
+    async def delete(self, conversation_id: str, owner: str) -> bool:
+        """删除 owner 的会话，不存在或属于其他用户时返回False"""
+        if await self.get(conversation_id, owner) is None:
+            return False
+        self._conversations.pop(conversation_id)
+        if self.state:
+            await self.state.delete(self._state_key(conversation_id))
+        return True
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'max_context_tokens': self.max_context_tokens,
+            'shared': self.state is not None,
+            **self._conversations.stats()
+        }
+
+
+# 全局会话存储实例
+conversation_store = ConversationStore(
+    max_conversations=config.conversation_max_entries,
+    ttl=config.conversation_ttl,
+    max_context_tokens=config.conversation_max_context_tokens,
+    state=shared_state
+)
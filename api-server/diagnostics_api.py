@@ -0,0 +1,40 @@
+"""
+诊断API端点（压测用）
+
+提供不调用上游模型的合成流式响应，用于测量服务本身的吞吐与并发流容量。
+需设置 DIAGNOSTICS_ENABLED=true 才会注册。
+"""
+import asyncio
+import json
+import os
+import time
+from fastapi import APIRouter, Query
+from fastapi.responses import StreamingResponse
+
+router = APIRouter()
+
+@router.get("/api/diagnostics/ping", tags=["诊断"], summary="最小响应")
+async def diagnostics_ping():
+    """不做任何处理的最小响应，用于测量框架本身的请求吞吐"""
+    return {"pid": os.getpid(), "timestamp": time.time()}
+
+@router.get("/api/diagnostics/stream", tags=["诊断"], summary="合成SSE流")
+async def diagnostics_stream(
+    chunks: int = Query(20, ge=1, le=10000),
+    interval_ms: int = Query(50, ge=0, le=10000),
+    chunk_size: int = Query(16, ge=1, le=65536)
+):
+    """按固定间隔输出 chunks 个内容块，格式与聊天流一致"""
+    async def generate():
+        yield f"data: {json.dumps({'type': 'start', 'pid': os.getpid()})}\n\n"
+        content = 'x' * chunk_size
+        for index in range(chunks):
+            if interval_ms:
+                await asyncio.sleep(interval_ms / 1000)
+            yield f"data: {json.dumps({'type': 'content', 'index': index, 'content': content})}\n\n"
+        yield f"data: {json.dumps({'type': 'end'})}\n\n"
+
+    return StreamingResponse(generate(), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
@@ -16,6 +16,7 @@ from fastapi.middleware.cors import CORSMiddleware
 from config_api import router as config_router
 from exchange_rate_api import router as exchange_rate_router
 from exchange_rate_api import router as exchange_rate_router
+from cache_api import router as cache_router
 from fastapi.responses import StreamingResponse, JSONResponse
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from pydantic import BaseModel, Field
@@ -30,6 +31,35 @@ from token_verification import token_verifier
 from token_stats import TokenStatsCollector
 from token_stats import TokenStatsCollector
 from token_stats import TokenStatsCollector
+from response_cache import response_cache, ResponseCache, build_cache_hit_stats
+from near_duplicate_cache import near_duplicate_cache
+from tokenizer_service import tokenizer_service
+from group_chat_fix import DiscussionTranscript
+from conversation_store import conversation_store, ConversationNotFound, ConversationConflict
+from conversation_api import router as conversation_router
+from session_store import session_store
+from shared_state import shared_state
+from lifecycle import WS_CLOSE_SERVICE_RESTART, DrainMiddleware, drain_controller
+from lifecycle_api import router as lifecycle_router
+from admission import AdmissionMiddleware, AdmissionRejected, admission_controller, normalize_priority
+from admission_api import router as admission_router
+from quota import QuotaMiddleware, QuotaExceeded, quota_manager, register_token, admit_current, check_tokens, record_usage, identify
+from quota_api import router as quota_router
+from batch_jobs import get_batch_runner
+from batch_api import router as batch_router
+from model_benchmark import get_model_benchmark
+from benchmark_api import router as benchmark_router
+from resumable_stream import stream_registry, parse_last_event_id, request_fingerprint, ResumableStream, SSE_HEADERS
+from stream_hub import HubFull
+from history_api import router as history_router
+from backpressure import (
+    channel_registry, ConnectionWriter, CLOSE_DISCONNECTED, CLOSE_DRAINING, CLOSE_ERROR, CLOSE_OVERFLOW,
+    CLOSE_TIMEOUT, WS_CLOSE_TRY_AGAIN_LATER
+)
+from backpressure_api import router as backpressure_router
+from heartbeat import heartbeat_monitor
+from ws_codec import WireCodec, accept_websocket, json_codec, get_codec_info
+from mux import MuxConnection, MuxStream, register_kind, parse_sse_event, get_mux_stats
 
 # 导入提供商相关模块
 from providers import (
@@ -65,6 +95,10 @@ logger = logging.getLogger(__name__)
 # 创建全局Provider管理器
 provider_manager = ProviderManager()
 
+# 批量任务运行器、基准测试与在线请求共用提供商管理器
+get_batch_runner(provider_manager)
+get_model_benchmark(provider_manager)
+
 # 初始化配置指令处理器
 if ConfigCommandHandler is not None:
     from config_manager import ConfigManager
@@ -136,6 +170,9 @@ async def lifespan(app: FastAPI):
     
     # 启动时初始化
     try:
+        # 其他worker修改提供商配置后重新加载
+        if shared_state.shared:
+            await shared_state.subscribe(config_manager.CHANGED_CHANNEL, config_manager.reload)
         logger.info("提供商管理器初始化完成")
     except Exception as e:
         logger.error(f"提供商管理器初始化失败: {e}")
@@ -145,6 +182,11 @@ async def lifespan(app: FastAPI):
     # 关闭时清理
     logger.info("FastAPI应用关闭中...")
     try:
+        # 中断运行中的批量任务并写入检查点（重启后可续传）
+        await get_batch_runner().close()
+        # 写入尚未提交的群聊会话数据
+        await session_store.close()
+        await shared_state.close()
         logger.info("提供商管理器清理完成")
     except Exception as e:
         logger.error(f"提供商管理器清理失败: {e}")
@@ -163,6 +205,47 @@ app.include_router(config_router)
 # 包含汇率API路由
 app.include_router(exchange_rate_router)
 
+# 包含响应缓存API路由
+app.include_router(cache_router)
+
+# 包含单聊会话API路由
+app.include_router(conversation_router)
+
+# 注册聊天历史路由
+app.include_router(history_router)
+
+# 注册生命周期路由
+app.include_router(lifecycle_router)
+
+# 注册背压指标路由
+app.include_router(backpressure_router)
+
+# 注册准入控制指标路由
+app.include_router(admission_router)
+
+# 注册配额路由
+app.include_router(quota_router)
+
+# 注册批量任务路由
+app.include_router(batch_router)
+
+# 注册基准测试路由
+app.include_router(benchmark_router)
+
+# 准入中间件：限制同时进行的生成数，超出时按优先级排队或返回503（位于排空中间件内层；续传与幂等重放不占名额）
+app.add_middleware(AdmissionMiddleware, controller=admission_controller, exempt=stream_registry.serves)
+
+# 配额中间件：识别用户，超出每分钟请求数或token数时返回429（先于准入检查，超配额的请求不占用排队位置；续传与幂等重放不计入）
+app.add_middleware(QuotaMiddleware, manager=quota_manager, exempt=stream_registry.serves)
+
+# 排空中间件：重启时拒绝新的生成请求，统计进行中的流
+app.add_middleware(DrainMiddleware, controller=drain_controller)
+
+# 诊断路由（压测用，默认不注册）
+if config.diagnostics_enabled:
+    from diagnostics_api import router as diagnostics_router
+    app.include_router(diagnostics_router)
+
 # 包含简化配置API路由
 
 
@@ -181,7 +264,39 @@ async def websocket_group_chat_endpoint_with_id(websocket: WebSocket, session_id
     handler = get_group_chat_handler(provider_manager)
     await handler.handle_websocket(websocket, session_id)
 
+@app.websocket("/ws/group-chat/{session_id}/watch")
+async def websocket_group_chat_watch_endpoint(websocket: WebSocket, session_id: str, last_seq: int = 0):
+    """只读观看群聊会话：先补齐已有的消息再实时接收，不触发模型调用（断线后带 last_seq 重连）"""
+    handler = get_group_chat_handler(provider_manager)
+    await handler.handle_watch_websocket(websocket, session_id, last_seq)
+
+@app.websocket("/ws/mux")
+async def websocket_mux_endpoint(websocket: WebSocket):
+    """多路复用WebSocket端点：一个连接同时承载多个单聊、群聊与状态推送流（协议见 mux.py）"""
+    await MuxConnection(websocket).run()
+
 # 群聊相关API
+@app.get("/api/group-chat/{session_id}/watch")
+async def watch_group_chat(session_id: str, http_request: Request, last_seq: int = 0):
+    """以SSE只读观看群聊会话，事件id为消息序号（EventSource重连时自动带 Last-Event-ID 补齐）"""
+    last_event_id = http_request.headers.get('last-event-id')
+    if last_event_id and last_event_id.isdigit():
+        last_seq = int(last_event_id)
+    handler = get_group_chat_handler(provider_manager)
+    try:
+        subscription = handler.connection_manager.watch(session_id, last_seq, f"sse-watch:{session_id}:{uuid.uuid4().hex[:8]}")
+    except HubFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+    async def events():
+        async for seq, payload in subscription:
+            prefix = f"id: {seq}\n" if seq else ""
+            yield f"{prefix}data: {payload}\n\n"
+        if subscription.close_reason == CLOSE_OVERFLOW:
+            yield f"data: {json.dumps({'type': 'slow_consumer', 'reconnect': True})}\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers=SSE_HEADERS)
+
 @app.get("/api/models")
 async def get_available_models():
     """获取所有可用的模型列表"""
@@ -350,6 +465,8 @@ async def chat_message(request: dict):
         # 发送消息并获取响应
         response_content = ""
         chunk_count = 0
+        cache_key = None
+        use_near_dup = False
         usage_info = None  # 存储真实的token使用信息
         
         # 计算开始时间用于性能统计
@@ -431,11 +548,8 @@ async def chat_message(request: dict):
                     model_response = resp['response']
                     
                     # 估算token数量
-                    input_tokens = len(message) // 2 if any('\u4e00' <= c <= '\u9fff' for c in message) else len(message) // 4
-                    input_tokens = max(10, input_tokens)
-                    
-                    output_tokens = len(model_response) // 2 if any('\u4e00' <= c <= '\u9fff' for c in model_response) else len(model_response) // 4
-                    output_tokens = max(1, output_tokens)
+                    input_tokens = tokenizer_service.count_messages([{"role": "user", "content": message}], model_name)
+                    output_tokens = max(1, tokenizer_service.count_text(model_response, model_name))
                     
                     total_tokens = input_tokens + output_tokens
                     
@@ -479,10 +593,48 @@ async def chat_message(request: dict):
             # 单聊模式：使用单个模型
             selected_model = model
             
+            # 查询响应缓存（精确匹配优先，其次是按端点开启的近似匹配）
+            use_cache = request.get("use_cache", True)
+            cache_messages = [{"role": "user", "content": message}]
+            # 实际发给上游的采样参数（请求未指定的取该提供商的默认值），缓存键与上游调用使用同一份
+            completion_params = provider_instance.completion_params(
+                temperature=request.get("temperature", provider_config.get('temperature')),
+                max_tokens=request.get("max_tokens", provider_config.get('max_tokens'))
+            )
+            cache_params = {"base_url": provider_config.get('baseUrl', ''), **completion_params}
+            use_near_dup = use_cache and near_duplicate_cache.is_enabled('chat_message')
+            cached, cache_type = None, 'exact'
+            if use_cache and response_cache.enabled:
+                cache_key = ResponseCache.make_key(provider, selected_model, cache_messages, **cache_params)
+                cached = await response_cache.get(cache_key)
+            if not cached and use_near_dup:
+                cached = near_duplicate_cache.lookup(provider, selected_model, cache_messages, **cache_params)
+                cache_type = 'near_duplicate'
+            if cached:
+                logger.info(f"响应缓存命中({cache_type}): provider={provider}, model={selected_model}")
+                hit_stats = build_cache_hit_stats(cached, time.time() - start_time, cache_type)
+                result = {
+                    "response": cached['content'],
+                    "provider": provider,
+                    "model": selected_model,
+                    "cache_hit": True,
+                    "cache_type": cache_type,
+                    "performance": hit_stats['performance'],
+                    "tokens": hit_stats['tokens'],
+                    "saved": hit_stats['saved']
+                }
+                if 'near_duplicate' in hit_stats:
+                    result['near_duplicate'] = hit_stats['near_duplicate']
+                return result
+            
+            verify_request_id = uuid.uuid4().hex
+            token_verifier.log_api_request(provider, selected_model, cache_messages, verify_request_id)
+            
             async for chunk in provider_instance.chat_completion(
-                messages=[{"role": "user", "content": message}],
+                messages=cache_messages,
                 model=selected_model,
-                stream=False
+                stream=False,
+                **completion_params
             ):
                 if first_token_time is None:
                     first_token_time = time.time() - start_time
@@ -496,6 +648,9 @@ async def chat_message(request: dict):
                 elif isinstance(chunk, str):
                     response_content += chunk
                     chunk_count += 1
+            
+            # 对比估算与真实usage，并用真实usage校准估算系数
+            token_verifier.log_api_response(verify_request_id, response_content, usage_info)
         
         # 计算性能统计
         total_time = time.time() - start_time
@@ -509,11 +664,8 @@ async def chat_message(request: dict):
             cache_tokens = usage_info.get('cache_creation_input_tokens', 0) + usage_info.get('cache_read_input_tokens', 0)
         else:
             # 回退到估算token数量
-            input_tokens = len(message) // 2 if any('\u4e00' <= c <= '\u9fff' for c in message) else len(message) // 4
-            input_tokens = max(10, input_tokens)
-            
-            output_tokens = len(response_content) // 2 if any('\u4e00' <= c <= '\u9fff' for c in response_content) else len(response_content) // 4
-            output_tokens = max(1, output_tokens)
+            input_tokens = tokenizer_service.count_messages([{"role": "user", "content": message}], selected_model)
+            output_tokens = max(1, tokenizer_service.count_text(response_content, selected_model))
             
             total_tokens = input_tokens + output_tokens
             cache_tokens = 0
@@ -568,10 +720,34 @@ async def chat_message(request: dict):
                 output_cost = (output_tokens / 1000) * cost_per_1k_output
                 total_cost_cny = (input_cost + output_cost) * usd_to_cny_rate
         
+        # 写入响应缓存
+        if response_content and len(models) <= 1:
+            cache_entry = {
+                "provider": provider,
+                "model": selected_model,
+                "content": response_content,
+                "tokens": {
+                    "input": input_tokens,
+                    "output": output_tokens,
+                    "total": total_tokens,
+                    "prompt_tokens": input_tokens,
+                    "completion_tokens": output_tokens,
+                    "total_tokens": total_tokens,
+                    "total_cost_usd": input_cost + output_cost,
+                    "total_cost_cny": total_cost_cny
+                }
+            }
+            if cache_key:
+                await response_cache.set(cache_key, cache_entry)
+            if use_near_dup:
+                near_duplicate_cache.add(provider, selected_model, cache_messages, cache_entry, **cache_params)
+        
         return {
             "response": response_content,
             "provider": provider,
             "model": selected_model,
+            "cache_hit": False,
+            "quota": await record_usage(total_tokens),
             "performance": {
                 "first_token_time": first_token_time or 0,
                 "response_time": total_time,
@@ -598,10 +774,39 @@ async def chat_message(request: dict):
 
 @app.get("/api/health")
 async def api_health_check():
-    """API健康检查端点"""
+    """API健康检查端点（排空中返回503，负载均衡据此不再分配新请求）"""
+    if drain_controller.draining:
+        return JSONResponse(status_code=503, headers={"Retry-After": str(drain_controller.retry_after)}, content={
+            "status": "draining",
+            "timestamp": datetime.now().isoformat(),
+            "lifecycle": drain_controller.get_status()
+        })
     return {
         "status": "healthy",
-        "timestamp": datetime.now().isoformat()
+        "timestamp": datetime.now().isoformat(),
+        "worker": worker_status()
+    }
+
+@app.get("/api/ws/codecs")
+async def api_ws_codecs():
+    """WebSocket可协商的消息编码（子协议）与 chat-msgpack 的字段表"""
+    return get_codec_info()
+
+def worker_status() -> Dict[str, Any]:
+    """本worker的连接、队列与流状态（健康检查与多路复用状态推送共用）"""
+    return {
+        "pid": os.getpid(),
+        "shared_state": shared_state.get_stats(),
+        "resumable_streams": stream_registry.get_stats(),
+        "send_queues": channel_registry.get_stats(),
+        "websockets": manager.get_stats(),
+        "heartbeat": heartbeat_monitor.get_stats(),
+        "admission": admission_controller.get_stats(),
+        "quota": quota_manager.get_stats(),
+        "batch": get_batch_runner().get_stats(),
+        "benchmark": get_model_benchmark().get_stats(),
+        "group_chat": get_group_chat_handler(provider_manager).get_stats(),
+        "mux": get_mux_stats()
     }
 
 
@@ -612,6 +817,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
     allow_headers=["*"],
+    expose_headers=["X-Stream-Id"],
 )
 
 # 添加验证路由
@@ -619,45 +825,119 @@ app.include_router(verify_router)
 
 # 连接管理器
 class ConnectionManager:
+    """
+    WebSocket连接管理器
+
+    每个连接有独立的发送任务与有界队列（见 backpressure.py）：单发与广播只入队，
+    广播对每个连接是一次不等待的入队，耗时与最慢的客户端无关；
+    队列溢出或单条消息发送超过 WS_SEND_TIMEOUT 的连接被移除并以1013关闭。
+    """
+    
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Dict[WebSocket, ConnectionWriter] = {}
         self.user_connections: Dict[str, WebSocket] = {}
+        # 各连接协商的消息编码（见 ws_codec.py）
+        self.codecs: Dict[WebSocket, WireCodec] = {}
+        self.metrics = {'evicted_overflow': 0, 'evicted_timeout': 0, 'send_errors': 0}
 
     async def connect(self, websocket: WebSocket, user_id: str = None):
-        await websocket.accept()
-        self.active_connections.append(websocket)
+        codec = await accept_websocket(websocket)
+        self.codecs[websocket] = codec
+        writer = ConnectionWriter(
+            f"ws-user:{user_id or id(websocket)}", lambda frame: codec.send_frame(websocket, frame),
+            config.ws_queue_size, config.ws_backpressure_policy,
+            on_close=lambda reason: self._writer_closed(websocket, user_id, reason),
+            send_timeout=config.ws_send_timeout
+        )
+        self.active_connections[websocket] = writer
+        writer.start()
+        heartbeat_monitor.register(
+            websocket, 'user', writer.send_nowait,
+            lambda: self._reaped(websocket, user_id)
+        )
+        drain_controller.on_drain(
+            lambda hint: writer.send_nowait(codec.encode(hint)),
+            lambda: writer.channel.close(CLOSE_DRAINING)
+        )
         if user_id:
             self.user_connections[user_id] = websocket
         logger.info(f"WebSocket连接建立，当前连接数: {len(self.active_connections)}")
 
     def disconnect(self, websocket: WebSocket, user_id: str = None):
-        if websocket in self.active_connections:
-            self.active_connections.remove(websocket)
-        if user_id and user_id in self.user_connections:
+        heartbeat_monitor.unregister(websocket)
+        writer = self.active_connections.pop(websocket, None)
+        self.codecs.pop(websocket, None)
+        if user_id and self.user_connections.get(user_id) is websocket:
             del self.user_connections[user_id]
-        logger.info(f"WebSocket连接断开，当前连接数: {len(self.active_connections)}")
-
-    async def send_personal_message(self, message: str, user_id: str):
-        if user_id in self.user_connections:
-            websocket = self.user_connections[user_id]
+        if writer:
+            writer.close()
+            logger.info(f"WebSocket连接断开，当前连接数: {len(self.active_connections)}")
+
+    async def _reaped(self, websocket: WebSocket, user_id: Optional[str]):
+        """心跳判定连接失效并关闭后，从连接表移除"""
+        self.disconnect(websocket, user_id)
+
+    async def _writer_closed(self, websocket: WebSocket, user_id: Optional[str], reason: str):
+        """发送任务结束：移除连接，过慢或卡死的连接同时以1013关闭，排空时以1012关闭"""
+        if reason == CLOSE_DISCONNECTED:
+            return
+        if reason in (CLOSE_OVERFLOW, CLOSE_TIMEOUT):
+            self.metrics['evicted_overflow' if reason == CLOSE_OVERFLOW else 'evicted_timeout'] += 1
+        if reason in (CLOSE_OVERFLOW, CLOSE_TIMEOUT, CLOSE_DRAINING):
+            code = WS_CLOSE_SERVICE_RESTART if reason == CLOSE_DRAINING else WS_CLOSE_TRY_AGAIN_LATER
             try:
-                await websocket.send_text(message)
-            except Exception as e:
-                logger.error(f"发送个人消息失败: {e}")
-                self.disconnect(websocket, user_id)
+                await asyncio.wait_for(websocket.close(code=code), 1)
+            except Exception:
+                pass
+        elif reason == CLOSE_ERROR:
+            self.metrics['send_errors'] += 1
+        self.disconnect(websocket, user_id)
+
+    async def receive(self, websocket: WebSocket) -> Any:
+        """按连接协商的编码接收一条消息"""
+        return await self.codecs.get(websocket, json_codec).receive(websocket)
+
+    async def send(self, websocket: WebSocket, message: str) -> bool:
+        """放入连接的发送队列（按 WS_BACKPRESSURE_POLICY 处理队列已满；JSON文本在发送时按连接的编码转换）"""
+        writer = self.active_connections.get(websocket)
+        return await writer.send(message) if writer else False
 
-    async def broadcast(self, message: str):
-        disconnected = []
-        for connection in self.active_connections:
-            try:
-                await connection.send_text(message)
-            except Exception as e:
-                logger.error(f"广播消息失败: {e}")
-                disconnected.append(connection)
-        
-        # 清理断开的连接
-        for connection in disconnected:
-            self.disconnect(connection)
+    async def send_personal_message(self, message: str, user_id: str):
+        websocket = self.user_connections.get(user_id)
+        if websocket is not None:
+            await self.send(websocket, message)
+
+    async def broadcast(self, message: str) -> int:
+        """
+        广播：对每个连接做一次不等待的入队（每种编码只编码一次）
+
+        Returns:
+            接收该消息的连接数（队列已满的连接被移除）
+        """
+        delivered = 0
+        frames: Dict[str, Any] = {}
+        for websocket, writer in list(self.active_connections.items()):
+            codec = self.codecs.get(websocket, json_codec)
+            frame = frames.get(codec.name)
+            if frame is None:
+                frame = frames[codec.name] = codec.encode(text=message)
+            if writer.send_nowait(frame):
+                delivered += 1
+        return delivered
+
+    def get_stats(self) -> dict:
+        depths = [writer.channel.depth for writer in self.active_connections.values()]
+        by_codec: Dict[str, int] = {}
+        for codec in self.codecs.values():
+            by_codec[codec.name] = by_codec.get(codec.name, 0) + 1
+        return {
+            'connections': len(depths),
+            'users': len(self.user_connections),
+            'by_codec': by_codec,
+            'queued_messages': sum(depths),
+            'max_depth': max(depths, default=0),
+            **self.metrics
+        }
 
 manager = ConnectionManager()
 
@@ -926,7 +1206,7 @@ async def login(user_data: UserLogin):
         # 暂时返回模拟token
         if user_data.username == "admin" and user_data.password == "admin123":
             token = str(uuid.uuid4())
-            return {
+            response = {
                 "success": True,
                 "token": token,
                 "user": {
@@ -937,7 +1217,7 @@ async def login(user_data: UserLogin):
             }
         elif user_data.username == "user1" and user_data.password == "user123":
             token = str(uuid.uuid4())
-            return {
+            response = {
                 "success": True,
                 "token": token,
                 "user": {
@@ -948,7 +1228,7 @@ async def login(user_data: UserLogin):
             }
         elif user_data.username == "demo" and user_data.password == "demo123":
             token = str(uuid.uuid4())
-            return {
+            response = {
                 "success": True,
                 "token": token,
                 "user": {
@@ -959,6 +1239,9 @@ async def login(user_data: UserLogin):
             }
         else:
             raise HTTPException(status_code=401, detail="用户名或密码错误")
+        # 登记token，生成请求据此按用户计算配额
+        await register_token(token, response["user"])
+        return response
     except HTTPException as e:
         # 显式捕获HTTPException并重新抛出
         raise e
@@ -1679,37 +1962,78 @@ async def cline_generate(request: CodeGenerateRequest):
         logger.error(f"代码生成请求失败: {e}")
         return {"success": False, "error": f"代码生成请求失败: {str(e)}"}
 
+async def create_chat_response(request: dict, owner: str = '') -> StreamingResponse:
+    """按 /api/chat/stream 的请求体开始单聊或群聊生成（参数错误时抛出HTTPException；owner 为服务端会话的所属用户）"""
+    query = request.get('query', '')
+    chat_mode = request.get('chat_mode', 'single')  # 'single' 或 'group'
+    provider_name = request.get('provider', 'openrouter')
+    provider_config = request.get('config', {})
+    group_settings = request.get('group_settings', {})
+    
+    logger.info(f"收到流式请求: query={query}, mode={chat_mode}, provider={provider_name}")
+    
+    if not query:
+        raise HTTPException(status_code=400, detail="缺少query参数")
+    
+    # 单聊模式
+    if chat_mode == 'single':
+        if not provider_config:
+            raise HTTPException(status_code=400, detail="单聊模式缺少provider配置")
+        
+        use_cache = request.get('use_cache', True)
+        # 携带 conversation_id 字段（为空表示新建）时使用服务端会话历史
+        response = await handle_single_chat(
+            query, provider_name, provider_config, use_cache,
+            conversation_id=request.get('conversation_id'),
+            use_conversation='conversation_id' in request,
+            system_prompt=request.get('system_prompt', ''),
+            owner=owner
+        )
+    
+    # 群聊模式
+    elif chat_mode == 'group':
+        if not group_settings.get('selectedProviders'):
+            raise HTTPException(status_code=400, detail="群聊模式缺少选择的providers")
+        
+        response = await handle_group_chat(query, group_settings)
+    
+    else:
+        raise HTTPException(status_code=400, detail=f"不支持的聊天模式: {chat_mode}")
+    
+    return response
+
 @app.post("/api/chat/stream")
-async def stream_chat_with_config(request: dict):
-    """POST方式的流式聊天API，支持单聊和群聊模式"""
+async def stream_chat_with_config(request: dict, http_request: Request):
+    """
+    POST方式的流式聊天API，支持单聊和群聊模式
+
+    每个事件带有 "{stream_id}:{seq}" 格式的id，断线后带 Last-Event-ID 请求头重连即可续传；
+    带 Idempotency-Key 请求头（或 idempotency_key 字段）的重试复用同一次生成。
+    """
     try:
-        query = request.get('query', '')
-        chat_mode = request.get('chat_mode', 'single')  # 'single' 或 'group'
-        provider_name = request.get('provider', 'openrouter')
-        provider_config = request.get('config', {})
-        group_settings = request.get('group_settings', {})
-        
-        logger.info(f"收到POST流式请求: query={query}, mode={chat_mode}, provider={provider_name}")
-        
-        if not query:
-            raise HTTPException(status_code=400, detail="缺少query参数")
-        
-        # 单聊模式
-        if chat_mode == 'single':
-            if not provider_config:
-                raise HTTPException(status_code=400, detail="单聊模式缺少provider配置")
-            
-            return await handle_single_chat(query, provider_name, provider_config)
-        
-        # 群聊模式
-        elif chat_mode == 'group':
-            if not group_settings.get('selectedProviders'):
-                raise HTTPException(status_code=400, detail="群聊模式缺少选择的providers")
-            
-            return await handle_group_chat(query, group_settings)
-        
-        else:
-            raise HTTPException(status_code=400, detail=f"不支持的聊天模式: {chat_mode}")
+        # 断线重连：生成仍在缓冲中时从断点续传，否则按新请求处理
+        last_event_id = http_request.headers.get('last-event-id')
+        if last_event_id:
+            resumed = stream_registry.resume(last_event_id)
+            if resumed:
+                return resumed
+            logger.info(f"续传的生成已过期或不在本worker: {last_event_id}，重新生成")
+        
+        idempotency_key = http_request.headers.get('idempotency-key') or request.get('idempotency_key')
+        fingerprint = None
+        if idempotency_key:
+            fingerprint = request_fingerprint(request)
+            existing = stream_registry.find(idempotency_key)
+            if existing:
+                if existing.fingerprint != fingerprint:
+                    raise HTTPException(status_code=409, detail="Idempotency-Key已用于内容不同的请求")
+                return stream_registry.replay(existing)
+        
+        identity = await identify(http_request.scope)
+        response = await create_chat_response(request, identity.user_id)
+        
+        # 生成在后台进行，客户端断开后继续写入重放缓冲
+        return stream_registry.attach(response, idempotency_key, fingerprint)
             
     except HTTPException as e:
         raise e
@@ -1717,10 +2041,115 @@ async def stream_chat_with_config(request: dict):
         logger.error(f"流式响应失败: {e}")
         raise HTTPException(status_code=500, detail=f"流式响应失败: {str(e)}")
 
-async def handle_single_chat(query: str, provider_name: str, provider_config: dict):
-    """处理单聊模式"""
-    # 构建消息格式
-    messages = [{"role": "user", "content": query}]
+@app.get("/api/chat/stream/{stream_id}/watch")
+async def watch_chat_stream(stream_id: str):
+    """观看进行中或宽限期内的生成（如演示时多人同看）：从头补齐后实时接收，不再调用上游"""
+    stream = stream_registry.watch(stream_id)
+    if not stream:
+        raise HTTPException(status_code=404, detail="生成已过期或不在本worker")
+    return stream_registry.response(stream, 0)
+
+@app.get("/api/chat/stream/resume")
+async def resume_chat_stream(http_request: Request):
+    """按 Last-Event-ID 请求头（或 last_event_id 参数）续传进行中或宽限期内的生成，可直接用于EventSource"""
+    last_event_id = http_request.headers.get('last-event-id') or http_request.query_params.get('last_event_id')
+    if not parse_last_event_id(last_event_id):
+        raise HTTPException(status_code=400, detail="缺少或无法解析Last-Event-ID")
+    resumed = stream_registry.resume(last_event_id)
+    if not resumed:
+        raise HTTPException(status_code=404, detail="生成已过期或不在本worker，请重新发起请求")
+    return resumed
+
+async def run_mux_chat(stream: MuxStream, params: dict):
+    """
+    多路复用连接上的单聊/群聊流：params 与 /api/chat/stream 的请求体相同
+
+    生成同样在后台进行并写入重放缓冲，params 带 last_event_id 时续传，带 idempotency_key 时复用同一次生成；
+    连接断开时生成继续（宽限期内可在新连接上续传），客户端取消该流时同时取消生成。
+    """
+    resumable, after_seq = None, 0
+    parsed = parse_last_event_id(params.get('last_event_id'))
+    if parsed:
+        resumable, after_seq = stream_registry.get(parsed[0]), parsed[1]
+        if resumable:
+            resumable.resumes += 1
+            stream_registry.metrics['resumed'] += 1
+        else:
+            after_seq = 0
+    request = {key: value for key, value in params.items() if key != 'last_event_id'}
+    idempotency_key = request.get('idempotency_key')
+    fingerprint = request_fingerprint(request) if idempotency_key else None
+    if resumable is None and idempotency_key:
+        resumable = stream_registry.find(idempotency_key)
+        if resumable:
+            if resumable.fingerprint != fingerprint:
+                raise HTTPException(status_code=409, detail="Idempotency-Key已用于内容不同的请求")
+            stream_registry.metrics['idempotent_replays'] += 1
+    if resumable is None:
+        await admit_current()
+        # 后台生成接管名额，直到生成结束
+        async with admission_controller.slot(normalize_priority(request.pop('priority', None))):
+            identity = await identify(stream.connection.websocket.scope)
+            response = await create_chat_response(request, identity.user_id)
+            resumable = stream_registry.start(response.body_iterator, idempotency_key, fingerprint)
+    
+    try:
+        await emit_resumable(stream, resumable, after_seq)
+    finally:
+        if stream.cancelled:
+            resumable.cancel()
+
+async def emit_resumable(stream: MuxStream, resumable: ResumableStream, after_seq: int = 0):
+    """把生成中序号大于 after_seq 的事件作为数据帧发送（本流是该生成的一个订阅者）"""
+    events = resumable.events(after_seq)
+    try:
+        async for event in events:
+            event_id, data = parse_sse_event(event)
+            if event_id:
+                await stream.emit(data, id=event_id)
+            else:
+                await stream.emit(data)
+    finally:
+        await events.aclose()
+
+async def run_mux_status(stream: MuxStream, params: dict):
+    """多路复用连接上的状态推送流：每 interval 秒（至少1秒）发送一次本worker的状态"""
+    interval = max(1.0, float(params.get('interval', 5)))
+    while True:
+        await stream.emit({'type': 'status', 'timestamp': datetime.now().isoformat(), 'worker': worker_status()})
+        await asyncio.sleep(interval)
+
+async def run_mux_group(stream: MuxStream, params: dict):
+    """多路复用连接上的群聊会话流：等同于 /ws/group-chat/{session_id}，data 帧即原WebSocket消息"""
+    session_id = params.get('session_id') or str(uuid.uuid4())
+    handler = get_group_chat_handler(provider_manager)
+    await handler.handle_mux_stream(stream, session_id)
+
+async def run_mux_watch(stream: MuxStream, params: dict):
+    """
+    多路复用连接上的观看流（只读，不调用上游）
+
+    params 带 session_id（可选 last_seq）时观看群聊会话，带 stream_id 时观看进行中的单聊/群聊生成（从头补齐）
+    """
+    if params.get('session_id'):
+        handler = get_group_chat_handler(provider_manager)
+        await handler.handle_mux_watch(stream, params['session_id'], int(params.get('last_seq') or 0))
+        return
+    resumable = stream_registry.watch(params.get('stream_id') or '')
+    if not resumable:
+        raise HTTPException(status_code=404, detail="生成已过期或不在本worker")
+    await emit_resumable(stream, resumable)
+
+# 注册多路复用流类型
+register_kind('chat', run_mux_chat)
+register_kind('group', run_mux_group)
+register_kind('status', run_mux_status)
+register_kind('watch', run_mux_watch)
+
+async def handle_single_chat(query: str, provider_name: str, provider_config: dict, use_cache: bool = True,
+                             conversation_id: Optional[str] = None, use_conversation: bool = False,
+                             system_prompt: str = '', owner: str = ''):
+    """处理单聊模式（use_conversation 时使用服务端保存的、属于 owner 的会话历史）"""
     
     # 根据provider类型创建临时配置
     provider_type_map = {
@@ -1753,55 +2182,138 @@ async def handle_single_chat(query: str, provider_name: str, provider_config: di
         from providers.openai import OpenAIProvider
         temp_provider = OpenAIProvider(temp_config)
     
+    # 确保模型名称不包含提供商前缀
+    model_name = temp_config.default_model or ''
+    if ':' in model_name:
+        model_name = model_name.split(':', 1)[1]
+    
+    # 生成参数（配置未指定的取该提供商的默认值，同时参与缓存键计算）
+    chat_params = temp_provider.completion_params(
+        temperature=provider_config.get('temperature'),
+        max_tokens=provider_config.get('max_tokens')
+    )
+    
+    # 服务端会话：客户端只上传本轮用户消息
+    conversation = None
+    if use_conversation:
+        try:
+            conversation = await conversation_store.get_or_create(
+                conversation_id, provider_name, model_name, owner, system_prompt
+            )
+        except ConversationNotFound as e:
+            raise HTTPException(status_code=404, detail=str(e))
+        except ConversationConflict as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    
+    # 近似重复缓存需在端点级别显式开启
+    use_near_dup = use_cache and near_duplicate_cache.is_enabled('chat_stream')
+    
     # 流式响应生成器
     async def generate():
+        if conversation is None:
+            async for event in generate_turn([{"role": "user", "content": query}]):
+                yield event
+            return
+        # 同一会话的多轮请求串行执行，保证历史顺序
+        async with conversation.lock:
+            async for event in generate_turn(conversation.build_messages(query)):
+                yield event
+    
+    async def generate_turn(messages: List[Dict[str, str]]):
         import time
         start_time = time.time()
-        first_token_time = None
-        total_tokens = 0
-        content_length = 0
+        
+        # 响应缓存键（会话模式下包含完整历史）
+        cache_key = None
+        if use_cache and response_cache.enabled:
+            cache_key = ResponseCache.make_key(
+                provider_name, model_name, messages,
+                base_url=temp_config.base_url, **chat_params
+            )
         
         try:
-            yield f"data: {json.dumps({'type': 'start'})}\n\n"
-            
-            # 确保模型名称不包含提供商前缀
-            model_name = temp_config.default_model
-            if ':' in model_name:
-                model_name = model_name.split(':', 1)[1]
+            start_event = {'type': 'start'}
+            if conversation is not None:
+                start_event['conversation_id'] = conversation.conversation_id
+            yield f"data: {json.dumps(start_event)}\n\n"
+            
+            # 缓存命中：直接全速回放，不调用上游
+            cached, cache_type = None, 'exact'
+            if cache_key:
+                cached = await response_cache.get(cache_key)
+            if not cached and use_near_dup:
+                cached = near_duplicate_cache.lookup(
+                    provider_name, model_name, messages,
+                    base_url=temp_config.base_url, **chat_params
+                )
+                cache_type = 'near_duplicate'
+            if cached:
+                logger.info(f"响应缓存命中({cache_type}): provider={provider_name}, model={model_name}")
+                data = {
+                    "type": "content",
+                    "content": cached['content'],
+                    "cache_hit": True
+                }
+                yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+                stats = build_cache_hit_stats(cached, time.time() - start_time, cache_type)
+                if conversation is not None:
+                    stats['conversation'] = save_conversation_turn(cached['content'])
+                yield f"data: {json.dumps(stats, ensure_ascii=False)}\n\n"
+                yield f"data: {json.dumps({'type': 'end'})}\n\n"
+                return
             
             logger.info(f"使用模型名称: {model_name}")
             
+            stats_collector = TokenStatsCollector(model_name)
+            stats_collector.start_timing()
+            response_content = ""
+            usage_info = None
+            verify_request_id = uuid.uuid4().hex
+            token_verifier.log_api_request(provider_name, model_name, messages, verify_request_id)
+            
             async for chunk in temp_provider.chat_completion(
                 messages=messages,
                 model=model_name,
-                stream=True
+                stream=True,
+                **chat_params
             ):
+                if chunk.usage:
+                    usage_info = chunk.usage
                 if chunk.content:
+                    stats_collector.record_chunk(chunk.content)
+                    response_content += chunk.content
                     data = {
                         "type": "content",
                         "content": chunk.content
                     }
                     yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
             
-            # 计算总耗时和性能数据
-            total_time = time.time() - start_time
-            tokens_per_second = total_tokens / total_time if total_time > 0 else 0
-            
-            # 估算输入token数量
-            input_text = ' '.join([msg['content'] for msg in messages])
-            input_tokens = len(input_text) // 2 if any('\u4e00' <= c <= '\u9fff' for c in input_text) else len(input_text) // 4
-            input_tokens = max(10, input_tokens)  # 最少10个token
-            
-            total_all_tokens = input_tokens + total_tokens
-            
-            # 费用计算（以DeepSeek为例：输入¥0.0014/1K tokens，输出¥0.0028/1K tokens）
-            input_cost = (input_tokens / 1000) * 0.0014
-            output_cost = (total_tokens / 1000) * 0.0028
-            total_cost_usd = input_cost + output_cost
-            # 获取当前汇率
-            usd_to_cny_rate = get_current_usd_to_cny_rate()
-            total_cost_cny = total_cost_usd * usd_to_cny_rate  # 美元转人民币汇率
-            
+            # 部分提供商在流式最后一块返回usage，用于校准估算系数
+            token_verifier.log_api_response(verify_request_id, response_content, usage_info)
+            
+            # 统计性能与费用
+            stats = stats_collector.get_stats(messages, usage_info)
+            stats['cache_hit'] = False
+            stats['quota'] = await record_usage(stats['tokens']['total_tokens'])
+            if conversation is not None and response_content:
+                stats['conversation'] = save_conversation_turn(response_content)
+            yield f"data: {json.dumps(stats, ensure_ascii=False)}\n\n"
+            
+            # 写入响应缓存
+            if response_content:
+                cache_entry = {
+                    "provider": provider_name,
+                    "model": model_name,
+                    "content": response_content,
+                    "tokens": stats['tokens']
+                }
+                if cache_key:
+                    await response_cache.set(cache_key, cache_entry)
+                if use_near_dup:
+                    near_duplicate_cache.add(
+                        provider_name, model_name, messages, cache_entry,
+                        base_url=temp_config.base_url, **chat_params
+                    )
             
             yield f"data: {json.dumps({'type': 'end'})}\n\n"
             
@@ -1809,6 +2321,12 @@ async def handle_single_chat(query: str, provider_name: str, provider_config: di
             logger.error(f"单聊流式生成失败: {e}")
             error_data = {"type": "error", "error": str(e)}
             yield f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n"
+    
+    def save_conversation_turn(response_content: str) -> dict:
+        """本轮成功后写入会话历史，返回会话状态"""
+        conversation.append_turn(query, response_content)
+        conversation_store.save(conversation)
+        return conversation.to_dict(include_messages=False)
             
     return StreamingResponse(generate(), media_type='text/event-stream', headers={
         'Cache-Control': 'no-cache',
@@ -2000,8 +2518,8 @@ async def handle_discussion_mode(query: str, provider_configs: dict, system_prom
         try:
             yield f"data: {json.dumps({'type': 'start', 'mode': 'discussion'})}\n\n"
             
-            # 初始消息
-            conversation = [{"role": "user", "content": query}]
+            # 多轮讨论记录：固定前缀 + 依次追加的发言
+            transcript = DiscussionTranscript(query, system_prompt)
             
             # AI名称映射 - 使用模型名称
             ai_names = {
@@ -2011,8 +2529,6 @@ async def handle_discussion_mode(query: str, provider_configs: dict, system_prom
                 'glm': '智谱GLM'
             }
             
-            previous_responses = []  # 存储之前的回复用于引用
-            
             # 按顺序调用每个provider
             for i, (provider_key, config_data) in enumerate(provider_configs.items()):
                 import time
@@ -2076,33 +2592,22 @@ async def handle_discussion_mode(query: str, provider_configs: dict, system_prom
                 yield f"data: {json.dumps({'type': 'provider_start', 'provider': provider_name, 'ai_name': ai_name, 'index': i})}\n\n"
                 
                 try:
-                    # 构建包含讨论上下文的提示词
-                    discussion_messages = []
+                    # 构建讨论提示词（之前的发言作为不变的前缀）
+                    discussion_messages = transcript.messages_for(ai_name)
                     
-                    # 添加系统提示词（如果有）
-                    if system_prompt:
-                        discussion_messages.append({"role": "system", "content": system_prompt})
-                    
-                    if i == 0:
-                        # 第一个AI，直接回答问题
-                        discussion_messages.append({"role": "user", "content": f"请{ai_name}回答以下问题: {query}"})
-                    else:
-                        # 后续AI，可以看到前面的讨论
-                        discussion_context = f"以下是关于问题「{query}」的讨论:\n\n"
-                        for j, msg in enumerate(conversation[1:], 1):  # 跳过原始用户问题
-                            if msg['role'] == 'assistant':
-                                discussion_context += f"{msg['content']}\n\n"
-                        
-                        discussion_context += f"现在请{ai_name}发表你的观点，你可以参考或回应之前的观点："
-                        discussion_messages.append({"role": "user", "content": discussion_context})
+                    # 长时间的讨论每位发言者调用前都检查token配额，超出时该发言者报错
+                    await check_tokens()
                     
                     # 获取当前provider的回复
                     response_content = ""
+                    usage_info = None
                     async for chunk in provider.chat_completion(
                         messages=discussion_messages,
                         model=temp_config.default_model,
                         stream=True
                     ):
+                        if chunk.usage:
+                            usage_info = chunk.usage
                         if chunk.content:
                             response_content += chunk.content
                             data = {
@@ -2114,27 +2619,26 @@ async def handle_discussion_mode(query: str, provider_configs: dict, system_prom
                             }
                             yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
                     
-                    # 将这个回复添加到对话历史中
+                    # 将这个回复添加到讨论记录中
                     if response_content:
-                        conversation.append({
-                            "role": "assistant", 
-                            "content": f"[{ai_name}]: {response_content}"
-                        })
+                        transcript.add_answer(ai_name, response_content, temp_config.default_model)
                     
                     # 标记当前provider回复完成
                     # 导入修复补丁
                     from group_chat_fix import calculate_performance_and_tokens, format_group_chat_event
                     
-                    # 计算性能统计和token信息
+                    # 计算性能统计和token信息（有真实usage时报告缓存命中的输入token）
                     provider_end_data = calculate_performance_and_tokens(
                         start_time if 'start_time' in locals() else time.time() - 1.0,
                         response_content, 
                         discussion_messages, 
                         provider_name, 
                         ai_name, 
-                        temp_config.default_model
+                        temp_config.default_model,
+                        usage=usage_info
                     )
                     provider_end_data['index'] = i
+                    provider_end_data['quota'] = await record_usage(provider_end_data['tokens']['total'])
                     yield format_group_chat_event(provider_end_data)
                     
                 except Exception as e:
@@ -2253,16 +2757,31 @@ async def websocket_endpoint(websocket: WebSocket, user_id: str):
     await manager.connect(websocket, user_id)
     try:
         while True:
-            data = await websocket.receive_text()
-            message_data = json.loads(data)
+            message_data = await manager.receive(websocket)
+            message_type = message_data.get("type")
+            heartbeat_monitor.touch(websocket, activity=message_type not in ("ping", "pong"))
             
             # 处理不同类型的WebSocket消息
-            if message_data.get("type") == "chat":
-                await handle_websocket_chat(websocket, user_id, message_data)
-            elif message_data.get("type") == "ping":
-                await websocket.send_text(json.dumps({"type": "pong", "timestamp": time.time()}))
+            if message_type == "chat":
+                try:
+                    await admit_current()
+                    async with drain_controller.turn(), heartbeat_monitor.busy(websocket), \
+                            admission_controller.slot(normalize_priority(message_data.get("priority"))):
+                        await handle_websocket_chat(websocket, user_id, message_data)
+                except (AdmissionRejected, QuotaExceeded) as e:
+                    await manager.send(websocket, json.dumps({
+                        "type": "error",
+                        "message": str(e),
+                        "reason": e.reason,
+                        "retryAfter": e.retry_after
+                    }, ensure_ascii=False))
+            elif message_type == "ping":
+                await manager.send(websocket, json.dumps({"type": "pong", "timestamp": time.time()}))
+            elif message_type == "pong":
+                # 服务端心跳的回复
+                pass
             else:
-                await websocket.send_text(json.dumps({"error": "未知消息类型"}))
+                await manager.send(websocket, json.dumps({"error": "未知消息类型"}))
                 
     except WebSocketDisconnect:
         manager.disconnect(websocket, user_id)
@@ -2278,7 +2797,7 @@ async def handle_websocket_chat(websocket: WebSocket, user_id: str, message_data
         chat_request = ChatRequest(**message_data.get("data", {}))
         
         # 发送开始响应标识
-        await websocket.send_text(json.dumps({
+        await manager.send(websocket, json.dumps({
             "type": "chat_start",
             "timestamp": time.time()
         }))
@@ -2288,20 +2807,20 @@ async def handle_websocket_chat(websocket: WebSocket, user_id: str, message_data
             if chunk_data.startswith("data: "):
                 chunk_json = chunk_data[6:].strip()
                 if chunk_json and chunk_json != "[DONE]":
-                    await websocket.send_text(json.dumps({
+                    await manager.send(websocket, json.dumps({
                         "type": "chat_chunk",
                         "data": json.loads(chunk_json)
                     }))
         
         # 发送结束标识
-        await websocket.send_text(json.dumps({
+        await manager.send(websocket, json.dumps({
             "type": "chat_end",
             "timestamp": time.time()
         }))
         
     except Exception as e:
         logger.error(f"WebSocket聊天处理失败: {e}")
-        await websocket.send_text(json.dumps({
+        await manager.send(websocket, json.dumps({
             "type": "error",
             "message": f"聊天处理失败: {str(e)}"
         }))
@@ -5,7 +5,59 @@
 
 import time
 import json
-from typing import Dict, Any
+from typing import Dict, Any, List, Optional, Tuple
+
+from config import config
+from tokenizer_service import tokenizer_service
+from utils.exchange_rate import get_current_usd_to_cny_rate
+
+
+class DiscussionTranscript:
+    """
+    讨论模式的多轮消息记录
+
+    提示词结构为固定前缀 + 依次追加的发言：
+        [系统提示词] [问题] [发言1] [发言2] ... [本轮指令]
+    之前的发言一旦加入就不再改写，后续每位参与者的提示词只在末尾追加，
+    前缀保持不变，提供商侧的前缀缓存可以命中；输入token随参与者数线性增长，
+    而不是每轮重新拼接全部历史。每条发言在加入时按预算截断一次。
+
+    对当前参与者来说，自己之前的发言以 assistant 角色发送，其他参与者的发言
+    与指令以 user 角色发送，相邻的 user 内容合并为一条，保持 user/assistant 交替。
+    """
+
+    def __init__(self, query: str, system_prompt: str = '', answer_max_tokens: Optional[int] = None):
+        self.answer_max_tokens = answer_max_tokens or config.discussion_answer_max_tokens
+        self.system_prompt = system_prompt
+        self.question = f"以下问题将由多位AI依次发言讨论，每位发言者都能看到之前的发言。\n\n问题：{query}"
+        # (发言者, 截断后的发言)
+        self.turns: List[Tuple[str, str]] = []
+
+    def messages_for(self, ai_name: str) -> List[Dict[str, str]]:
+        """构建当前参与者的消息列表（只有最后一条指令随参与者变化）"""
+        if self.turns:
+            instruction = f"现在请{ai_name}发表你的观点，你可以参考或回应之前的观点。"
+        else:
+            instruction = f"请{ai_name}首先回答这个问题。"
+        messages = [{"role": "system", "content": self.system_prompt}] if self.system_prompt else []
+        pending = [self.question]
+        for speaker, content in self.turns:
+            if speaker == ai_name:
+                messages.append({"role": "user", "content": "\n\n".join(pending)})
+                messages.append({"role": "assistant", "content": content})
+                pending = []
+            else:
+                pending.append(f"[{speaker}]: {content}")
+        pending.append(instruction)
+        messages.append({"role": "user", "content": "\n\n".join(pending)})
+        return messages
+
+    def add_answer(self, ai_name: str, content: str, model: Optional[str] = None):
+        """记录一位参与者的发言，超出预算的部分截断后固定下来"""
+        trimmed = tokenizer_service.truncate_text(content, self.answer_max_tokens, model)
+        if len(trimmed) < len(content):
+            trimmed += "……（后文已省略）"
+        self.turns.append((ai_name, trimmed))
 
 def calculate_performance_and_tokens(
     start_time: float,
@@ -13,26 +65,34 @@ def calculate_performance_and_tokens(
     discussion_messages: list,
     provider_name: str,
     ai_name: str,
-    model: str
+    model: str,
+    usage: Optional[Dict[str, int]] = None
 ) -> Dict[str, Any]:
     """
     计算性能统计和token信息
+
+    提供商返回了usage时使用真实token数，并报告命中提示词缓存的输入token
     """
     end_time = time.time()
     response_time = end_time - start_time
     first_token_time = 0.3  # 模拟首字延迟
     
-    # 简单的token估算
-    input_text = ' '.join([msg['content'] for msg in discussion_messages])
-    input_tokens = int(len(input_text.split()) * 1.3)
-    output_tokens = int(len(response_content.split()) * 1.3)
+    # token统计
+    if usage:
+        input_tokens = usage.get('prompt_tokens', 0)
+        output_tokens = usage.get('completion_tokens', 0)
+    else:
+        input_tokens = tokenizer_service.count_messages(discussion_messages, model)
+        output_tokens = tokenizer_service.count_text(response_content, model)
+    cache_read_tokens = (usage or {}).get('cache_read_input_tokens', 0)
     total_tokens = input_tokens + output_tokens
     tokens_per_second = output_tokens / response_time if response_time > 0 else 0
     
-    # 费用计算（根据不同provider调整）
+    # 费用计算（根据不同provider调整），汇率与单聊统计相同
+    usd_to_cny_rate = get_current_usd_to_cny_rate()
     if provider_name == 'deepseek':
-        input_cost_per_1k = 0.0014 / 7.2  # DeepSeek定价转USD
-        output_cost_per_1k = 0.0028 / 7.2
+        input_cost_per_1k = 0.0014 / usd_to_cny_rate  # DeepSeek定价转USD
+        output_cost_per_1k = 0.0028 / usd_to_cny_rate
     elif provider_name == 'openai':
         input_cost_per_1k = 0.0015
         output_cost_per_1k = 0.002
@@ -40,9 +100,10 @@ def calculate_performance_and_tokens(
         input_cost_per_1k = 0.0015
         output_cost_per_1k = 0.002
     
-    input_cost = (input_tokens / 1000) * input_cost_per_1k
+    # 命中缓存的输入token按半价估算
+    input_cost = ((input_tokens - cache_read_tokens * 0.5) / 1000) * input_cost_per_1k
     output_cost = (output_tokens / 1000) * output_cost_per_1k
-    total_cost_cny = (input_cost + output_cost) * 7.2  # 汇率转换
+    total_cost_cny = (input_cost + output_cost) * usd_to_cny_rate  # 汇率转换
     
     return {
         'type': 'groupChatProviderEnd', 
@@ -59,6 +120,9 @@ def calculate_performance_and_tokens(
             'input': input_tokens,
             'output': output_tokens,
             'total': total_tokens,
+            'cache_read_input_tokens': cache_read_tokens,
+            'cache_creation_input_tokens': (usage or {}).get('cache_creation_input_tokens', 0),
+            'source': 'provider' if usage else 'estimate',
             'input_cost': input_cost,
             'output_cost': output_cost,
             'total_cost_cny': total_cost_cny
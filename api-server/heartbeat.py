@@ -0,0 +1,196 @@
+"""
+WebSocket心跳与空闲连接回收
+
+被代理或移动网络静默断开的连接不会触发 WebSocketDisconnect，会一直留在连接表里。
+HeartbeatMonitor 定期检查所有已注册的连接：
+- 超过 interval 秒没有收到客户端任何消息时，发送 {"type": "ping"}（经连接的发送队列，不阻塞检查）
+- 发送ping后 timeout 秒内仍没有收到任何消息（客户端应回复 {"type": "pong"}），判定连接已失效，
+  关闭并回调 on_reap 清理连接表
+- 设置了 idle_timeout 时，超过该时间没有业务消息（ping/pong以外）的连接也被关闭
+
+另外，检查循环每轮调用注册的清理函数（如群聊处理器按空闲时间淘汰内存中的会话）。
+
+使用方法:
+    heartbeat_monitor.register(websocket, 'group_chat', send_nowait, on_reap)
+    heartbeat_monitor.touch(websocket, activity=message_type not in ('ping', 'pong'))
+    async with heartbeat_monitor.busy(websocket):
+        ...  # 处理一轮对话
+    heartbeat_monitor.unregister(websocket)
+"""
+
+import asyncio
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# WebSocket关闭码：连接失效或空闲被服务端关闭
+WS_CLOSE_GOING_AWAY = 1001
+
+
+class _Peer:
+    __slots__ = ('websocket', 'kind', 'send', 'on_reap', 'connected_at', 'last_seen', 'last_activity',
+                 'ping_sent_at', 'busy')
+
+    def __init__(self, websocket, kind: str, send: Callable[[str], bool],
+                 on_reap: Callable[[], Awaitable[Any]]):
+        now = time.monotonic()
+        self.websocket = websocket
+        self.kind = kind
+        self.send = send
+        self.on_reap = on_reap
+        self.connected_at = now
+        self.last_seen = now
+        self.last_activity = now
+        self.ping_sent_at: Optional[float] = None
+        # 正在处理的轮次数：处理期间接收循环不读取消息，收不到pong不代表连接失效
+        self.busy = 0
+
+
+class HeartbeatMonitor:
+    """服务端心跳：发送ping、回收无响应与空闲的连接"""
+
+    def __init__(self, interval: float = 25, timeout: float = 20, idle_timeout: float = 0):
+        self.interval = interval
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self.peers: Dict[int, _Peer] = {}
+        self._sweepers: List[Callable[[], Awaitable[Any]]] = []
+        self._task: Optional[asyncio.Task] = None
+        self.metrics = {
+            'pings_sent': 0,
+            'reaped_unresponsive': 0,
+            'reaped_idle': 0
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return self.interval > 0
+
+    def register(self, websocket, kind: str, send: Callable[[str], bool],
+                 on_reap: Callable[[], Awaitable[Any]]):
+        """
+        注册连接
+
+        Args:
+            send: 不等待的发送函数（放入连接的发送队列），返回是否入队
+            on_reap: 连接被判定失效或空闲并关闭后调用，用于清理连接表
+        """
+        self.peers[id(websocket)] = _Peer(websocket, kind, send, on_reap)
+        self._ensure_running()
+
+    def unregister(self, websocket):
+        self.peers.pop(id(websocket), None)
+
+    def touch(self, websocket, activity: bool = True):
+        """收到客户端消息（activity 为False表示只是ping/pong）"""
+        peer = self.peers.get(id(websocket))
+        if peer is None:
+            return
+        peer.last_seen = time.monotonic()
+        peer.ping_sent_at = None
+        if activity:
+            peer.last_activity = peer.last_seen
+
+    @asynccontextmanager
+    async def busy(self, websocket):
+        """标记连接正在处理一轮对话（期间不按ping超时回收，卡死的连接由发送超时处理）"""
+        peer = self.peers.get(id(websocket))
+        if peer is not None:
+            peer.busy += 1
+        try:
+            yield
+        finally:
+            if peer is not None:
+                peer.busy -= 1
+                peer.last_seen = time.monotonic()
+                peer.ping_sent_at = None
+
+    def add_sweeper(self, sweeper: Callable[[], Awaitable[Any]]):
+        """注册每轮检查时调用的清理函数"""
+        if sweeper not in self._sweepers:
+            self._sweepers.append(sweeper)
+        self._ensure_running()
+
+    def _ensure_running(self):
+        if not self.enabled and not self._sweepers:
+            return
+        if self._task is None or self._task.done():
+            try:
+                self._task = asyncio.get_running_loop().create_task(self._run())
+            except RuntimeError:
+                pass
+
+    async def _run(self):
+        # 关闭心跳时只执行清理函数
+        tick = max(0.5, min(self.interval, self.timeout) / 2) if self.enabled else 30
+        while True:
+            await asyncio.sleep(tick)
+            try:
+                await self.check()
+            except Exception as e:
+                logger.error(f"心跳检查失败: {e}")
+
+    async def check(self):
+        """检查一轮：发送ping、回收失效与空闲的连接、执行清理函数"""
+        now = time.monotonic()
+        for peer in list(self.peers.values()) if self.enabled else []:
+            if peer.busy:
+                continue
+            if peer.ping_sent_at is not None and now - peer.ping_sent_at > self.timeout:
+                await self._reap(peer, 'unresponsive')
+            elif self.idle_timeout and now - peer.last_activity > self.idle_timeout:
+                await self._reap(peer, 'idle')
+            elif peer.ping_sent_at is None and now - peer.last_seen >= self.interval:
+                peer.ping_sent_at = now
+                self.metrics['pings_sent'] += 1
+                if not peer.send(json.dumps({'type': 'ping', 'timestamp': time.time()})):
+                    # 发送队列已满或已关闭，连接同样视为失效
+                    await self._reap(peer, 'unresponsive')
+        for sweeper in list(self._sweepers):
+            await sweeper()
+
+    async def _reap(self, peer: _Peer, reason: str):
+        self.unregister(peer.websocket)
+        self.metrics[f'reaped_{reason}'] += 1
+        logger.info(f"回收{'无响应' if reason == 'unresponsive' else '空闲'}的WebSocket连接 ({peer.kind})")
+        try:
+            await asyncio.wait_for(peer.websocket.close(code=WS_CLOSE_GOING_AWAY), 1)
+        except Exception:
+            pass
+        try:
+            await peer.on_reap()
+        except Exception as e:
+            logger.error(f"回收连接后清理失败: {e}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        peers = list(self.peers.values())
+        by_kind: Dict[str, int] = {}
+        for peer in peers:
+            by_kind[peer.kind] = by_kind.get(peer.kind, 0) + 1
+        return {
+            'enabled': self.enabled,
+            'interval': self.interval,
+            'timeout': self.timeout,
+            'open': len(peers),
+            'by_kind': by_kind,
+            # 超过一个心跳间隔没有业务消息的连接
+            'idle': sum(1 for peer in peers if not peer.busy and now - peer.last_activity > (self.interval or 60)),
+            'busy': sum(1 for peer in peers if peer.busy),
+            'awaiting_pong': sum(1 for peer in peers if peer.ping_sent_at is not None),
+            **self.metrics
+        }
+
+
+# 全局心跳监视器实例
+heartbeat_monitor = HeartbeatMonitor(
+    interval=config.ws_heartbeat_interval,
+    timeout=config.ws_heartbeat_timeout,
+    idle_timeout=config.ws_idle_timeout
+)
@@ -0,0 +1,91 @@
+"""
+聊天历史API端点（分页、全文检索、导出）
+
+只返回当前用户（与单聊会话相同按 quota.identify 识别）初始化的群聊会话，其他用户的会话按不存在处理
+"""
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi.responses import StreamingResponse
+from session_store import session_store
+from quota import identify
+import logging
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+async def _owned_session(http_request: Request, session_id: str) -> str:
+    """检查会话属于当前用户，返回用户ID（不存在或属于其他用户时404）"""
+    identity = await identify(http_request.scope)
+    if not await session_store.owns(session_id, identity.user_id):
+        raise HTTPException(status_code=404, detail="会话不存在")
+    return identity.user_id
+
+@router.get("/api/history/sessions", tags=["聊天历史"], summary="分页列出会话")
+async def list_history_sessions(
+    http_request: Request,
+    limit: int = Query(20, ge=1, le=200),
+    cursor_updated_at: Optional[str] = Query(None, description="上一页返回的 next_cursor.updated_at"),
+    cursor_id: Optional[str] = Query(None, description="上一页返回的 next_cursor.id")
+):
+    """按最近更新时间倒序列出当前用户的会话"""
+    cursor = (cursor_updated_at, cursor_id) if cursor_updated_at is not None and cursor_id else None
+    identity = await identify(http_request.scope)
+    try:
+        return {"success": True, **await session_store.list_sessions(identity.user_id, cursor, limit)}
+    except Exception as e:
+        logger.error(f"获取会话列表失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取会话列表失败: {str(e)}")
+
+@router.get("/api/history/sessions/{session_id}/messages", tags=["聊天历史"], summary="分页获取会话消息")
+async def get_history_messages(
+    session_id: str,
+    http_request: Request,
+    limit: int = Query(50, ge=1, le=200),
+    before_id: Optional[int] = Query(None, description="获取该消息ID之前的更早消息"),
+    after_id: Optional[int] = Query(None, description="获取该消息ID之后的新消息")
+):
+    """默认返回最新一页消息，按时间顺序排列"""
+    await _owned_session(http_request, session_id)
+    try:
+        return {"success": True, **await session_store.get_messages(session_id, before_id, after_id, limit)}
+    except Exception as e:
+        logger.error(f"获取会话消息失败: {e}")
+        raise HTTPException(status_code=500, detail=f"获取会话消息失败: {str(e)}")
+
+@router.get("/api/history/search", tags=["聊天历史"], summary="全文检索消息")
+async def search_history(
+    http_request: Request,
+    q: str = Query(..., min_length=1, description="检索词，空格分隔的多个词需同时出现"),
+    session_id: Optional[str] = Query(None, description="只检索指定会话"),
+    limit: int = Query(20, ge=1, le=200),
+    before_id: Optional[int] = Query(None, description="上一页返回的 next_before_id")
+):
+    """在当前用户的会话中检索，按时间倒序返回匹配的消息"""
+    identity = await identify(http_request.scope)
+    try:
+        return {
+            "success": True,
+            **await session_store.search_messages(q, identity.user_id, session_id, before_id, limit)
+        }
+    except Exception as e:
+        logger.error(f"检索消息失败: {e}")
+        raise HTTPException(status_code=500, detail=f"检索消息失败: {str(e)}")
+
+@router.get("/api/history/sessions/{session_id}/export", tags=["聊天历史"], summary="导出会话消息（NDJSON）")
+async def export_history(session_id: str, http_request: Request):
+    """流式导出会话全部消息，每行一条JSON，适用于消息量很大的会话"""
+    await _owned_session(http_request, session_id)
+    return StreamingResponse(
+        session_store.export_messages(session_id),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{session_id}.ndjson"'}
+    )
+
+@router.delete("/api/history/sessions/{session_id}", tags=["聊天历史"], summary="删除会话历史")
+async def delete_history_session(session_id: str, http_request: Request):
+    """删除当前用户的会话及其全部消息"""
+    await _owned_session(http_request, session_id)
+    session_store.delete_session(session_id)
+    await session_store.flush()
+    return {"success": True, "message": "会话历史已删除"}
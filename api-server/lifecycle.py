@@ -0,0 +1,293 @@
+"""
+排空模式（优雅退出）
+
+重启或发布时，worker 先进入排空模式而不是直接断开连接：
+- 停止接受新的生成请求（HTTP返回503 + Retry-After，新的WebSocket以1012拒绝）
+- 进行中的SSE流与群聊轮次继续执行，直到完成或到达截止时间
+- 向已连接的WebSocket客户端发送重连提示，空闲的连接立即以1012（服务重启）关闭，
+  正在进行一轮回答的连接在本轮结束后关闭
+
+请求与连接的统计由 DrainMiddleware 在ASGI层完成，各端点无需改动；
+WebSocket端点用 drain_controller.turn() 标记一轮处理的开始与结束，并用 on_drain() 注册
+重连提示的发送与关闭方式：提示经连接自己的发送队列按协商的编码（JSON或MessagePack）发送，
+关闭在队列中的消息发完之后进行。没有注册的连接不发送提示，直接以1012关闭。
+
+使用方法:
+    app.add_middleware(DrainMiddleware, controller=drain_controller)
+
+    drain_controller.on_drain(send_hint, close)    # 连接建立后
+    async with drain_controller.turn():
+        ...  # 处理一轮对话
+
+    await drain_controller.drain(timeout=60)
+    drain_controller.resume()    # 取消手动排空（进程退出时的排空不可取消）
+"""
+
+import asyncio
+import contextvars
+import json
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Callable, Dict, Optional, Set, Tuple
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# WebSocket关闭码：服务重启，客户端应稍后重连
+WS_CLOSE_SERVICE_RESTART = 1012
+
+# 会产生模型调用的HTTP端点（method, 路径前缀）
+GENERATION_ENDPOINTS: Tuple[Tuple[str, str], ...] = (
+    ('POST', '/api/chat/message'),
+    ('POST', '/api/chat/stream'),
+    ('GET', '/api/stream'),
+    ('POST', '/api/stream'),
+    ('POST', '/api/cline/'),
+    ('GET', '/api/diagnostics/stream'),
+)
+
+
+class _WebSocketState:
+    """单个WebSocket连接的排空状态"""
+
+    def __init__(self, send):
+        self.send = send
+        self.busy = 0
+        self.closed = False
+        self.closing = False
+        # 连接注册的提示发送与关闭方式（见 DrainController.on_drain）
+        self.send_hint: Optional[Callable[[Dict[str, Any]], Any]] = None
+        self.close_gracefully: Optional[Callable[[], Any]] = None
+
+    def notify(self, hint: Dict[str, Any]):
+        if self.send_hint and not (self.closed or self.closing):
+            self.send_hint(hint)
+
+    async def close(self):
+        if self.closed or self.closing:
+            return
+        self.closing = True
+        if self.close_gracefully:
+            self.close_gracefully()
+            return
+        self.closed = True
+        await self.send({'type': 'websocket.close', 'code': WS_CLOSE_SERVICE_RESTART})
+
+
+# 当前任务所属的WebSocket连接（由中间件设置，turn() 据此标记连接忙碌）
+_current_websocket: contextvars.ContextVar[Optional[_WebSocketState]] = contextvars.ContextVar(
+    'current_websocket', default=None
+)
+
+
+class DrainController:
+    """统计进行中的流与连接，控制排空"""
+
+    def __init__(self, retry_after: int = 2):
+        self.retry_after = retry_after
+        self.draining = False
+        self.drain_started_at: Optional[float] = None
+        self.deadline: Optional[float] = None
+        # 进程退出触发的排空不可取消
+        self.cancellable = True
+        self.active_streams = 0
+        self.active_turns = 0
+        self._websockets: Set[_WebSocketState] = set()
+        self.metrics = {
+            'rejected_requests': 0,
+            'rejected_websockets': 0,
+            'completed_during_drain': 0
+        }
+
+    @staticmethod
+    def is_generation(method: str, path: str) -> bool:
+        return any(method == m and path.startswith(prefix) for m, prefix in GENERATION_ENDPOINTS)
+
+    @property
+    def drain_hint(self) -> Dict[str, Any]:
+        """发给WebSocket客户端的重连提示"""
+        return {
+            'type': 'server_draining',
+            'reconnect': True,
+            'retryAfter': self.retry_after,
+            'deadline': self.deadline
+        }
+
+    def on_drain(self, send_hint: Callable[[Dict[str, Any]], Any], close: Callable[[], Any]):
+        """
+        注册当前WebSocket连接的排空处理（在连接的处理任务中、连接建立后调用）
+
+        Args:
+            send_hint: 把重连提示放入连接的发送队列（按连接协商的编码发送），不等待
+            close: 队列中的消息发完后以1012关闭连接，不等待
+        """
+        state = _current_websocket.get()
+        if state:
+            state.send_hint = send_hint
+            state.close_gracefully = close
+
+    @asynccontextmanager
+    async def turn(self):
+        """标记一轮处理（排空时等待其完成，完成后关闭所在的WebSocket连接）"""
+        state = _current_websocket.get()
+        self.active_turns += 1
+        if state:
+            state.busy += 1
+        try:
+            yield
+        finally:
+            self.active_turns -= 1
+            if self.draining:
+                self.metrics['completed_during_drain'] += 1
+            if state:
+                state.busy -= 1
+                if self.draining and state.busy == 0:
+                    await self._close_quietly(state)
+
+    async def drain(self, timeout: float, cancellable: bool = True) -> bool:
+        """
+        进入排空模式，等待进行中的流与轮次结束
+
+        Args:
+            timeout: 最长等待秒数
+            cancellable: 是否允许通过 resume() 取消（进程退出时为False）
+
+        Returns:
+            是否在截止时间前全部完成（被取消时返回False）
+        """
+        if not cancellable:
+            self.cancellable = False
+        if not self.draining:
+            self.draining = True
+            self.drain_started_at = time.time()
+            self.deadline = self.drain_started_at + timeout
+            logger.info(
+                f"进入排空模式: {self.active_streams} 个流、{self.active_turns} 个轮次进行中，"
+                f"{len(self._websockets)} 个WebSocket连接，最长等待 {timeout} 秒"
+            )
+            for state in list(self._websockets):
+                try:
+                    state.notify(self.drain_hint)
+                    if state.busy == 0:
+                        await state.close()
+                except Exception:
+                    state.closed = True
+
+        while self.draining and time.time() < self.deadline:
+            if self.active_streams == 0 and self.active_turns == 0:
+                logger.info("排空完成")
+                return True
+            await asyncio.sleep(0.2)
+        if not self.draining:
+            return False
+        logger.warning(f"排空超时: 仍有 {self.active_streams} 个流、{self.active_turns} 个轮次未完成")
+        return False
+
+    def resume(self) -> bool:
+        """
+        取消手动排空，重新接受新的请求与连接（排空期间已关闭的WebSocket客户端会按提示重连）
+
+        Returns:
+            是否已取消（未在排空或排空由进程退出触发时返回False）
+        """
+        if not self.draining or not self.cancellable:
+            return False
+        self.draining = False
+        self.drain_started_at = None
+        self.deadline = None
+        logger.info("已取消排空，恢复接受新请求")
+        return True
+
+    @staticmethod
+    async def _close_quietly(state: _WebSocketState):
+        try:
+            await state.close()
+        except Exception:
+            state.closed = True
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            'draining': self.draining,
+            'cancellable': self.cancellable,
+            'drain_started_at': self.drain_started_at,
+            'deadline': self.deadline,
+            'active_streams': self.active_streams,
+            'active_turns': self.active_turns,
+            'websockets': len(self._websockets),
+            **self.metrics
+        }
+
+
+class DrainMiddleware:
+    """ASGI中间件：排空时拒绝新的生成请求与WebSocket连接，并统计进行中的流"""
+
+    def __init__(self, app, controller: DrainController):
+        self.app = app
+        self.controller = controller
+
+    async def __call__(self, scope, receive, send):
+        controller = self.controller
+        if scope['type'] == 'http' and controller.is_generation(scope['method'], scope['path']):
+            if controller.draining:
+                controller.metrics['rejected_requests'] += 1
+                await self._reject_http(send)
+                return
+            # StreamingResponse 在响应体发送完毕后才返回，计数覆盖整个流
+            controller.active_streams += 1
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                controller.active_streams -= 1
+            return
+
+        if scope['type'] == 'websocket':
+            if controller.draining:
+                controller.metrics['rejected_websockets'] += 1
+                await receive()  # websocket.connect
+                await send({'type': 'websocket.close', 'code': WS_CLOSE_SERVICE_RESTART})
+                return
+            state = _WebSocketState(send)
+
+            async def tracked_send(message):
+                if state.closed:
+                    # 排空时已关闭连接，丢弃之后的发送
+                    return
+                if message['type'] == 'websocket.close':
+                    state.closed = True
+                await send(message)
+
+            state.send = send
+            controller._websockets.add(state)
+            token = _current_websocket.set(state)
+            try:
+                await self.app(scope, receive, tracked_send)
+            finally:
+                _current_websocket.reset(token)
+                controller._websockets.discard(state)
+            return
+
+        await self.app(scope, receive, send)
+
+    async def _reject_http(self, send):
+        body = json.dumps({
+            'success': False,
+            'error': '服务正在重启，请稍后重试',
+            'retry_after': self.controller.retry_after
+        }, ensure_ascii=False).encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': 503,
+            'headers': [
+                (b'content-type', b'application/json; charset=utf-8'),
+                (b'retry-after', str(self.controller.retry_after).encode()),
+                (b'connection', b'close'),
+                (b'content-length', str(len(body)).encode()),
+            ]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+
+# 全局排空控制器实例
+drain_controller = DrainController(retry_after=config.drain_retry_after)
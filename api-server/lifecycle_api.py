@@ -0,0 +1,57 @@
+"""
+服务生命周期API端点（排空状态与手动排空）
+"""
+from fastapi import APIRouter, HTTPException, Request
+from config import config
+from lifecycle import drain_controller
+import asyncio
+import hmac
+import logging
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter()
+
+# 只允许本机调用排空（部署脚本在服务器上执行）
+LOCAL_HOSTS = {"127.0.0.1", "::1", "localhost"}
+
+# 经代理转发的请求带有这些头，此时 request.client 可能是代理头中客户端自报的地址
+FORWARDED_HEADERS = ("x-forwarded-for", "x-real-ip", "forwarded")
+
+def _check_drain_caller(request: Request):
+    """
+    排空接口的调用方校验
+
+    设置了 DRAIN_TOKEN 时要求请求头 X-Drain-Token 匹配；否则只接受本机直连
+    （带转发头的请求一律拒绝，客户端无法通过伪造 X-Forwarded-For 冒充本机）。
+    """
+    if config.drain_token:
+        token = request.headers.get("x-drain-token", "")
+        if not hmac.compare_digest(token.encode(), config.drain_token.encode()):
+            raise HTTPException(status_code=403, detail="排空令牌无效")
+        return
+    if any(name in request.headers for name in FORWARDED_HEADERS):
+        raise HTTPException(status_code=403, detail="只允许本机直连调用")
+    if request.client is None or request.client.host not in LOCAL_HOSTS:
+        raise HTTPException(status_code=403, detail="只允许本机调用")
+
+@router.get("/api/lifecycle/status", tags=["生命周期"], summary="获取排空状态")
+async def get_lifecycle_status():
+    """当前worker是否处于排空模式，以及进行中的流与连接数"""
+    return {"success": True, "status": drain_controller.get_status()}
+
+@router.post("/api/lifecycle/drain", tags=["生命周期"], summary="进入排空模式")
+async def start_drain(request: Request, timeout: int = None):
+    """停止接受新的生成请求，进行中的流在截止时间内继续完成（仅限本机直连或携带排空令牌）"""
+    _check_drain_caller(request)
+    asyncio.create_task(drain_controller.drain(timeout or config.drain_timeout))
+    await asyncio.sleep(0)
+    return {"success": True, "status": drain_controller.get_status()}
+
+@router.delete("/api/lifecycle/drain", tags=["生命周期"], summary="取消排空")
+async def cancel_drain(request: Request):
+    """取消手动触发的排空，恢复接受新请求（进程退出触发的排空不可取消）"""
+    _check_drain_caller(request)
+    if not drain_controller.resume():
+        raise HTTPException(status_code=409, detail="当前没有可取消的排空")
+    return {"success": True, "status": drain_controller.get_status()}
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本机 Redis 兼容服务（替身）
+
+没有安装 Redis 的开发机或单机部署上，代替 Redis 供 SHARED_STATE_BACKEND=redis 使用，
+多个 worker 通过它共享状态与发布/订阅。数据只在内存中，进程退出即清空，不做持久化、复制与鉴权，
+只监听本机地址，不要用于生产环境的跨主机部署。
+
+实现 RESP2 协议中 RedisStateBackend（redis.asyncio）用到的命令：
+- 连接: PING, ECHO, SELECT, CLIENT, QUIT
+- 键值: GET, SET（EX/PX/NX/XX）, DEL, EXISTS, INCR, INCRBY, EXPIRE, PEXPIRE, TTL, PTTL, FLUSHDB, DBSIZE
+- 列表: RPUSH, LTRIM, LRANGE, LLEN
+- 事务: MULTI, EXEC, DISCARD（按顺序执行，单线程事件循环中天然原子）
+- 发布/订阅: PUBLISH, SUBSCRIBE, UNSUBSCRIBE
+- 脚本: EVAL 只支持 shared_state 中登记的脚本（见 SCRIPTS），不执行任意Lua
+
+使用方法:
+    python local_redis.py --port 6379
+    SHARED_STATE_BACKEND=redis SHARED_STATE_REDIS_URL=redis://127.0.0.1:6379/0 python start_production.py --workers 4
+"""
+
+import argparse
+import asyncio
+import logging
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from shared_state import RedisStateBackend
+
+logger = logging.getLogger(__name__)
+
+# 命令参数（字节串）
+Args = List[bytes]
+
+
+class CommandError(Exception):
+    """返回给客户端的错误（-ERR ...）"""
+
+
+def _int(value: bytes) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        raise CommandError("value is not an integer or out of range")
+
+
+def _encode(value: Any) -> bytes:
+    """把命令结果编码为RESP2回复"""
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, CommandError):
+        return b'-ERR ' + str(value).encode() + b'\r\n'
+    if isinstance(value, bool):
+        return b':%d\r\n' % int(value)
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, str):
+        return b'+' + value.encode() + b'\r\n'
+    if isinstance(value, bytes):
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+    return b'*%d\r\n' % len(value) + b''.join(_encode(item) for item in value)
+
+
+def _slice(length: int, start: int, stop: int) -> Tuple[int, int]:
+    """Redis 列表下标（含两端、可为负）转为 Python 切片"""
+    if start < 0:
+        start = max(length + start, 0)
+    if stop < 0:
+        stop = length + stop
+    return start, min(stop, length - 1) + 1
+
+
+class LocalRedisStore:
+    """键空间：值为字节串或列表，过期时间在访问时检查"""
+
+    def __init__(self):
+        self.values: Dict[bytes, Any] = {}
+        self.expires: Dict[bytes, float] = {}
+
+    def alive(self, key: bytes) -> bool:
+        expires_at = self.expires.get(key)
+        if expires_at is not None and expires_at <= time.time():
+            self.values.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.values
+
+    def get(self, key: bytes, kind: type) -> Any:
+        if not self.alive(key):
+            return None
+        value = self.values[key]
+        if not isinstance(value, kind):
+            raise CommandError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        return value
+
+    def delete(self, key: bytes) -> bool:
+        existed = self.alive(key)
+        self.values.pop(key, None)
+        self.expires.pop(key, None)
+        return existed
+
+    def expire(self, key: bytes, seconds: float) -> bool:
+        if not self.alive(key):
+            return False
+        self.expires[key] = time.time() + seconds
+        return True
+
+    def ttl_ms(self, key: bytes) -> int:
+        if not self.alive(key):
+            return -2
+        expires_at = self.expires.get(key)
+        return -1 if expires_at is None else max(int((expires_at - time.time()) * 1000), 0)
+
+    def incrby(self, key: bytes, amount: int) -> int:
+        current = self.get(key, bytes)
+        value = (_int(current) if current is not None else 0) + amount
+        self.values[key] = str(value).encode()
+        return value
+
+
+def _incr_script(store: LocalRedisStore, keys: Args, argv: Args) -> int:
+    """RedisStateBackend._INCR_SCRIPT：自增，并只在键没有过期时间时设置"""
+    value = store.incrby(keys[0], _int(argv[0]))
+    ttl_ms = _int(argv[1])
+    if ttl_ms > 0 and store.ttl_ms(keys[0]) < 0:
+        store.expire(keys[0], ttl_ms / 1000)
+    return value
+
+
+# EVAL 支持的脚本：脚本原文 -> 等价的Python实现
+SCRIPTS: Dict[bytes, Callable[[LocalRedisStore, Args, Args], Any]] = {
+    RedisStateBackend._INCR_SCRIPT.encode(): _incr_script,
+}
+
+
+class LocalRedisServer:
+    """单进程 asyncio 服务：所有命令在事件循环中顺序执行"""
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 6379):
+        self.host = host
+        self.port = port
+        self.store = LocalRedisStore()
+        # 频道 -> 订阅该频道的连接
+        self.channels: Dict[bytes, Set[asyncio.StreamWriter]] = {}
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.metrics = {'connections': 0, 'commands': 0, 'published': 0}
+        self.commands: Dict[bytes, Callable[[Args], Any]] = {
+            b'PING': lambda args: args[0] if args else 'PONG',
+            b'ECHO': lambda args: args[0],
+            b'SELECT': lambda args: 'OK',
+            b'CLIENT': lambda args: 'OK',
+            b'GET': lambda args: self.store.get(args[0], bytes),
+            b'SET': self._set,
+            b'DEL': lambda args: sum(self.store.delete(key) for key in args),
+            b'EXISTS': lambda args: sum(self.store.alive(key) for key in args),
+            b'INCR': lambda args: self.store.incrby(args[0], 1),
+            b'INCRBY': lambda args: self.store.incrby(args[0], _int(args[1])),
+            b'EXPIRE': lambda args: self.store.expire(args[0], _int(args[1])),
+            b'PEXPIRE': lambda args: self.store.expire(args[0], _int(args[1]) / 1000),
+            b'TTL': self._ttl,
+            b'PTTL': lambda args: self.store.ttl_ms(args[0]),
+            b'FLUSHDB': self._flush,
+            b'FLUSHALL': self._flush,
+            b'DBSIZE': lambda args: sum(self.store.alive(key) for key in list(self.store.values)),
+            b'RPUSH': self._rpush,
+            b'LTRIM': self._ltrim,
+            b'LRANGE': self._lrange,
+            b'LLEN': lambda args: len(self.store.get(args[0], list) or []),
+            b'PUBLISH': self._publish,
+            b'EVAL': self._eval,
+        }
+
+    # ---------- 命令 ----------
+
+    def _set(self, args: Args) -> Any:
+        key, value, ttl, mode = args[0], args[1], None, None
+        options = iter(args[2:])
+        for option in options:
+            name = option.upper()
+            if name in (b'EX', b'PX'):
+                amount = _int(next(options, b''))
+                ttl = amount if name == b'EX' else amount / 1000
+            elif name in (b'NX', b'XX'):
+                mode = name
+            else:
+                raise CommandError("syntax error")
+        exists = self.store.alive(key)
+        if (mode == b'NX' and exists) or (mode == b'XX' and not exists):
+            return None
+        self.store.values[key] = value
+        self.store.expires.pop(key, None)
+        if ttl:
+            self.store.expire(key, ttl)
+        return 'OK'
+
+    def _ttl(self, args: Args) -> int:
+        ttl_ms = self.store.ttl_ms(args[0])
+        return ttl_ms if ttl_ms < 0 else (ttl_ms + 999) // 1000
+
+    def _flush(self, args: Args) -> str:
+        self.store.values.clear()
+        self.store.expires.clear()
+        return 'OK'
+
+    def _rpush(self, args: Args) -> int:
+        items = self.store.get(args[0], list)
+        if items is None:
+            items = self.store.values[args[0]] = []
+        items.extend(args[1:])
+        return len(items)
+
+    def _ltrim(self, args: Args) -> str:
+        items = self.store.get(args[0], list)
+        if items is not None:
+            start, stop = _slice(len(items), _int(args[1]), _int(args[2]))
+            items[:] = items[start:stop]
+            if not items:
+                self.store.delete(args[0])
+        return 'OK'
+
+    def _lrange(self, args: Args) -> List[bytes]:
+        items = self.store.get(args[0], list) or []
+        start, stop = _slice(len(items), _int(args[1]), _int(args[2]))
+        return items[start:stop]
+
+    def _publish(self, args: Args) -> int:
+        channel, message = args[0], args[1]
+        subscribers = self.channels.get(channel, set())
+        payload = _encode([b'message', channel, message])
+        for writer in list(subscribers):
+            writer.write(payload)
+        self.metrics['published'] += 1
+        return len(subscribers)
+
+    def _eval(self, args: Args) -> Any:
+        script = SCRIPTS.get(args[0].strip())
+        if script is None:
+            raise CommandError("本地替身不执行任意Lua脚本，只支持 shared_state 中登记的脚本")
+        count = _int(args[1])
+        return script(self.store, args[2:2 + count], args[2 + count:])
+
+    def execute(self, command: Args) -> Any:
+        """执行一条命令，错误作为 CommandError 返回（不断开连接）"""
+        self.metrics['commands'] += 1
+        handler = self.commands.get(command[0].upper())
+        if handler is None:
+            return CommandError(f"unknown command '{command[0].decode(errors='replace')}'")
+        try:
+            return handler(command[1:])
+        except CommandError as e:
+            return e
+        except (IndexError, StopIteration):
+            return CommandError(f"wrong number of arguments for '{command[0].decode(errors='replace').lower()}' command")
+
+    # ---------- 连接 ----------
+
+    @staticmethod
+    async def _read_command(reader: asyncio.StreamReader) -> Optional[Args]:
+        """读取一条命令（RESP数组或内联命令），连接关闭时返回None"""
+        line = await reader.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.split()
+        command = []
+        for _ in range(int(line[1:])):
+            header = await reader.readline()
+            if not header.startswith(b'$'):
+                raise ValueError("协议错误：期望批量字符串")
+            data = await reader.readexactly(int(header[1:]) + 2)
+            command.append(data[:-2])
+        return command
+
+    def _subscribe(self, writer: asyncio.StreamWriter, subscribed: Set[bytes], channels: Args):
+        for channel in channels:
+            subscribed.add(channel)
+            self.channels.setdefault(channel, set()).add(writer)
+            writer.write(_encode([b'subscribe', channel, len(subscribed)]))
+
+    def _unsubscribe(self, writer: asyncio.StreamWriter, subscribed: Set[bytes], channels: Args):
+        for channel in channels or list(subscribed):
+            subscribed.discard(channel)
+            listeners = self.channels.get(channel)
+            if listeners is not None:
+                listeners.discard(writer)
+                if not listeners:
+                    del self.channels[channel]
+            writer.write(_encode([b'unsubscribe', channel, len(subscribed)]))
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.metrics['connections'] += 1
+        subscribed: Set[bytes] = set()
+        queued: Optional[List[Args]] = None
+        try:
+            while True:
+                try:
+                    command = await self._read_command(reader)
+                except (ValueError, asyncio.IncompleteReadError) as e:
+                    writer.write(_encode(CommandError(f"Protocol error: {e}")))
+                    break
+                if command is None:
+                    break
+                if not command:
+                    continue
+                name = command[0].upper()
+                if name == b'QUIT':
+                    writer.write(_encode('OK'))
+                    break
+                if name == b'SUBSCRIBE':
+                    self._subscribe(writer, subscribed, command[1:])
+                elif name == b'UNSUBSCRIBE':
+                    self._unsubscribe(writer, subscribed, command[1:])
+                elif subscribed and name != b'PING':
+                    writer.write(_encode(CommandError(
+                        "only (UN)SUBSCRIBE / PING / QUIT are allowed in this context")))
+                elif name == b'MULTI':
+                    queued = []
+                    writer.write(_encode('OK'))
+                elif name == b'DISCARD':
+                    queued = None
+                    writer.write(_encode('OK'))
+                elif name == b'EXEC':
+                    if queued is None:
+                        writer.write(_encode(CommandError("EXEC without MULTI")))
+                    else:
+                        writer.write(_encode([self.execute(item) for item in queued]))
+                        queued = None
+                elif queued is not None:
+                    queued.append(command)
+                    writer.write(_encode('QUEUED'))
+                elif subscribed:
+                    writer.write(_encode([b'pong', command[1] if len(command) > 1 else b'']))
+                else:
+                    writer.write(_encode(self.execute(command)))
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.metrics['connections'] -= 1
+            self._unsubscribe_silently(writer, subscribed)
+            writer.close()
+
+    def _unsubscribe_silently(self, writer: asyncio.StreamWriter, subscribed: Set[bytes]):
+        for channel in subscribed:
+            listeners = self.channels.get(channel)
+            if listeners is not None:
+                listeners.discard(writer)
+                if not listeners:
+                    del self.channels[channel]
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        logger.info(f"本地Redis替身已启动: redis://{self.host}:{self.port}/0")
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本机Redis兼容服务（共享状态的Redis替身）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--log-level", default="info")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=args.log_level.upper(), format="%(asctime)s %(levelname)s %(message)s")
+
+    async def serve():
+        server = LocalRedisServer(args.host, args.port)
+        await server.start()
+        await server.server.serve_forever()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地模拟上游（OpenAI / OpenRouter 兼容）
+
+实现 OpenRouterProvider（aiohttp）与 OpenAIProvider（AsyncOpenAI）用到的接口，压测网关时代替真实API，
+不消耗费用也不受上游限流影响：
+- POST {prefix}/chat/completions：流式（SSE，chat.completion.chunk，最后一块带usage，以 [DONE] 结束）与非流式
+- GET  {prefix}/models：模型列表（含 context_length 与 pricing 字段）
+prefix 为 /v1（OpenAI，base_url=http://host:port/v1）或 /api/v1（OpenRouter，base_url=http://host:port/api/v1）。
+
+可配置的行为（启动参数，或运行时 POST /mock/config 修改）：
+- ttft_ms / jitter：首块延迟及其随机浮动比例
+- tokens_per_sec / chunk_tokens：输出速率与每块包含的token数
+- output_tokens / token_chars：每次回复的token数（不超过请求的 max_tokens）与每个token的字符数
+- rate_limit_rate / retry_after：按概率返回429（带 Retry-After）
+- error_rate：按概率返回500
+- stall_rate / stall_ms：按概率在输出到一半时停顿
+- drop_rate：按概率在输出到一半时提前结束流（不发送结束块、usage与 [DONE]）
+- profiles：按模型覆盖以上参数，如 {"mock/slow": {"ttft_ms": 2000, "tokens_per_sec": 10}}
+
+GET /mock/stats 返回请求数、进行中的流、已发送token数与各类注入次数，POST /mock/reset 清零。
+
+使用方法:
+    python mock_upstream.py --port 18200 --ttft-ms 300 --tokens-per-sec 40 --output-tokens 200
+    python mock_upstream.py --rate-limit-rate 0.05 --stall-rate 0.01 --profiles '{"mock/slow": {"ttft_ms": 2000}}'
+
+    网关请求中使用 {"provider": "openrouter", "config": {"api_key": "sk-or-mock",
+    "base_url": "http://127.0.0.1:18200/api/v1", "default_model": "mock/fast"}}
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from typing import Any, Dict, Optional
+
+from fastapi import APIRouter, FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+# 可配置参数及默认值
+DEFAULT_SETTINGS: Dict[str, Any] = {
+    'ttft_ms': 200.0,
+    'jitter': 0.1,
+    'tokens_per_sec': 50.0,
+    'chunk_tokens': 1,
+    'output_tokens': 200,
+    'token_chars': 4,
+    'rate_limit_rate': 0.0,
+    'retry_after': 1,
+    'error_rate': 0.0,
+    'stall_rate': 0.0,
+    'stall_ms': 5000.0,
+    'drop_rate': 0.0,
+}
+
+# 模型列表中的模型（未在列表中的模型同样可以调用）
+MOCK_MODELS = ['mock/fast', 'mock/slow', 'mock/free:free']
+
+
+class MockSettings:
+    """模拟行为参数：全局值 + 按模型覆盖"""
+
+    def __init__(self, profiles: Optional[Dict[str, Dict[str, Any]]] = None, **overrides):
+        self.values = dict(DEFAULT_SETTINGS)
+        self.profiles: Dict[str, Dict[str, Any]] = {}
+        self.update(dict(overrides, profiles=profiles or {}))
+
+    def _validate(self, values: Dict[str, Any]) -> Dict[str, Any]:
+        validated = {}
+        for key, value in values.items():
+            if key not in DEFAULT_SETTINGS:
+                raise ValueError(f"未知参数: {key}")
+            value = type(DEFAULT_SETTINGS[key])(value)
+            if value < 0 or (key.endswith('_rate') and value > 1):
+                raise ValueError(f"参数超出范围: {key}={value}")
+            validated[key] = value
+        return validated
+
+    def update(self, values: Dict[str, Any]):
+        """更新参数（profiles 整体替换）"""
+        values = dict(values)
+        profiles = values.pop('profiles', None)
+        self.values.update(self._validate(values))
+        if profiles is not None:
+            self.profiles = {model: self._validate(profile) for model, profile in profiles.items()}
+
+    def for_model(self, model: str) -> Dict[str, Any]:
+        return dict(self.values, **self.profiles.get(model, {}))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return dict(self.values, profiles=self.profiles)
+
+
+class MockStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.requests = 0
+        self.active_streams = 0
+        self.completed = 0
+        self.tokens_sent = 0
+        self.injected = {'rate_limited': 0, 'errors': 0, 'stalls': 0, 'drops': 0}
+        self.started_at = time.time()
+
+    def to_dict(self) -> Dict[str, Any]:
+        elapsed = max(time.time() - self.started_at, 1e-6)
+        return {
+            'requests': self.requests,
+            'active_streams': self.active_streams,
+            'completed': self.completed,
+            'tokens_sent': self.tokens_sent,
+            'tokens_per_sec': round(self.tokens_sent / elapsed, 1),
+            'injected': dict(self.injected)
+        }
+
+
+def error_response(status: int, message: str, error_type: str, headers: Optional[Dict[str, str]] = None):
+    """OpenAI格式的错误响应"""
+    return JSONResponse(status_code=status, headers=headers, content={
+        'error': {'message': message, 'type': error_type, 'code': status}
+    })
+
+
+def create_app(settings: Optional[MockSettings] = None, seed: Optional[int] = None) -> FastAPI:
+    settings = settings or MockSettings()
+    stats = MockStats()
+    rng = random.Random(seed)
+    app = FastAPI(title="Mock Upstream")
+    api = APIRouter()
+
+    @api.get("/models")
+    async def list_models():
+        return {'object': 'list', 'data': [
+            {'id': model, 'object': 'model', 'name': model, 'owned_by': 'mock', 'created': 0,
+             'context_length': 32768, 'pricing': {'prompt': 0.0, 'completion': 0.0}}
+            for model in MOCK_MODELS
+        ]}
+
+    @api.post("/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        model = body.get('model') or MOCK_MODELS[0]
+        current = settings.for_model(model)
+        stats.requests += 1
+
+        if rng.random() < current['rate_limit_rate']:
+            stats.injected['rate_limited'] += 1
+            return error_response(429, "Rate limit exceeded (mock)", 'rate_limit_exceeded',
+                                  {'retry-after': str(current['retry_after'])})
+        if rng.random() < current['error_rate']:
+            stats.injected['errors'] += 1
+            return error_response(500, "Internal error (mock)", 'server_error')
+
+        output_tokens = min(current['output_tokens'], int(body.get('max_tokens') or current['output_tokens']))
+        prompt_tokens = sum(len(str(message.get('content', ''))) for message in body.get('messages', [])) // 4 + 1
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': output_tokens,
+                 'total_tokens': prompt_tokens + output_tokens}
+        token = 'x' * max(current['token_chars'] - 1, 0) + ' '
+        ttft = current['ttft_ms'] / 1000 * rng.uniform(1 - current['jitter'], 1 + current['jitter'])
+        interval = current['chunk_tokens'] / current['tokens_per_sec'] if current['tokens_per_sec'] else 0
+        completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+
+        if not body.get('stream'):
+            await asyncio.sleep(ttft + interval * output_tokens / max(current['chunk_tokens'], 1))
+            stats.tokens_sent += output_tokens
+            stats.completed += 1
+            return {
+                'id': completion_id, 'object': 'chat.completion', 'created': created, 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': token * output_tokens},
+                             'finish_reason': 'stop'}],
+                'usage': usage
+            }
+
+        include_usage = bool((body.get('stream_options') or {}).get('include_usage')
+                             or (body.get('usage') or {}).get('include'))
+        stall = rng.random() < current['stall_rate']
+        drop = rng.random() < current['drop_rate']
+
+        def chunk(delta: Dict[str, Any], finish_reason: Optional[str] = None, **extra) -> str:
+            data = {'id': completion_id, 'object': 'chat.completion.chunk', 'created': created, 'model': model,
+                    'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish_reason}] if delta is not None else []}
+            data.update(extra)
+            return f"data: {json.dumps(data)}\n\n"
+
+        async def generate():
+            nonlocal stall
+            stats.active_streams += 1
+            try:
+                await asyncio.sleep(ttft)
+                yield chunk({'role': 'assistant', 'content': ''})
+                deadline = time.perf_counter()
+                sent = 0
+                while sent < output_tokens:
+                    if sent >= output_tokens // 2 and (stall or drop):
+                        if drop:
+                            stats.injected['drops'] += 1
+                            return
+                        stats.injected['stalls'] += 1
+                        stall_seconds = current['stall_ms'] / 1000
+                        await asyncio.sleep(stall_seconds)
+                        deadline += stall_seconds
+                        stall = False
+                    count = min(current['chunk_tokens'], output_tokens - sent)
+                    yield chunk({'content': token * count})
+                    sent += count
+                    stats.tokens_sent += count
+                    # 按绝对时间推进，避免sleep误差累积
+                    deadline += interval
+                    delay = deadline - time.perf_counter()
+                    if delay > 0 and sent < output_tokens:
+                        await asyncio.sleep(delay)
+                yield chunk({}, 'stop')
+                if include_usage:
+                    yield chunk(None, usage=usage)
+                yield "data: [DONE]\n\n"
+                stats.completed += 1
+            finally:
+                stats.active_streams -= 1
+
+        return StreamingResponse(generate(), media_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+    app.include_router(api, prefix="/v1")
+    app.include_router(api, prefix="/api/v1")
+
+    @app.get("/mock/stats")
+    async def mock_stats():
+        return stats.to_dict()
+
+    @app.post("/mock/reset")
+    async def mock_reset():
+        stats.reset()
+        return stats.to_dict()
+
+    @app.get("/mock/config")
+    async def get_mock_config():
+        return settings.to_dict()
+
+    @app.post("/mock/config")
+    async def update_mock_config(values: Dict[str, Any]):
+        try:
+            settings.update(values)
+        except (TypeError, ValueError) as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return settings.to_dict()
+
+    return app
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="本地模拟上游（OpenAI/OpenRouter兼容）")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18200)
+    for key, default in DEFAULT_SETTINGS.items():
+        parser.add_argument("--" + key.replace('_', '-'), type=type(default), default=default)
+    parser.add_argument("--profiles", default="{}", help="按模型覆盖参数（JSON）")
+    parser.add_argument("--seed", type=int, help="随机种子（注入错误可复现）")
+    parser.add_argument("--log-level", default="warning")
+    args = parser.parse_args(argv)
+
+    import uvicorn
+    settings = MockSettings(json.loads(args.profiles), **{key: getattr(args, key) for key in DEFAULT_SETTINGS})
+    uvicorn.run(create_app(settings, args.seed), host=args.host, port=args.port,
+                log_level=args.log_level, access_log=False, backlog=4096)
+
+
+if __name__ == "__main__":
+    main()
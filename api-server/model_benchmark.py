@@ -0,0 +1,412 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+模型基准测试
+
+对选定的 provider/model 组合运行一组提示词（代替 test_*.py 脚本逐个手工计时），每次调用以流式方式进行并记录：
+- TTFT：发出请求到收到第一段内容的时间
+- 逐token延迟（ITL）：首段内容之后平均每个输出token的间隔
+- tokens/sec：输出token数 / 整次调用耗时
+- 错误率（按错误类型分类）与成本（按提供商登记的模型价格计算，免费模型标记 free）
+
+各目标依次测试，目标内按 concurrency 并发、每条提示词重复 repeat 次，避免目标之间互相影响延迟。
+每次调用以 batch 优先级获取准入名额（见 admission.py），计时从获得名额后开始，排队时间不计入结果。
+报告包含逐次调用的样本与每个目标的分位数汇总（p50/p95/p99），JSON与CSV字段固定，
+不同运行的CSV可以直接拼接比较。
+
+提示词集为JSONL，格式与批量任务相同：{"id": "q1", "prompt": "..."} 或 {"id": "q1", "messages": [...]}，
+可带 temperature、max_tokens；未指定时使用内置提示词集（DEFAULT_SUITE）。
+
+使用方法:
+    python model_benchmark.py --targets openrouter:deepseek/deepseek-chat,openrouter:qwen/qwen-2.5-72b-instruct
+    python model_benchmark.py --targets openrouter --prompts suite.jsonl --repeat 5 --concurrency 4 \\
+        --output report.json --csv report.csv
+
+    或通过接口：POST /api/benchmark/runs（见 benchmark_api.py）
+"""
+
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+import time
+import uuid
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+from admission import PRIORITY_BATCH, admission_controller
+from batch_jobs import ITEM_PARAMS, BatchInputError, parse_items, parse_targets
+from config import config
+from providers import ProviderManager
+from tokenizer_service import tokenizer_service
+
+logger = logging.getLogger(__name__)
+
+# 运行状态
+STATUS_RUNNING = 'running'
+STATUS_COMPLETED = 'completed'
+STATUS_FAILED = 'failed'
+
+# 内置提示词集：短回复、推理、代码、长文本各一条
+DEFAULT_SUITE = [
+    {'id': 'greeting', 'prompt': '用一句话介绍你自己。', 'max_tokens': 64},
+    {'id': 'reasoning', 'prompt': '甲管单独注满水池需要6小时，乙管需要3小时，两管同时打开需要多久注满？请给出推理过程。',
+     'max_tokens': 256},
+    {'id': 'code', 'prompt': '用Python写一个判断字符串是否为回文的函数，并简要说明思路。', 'max_tokens': 384},
+    {'id': 'long_form', 'prompt': '写一篇约400字的短文，介绍多个AI模型同时参与讨论的优点和不足。', 'max_tokens': 768},
+]
+
+# 需要分位数汇总的样本指标
+SUMMARY_METRICS = ('ttft_ms', 'itl_ms', 'latency_ms', 'tokens_per_sec')
+
+# CSV汇总列（每个目标一行）
+CSV_FIELDS = (
+    ['run_id', 'name', 'provider', 'model', 'free', 'requests', 'succeeded', 'errors', 'error_rate']
+    + [f'{metric}_{stat}' for metric in SUMMARY_METRICS for stat in ('mean', 'p50', 'p95', 'p99')]
+    + ['throughput_tokens_per_sec', 'input_tokens', 'output_tokens', 'cost_usd', 'cost_per_request_usd']
+)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def summarize(values: List[float]) -> Dict[str, float]:
+    """均值、分位数与最大值"""
+    if not values:
+        return {'count': 0, 'mean': 0.0, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0}
+    return {
+        'count': len(values),
+        'mean': round(sum(values) / len(values), 2),
+        'p50': round(percentile(values, 0.5), 2),
+        'p95': round(percentile(values, 0.95), 2),
+        'p99': round(percentile(values, 0.99), 2),
+        'max': round(max(values), 2)
+    }
+
+
+class BenchmarkRun:
+    """一次基准测试运行：目标 × 提示词 × 重复次数"""
+
+    def __init__(self, run_id: str, name: str, targets: List[Dict[str, Optional[str]]],
+                 prompts: List[Dict[str, Any]], repeat: int, concurrency: int, timeout: float):
+        self.run_id = run_id
+        self.name = name
+        self.targets = targets
+        self.prompts = prompts
+        self.repeat = repeat
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.status = STATUS_RUNNING
+        self.created_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.error: Optional[str] = None
+        self.samples: List[Dict[str, Any]] = []
+        self.summary: List[Dict[str, Any]] = []
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def total(self) -> int:
+        return len(self.targets) * len(self.prompts) * self.repeat
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'run_id': self.run_id,
+            'name': self.name,
+            'status': self.status,
+            'targets': self.targets,
+            'prompts': len(self.prompts),
+            'repeat': self.repeat,
+            'concurrency': self.concurrency,
+            'timeout': self.timeout,
+            'total': self.total,
+            'completed': len(self.samples),
+            'created_at': self.created_at,
+            'finished_at': self.finished_at,
+            'error': self.error
+        }
+
+    def report(self) -> Dict[str, Any]:
+        report = self.to_dict()
+        report['summary'] = self.summary
+        report['samples'] = self.samples
+        return report
+
+
+def csv_rows(report: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """报告汇总展开为CSV行"""
+    rows = []
+    for target in report.get('summary', []):
+        row = {'run_id': report['run_id'], 'name': report['name']}
+        row.update({key: target[key] for key in CSV_FIELDS if key in target})
+        for metric in SUMMARY_METRICS:
+            for stat in ('mean', 'p50', 'p95', 'p99'):
+                row[f'{metric}_{stat}'] = target[metric][stat]
+        rows.append(row)
+    return rows
+
+
+def write_csv(report: Dict[str, Any], path: str):
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS)
+        writer.writeheader()
+        writer.writerows(csv_rows(report))
+
+
+class ModelBenchmark:
+    """运行基准测试并保存报告（{directory}/{run_id}.json 与 .csv）"""
+
+    def __init__(self, provider_manager: ProviderManager, directory: str = 'cache/benchmarks',
+                 max_concurrency: int = 16, max_calls: int = 2000, timeout: float = 120):
+        self.provider_manager = provider_manager
+        self.directory = directory
+        self.max_concurrency = max_concurrency
+        self.max_calls = max_calls
+        self.timeout = timeout
+        self.runs: Dict[str, BenchmarkRun] = {}
+
+    def create(self, targets: Any, prompts: Optional[List[Dict[str, Any]]] = None, repeat: int = 1,
+               concurrency: int = 1, name: str = '', timeout: Optional[float] = None) -> BenchmarkRun:
+        """校验参数并创建运行（不启动）"""
+        targets = parse_targets(targets)
+        if not targets:
+            raise BatchInputError("至少需要一个目标模型")
+        for target in targets:
+            if not self.provider_manager.get_provider(target['provider']):
+                raise BatchInputError(f"提供商 {target['provider']} 不存在或未启用")
+        if prompts is None:
+            prompts = [dict(item) for item in DEFAULT_SUITE]
+        if repeat < 1 or concurrency < 1:
+            raise BatchInputError("repeat 与 concurrency 必须大于0")
+        if concurrency > self.max_concurrency:
+            raise BatchInputError(f"并发数超过上限 {self.max_concurrency}")
+        run_id = time.strftime('%Y%m%d-%H%M%S') + '-' + uuid.uuid4().hex[:6]
+        run = BenchmarkRun(run_id, name or run_id, targets, prompts, repeat, concurrency, timeout or self.timeout)
+        if run.total > self.max_calls:
+            raise BatchInputError(f"调用次数 {run.total} 超过上限 {self.max_calls}")
+        return run
+
+    async def start(self, run: BenchmarkRun) -> BenchmarkRun:
+        """后台运行，完成后保存报告"""
+        self.runs[run.run_id] = run
+        run.task = asyncio.create_task(self.execute(run))
+        return run
+
+    async def execute(self, run: BenchmarkRun) -> Dict[str, Any]:
+        """依次测试每个目标并返回报告"""
+        self.runs[run.run_id] = run
+        try:
+            for target in run.targets:
+                run.summary.append(await self._bench_target(run, target))
+            run.status = STATUS_COMPLETED
+        except asyncio.CancelledError:
+            run.status = STATUS_FAILED
+            run.error = "运行被取消"
+            raise
+        except Exception as e:
+            logger.error(f"基准测试 {run.run_id} 失败: {e}")
+            run.status = STATUS_FAILED
+            run.error = str(e)
+        finally:
+            run.finished_at = time.time()
+            self.save(run)
+        logger.info(f"基准测试 {run.run_id} 完成: {len(run.samples)} 次调用")
+        return run.report()
+
+    async def _bench_target(self, run: BenchmarkRun, target: Dict[str, Optional[str]]) -> Dict[str, Any]:
+        provider = self.provider_manager.get_provider(target['provider'])
+        model = target['model'] or provider.config.default_model
+        semaphore = asyncio.Semaphore(run.concurrency)
+
+        async def measure(item: Dict[str, Any], repetition: int) -> Dict[str, Any]:
+            async with semaphore:
+                sample = await self._measure(provider, model, item, run.timeout)
+            sample.update({'provider': target['provider'], 'model': model, 'prompt_id': item['id'],
+                           'repetition': repetition})
+            run.samples.append(sample)
+            return sample
+
+        started = time.perf_counter()
+        samples = await asyncio.gather(*[
+            measure(item, repetition) for repetition in range(run.repeat) for item in run.prompts
+        ])
+        wall = time.perf_counter() - started
+        return self._summarize_target(target['provider'], model, samples, wall)
+
+    async def _measure(self, provider, model: str, item: Dict[str, Any], timeout: float) -> Dict[str, Any]:
+        """流式调用一次，计时从获得准入名额后开始"""
+        messages = item.get('messages') or [{'role': 'user', 'content': item['prompt']}]
+        params = {key: item[key] for key in ITEM_PARAMS if key in item}
+        timings: Dict[str, Optional[float]] = {'first': None, 'last': None}
+        result: Dict[str, Any] = {'content': '', 'usage': None}
+
+        async def consume():
+            async for chunk in provider.chat_completion(messages=messages, model=model, stream=True, **params):
+                if chunk.content:
+                    now = time.perf_counter()
+                    if timings['first'] is None:
+                        timings['first'] = now
+                    timings['last'] = now
+                    result['content'] += chunk.content
+                if chunk.usage:
+                    result['usage'] = chunk.usage
+
+        sample: Dict[str, Any] = {'ok': False, 'error': None}
+        async with admission_controller.slot(PRIORITY_BATCH):
+            started = time.perf_counter()
+            try:
+                await asyncio.wait_for(consume(), timeout)
+                sample['ok'] = True
+            except asyncio.TimeoutError:
+                sample['error'] = 'timeout'
+            except Exception as e:
+                sample['error'] = f"{type(e).__name__}: {e}"
+            elapsed = time.perf_counter() - started
+
+        usage = result['usage'] or {}
+        input_tokens = usage.get('prompt_tokens') or tokenizer_service.count_messages(messages, model)
+        output_tokens = usage.get('completion_tokens') or tokenizer_service.count_text(result['content'], model)
+        first, last = timings['first'], timings['last']
+        cost = provider.calculate_cost(model, input_tokens, output_tokens)['total_cost'] if sample['ok'] else 0.0
+        sample.update({
+            'ttft_ms': round((first - started) * 1000, 2) if first else None,
+            'itl_ms': round((last - first) * 1000 / (output_tokens - 1), 2) if first and output_tokens > 1 else None,
+            'latency_ms': round(elapsed * 1000, 2),
+            'input_tokens': input_tokens,
+            'output_tokens': output_tokens if sample['ok'] else 0,
+            'tokens_per_sec': round(output_tokens / elapsed, 2) if sample['ok'] and elapsed > 0 else None,
+            'cost_usd': cost
+        })
+        if sample['ok'] and not first:
+            sample.update({'ok': False, 'error': 'empty_response'})
+        return sample
+
+    def _summarize_target(self, provider: str, model: str, samples: List[Dict[str, Any]],
+                          wall: float) -> Dict[str, Any]:
+        succeeded = [sample for sample in samples if sample['ok']]
+        output_tokens = sum(sample['output_tokens'] for sample in succeeded)
+        cost = sum(sample['cost_usd'] for sample in succeeded)
+        summary = {
+            'provider': provider,
+            'model': model,
+            'free': self.provider_manager.is_free_model(model),
+            'requests': len(samples),
+            'succeeded': len(succeeded),
+            'errors': len(samples) - len(succeeded),
+            'error_rate': round((len(samples) - len(succeeded)) / len(samples), 4) if samples else 0.0,
+            'error_types': dict(Counter(sample['error'].split(':', 1)[0] for sample in samples if sample['error'])),
+            'throughput_tokens_per_sec': round(output_tokens / wall, 2) if wall > 0 else 0.0,
+            'input_tokens': sum(sample['input_tokens'] for sample in succeeded),
+            'output_tokens': output_tokens,
+            'cost_usd': round(cost, 6),
+            'cost_per_request_usd': round(cost / len(succeeded), 6) if succeeded else 0.0
+        }
+        for metric in SUMMARY_METRICS:
+            summary[metric] = summarize([sample[metric] for sample in succeeded if sample[metric] is not None])
+        return summary
+
+    def save(self, run: BenchmarkRun):
+        os.makedirs(self.directory, exist_ok=True)
+        report = run.report()
+        path = os.path.join(self.directory, f'{run.run_id}.json')
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        os.replace(path + '.tmp', path)
+        write_csv(report, self.csv_path(run.run_id))
+
+    def csv_path(self, run_id: str) -> str:
+        return os.path.join(self.directory, f'{run_id}.csv')
+
+    def get_report(self, run_id: str) -> Optional[Dict[str, Any]]:
+        """运行中的返回当前进度，已完成的从磁盘读取"""
+        run = self.runs.get(run_id)
+        if run and run.status == STATUS_RUNNING:
+            return run.report()
+        path = os.path.join(self.directory, f'{os.path.basename(run_id)}.json')
+        if not os.path.exists(path):
+            return None
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+
+    def list_runs(self) -> List[Dict[str, Any]]:
+        """列出运行（最新在前），包含各目标汇总"""
+        runs = {run_id: run.to_dict() for run_id, run in self.runs.items() if run.status == STATUS_RUNNING}
+        if os.path.isdir(self.directory):
+            for filename in os.listdir(self.directory):
+                if filename.endswith('.json') and filename[:-5] not in runs:
+                    report = self.get_report(filename[:-5])
+                    report.pop('samples', None)
+                    runs[report['run_id']] = report
+        return sorted(runs.values(), key=lambda run: run['created_at'], reverse=True)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {'running': sum(1 for run in self.runs.values() if run.status == STATUS_RUNNING)}
+
+
+# 全局基准测试实例
+model_benchmark: Optional[ModelBenchmark] = None
+
+
+def get_model_benchmark(provider_manager: Optional[ProviderManager] = None) -> ModelBenchmark:
+    """获取基准测试实例"""
+    global model_benchmark
+    if model_benchmark is None:
+        model_benchmark = ModelBenchmark(
+            provider_manager or ProviderManager(),
+            directory=config.benchmark_dir,
+            max_concurrency=config.benchmark_max_concurrency,
+            max_calls=config.benchmark_max_calls,
+            timeout=config.benchmark_timeout
+        )
+    return model_benchmark
+
+
+def print_summary(report: Dict[str, Any]):
+    print(f"\n{'目标':<48} 成功/总数  错误率   TTFT p50/p95(ms)   ITL p50(ms)  tok/s p50  成本(USD)")
+    for target in report['summary']:
+        name = f"{target['provider']}:{target['model']}" + (' [free]' if target['free'] else '')
+        print(f"{name:<48} {target['succeeded']:>4}/{target['requests']:<5} {target['error_rate']:<8} "
+              f"{target['ttft_ms']['p50']:>7}/{target['ttft_ms']['p95']:<9} {target['itl_ms']['p50']:<12} "
+              f"{target['tokens_per_sec']['p50']:<10} {target['cost_usd']}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="模型基准测试：TTFT、逐token延迟、吞吐、错误率与成本")
+    parser.add_argument("--targets", required=True, help="目标模型：\"provider:model,provider\" 或JSON数组")
+    parser.add_argument("--prompts", help="提示词集JSONL（默认使用内置提示词集）")
+    parser.add_argument("--repeat", type=int, default=3, help="每条提示词的重复次数")
+    parser.add_argument("--concurrency", type=int, default=1, help="每个目标同时进行的调用数")
+    parser.add_argument("--timeout", type=float, default=config.benchmark_timeout, help="单次调用超时秒数")
+    parser.add_argument("--name", default="")
+    parser.add_argument("--output", help="报告写入JSON文件（默认保存到 BENCHMARK_DIR）")
+    parser.add_argument("--csv", help="汇总写入CSV文件")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+    prompts = None
+    if args.prompts:
+        with open(args.prompts, 'rb') as f:
+            prompts = parse_items(f.read(), config.benchmark_max_calls)
+    # 命令行不受接口的并发与调用次数上限约束
+    benchmark = ModelBenchmark(ProviderManager(), directory=config.benchmark_dir,
+                               max_concurrency=args.concurrency, max_calls=float('inf'), timeout=args.timeout)
+    run = benchmark.create(args.targets, prompts, args.repeat, args.concurrency, args.name)
+    report = asyncio.run(benchmark.execute(run))
+    if report['error']:
+        print(f"运行失败: {report['error']}")
+    print_summary(report)
+    print(f"\n报告: {os.path.join(benchmark.directory, run.run_id + '.json')}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    if args.csv:
+        write_csv(report, args.csv)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""
+多路复用WebSocket协议（/ws/mux）
+
+一个WebSocket连接上同时承载多个流（单聊、群聊、状态推送），每个流有客户端指定的 stream id，
+帧为JSON（或握手时协商的MessagePack，见 ws_codec.py），字段 op 表示帧类型。
+
+客户端 -> 服务端:
+    {"op": "open",   "stream": 1, "kind": "chat", "params": {...}, "credit": 64}
+    {"op": "data",   "stream": 1, "data": {...}}      # 发给流的消息（如群聊的 user_message）
+    {"op": "credit", "stream": 1, "n": 32}            # 追加可接收的数据帧数
+    {"op": "cancel", "stream": 1}
+    {"op": "ping"} / {"op": "pong"}
+
+服务端 -> 客户端:
+    {"op": "opened", "stream": 1, ...}
+    {"op": "data",   "stream": 1, "data": {...}}      # 每帧消耗该流的一个credit
+    {"op": "close",  "stream": 1, "reason": "end" | "cancelled" | "error", "error": "..."}
+    {"op": "close",  "stream": 1, "reason": "rejected", "error": "...", "retryAfter": 2}   # 未获准入或超出配额
+    {"op": "error",  "stream": 1, "error": "..."}     # 协议错误（如重复的stream id）
+    {"op": "ping"} / {"op": "pong"}
+    {"op": "draining", "reconnect": true, "retryAfter": 2, "deadline": ...}   # 服务排空，进行中的流结束后以1012关闭
+
+流量控制按流进行：某个流的credit用完时只有该流暂停（其上游随之暂停），其他流不受影响。
+控制帧（opened/close/error/ping/pong/draining）不消耗credit。
+
+流的类型由 mux_kinds 注册，处理函数签名为 async def run(stream: MuxStream, params: dict)，
+函数返回即流正常结束。MuxStream 同时实现了 accept/send_text/close，
+可以作为WebSocket交给 websocket_handler.ConnectionManager 使用。
+"""
+
+import asyncio
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+from admission import AdmissionRejected
+from quota import QuotaExceeded
+from backpressure import ConnectionWriter, POLICY_BLOCK, CLOSE_DISCONNECTED, CLOSE_DRAINING
+from config import config
+from heartbeat import heartbeat_monitor
+from lifecycle import WS_CLOSE_SERVICE_RESTART, drain_controller
+from ws_codec import WireCodec, accept_websocket, json_codec
+
+logger = logging.getLogger(__name__)
+
+# 流类型 -> 处理函数
+MuxHandler = Callable[['MuxStream', Dict[str, Any]], Awaitable[Any]]
+mux_kinds: Dict[str, MuxHandler] = {}
+
+
+def register_kind(kind: str, handler: MuxHandler):
+    """注册流类型"""
+    mux_kinds[kind] = handler
+
+
+def parse_sse_event(event: str) -> Tuple[Optional[str], Any]:
+    """把一条SSE事件拆成 (id, data)，data 能解析为JSON时返回解析结果"""
+    event_id = None
+    lines = []
+    for line in event.splitlines():
+        if line.startswith('id:'):
+            event_id = line[3:].strip()
+        elif line.startswith('data:'):
+            lines.append(line[5:].lstrip())
+    text = '\n'.join(lines)
+    try:
+        return event_id, json.loads(text)
+    except ValueError:
+        return event_id, text
+
+
+def parse_credit(value: Any) -> Optional[int]:
+    """credit 必须是非负整数（JSON数字或数字字符串），否则返回None"""
+    if isinstance(value, bool):
+        return None
+    try:
+        credit = int(value)
+    except (TypeError, ValueError, OverflowError):
+        return None
+    return credit if credit >= 0 else None
+
+
+def valid_stream_id(stream_id: Any) -> bool:
+    """stream id 只能是字符串或整数（作为字典键，且能原样写回帧中）"""
+    return isinstance(stream_id, (str, int)) and not isinstance(stream_id, bool)
+
+
+class MuxStream:
+    """多路复用连接上的一个流"""
+
+    def __init__(self, connection: 'MuxConnection', stream_id: Any, kind: str, credit: int):
+        self.connection = connection
+        self.stream_id = stream_id
+        self.kind = kind
+        self.credit = credit
+        self._credit_available = asyncio.Event()
+        if credit > 0:
+            self._credit_available.set()
+        self.inbound: asyncio.Queue = asyncio.Queue()
+        self.task: Optional[asyncio.Task] = None
+        # 客户端主动取消（区别于连接断开：断开时可续传的生成继续在后台运行）
+        self.cancelled = False
+        self.closed = False
+        self.frames_sent = 0
+
+    def grant(self, n: int):
+        self.credit += n
+        if self.credit > 0:
+            self._credit_available.set()
+
+    async def emit(self, data: Any, **extra):
+        """发送数据帧：没有credit时等待客户端追加"""
+        while self.credit <= 0:
+            if self.closed:
+                raise asyncio.CancelledError()
+            self._credit_available.clear()
+            await self._credit_available.wait()
+        self.credit -= 1
+        self.frames_sent += 1
+        await self.connection.send_frame({'op': 'data', 'stream': self.stream_id, **extra, 'data': data})
+
+    async def receive(self) -> Any:
+        """接收客户端发给本流的消息"""
+        return await self.inbound.get()
+
+    # 以下方法使流可以当作WebSocket交给 ConnectionManager 使用
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text: str):
+        await self.emit(json.loads(text))
+
+    async def close(self, code: int = 1000, reason: str = ''):
+        if self.task and self.task is not asyncio.current_task():
+            self.task.cancel()
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            'stream': self.stream_id,
+            'kind': self.kind,
+            'credit': self.credit,
+            'frames_sent': self.frames_sent,
+            'inbound_pending': self.inbound.qsize()
+        }
+
+
+class MuxConnection:
+    """一个多路复用WebSocket连接：解析帧、管理流、共享一个发送队列"""
+
+    def __init__(self, websocket: WebSocket):
+        self.websocket = websocket
+        self.streams: Dict[Any, MuxStream] = {}
+        self.writer: Optional[ConnectionWriter] = None
+        self.codec: WireCodec = json_codec
+
+    async def send_frame(self, frame: Dict[str, Any]):
+        """按连接的编码编码后放入发送队列"""
+        if self.writer:
+            await self.writer.send(self.codec.encode(frame))
+
+    async def run(self):
+        self.codec = await accept_websocket(self.websocket)
+        # 各流的数据帧已受credit限制，共享的发送队列满时直接等待
+        self.writer = ConnectionWriter(
+            f"mux:{id(self.websocket)}", lambda frame: self.codec.send_frame(self.websocket, frame),
+            config.ws_queue_size, POLICY_BLOCK, send_timeout=config.ws_send_timeout,
+            on_close=self._writer_closed
+        )
+        self.writer.start()
+        heartbeat_monitor.register(self.websocket, 'mux', self._send_ping, self._reaped)
+        drain_controller.on_drain(self._send_drain_hint, lambda: self.writer.channel.close(CLOSE_DRAINING))
+        mux_metrics['connections'] += 1
+        try:
+            while True:
+                try:
+                    frame = await self.codec.receive(self.websocket)
+                except ValueError:
+                    await self.send_frame({'op': 'error', 'error': f'无法解析的帧（{self.codec.name}）'})
+                    continue
+                if not isinstance(frame, dict):
+                    await self.send_frame({'op': 'error', 'error': '帧必须是对象'})
+                    continue
+                op = frame.get('op')
+                heartbeat_monitor.touch(self.websocket, activity=op not in ('ping', 'pong'))
+                await self.dispatch(op, frame)
+        except WebSocketDisconnect:
+            pass
+        except Exception as e:
+            logger.error(f"多路复用连接异常: {e}")
+        finally:
+            mux_metrics['connections'] -= 1
+            heartbeat_monitor.unregister(self.websocket)
+            for stream in list(self.streams.values()):
+                self._stop(stream)
+            self.writer.close()
+
+    async def dispatch(self, op: Optional[str], frame: Dict[str, Any]):
+        stream_id = frame.get('stream')
+        if stream_id is not None and not valid_stream_id(stream_id):
+            await self.send_frame({'op': 'error', 'stream': stream_id, 'error': 'stream id 必须是字符串或整数'})
+            return
+        if op == 'ping':
+            await self.send_frame({'op': 'pong'})
+        elif op == 'pong':
+            pass
+        elif op == 'open':
+            await self.open(stream_id, frame)
+        elif stream_id not in self.streams:
+            # 流刚结束时客户端发出的credit/cancel属于正常竞争，直接忽略
+            if op in ('credit', 'cancel'):
+                return
+            await self.send_frame({'op': 'error', 'stream': stream_id, 'error': '流不存在或已关闭'})
+        elif op == 'data':
+            await self.streams[stream_id].inbound.put(frame.get('data'))
+        elif op == 'credit':
+            n = parse_credit(frame.get('n') or 0)
+            if n is None:
+                await self.send_frame({'op': 'error', 'stream': stream_id, 'error': f"credit 必须是非负整数: {frame.get('n')!r}"})
+                return
+            self.streams[stream_id].grant(n)
+        elif op == 'cancel':
+            stream = self.streams[stream_id]
+            stream.cancelled = True
+            self._stop(stream)
+        else:
+            await self.send_frame({'op': 'error', 'stream': stream_id, 'error': f'未知的帧类型: {op}'})
+
+    async def open(self, stream_id: Any, frame: Dict[str, Any]):
+        kind = frame.get('kind')
+        credit = parse_credit(frame['credit'] if frame.get('credit') is not None else config.mux_initial_credit)
+        error = None
+        if stream_id is None or stream_id in self.streams:
+            error = 'stream id 缺失或已被使用'
+        elif not isinstance(kind, str) or kind not in mux_kinds:
+            error = f'不支持的流类型: {kind}'
+        elif credit is None:
+            error = f"credit 必须是非负整数: {frame.get('credit')!r}"
+        elif len(self.streams) >= config.mux_max_streams:
+            error = f'每个连接最多同时打开 {config.mux_max_streams} 个流'
+        if error:
+            await self.send_frame({'op': 'error', 'stream': stream_id, 'error': error})
+            return
+        stream = MuxStream(self, stream_id, kind, credit)
+        self.streams[stream_id] = stream
+        mux_metrics['streams_opened'] += 1
+        stream.task = asyncio.create_task(self._run_stream(stream, frame.get('params') or {}))
+
+    async def _run_stream(self, stream: MuxStream, params: Dict[str, Any]):
+        reason, error, retry_after = 'end', None, None
+        try:
+            await self.send_frame({'op': 'opened', 'stream': stream.stream_id, 'kind': stream.kind})
+            await mux_kinds[stream.kind](stream, params)
+        except asyncio.CancelledError:
+            reason = 'cancelled'
+        except (AdmissionRejected, QuotaExceeded) as e:
+            reason, error, retry_after = 'rejected', str(e), e.retry_after
+        except Exception as e:
+            logger.error(f"多路复用流 {stream.stream_id} ({stream.kind}) 失败: {e}")
+            reason, error = 'error', str(e)
+        finally:
+            stream.closed = True
+            self.streams.pop(stream.stream_id, None)
+        frame = {'op': 'close', 'stream': stream.stream_id, 'reason': reason}
+        if error:
+            frame['error'] = error
+        if retry_after is not None:
+            frame['retryAfter'] = retry_after
+        try:
+            await self.send_frame(frame)
+        except Exception:
+            pass
+
+    def _send_ping(self, text: str) -> bool:
+        """心跳ping改为多路复用的控制帧"""
+        return self.writer.send_nowait(self.codec.encode({'op': 'ping', 'timestamp': json.loads(text)['timestamp']}))
+
+    def _stop(self, stream: MuxStream):
+        stream.closed = True
+        stream._credit_available.set()
+        if stream.task and not stream.task.done():
+            stream.task.cancel()
+
+    async def _reaped(self):
+        """心跳判定连接失效：结束所有流"""
+        for stream in list(self.streams.values()):
+            self._stop(stream)
+
+    def _send_drain_hint(self, hint: Dict[str, Any]):
+        """排空时的重连提示作为连接级控制帧发送"""
+        self.writer.send_nowait(self.codec.encode({'op': 'draining', **{k: v for k, v in hint.items() if k != 'type'}}))
+
+    async def _writer_closed(self, reason: str):
+        if reason != CLOSE_DISCONNECTED:
+            code = WS_CLOSE_SERVICE_RESTART if reason == CLOSE_DRAINING else 1013
+            try:
+                await asyncio.wait_for(self.websocket.close(code=code), 1)
+            except Exception:
+                pass
+
+
+# 多路复用指标
+mux_metrics = {'connections': 0, 'streams_opened': 0}
+
+
+def get_mux_stats() -> Dict[str, Any]:
+    return dict(mux_metrics)
@@ -0,0 +1,296 @@
+"""
+近似重复提示词缓存
+
+很多提示词只在空白、标点或个别字词上有差异，精确缓存无法命中。
+这里在本地计算 SimHash（64位）与 MinHash 签名：先用 NumPy 向量化的
+汉明距离在同一分区内筛选候选，再用 MinHash 估计的 Jaccard 相似度按模型阈值确认。
+完全离线运行，不依赖任何向量/嵌入服务。
+"""
+
+import hashlib
+import logging
+import re
+import threading
+import time
+import unicodedata
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# MinHash 使用的哈希函数数量，每个函数用不同种子异或后经 splitmix64 混洗
+MINHASH_PERMUTATIONS = 128
+_rng = np.random.RandomState(20250908)
+_MINHASH_SEEDS = _rng.randint(0, np.iinfo(np.int64).max, size=MINHASH_PERMUTATIONS, dtype=np.int64).astype(np.uint64)
+_BIT_SHIFTS = np.arange(64, dtype=np.uint64)
+
+_DIGITS_RE = re.compile(r'\d+')
+
+
+def normalize_text(text: str) -> str:
+    """归一化：NFKC、小写、去掉空白与标点符号"""
+    text = unicodedata.normalize('NFKC', text).lower()
+    return ''.join(
+        ch for ch in text
+        if not unicodedata.category(ch).startswith(('P', 'Z', 'S', 'C'))
+    )
+
+
+def extract_features(text: str, ngram: int = 3) -> List[str]:
+    """提取字符n-gram特征，中英文统一处理"""
+    normalized = normalize_text(text)
+    if len(normalized) <= ngram:
+        return [normalized] if normalized else []
+    return [normalized[i:i + ngram] for i in range(len(normalized) - ngram + 1)]
+
+
+def _hash_features(features: List[str]) -> np.ndarray:
+    """将特征哈希为64位整数"""
+    return np.fromiter(
+        (int.from_bytes(hashlib.blake2b(f.encode('utf-8'), digest_size=8).digest(), 'little') for f in features),
+        dtype=np.uint64,
+        count=len(features)
+    )
+
+
+def simhash(hashes: np.ndarray) -> int:
+    """根据特征哈希计算64位SimHash"""
+    if hashes.size == 0:
+        return 0
+    bits = ((hashes[:, None] >> _BIT_SHIFTS) & np.uint64(1)).astype(np.int32)
+    votes = (bits * 2 - 1).sum(axis=0)
+    signature = 0
+    for i in np.nonzero(votes > 0)[0]:
+        signature |= 1 << int(i)
+    return signature
+
+
+def _splitmix64(values: np.ndarray) -> np.ndarray:
+    """splitmix64 混洗（uint64 乘法按 2^64 自然溢出）"""
+    z = values + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def minhash(hashes: np.ndarray) -> np.ndarray:
+    """根据特征哈希计算MinHash签名"""
+    if hashes.size == 0:
+        return np.full(MINHASH_PERMUTATIONS, np.iinfo(np.uint64).max, dtype=np.uint64)
+    return _splitmix64(hashes[:, None] ^ _MINHASH_SEEDS).min(axis=0)
+
+
+def hamming_distances(signatures: np.ndarray, query: int) -> np.ndarray:
+    """向量化计算一组64位签名与查询签名的汉明距离"""
+    xor = signatures ^ np.uint64(query)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(xor)
+    return np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class _Partition:
+    """同一分区（相同模型、相同上文与参数）内的签名索引"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.signatures = np.zeros(0, dtype=np.uint64)
+        self.minhashes = np.zeros((0, MINHASH_PERMUTATIONS), dtype=np.uint64)
+        self.entries: List[Dict[str, Any]] = []
+
+    def add(self, signature: int, mh: np.ndarray, entry: Dict[str, Any]):
+        self.signatures = np.append(self.signatures, np.uint64(signature))
+        self.minhashes = np.vstack([self.minhashes, mh[None, :]])
+        self.entries.append(entry)
+        if len(self.entries) > self.capacity:
+            overflow = len(self.entries) - self.capacity
+            self.signatures = self.signatures[overflow:]
+            self.minhashes = self.minhashes[overflow:]
+            self.entries = self.entries[overflow:]
+
+    def remove(self, entry_id: str) -> bool:
+        for i, entry in enumerate(self.entries):
+            if entry['entry_id'] == entry_id:
+                self.signatures = np.delete(self.signatures, i)
+                self.minhashes = np.delete(self.minhashes, i, axis=0)
+                del self.entries[i]
+                return True
+        return False
+
+
+class NearDuplicateCache:
+    """基于SimHash/MinHash的近似重复响应缓存"""
+
+    def __init__(
+        self,
+        endpoints: List[str],
+        thresholds: Dict[str, float],
+        max_hamming: int = 16,
+        max_entries: int = 5000,
+        ttl: int = 3600,
+        partition_capacity: int = 256
+    ):
+        self.endpoints = set(endpoints)
+        self.thresholds = thresholds
+        self.max_hamming = max_hamming
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.partition_capacity = partition_capacity
+        self._partitions: "OrderedDict[str, _Partition]" = OrderedDict()
+        self._entry_partition: Dict[str, str] = {}
+        self._lock = threading.Lock()
+        self.metrics = {
+            'lookups': 0,
+            'hits': 0,
+            'misses': 0,
+            'rejected_candidates': 0,
+            'false_hits': 0
+        }
+
+    def is_enabled(self, endpoint: str) -> bool:
+        """端点是否开启近似缓存"""
+        return endpoint in self.endpoints
+
+    def threshold_for(self, model: str) -> float:
+        """获取模型的相似度阈值"""
+        return float(self.thresholds.get(model, self.thresholds.get('default', 0.8)))
+
+    @staticmethod
+    def _partition_key(provider: str, model: str, messages: List[Dict[str, Any]], params: Dict[str, Any]) -> str:
+        """分区键：除最后一条用户消息外的上文必须完全一致"""
+        context = [(m.get('role'), m.get('content')) for m in messages[:-1]]
+        raw = repr((provider, model, context, sorted((k, v) for k, v in params.items() if v is not None)))
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def _signatures(text: str) -> Tuple[int, np.ndarray]:
+        hashes = _hash_features(extract_features(text))
+        return simhash(hashes), minhash(hashes)
+
+    def lookup(self, provider: str, model: str, messages: List[Dict[str, Any]], **params) -> Optional[Dict[str, Any]]:
+        """查找近似重复的已缓存回答，命中时返回条目（附带相似度）"""
+        if not messages:
+            return None
+        query_text = messages[-1].get('content', '')
+        key = self._partition_key(provider, model, messages, params)
+        signature, mh = self._signatures(query_text)
+        digits = _DIGITS_RE.findall(query_text)
+        threshold = self.threshold_for(model)
+        now = time.time()
+
+        with self._lock:
+            self.metrics['lookups'] += 1
+            partition = self._partitions.get(key)
+            if partition is None or not partition.entries:
+                self.metrics['misses'] += 1
+                return None
+            self._partitions.move_to_end(key)
+
+            distances = hamming_distances(partition.signatures, signature)
+            candidates = np.nonzero(distances <= self.max_hamming)[0]
+            best, best_similarity = None, 0.0
+            for idx in candidates[np.argsort(distances[candidates])]:
+                entry = partition.entries[idx]
+                if entry['expires_at'] < now:
+                    continue
+                similarity = float(np.mean(partition.minhashes[idx] == mh))
+                # 数字不同的问题（如不同的算式、年份）视为不同问题
+                if similarity < threshold or entry['digits'] != digits:
+                    self.metrics['rejected_candidates'] += 1
+                    continue
+                if similarity > best_similarity:
+                    best, best_similarity = entry, similarity
+                    if similarity >= 1.0:
+                        break
+
+            if best is None:
+                self.metrics['misses'] += 1
+                return None
+            self.metrics['hits'] += 1
+            return dict(best, similarity=best_similarity)
+
+    def add(self, provider: str, model: str, messages: List[Dict[str, Any]], entry: Dict[str, Any], **params) -> Optional[str]:
+        """缓存回答，返回条目ID"""
+        if not messages or not entry.get('content'):
+            return None
+        query_text = messages[-1].get('content', '')
+        key = self._partition_key(provider, model, messages, params)
+        signature, mh = self._signatures(query_text)
+        entry_id = uuid.uuid4().hex[:12]
+        record = dict(
+            entry,
+            entry_id=entry_id,
+            digits=_DIGITS_RE.findall(query_text),
+            expires_at=time.time() + self.ttl
+        )
+
+        with self._lock:
+            partition = self._partitions.get(key)
+            if partition is None:
+                partition = _Partition(self.partition_capacity)
+                self._partitions[key] = partition
+            self._partitions.move_to_end(key)
+            partition.add(signature, mh, record)
+            self._entry_partition[entry_id] = key
+            self._evict()
+        return entry_id
+
+    def report_false_hit(self, entry_id: str) -> bool:
+        """客户端反馈错误命中：计数并移除该条目"""
+        with self._lock:
+            key = self._entry_partition.pop(entry_id, None)
+            if key is None:
+                return False
+            self.metrics['false_hits'] += 1
+            partition = self._partitions.get(key)
+            if partition is not None:
+                partition.remove(entry_id)
+            return True
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._partitions.clear()
+            self._entry_partition.clear()
+
+    def _evict(self):
+        """超过总条目上限时淘汰最久未使用的分区"""
+        total = sum(len(p.entries) for p in self._partitions.values())
+        while total > self.max_entries and self._partitions:
+            _, partition = self._partitions.popitem(last=False)
+            total -= len(partition.entries)
+            for entry in partition.entries:
+                self._entry_partition.pop(entry['entry_id'], None)
+        if len(self._entry_partition) > self.max_entries * 2:
+            # 分区内部滚动淘汰的条目也从反查表中清理
+            live = {e['entry_id'] for p in self._partitions.values() for e in p.entries}
+            self._entry_partition = {k: v for k, v in self._entry_partition.items() if k in live}
+
+    def get_stats(self) -> Dict[str, Any]:
+        """命中与错误命中统计"""
+        hits = self.metrics['hits']
+        lookups = self.metrics['lookups']
+        return {
+            'endpoints': sorted(self.endpoints),
+            'thresholds': self.thresholds,
+            'max_hamming': self.max_hamming,
+            'entries': sum(len(p.entries) for p in self._partitions.values()),
+            'partitions': len(self._partitions),
+            **self.metrics,
+            'hit_rate': hits / lookups if lookups else 0.0,
+            'false_hit_rate': self.metrics['false_hits'] / hits if hits else 0.0
+        }
+
+
+# 全局近似缓存实例
+near_duplicate_cache = NearDuplicateCache(
+    endpoints=config.near_dup_cache_endpoints,
+    thresholds=config.near_dup_cache_thresholds,
+    max_hamming=config.near_dup_cache_max_hamming,
+    max_entries=config.near_dup_cache_max_entries,
+    ttl=config.near_dup_cache_ttl
+)
@@ -19,7 +19,7 @@ from .base import (
     BaseModelProvider, ProviderConfig, ProviderType, ModelInfo,
     StreamChunk, CompletionResponse, ProviderError,
     ProviderConnectionError, ProviderAuthenticationError, 
-    ProviderRateLimitError, ProviderModelNotFoundError
+    ProviderRateLimitError, ProviderModelNotFoundError, normalize_usage
 )
 from .openrouter import OpenRouterProvider
 from .openai import OpenAIProvider
@@ -30,6 +30,6 @@ __all__ = [
     'BaseModelProvider', 'ProviderConfig', 'ProviderType', 'ModelInfo',
     'StreamChunk', 'CompletionResponse', 'ProviderError',
     'ProviderConnectionError', 'ProviderAuthenticationError', 
-    'ProviderRateLimitError', 'ProviderModelNotFoundError',
+    'ProviderRateLimitError', 'ProviderModelNotFoundError', 'normalize_usage',
     'OpenRouterProvider', 'OpenAIProvider', 'GLMProvider', 'ProviderManager'
 ]
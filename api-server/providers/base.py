@@ -9,6 +9,7 @@ from typing import Dict, List, Any, Optional, AsyncGenerator, Union
 from pydantic import BaseModel, Field
 from enum import Enum
 import asyncio
+import inspect
 import logging
 
 logger = logging.getLogger(__name__)
@@ -52,6 +53,34 @@ class StreamChunk(BaseModel):
     provider: str = Field(..., description="提供商")
     usage: Optional[Dict[str, int]] = Field(None, description="Token使用统计")
 
+def normalize_usage(usage: Any) -> Optional[Dict[str, int]]:
+    """
+    把各家返回的usage统一为 prompt/completion/total 与缓存token字段
+
+    缓存读取token的来源：OpenAI/OpenRouter 的 prompt_tokens_details.cached_tokens、
+    DeepSeek 的 prompt_cache_hit_tokens、Anthropic 风格的 cache_read_input_tokens。
+    """
+    if not usage:
+        return None
+    if not isinstance(usage, dict):
+        usage = usage.model_dump() if hasattr(usage, 'model_dump') else dict(vars(usage))
+    details = usage.get('prompt_tokens_details') or {}
+    cache_read = (
+        usage.get('cache_read_input_tokens')
+        or details.get('cached_tokens')
+        or usage.get('prompt_cache_hit_tokens')
+        or 0
+    )
+    prompt_tokens = usage.get('prompt_tokens') or 0
+    completion_tokens = usage.get('completion_tokens') or 0
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": usage.get('total_tokens') or prompt_tokens + completion_tokens,
+        "cache_creation_input_tokens": usage.get('cache_creation_input_tokens') or 0,
+        "cache_read_input_tokens": cache_read
+    }
+
 class CompletionResponse(BaseModel):
     """完成响应"""
     content: str = Field(..., description="完整内容")
@@ -222,6 +251,27 @@ class BaseModelProvider(ABC):
             "currency": "USD"
         }
         
+    def completion_params(self, **params) -> Dict[str, Any]:
+        """
+        chat_completion 实际使用的采样参数（用于响应缓存键）
+        
+        未指定（None）的参数取本提供商 chat_completion 的默认值，
+        依赖不同默认值的请求得到不同的参数
+        
+        Args:
+            **params: 请求指定的参数，如 temperature、max_tokens
+            
+        Returns:
+            Dict[str, Any]: 传给 chat_completion 的参数
+        """
+        effective = {}
+        for name, parameter in inspect.signature(self.chat_completion).parameters.items():
+            if name in ('messages', 'model', 'stream') or parameter.default is inspect.Parameter.empty:
+                continue
+            effective[name] = parameter.default
+        effective.update({name: value for name, value in params.items() if value is not None})
+        return effective
+        
     @property
     def provider_name(self) -> str:
         """获取提供商名称"""
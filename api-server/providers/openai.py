@@ -17,7 +17,7 @@ from .base import (
     BaseModelProvider, ProviderConfig, ProviderType, ModelInfo,
     StreamChunk, ProviderError, ProviderConnectionError, 
     ProviderAuthenticationError, ProviderRateLimitError,
-    ProviderModelNotFoundError
+    ProviderModelNotFoundError, normalize_usage
 )
 
 logger = logging.getLogger(__name__)
@@ -189,6 +189,9 @@ class OpenAIProvider(BaseModelProvider):
         
         logger.info(f"OpenAI请求 - ID: {request_id}, 模型: {model}, 流式: {stream}")
         
+        # 流式请求默认要求返回usage（最后一块），不兼容的服务可传 include_usage=False 关闭
+        include_usage = kwargs.pop('include_usage', True)
+        
         try:
             # 转换消息格式
             converted_messages = self._convert_messages(messages)
@@ -201,6 +204,8 @@ class OpenAIProvider(BaseModelProvider):
                 "max_tokens": max_tokens,
                 "stream": stream
             }
+            if stream and include_usage:
+                request_params["stream_options"] = {"include_usage": True}
             
             # 添加其他参数
             for key, value in kwargs.items():
@@ -227,10 +232,25 @@ class OpenAIProvider(BaseModelProvider):
                                 provider=self.provider_name
                             )
                             
-                        # 检查完成状态
+                        # 检查完成状态（请求了usage时继续读取最后的usage块）
                         if choice.finish_reason is not None:
                             logger.info(f"OpenAI完成 - 原因: {choice.finish_reason}")
-                            return
+                            if not include_usage and not getattr(chunk, 'usage', None):
+                                return
+                    
+                    # 开启include_usage时，usage在choices为空的最后一块中返回；
+                    # 部分兼容服务把usage放在最后一个内容块中，需先输出上面的内容
+                    if getattr(chunk, 'usage', None):
+                        yield StreamChunk(
+                            content="",
+                            chunk_id=chunk_count + 1,
+                            request_id=request_id,
+                            timestamp=time.time(),
+                            model=model,
+                            provider=self.provider_name,
+                            usage=normalize_usage(chunk.usage)
+                        )
+                        return
             else:
                 # 非流式响应
                 response = await self.client.chat.completions.create(**request_params)
@@ -241,11 +261,7 @@ class OpenAIProvider(BaseModelProvider):
                     # 提取usage信息
                     usage_info = None
                     if hasattr(response, 'usage') and response.usage:
-                        usage_info = {
-                            "prompt_tokens": response.usage.prompt_tokens,
-                            "completion_tokens": response.usage.completion_tokens,
-                            "total_tokens": response.usage.total_tokens
-                        }
+                        usage_info = normalize_usage(response.usage)
                     
                     yield StreamChunk(
                         content=content,
@@ -16,7 +16,7 @@ import logging
 from .base import (
     BaseModelProvider, ProviderConfig, ProviderType, ModelInfo,
     StreamChunk, ProviderError, ProviderConnectionError, 
-    ProviderAuthenticationError, ProviderRateLimitError
+    ProviderAuthenticationError, ProviderRateLimitError, normalize_usage
 )
 
 logger = logging.getLogger(__name__)
@@ -221,16 +221,7 @@ class OpenRouterProvider(BaseModelProvider):
                         content = result["choices"][0]["message"]["content"]
                         
                         # 提取token使用信息
-                        usage_info = None
-                        if "usage" in result:
-                            usage_data = result["usage"]
-                            usage_info = {
-                                "prompt_tokens": usage_data.get("prompt_tokens", 0),
-                                "completion_tokens": usage_data.get("completion_tokens", 0),
-                                "total_tokens": usage_data.get("total_tokens", 0),
-                                "cache_creation_input_tokens": usage_data.get("cache_creation_input_tokens", 0),
-                                "cache_read_input_tokens": usage_data.get("cache_read_input_tokens", 0)
-                            }
+                        usage_info = normalize_usage(result.get("usage"))
                         
                         yield StreamChunk(
                             content=content,
@@ -277,23 +268,12 @@ class OpenRouterProvider(BaseModelProvider):
                                             provider=self.provider_name
                                         )
                                 
-                                # 检查完成状态
+                                # 完成后不立即返回：usage在finish_reason之后的最后一块中
                                 if choice.get('finish_reason') is not None:
                                     logger.info(f"OpenRouter完成 - 原因: {choice.get('finish_reason')}")
-                                    return
                             
                             # 处理token使用信息（通常在最后一个chunk中）
-                            if 'usage' in chunk_data:
-                                usage_data = chunk_data['usage']
-                                # 提取token使用信息并通过最后一个chunk传递
-                                usage_info = {
-                                    "prompt_tokens": usage_data.get("prompt_tokens", 0),
-                                    "completion_tokens": usage_data.get("completion_tokens", 0),
-                                    "total_tokens": usage_data.get("total_tokens", 0),
-                                    "cache_creation_input_tokens": usage_data.get("cache_creation_input_tokens", 0),
-                                    "cache_read_input_tokens": usage_data.get("cache_read_input_tokens", 0)
-                                }
-                                
+                            if chunk_data.get('usage'):
                                 # 发送包含usage信息的最后一个chunk
                                 yield StreamChunk(
                                     content="",
@@ -302,20 +282,9 @@ class OpenRouterProvider(BaseModelProvider):
                                     timestamp=time.time(),
                                     model=model,
                                     provider=self.provider_name,
-                                    usage=usage_info
+                                    usage=normalize_usage(chunk_data['usage'])
                                 )
                                 return
-                                
-                                # 发送包含token使用信息的特殊chunk
-                                yield StreamChunk(
-                                    content="",
-                                    chunk_id=chunk_count + 1,
-                                    request_id=request_id,
-                                    timestamp=time.time(),
-                                    model=model,
-                                    provider=self.provider_name,
-                                    usage=usage_info
-                                )
                                     
         except aiohttp.ClientError as e:
             logger.error(f"OpenRouter连接错误: {e}")
@@ -0,0 +1,417 @@
+"""
+按用户与租户的请求数、token数配额
+
+每个用户和其所属租户各有每分钟请求数（requests_per_min）与每分钟token数（tokens_per_min）上限，
+用滑动窗口计数：上一窗口的计数按已过去的比例衰减后与当前窗口相加，不会在整分钟边界突然放开。
+
+- 计数默认在进程内；QUOTA_SYNC=true 时计数写入共享状态（shared_state.incr，
+  SHARED_STATE_BACKEND=sqlite/shm 时多个worker进程共享同一个SQLite计数），所有worker合计一个配额
+- 请求在调用上游之前检查：HTTP生成端点由 QuotaMiddleware 统一检查（超出返回429 + Retry-After），
+  WebSocket的每轮对话、群聊与讨论模式的每次模型调用另外检查token配额
+- 上游调用结束后按实际（或估算的）token数记账；用量通过响应头（x-ratelimit-*）
+  与SSE的 stats 事件（quota 字段）返回
+
+用户由 /api/login 发放的token识别（Authorization: Bearer，WebSocket可用 ?token=），
+token映射保存在共享状态中，各worker都能识别；未登录的请求按客户端IP计为匿名用户。
+
+使用方法:
+    app.add_middleware(QuotaMiddleware, manager=quota_manager)
+
+    await register_token(token, user)
+    await check_tokens(estimated_tokens)      # 一次上游调用之前
+    stats['quota'] = await record_usage(total_tokens)
+"""
+
+import contextvars
+import json
+import logging
+import math
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+
+from config import config
+from lifecycle import DrainController
+from shared_state import shared_state
+
+logger = logging.getLogger(__name__)
+
+METRIC_REQUESTS = 'requests'
+METRIC_TOKENS = 'tokens'
+_LIMIT_FIELDS = {METRIC_REQUESTS: 'requests_per_min', METRIC_TOKENS: 'tokens_per_min'}
+
+SCOPE_USER = 'user'
+SCOPE_TENANT = 'tenant'
+
+
+class QuotaExceeded(Exception):
+    """用户或租户的配额已用完"""
+
+    def __init__(self, scope: str, subject: str, metric: str, limit: int, retry_after: int):
+        self.scope = scope
+        self.subject = subject
+        self.metric = metric
+        self.limit = limit
+        self.retry_after = retry_after
+        self.reason = 'quota_exceeded'
+        scope_name = '用户' if scope == SCOPE_USER else '租户'
+        metric_name = '请求数' if metric == METRIC_REQUESTS else 'token数'
+        super().__init__(f"{scope_name} {subject} 的每分钟{metric_name}已达上限 {limit}，请 {retry_after} 秒后重试")
+
+
+class Identity:
+    """发起请求的用户与租户"""
+
+    __slots__ = ('user_id', 'username', 'tenant')
+
+    def __init__(self, user_id: str, username: str, tenant: str):
+        self.user_id = user_id
+        self.username = username
+        self.tenant = tenant
+
+
+class SlidingWindowCounter:
+    """进程内滑动窗口计数"""
+
+    def __init__(self, window: float):
+        self.window = window
+        # key -> [当前窗口序号, 当前窗口计数, 上一窗口计数]
+        self.windows: Dict[str, List[float]] = {}
+
+    def _roll(self, key: str, index: int) -> List[float]:
+        entry = self.windows.get(key)
+        if entry is None:
+            entry = self.windows[key] = [index, 0, 0]
+        elif entry[0] != index:
+            # 跳过一个以上窗口时上一窗口的计数为0
+            entry[2] = entry[1] if entry[0] == index - 1 else 0
+            entry[1] = 0
+            entry[0] = index
+        return entry
+
+    async def counts(self, key: str, now: float) -> Tuple[float, float]:
+        """(上一窗口计数, 当前窗口计数)"""
+        entry = self._roll(key, int(now // self.window))
+        return entry[2], entry[1]
+
+    async def add(self, key: str, amount: float, now: float):
+        self._roll(key, int(now // self.window))[1] += amount
+
+    def prune(self, now: float):
+        """清理两个窗口以上没有计数的键"""
+        index = int(now // self.window)
+        for key in [key for key, entry in self.windows.items() if entry[0] < index - 1]:
+            del self.windows[key]
+
+
+class SharedWindowCounter:
+    """写入共享状态的滑动窗口计数（每个窗口一个键，保留两个窗口）"""
+
+    def __init__(self, window: float):
+        self.window = window
+
+    def _key(self, key: str, index: int) -> str:
+        return f"quota:{key}:{index}"
+
+    async def counts(self, key: str, now: float) -> Tuple[float, float]:
+        index = int(now // self.window)
+        previous = await shared_state.get(self._key(key, index - 1), 0)
+        current = await shared_state.get(self._key(key, index), 0)
+        return float(previous or 0), float(current or 0)
+
+    async def add(self, key: str, amount: float, now: float):
+        if amount:
+            await shared_state.incr(self._key(key, int(now // self.window)), int(amount), ttl=self.window * 2)
+
+    def prune(self, now: float):
+        pass
+
+
+class QuotaManager:
+    """检查与记录用户、租户的配额"""
+
+    def __init__(self, limits: Dict[str, Any], user_tenants: Dict[str, str], window: float = 60.0,
+                 shared: bool = False, enabled: bool = True):
+        """
+        Args:
+            limits: {"user": {...}, "tenant": {...}, "user:admin": {...}, "tenant:demo": {...}}，
+                    值为 {"requests_per_min": N, "tokens_per_min": N}，0表示不限制，
+                    "user:{用户名}"、"tenant:{租户}" 覆盖默认值
+            user_tenants: 用户名 -> 租户，未列出的用户属于 default 租户
+        """
+        self.limits = limits
+        self.user_tenants = user_tenants
+        self.window = window
+        self.enabled = enabled
+        self.counter = SharedWindowCounter(window) if shared else SlidingWindowCounter(window)
+        self.metrics = {'checked': 0, 'rejected_requests': 0, 'rejected_tokens': 0, 'recorded_tokens': 0}
+        self._last_prune = 0.0
+
+    def tenant_of(self, username: str) -> str:
+        return self.user_tenants.get(username, 'default')
+
+    def limit(self, scope: str, subject: str, metric: str) -> int:
+        field = _LIMIT_FIELDS[metric]
+        override = self.limits.get(f"{scope}:{subject}") or {}
+        if field in override:
+            return int(override[field])
+        return int((self.limits.get(scope) or {}).get(field, 0))
+
+    @staticmethod
+    def _subjects(identity: Identity) -> Tuple[Tuple[str, str], ...]:
+        return (SCOPE_USER, identity.username), (SCOPE_TENANT, identity.tenant)
+
+    def _estimate(self, previous: float, current: float, now: float) -> float:
+        elapsed = (now % self.window) / self.window
+        return previous * (1 - elapsed) + current
+
+    def _retry_after(self, previous: float, excess: float, now: float) -> int:
+        """滑动窗口估计值降到上限以内需要等待的秒数"""
+        remaining = self.window - now % self.window
+        # 上一窗口的计数按 previous/window 每秒衰减，本窗口结束前能衰减掉 decay
+        decay = previous * remaining / self.window
+        if previous > 0 and excess <= decay:
+            return max(1, math.ceil(excess * self.window / previous))
+        return max(1, math.ceil(remaining))
+
+    async def _check(self, identity: Identity, metric: str, amount: float, now: float):
+        for scope, subject in self._subjects(identity):
+            limit = self.limit(scope, subject, metric)
+            if limit <= 0:
+                continue
+            previous, current = await self.counter.counts(f"{scope}:{subject}:{metric}", now)
+            estimate = self._estimate(previous, current, now)
+            # token数在调用结束后才记账：没有预估值时，已用量达到上限即拒绝
+            excess = estimate + max(amount, 1) - limit
+            if excess > 0:
+                self.metrics[f'rejected_{metric}'] += 1
+                retry_after = self._retry_after(previous, excess, now)
+                raise QuotaExceeded(scope, subject, metric, limit, retry_after)
+
+    async def admit(self, identity: Identity, estimated_tokens: int = 0) -> Dict[str, Any]:
+        """
+        一次请求开始前检查并计入请求数
+
+        Raises:
+            QuotaExceeded: 请求数或token数已达上限
+        """
+        if not self.enabled:
+            return {}
+        now = time.time()
+        self.metrics['checked'] += 1
+        await self._check(identity, METRIC_REQUESTS, 1, now)
+        await self._check(identity, METRIC_TOKENS, estimated_tokens, now)
+        for scope, subject in self._subjects(identity):
+            await self.counter.add(f"{scope}:{subject}:{METRIC_REQUESTS}", 1, now)
+        self._maybe_prune(now)
+        return await self.usage(identity, now)
+
+    async def ensure_tokens(self, identity: Identity, estimated_tokens: int = 0):
+        """同一请求中的又一次上游调用（如讨论模式的下一位发言者）之前检查token配额"""
+        if self.enabled:
+            await self._check(identity, METRIC_TOKENS, estimated_tokens, time.time())
+
+    async def record(self, identity: Identity, tokens: int) -> Dict[str, Any]:
+        """上游调用结束后记录token用量，返回当前用量"""
+        if not self.enabled:
+            return {}
+        now = time.time()
+        if tokens > 0:
+            self.metrics['recorded_tokens'] += tokens
+            for scope, subject in self._subjects(identity):
+                await self.counter.add(f"{scope}:{subject}:{METRIC_TOKENS}", tokens, now)
+        return await self.usage(identity, now)
+
+    async def usage(self, identity: Identity, now: Optional[float] = None) -> Dict[str, Any]:
+        """用户与租户在当前滑动窗口内的用量与剩余额度"""
+        now = now or time.time()
+        result: Dict[str, Any] = {
+            'user': identity.username,
+            'tenant': identity.tenant,
+            'window_seconds': self.window,
+            'reset_seconds': round(self.window - now % self.window, 1)
+        }
+        for scope, subject in self._subjects(identity):
+            usage = {}
+            for metric in (METRIC_REQUESTS, METRIC_TOKENS):
+                previous, current = await self.counter.counts(f"{scope}:{subject}:{metric}", now)
+                used = int(round(self._estimate(previous, current, now)))
+                limit = self.limit(scope, subject, metric)
+                usage[metric] = {
+                    'used': used,
+                    'limit': limit,
+                    'remaining': max(0, limit - used) if limit > 0 else None
+                }
+            result[f'{scope}_usage'] = usage
+        return result
+
+    @staticmethod
+    def headers(usage: Dict[str, Any]) -> List[Tuple[str, str]]:
+        """用量对应的响应头：取用户与租户中剩余最少的一项"""
+        if not usage:
+            return []
+        headers = []
+        for metric in (METRIC_REQUESTS, METRIC_TOKENS):
+            limited = [
+                usage[f'{scope}_usage'][metric] for scope in (SCOPE_USER, SCOPE_TENANT)
+                if usage[f'{scope}_usage'][metric]['limit'] > 0
+            ]
+            if not limited:
+                continue
+            tightest = min(limited, key=lambda item: item['remaining'])
+            headers.append((f'x-ratelimit-limit-{metric}', str(tightest['limit'])))
+            headers.append((f'x-ratelimit-remaining-{metric}', str(tightest['remaining'])))
+        headers.append(('x-ratelimit-reset', str(math.ceil(usage['reset_seconds']))))
+        return headers
+
+    def _maybe_prune(self, now: float):
+        if now - self._last_prune >= self.window:
+            self._last_prune = now
+            self.counter.prune(now)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': self.enabled,
+            'shared': isinstance(self.counter, SharedWindowCounter),
+            'window_seconds': self.window,
+            'limits': self.limits,
+            **self.metrics
+        }
+
+
+# 当前请求或WebSocket连接的用户（由中间件设置）
+_current_identity: contextvars.ContextVar[Optional[Identity]] = contextvars.ContextVar('quota_identity', default=None)
+
+
+def current_identity() -> Optional[Identity]:
+    return _current_identity.get()
+
+
+async def register_token(token: str, user: Dict[str, Any]):
+    """登录时登记token对应的用户（保存在共享状态中，各worker都能识别）"""
+    await shared_state.set(f"auth:token:{token}", {
+        'user_id': str(user.get('id', '')),
+        'username': user.get('username', ''),
+        'tenant': quota_manager.tenant_of(user.get('username', ''))
+    }, ttl=config.auth_token_ttl)
+
+
+async def resolve_identity(headers: Dict[str, str], query_string: bytes, client: Optional[Tuple[str, int]]) -> Identity:
+    """按登录token识别用户，未登录时按客户端IP识别为匿名用户"""
+    token = None
+    authorization = headers.get('authorization', '')
+    if authorization.lower().startswith('bearer '):
+        token = authorization[7:].strip()
+    elif query_string:
+        token = (parse_qs(query_string.decode('latin-1')).get('token') or [None])[0]
+    if token:
+        user = await shared_state.get(f"auth:token:{token}")
+        if user:
+            return Identity(user['user_id'], user['username'], user['tenant'])
+    host = client[0] if client else 'unknown'
+    return Identity(f"ip:{host}", f"ip:{host}", 'anonymous')
+
+
+async def identify(scope: Dict[str, Any]) -> Identity:
+    """请求（HTTP或WebSocket）的用户：配额中间件已识别时直接使用，否则按请求头识别"""
+    identity = current_identity()
+    if identity is None:
+        headers = {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope.get('headers', [])}
+        identity = await resolve_identity(headers, scope.get('query_string', b''), scope.get('client'))
+    return identity
+
+
+async def admit_current(estimated_tokens: int = 0) -> Dict[str, Any]:
+    """当前用户开始一轮对话（WebSocket）前检查配额，没有识别到用户时不检查"""
+    identity = current_identity()
+    return await quota_manager.admit(identity, estimated_tokens) if identity else {}
+
+
+async def check_tokens(estimated_tokens: int = 0):
+    """当前用户的一次上游调用之前检查token配额"""
+    identity = current_identity()
+    if identity:
+        await quota_manager.ensure_tokens(identity, estimated_tokens)
+
+
+async def record_usage(tokens: int) -> Dict[str, Any]:
+    """记录当前用户一次上游调用的token数，返回用量（放入SSE stats事件的 quota 字段）"""
+    identity = current_identity()
+    return await quota_manager.record(identity, tokens) if identity else {}
+
+
+class QuotaMiddleware:
+    """
+    ASGI中间件：识别用户；HTTP生成请求在调用端点前检查配额，超出时返回429，并在响应头中返回用量
+
+    exempt(headers) 为真的请求（如续传、幂等重放，不调用上游）只识别用户，不计入配额
+    """
+
+    def __init__(self, app, manager: QuotaManager,
+                 exempt: Optional[Callable[[Dict[str, str]], bool]] = None):
+        self.app = app
+        self.manager = manager
+        self.exempt = exempt
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] not in ('http', 'websocket') or not self.manager.enabled:
+            await self.app(scope, receive, send)
+            return
+        if scope['type'] == 'http' and not DrainController.is_generation(scope['method'], scope['path']):
+            await self.app(scope, receive, send)
+            return
+
+        headers = {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope['headers']}
+        identity = await resolve_identity(headers, scope.get('query_string', b''), scope.get('client'))
+        token = _current_identity.set(identity)
+        try:
+            if scope['type'] == 'websocket' or (self.exempt and self.exempt(headers)):
+                # WebSocket按轮次检查（见 admit_current），这里只识别用户
+                await self.app(scope, receive, send)
+                return
+            try:
+                usage = await self.manager.admit(identity)
+            except QuotaExceeded as e:
+                await self._reject_http(send, e)
+                return
+            quota_headers = [(name.encode(), value.encode()) for name, value in self.manager.headers(usage)]
+
+            async def send_with_usage(message):
+                if message['type'] == 'http.response.start':
+                    message = {**message, 'headers': list(message.get('headers', [])) + quota_headers}
+                await send(message)
+
+            await self.app(scope, receive, send_with_usage)
+        finally:
+            _current_identity.reset(token)
+
+    @staticmethod
+    async def _reject_http(send, error: QuotaExceeded):
+        body = json.dumps({
+            'success': False,
+            'error': str(error),
+            'scope': error.scope,
+            'metric': error.metric,
+            'limit': error.limit,
+            'retry_after': error.retry_after
+        }, ensure_ascii=False).encode('utf-8')
+        await send({
+            'type': 'http.response.start',
+            'status': 429,
+            'headers': [
+                (b'content-type', b'application/json; charset=utf-8'),
+                (b'retry-after', str(error.retry_after).encode()),
+                (b'content-length', str(len(body)).encode()),
+            ]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+
+# 全局配额管理器实例
+quota_manager = QuotaManager(
+    limits=config.quota_limits,
+    user_tenants=config.quota_user_tenants,
+    window=config.quota_window,
+    shared=config.quota_sync,
+    enabled=config.quota_enabled
+)
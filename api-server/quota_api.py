@@ -0,0 +1,19 @@
+"""
+用户配额API端点
+"""
+from fastapi import APIRouter, Request
+from quota import quota_manager, resolve_identity
+
+router = APIRouter()
+
+@router.get("/api/quota/usage", tags=["配额"], summary="获取当前用户的配额用量")
+async def get_quota_usage(request: Request):
+    """当前用户（按登录token识别，未登录时按IP）与其租户在滑动窗口内的请求数、token数用量"""
+    client = (request.client.host, request.client.port) if request.client else None
+    identity = await resolve_identity(dict(request.headers), request.url.query.encode(), client)
+    return {"success": True, "usage": await quota_manager.usage(identity)}
+
+@router.get("/api/quota/stats", tags=["配额"], summary="获取配额指标")
+async def get_quota_stats():
+    """配额配置与检查、拒绝次数"""
+    return {"success": True, "stats": quota_manager.get_stats()}
@@ -0,0 +1,244 @@
+"""
+精确匹配响应缓存
+
+以 (provider, model, messages, temperature, max_tokens 等参数) 的哈希为键，
+内存层使用带TTL和字节上限的LRU，磁盘层使用WAL模式的SQLite，
+用于拦截FAQ类问题、测试脚本的健康检查提示词等重复请求。
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from config import config
+from utils.lru_cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+
+def _entry_size(entry: Dict[str, Any]) -> int:
+    """估算缓存条目占用的字节数"""
+    return len(entry.get('content', '').encode('utf-8')) + 256
+
+
+class ResponseCache:
+    """精确匹配响应缓存（内存LRU + SQLite磁盘层）"""
+
+    # 每写入多少次清理一次磁盘层过期条目
+    PRUNE_EVERY = 200
+
+    def __init__(
+        self,
+        db_path: str,
+        ttl: int = 3600,
+        max_entries: int = 2000,
+        max_bytes: int = 32 * 1024 * 1024,
+        disk_max_entries: int = 50000,
+        enabled: bool = True
+    ):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.db_path = db_path
+        self.disk_max_entries = disk_max_entries
+        self.memory = LRUCache(max_entries=max_entries, max_bytes=max_bytes, ttl=ttl, sizeof=_entry_size)
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._writes = 0
+        self.disk_hits = 0
+        self.saved_tokens = 0
+        self.saved_cost_cny = 0.0
+
+    @staticmethod
+    def make_key(provider: str, model: str, messages: List[Dict[str, Any]], **params) -> str:
+        """根据请求内容生成缓存键（不包含API密钥）"""
+        payload = {
+            'provider': provider,
+            'model': model,
+            'messages': [{'role': m.get('role'), 'content': m.get('content')} for m in messages],
+            'params': {k: v for k, v in sorted(params.items()) if v is not None}
+        }
+        raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def _connect(self) -> sqlite3.Connection:
+        """延迟打开SQLite连接并启用WAL"""
+        if self._db is None:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            db = sqlite3.connect(self.db_path, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('''
+                CREATE TABLE IF NOT EXISTS response_cache (
+                    key TEXT PRIMARY KEY,
+                    provider TEXT,
+                    model TEXT,
+                    payload TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    expires_at REAL NOT NULL,
+                    hits INTEGER DEFAULT 0
+                )
+            ''')
+            db.execute('CREATE INDEX IF NOT EXISTS idx_response_cache_expires ON response_cache(expires_at)')
+            db.commit()
+            self._db = db
+        return self._db
+
+    def _disk_get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._db_lock:
+            db = self._connect()
+            row = db.execute(
+                'SELECT payload, expires_at FROM response_cache WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            payload, expires_at = row
+            if expires_at < time.time():
+                db.execute('DELETE FROM response_cache WHERE key = ?', (key,))
+                db.commit()
+                return None
+            db.execute('UPDATE response_cache SET hits = hits + 1 WHERE key = ?', (key,))
+            db.commit()
+        return json.loads(payload)
+
+    def _disk_set(self, key: str, entry: Dict[str, Any]):
+        now = time.time()
+        with self._db_lock:
+            db = self._connect()
+            db.execute(
+                'INSERT OR REPLACE INTO response_cache (key, provider, model, payload, created_at, expires_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, entry.get('provider'), entry.get('model'),
+                 json.dumps(entry, ensure_ascii=False), now, now + self.ttl)
+            )
+            self._writes += 1
+            if self._writes % self.PRUNE_EVERY == 0:
+                self._prune(db, now)
+            db.commit()
+
+    def _prune(self, db: sqlite3.Connection, now: float):
+        """删除过期条目，并把磁盘层控制在条目上限以内"""
+        db.execute('DELETE FROM response_cache WHERE expires_at < ?', (now,))
+        count = db.execute('SELECT COUNT(*) FROM response_cache').fetchone()[0]
+        if count > self.disk_max_entries:
+            db.execute(
+                'DELETE FROM response_cache WHERE key IN '
+                '(SELECT key FROM response_cache ORDER BY created_at LIMIT ?)',
+                (count - self.disk_max_entries,)
+            )
+
+    def _disk_clear(self):
+        with self._db_lock:
+            db = self._connect()
+            db.execute('DELETE FROM response_cache')
+            db.commit()
+
+    def _disk_count(self) -> int:
+        with self._db_lock:
+            return self._connect().execute('SELECT COUNT(*) FROM response_cache').fetchone()[0]
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """查询缓存，先查内存层，未命中再查磁盘层并回填内存"""
+        if not self.enabled:
+            return None
+        entry = self.memory.get(key)
+        if entry is None:
+            try:
+                entry = await asyncio.to_thread(self._disk_get, key)
+            except Exception as e:
+                logger.warning(f"读取磁盘响应缓存失败: {e}")
+                entry = None
+            if entry is None:
+                return None
+            self.disk_hits += 1
+            self.memory.set(key, entry)
+        self.record_saving(entry)
+        return entry
+
+    async def set(self, key: str, entry: Dict[str, Any]):
+        """写入缓存（内存层与磁盘层）"""
+        if not self.enabled or not entry.get('content'):
+            return
+        entry = dict(entry, cached_at=time.time())
+        self.memory.set(key, entry)
+        try:
+            await asyncio.to_thread(self._disk_set, key, entry)
+        except Exception as e:
+            logger.warning(f"写入磁盘响应缓存失败: {e}")
+
+    def record_saving(self, entry: Dict[str, Any]):
+        """累计缓存命中节省的token与费用"""
+        tokens = entry.get('tokens', {})
+        self.saved_tokens += tokens.get('total_tokens', 0)
+        self.saved_cost_cny += tokens.get('total_cost_cny', 0.0)
+
+    async def clear(self):
+        """清空缓存"""
+        self.memory.clear()
+        await asyncio.to_thread(self._disk_clear)
+
+    async def get_stats(self) -> Dict[str, Any]:
+        """获取缓存统计信息"""
+        try:
+            disk_entries = await asyncio.to_thread(self._disk_count)
+        except Exception as e:
+            logger.warning(f"统计磁盘响应缓存失败: {e}")
+            disk_entries = None
+        return {
+            'enabled': self.enabled,
+            'ttl': self.ttl,
+            'memory': self.memory.stats(),
+            'disk': {
+                'path': self.db_path,
+                'entries': disk_entries,
+                'hits': self.disk_hits
+            },
+            'saved_tokens': self.saved_tokens,
+            'saved_cost_cny': round(self.saved_cost_cny, 6)
+        }
+
+
+def build_cache_hit_stats(entry: Dict[str, Any], response_time: float, cache_type: str = 'exact') -> Dict[str, Any]:
+    """构造缓存命中时的stats事件，报告节省的token与费用"""
+    tokens = dict(entry.get('tokens', {}))
+    stats = {
+        'type': 'stats',
+        'cache_hit': True,
+        'cache_type': cache_type,
+        'performance': {
+            'first_token_time': response_time,
+            'response_time': response_time,
+            'tokens_per_second': 0
+        },
+        'tokens': tokens,
+        'saved': {
+            'tokens': tokens.get('total_tokens', 0),
+            'cost_usd': tokens.get('total_cost_usd', 0.0),
+            'cost_cny': tokens.get('total_cost_cny', 0.0)
+        }
+    }
+    if 'entry_id' in entry:
+        # 近似命中：返回条目ID与相似度，便于客户端反馈错误命中
+        stats['near_duplicate'] = {
+            'entry_id': entry['entry_id'],
+            'similarity': entry.get('similarity')
+        }
+    return stats
+
+
+# 全局响应缓存实例
+response_cache = ResponseCache(
+    db_path=config.response_cache_db,
+    ttl=config.response_cache_ttl,
+    max_entries=config.response_cache_max_entries,
+    max_bytes=config.response_cache_max_bytes,
+    disk_max_entries=config.response_cache_disk_max_entries,
+    enabled=config.response_cache_enabled
+)
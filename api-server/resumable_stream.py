@@ -0,0 +1,444 @@
+"""
+可续传的流式生成
+
+每次生成在后台任务中运行，产生的SSE事件带有序号并写入有界的重放缓冲：
+- 事件id格式为 "{stream_id}:{seq}"，客户端重连时带上 Last-Event-ID 即可定位到原来的生成，
+  从断点之后继续接收（生成仍在进行时继续接收新的事件）
+- 客户端断开后生成不会中止，缓冲保留 grace 秒；期间没有客户端重新连接则取消生成并释放缓冲
+- 带 Idempotency-Key 的重试请求复用同一次生成，从头重放，不会重复调用上游模型
+- 缓冲超过条数或字节上限时丢弃最早的事件，续传时若断点已被丢弃，先发送 replay_gap 事件
+- 生成与每个客户端之间各有一个有界队列（见 backpressure.py）：只有一个客户端时按
+  STREAM_BACKPRESSURE_POLICY 暂停上游读取、合并相邻内容块或断开该客户端（发送 slow_consumer 后结束，
+  客户端带 Last-Event-ID 重连续传）；有多个客户端时不再暂停上游，跟不上的客户端被断开后续传
+
+群聊WebSocket按会话使用同一个 ReplayBuffer（客户端发送 resume 消息续传），见 websocket_handler.ConnectionManager。
+
+同一次生成可以有任意多个订阅者（各自独立的队列），观看者通过 stream_registry.watch 加入，上游只调用一次。
+
+生成与缓冲保存在当前进程内，多worker部署时重连需要回到同一个worker（按客户端粘性路由），
+否则找不到原来的生成，客户端应重新发起请求。
+
+使用方法:
+    response = await handle_single_chat(...)
+    return stream_registry.attach(response, idempotency_key, fingerprint)
+
+    stream = stream_registry.get(stream_id)
+    return stream_registry.response(stream, after_seq)
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import time
+import uuid
+from collections import deque
+from itertools import islice
+from typing import Any, AsyncIterator, Deque, Dict, List, Optional, Set, Tuple
+
+from fastapi.responses import StreamingResponse
+
+from backpressure import BoundedChannel, ChannelClosed, CLOSE_DISCONNECTED, CLOSE_FINISHED, CLOSE_OVERFLOW
+from admission import Ticket, admission_controller
+from config import config
+from lifecycle import drain_controller
+
+logger = logging.getLogger(__name__)
+
+# 续传响应使用的SSE响应头
+SSE_HEADERS = {
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+    'X-Accel-Buffering': 'no'
+}
+
+
+def parse_last_event_id(value: Optional[str]) -> Optional[Tuple[str, int]]:
+    """解析 "{stream_id}:{seq}" 格式的事件id，格式不符时返回None"""
+    if not value:
+        return None
+    stream_id, sep, seq = value.strip().rpartition(':')
+    if not sep or not stream_id or not seq.isdigit():
+        return None
+    return stream_id, int(seq)
+
+
+def request_fingerprint(body: Dict[str, Any]) -> str:
+    """请求体指纹（不含幂等键），同一幂等键的请求内容不一致时拒绝复用"""
+    payload = {key: value for key, value in body.items() if key != 'idempotency_key'}
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+def coalesce_content_events(items: Deque[Tuple[int, str]], item: Tuple[int, str]) -> bool:
+    """
+    客户端跟不上时把新的内容事件合并进队尾的内容事件（保留较新的序号）
+
+    只合并除 content 外字段完全相同的 {"type": "content"} 事件，其他事件不合并
+    """
+    seq, event = item
+    last_seq, last_event = items[-1]
+    last_data, data = _parse_data_event(last_event), _parse_data_event(event)
+    if not last_data or not data or last_data.get('type') != 'content' or data.get('type') != 'content':
+        return False
+    if not isinstance(last_data.get('content'), str) or not isinstance(data.get('content'), str):
+        return False
+    if {k: v for k, v in last_data.items() if k != 'content'} != {k: v for k, v in data.items() if k != 'content'}:
+        return False
+    merged = dict(last_data, content=last_data['content'] + data['content'])
+    items[-1] = (seq, f"data: {json.dumps(merged, ensure_ascii=False)}\n\n")
+    return True
+
+
+def _parse_data_event(event: str) -> Optional[Dict[str, Any]]:
+    if not event.startswith('data: ') or event.count('\n') != 2:
+        return None
+    try:
+        data = json.loads(event[6:])
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+class ReplayBuffer:
+    """有界重放缓冲：按递增序号保存最近的事件，超过条数或字节上限时丢弃最早的事件"""
+
+    def __init__(self, max_events: int = 2000, max_bytes: int = 1024 * 1024):
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.events: Deque[Tuple[int, str]] = deque()
+        self.last_seq = 0
+        self.bytes = 0
+        self.dropped = 0
+        # 已丢弃的最大序号，断点不大于它时无法完整重放
+        self.dropped_until = 0
+        # 序号是否连续（外部分配的序号可能有间隔或乱序，此时按序号逐个比较）
+        self.contiguous = True
+
+    @property
+    def first_seq(self) -> int:
+        """缓冲中最早事件的序号（缓冲为空时为下一个序号）"""
+        return self.events[0][0] if self.events else self.last_seq + 1
+
+    def append(self, payload: str, seq: Optional[int] = None) -> int:
+        """写入事件，返回事件序号"""
+        if seq is None:
+            seq = self.last_seq + 1
+        elif seq != self.last_seq + 1:
+            self.contiguous = False
+        self.last_seq = max(self.last_seq, seq)
+        self.events.append((seq, payload))
+        self.bytes += len(payload)
+        while len(self.events) > 1 and (len(self.events) > self.max_events or self.bytes > self.max_bytes):
+            dropped_seq, dropped = self.events.popleft()
+            self.bytes -= len(dropped)
+            self.dropped += 1
+            self.dropped_until = max(self.dropped_until, dropped_seq)
+        return seq
+
+    def since(self, after_seq: int) -> Tuple[Optional[Tuple[int, int]], List[Tuple[int, str]]]:
+        """
+        取序号大于 after_seq 的事件
+
+        Returns:
+            (已被丢弃而无法重放的序号区间或None, 事件列表)
+        """
+        gap = None
+        if after_seq < self.dropped_until:
+            gap = (after_seq + 1, self.dropped_until)
+            after_seq = self.dropped_until
+        if not self.contiguous:
+            return gap, [event for event in self.events if event[0] > after_seq]
+        start = max(0, after_seq + 1 - self.first_seq)
+        return gap, list(islice(self.events, start, None))
+
+
+class ResumableStream:
+    """一次可续传的生成：后台任务消费生成器写入重放缓冲，客户端断开后生成继续"""
+
+    def __init__(self, stream_id: str, buffer: ReplayBuffer, idempotency_key: Optional[str] = None,
+                 fingerprint: Optional[str] = None, headers: Optional[Dict[str, str]] = None):
+        self.stream_id = stream_id
+        self.buffer = buffer
+        self.idempotency_key = idempotency_key
+        self.fingerprint = fingerprint
+        self.headers = headers or dict(SSE_HEADERS)
+        self.created_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+        # 没有客户端连接的起始时间（None表示有客户端连接）
+        self.detached_at: Optional[float] = self.created_at
+        self.subscribers = 0
+        self.resumes = 0
+        self.task: Optional[asyncio.Task] = None
+        # 各已连接客户端的发送队列
+        self.channels: Set[BoundedChannel] = set()
+
+    @property
+    def done(self) -> bool:
+        return self.finished_at is not None
+
+    def start(self, source: AsyncIterator[str]):
+        # 接管请求的准入名额：客户端断开后生成继续占用名额，直到生成结束
+        ticket = admission_controller.retain_current()
+        self.task = asyncio.create_task(self._run(source, ticket), name=f"stream-{self.stream_id}")
+
+    async def _run(self, source: AsyncIterator[str], ticket: Optional[Ticket] = None):
+        try:
+            # 排空时等待后台生成完成（客户端已断开的生成同样计入）
+            async with drain_controller.turn():
+                async for event in source:
+                    if isinstance(event, bytes):
+                        event = event.decode('utf-8')
+                    await self._emit(event)
+        except asyncio.CancelledError:
+            logger.info(f"生成 {self.stream_id} 已取消")
+        except Exception as e:
+            logger.error(f"生成 {self.stream_id} 失败: {e}")
+            error_data = {"type": "error", "error": str(e)}
+            await self._emit(f"data: {json.dumps(error_data, ensure_ascii=False)}\n\n")
+        finally:
+            aclose = getattr(source, 'aclose', None)
+            if aclose:
+                try:
+                    await aclose()
+                except Exception:
+                    pass
+            if ticket:
+                ticket.release()
+            self.finished_at = time.monotonic()
+            for channel in list(self.channels):
+                channel.close(CLOSE_FINISHED)
+
+    async def _emit(self, event: str):
+        """
+        写入重放缓冲并放入各客户端的发送队列
+
+        只有一个订阅者时按 STREAM_BACKPRESSURE_POLICY 处理（block 策略下客户端跟不上时在此等待）；
+        有观看者加入后发布从不等待：队列满且无法合并的订阅者被丢弃（收到 slow_consumer 后带
+        Last-Event-ID 续传），一个慢订阅者不会拖住生成与其他订阅者
+        """
+        seq = self.buffer.append(event)
+        channels = list(self.channels)
+        if len(channels) == 1:
+            await channels[0].put((seq, event))
+            return
+        for channel in channels:
+            channel.put_nowait((seq, event))
+
+    def _fan_out(self):
+        """订阅者变为多个时，丢弃队列已满的订阅者（同时唤醒阻塞在其队列上的生成）"""
+        for channel in list(self.channels):
+            if channel.depth >= channel.maxsize:
+                channel.drop()
+
+    def format(self, seq: int, event: str) -> str:
+        return f"id: {self.stream_id}:{seq}\n{event}"
+
+    async def events(self, after_seq: int = 0) -> AsyncIterator[str]:
+        """输出序号大于 after_seq 的事件：先重放缓冲中的事件，再从本客户端的有界队列接收新事件"""
+        # 取缓冲快照与注册队列之间没有await，新事件不会遗漏或重复
+        gap, backlog = self.buffer.since(after_seq)
+        channel = None
+        if not self.done:
+            channel = BoundedChannel(
+                f"sse:{self.stream_id}:{self.resumes}", config.stream_queue_size,
+                config.stream_backpressure_policy, coalesce_content_events
+            )
+            self.channels.add(channel)
+            if len(self.channels) > 1:
+                self._fan_out()
+        self.subscribers += 1
+        self.detached_at = None
+        try:
+            if gap:
+                gap_data = {'type': 'replay_gap', 'from': gap[0], 'to': gap[1]}
+                yield f"data: {json.dumps(gap_data)}\n\n"
+            for seq, event in backlog:
+                yield self.format(seq, event)
+            if channel is None:
+                return
+            while True:
+                try:
+                    seq, event = await channel.get()
+                except ChannelClosed:
+                    if channel.close_reason == CLOSE_OVERFLOW:
+                        # 客户端过慢被丢弃：提示其带 Last-Event-ID 重连续传
+                        slow_data = {'type': 'slow_consumer', 'reconnect': True}
+                        yield f"data: {json.dumps(slow_data)}\n\n"
+                    return
+                yield self.format(seq, event)
+        finally:
+            if channel is not None:
+                self.channels.discard(channel)
+                channel.close(CLOSE_DISCONNECTED)
+            self.subscribers -= 1
+            if self.subscribers == 0:
+                self.detached_at = time.monotonic()
+
+    def cancel(self):
+        if self.task and not self.task.done():
+            self.task.cancel()
+
+    def get_status(self) -> Dict[str, Any]:
+        return {
+            'stream_id': self.stream_id,
+            'done': self.done,
+            'last_seq': self.buffer.last_seq,
+            'first_seq': self.buffer.first_seq,
+            'dropped': self.buffer.dropped,
+            'subscribers': self.subscribers,
+            'queue_depths': [channel.depth for channel in self.channels],
+            'resumes': self.resumes
+        }
+
+
+class StreamRegistry:
+    """按 stream_id 与幂等键管理进行中与宽限期内的生成"""
+
+    def __init__(self, grace: float = 30, max_events: int = 2000, max_bytes: int = 1024 * 1024,
+                 max_streams: int = 1000):
+        self.grace = grace
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.max_streams = max_streams
+        self.streams: Dict[str, ResumableStream] = {}
+        self.by_key: Dict[str, str] = {}
+        self._sweeper: Optional[asyncio.Task] = None
+        self.metrics = {
+            'started': 0,
+            'resumed': 0,
+            'idempotent_replays': 0,
+            'cancelled': 0,
+            'expired': 0,
+            'watched': 0
+        }
+
+    def get(self, stream_id: str) -> Optional[ResumableStream]:
+        return self.streams.get(stream_id)
+
+    def find(self, idempotency_key: str) -> Optional[ResumableStream]:
+        stream_id = self.by_key.get(idempotency_key)
+        return self.streams.get(stream_id) if stream_id else None
+
+    def serves(self, headers: Dict[str, str]) -> bool:
+        """请求能否直接由缓冲中的生成响应（Last-Event-ID 续传或 Idempotency-Key 重放），这类请求不调用上游"""
+        parsed = parse_last_event_id(headers.get('last-event-id'))
+        if parsed and self.get(parsed[0]):
+            return True
+        idempotency_key = headers.get('idempotency-key')
+        return bool(idempotency_key and self.find(idempotency_key))
+
+    def start(self, source: AsyncIterator[str], idempotency_key: Optional[str] = None,
+              fingerprint: Optional[str] = None, headers: Optional[Dict[str, str]] = None) -> ResumableStream:
+        """在后台开始一次生成"""
+        self.sweep()
+        stream = ResumableStream(
+            uuid.uuid4().hex, ReplayBuffer(self.max_events, self.max_bytes),
+            idempotency_key, fingerprint, headers
+        )
+        self.streams[stream.stream_id] = stream
+        if idempotency_key:
+            self.by_key[idempotency_key] = stream.stream_id
+        stream.start(source)
+        self.metrics['started'] += 1
+        self._ensure_sweeper()
+        return stream
+
+    def attach(self, response: StreamingResponse, idempotency_key: Optional[str] = None,
+               fingerprint: Optional[str] = None) -> StreamingResponse:
+        """把端点返回的流式响应改为后台生成，返回带序号的可续传响应"""
+        headers = {
+            key: value for key, value in response.headers.items()
+            if key.lower() not in ('content-length', 'content-type')
+        }
+        stream = self.start(response.body_iterator, idempotency_key, fingerprint, headers)
+        return self.response(stream, 0, media_type=response.media_type)
+
+    def response(self, stream: ResumableStream, after_seq: int = 0,
+                 media_type: str = 'text/event-stream') -> StreamingResponse:
+        """从 after_seq 之后输出生成的事件"""
+        headers = dict(stream.headers)
+        headers['X-Stream-Id'] = stream.stream_id
+        return StreamingResponse(stream.events(after_seq), media_type=media_type, headers=headers)
+
+    def resume(self, last_event_id: Optional[str]) -> Optional[StreamingResponse]:
+        """按 Last-Event-ID 续传，找不到对应的生成时返回None"""
+        parsed = parse_last_event_id(last_event_id)
+        stream = self.get(parsed[0]) if parsed else None
+        if not stream:
+            return None
+        stream.resumes += 1
+        self.metrics['resumed'] += 1
+        logger.info(f"续传生成 {stream.stream_id}: 从序号 {parsed[1]} 之后，生成{'已完成' if stream.done else '进行中'}")
+        return self.response(stream, parsed[1])
+
+    def watch(self, stream_id: str) -> Optional[ResumableStream]:
+        """观看进行中或宽限期内的生成：作为又一个订阅者从头补齐，不再调用上游"""
+        stream = self.get(stream_id)
+        if stream:
+            self.metrics['watched'] += 1
+        return stream
+
+    def replay(self, stream: ResumableStream) -> StreamingResponse:
+        """幂等重试：从头重放同一次生成"""
+        self.metrics['idempotent_replays'] += 1
+        return self.response(stream, 0)
+
+    def sweep(self):
+        """取消宽限期内无人重连的生成，释放过期的缓冲"""
+        now = time.monotonic()
+        for stream_id, stream in list(self.streams.items()):
+            if stream.detached_at is None or now - stream.detached_at < self.grace:
+                continue
+            if not stream.done:
+                stream.cancel()
+                self.metrics['cancelled'] += 1
+            else:
+                self.metrics['expired'] += 1
+            self._remove(stream_id)
+
+        # 超过数量上限时优先释放已完成且没有客户端连接的生成
+        excess = len(self.streams) - self.max_streams
+        if excess > 0:
+            for stream_id, stream in list(self.streams.items()):
+                if excess <= 0:
+                    break
+                if stream.done and stream.subscribers == 0:
+                    self._remove(stream_id)
+                    self.metrics['expired'] += 1
+                    excess -= 1
+
+    def _remove(self, stream_id: str):
+        stream = self.streams.pop(stream_id, None)
+        if stream and stream.idempotency_key and self.by_key.get(stream.idempotency_key) == stream_id:
+            del self.by_key[stream.idempotency_key]
+
+    def _ensure_sweeper(self):
+        if self._sweeper is None or self._sweeper.done():
+            self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    async def _sweep_loop(self):
+        interval = max(0.5, self.grace / 2)
+        while self.streams:
+            await asyncio.sleep(interval)
+            self.sweep()
+
+    def get_stats(self) -> Dict[str, Any]:
+        running = sum(1 for stream in self.streams.values() if not stream.done)
+        return {
+            'streams': len(self.streams),
+            'running': running,
+            'detached': sum(1 for stream in self.streams.values() if stream.subscribers == 0),
+            'buffered_bytes': sum(stream.buffer.bytes for stream in self.streams.values()),
+            'grace_seconds': self.grace,
+            **self.metrics
+        }
+
+
+# 全局可续传生成注册表
+stream_registry = StreamRegistry(
+    grace=config.stream_replay_grace,
+    max_events=config.stream_replay_max_events,
+    max_bytes=config.stream_replay_max_bytes,
+    max_streams=config.stream_replay_max_streams
+)
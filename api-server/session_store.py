@@ -0,0 +1,572 @@
+"""
+群聊会话持久化（SQLite + 异步批量写入）
+
+- 复用 chat_history.db 中已有的 chat_sessions / messages 表，按 PRAGMA user_version 增量迁移；
+  数据库默认在 cache/ 下，旧版本工作目录中的 chat_history.db 在首次打开时复制过来
+- WAL 模式，读写互不阻塞
+- 所有写操作只是放入内存队列（不等待磁盘），由单个后台写入任务每隔 N 毫秒批量提交一次事务，
+  流式响应路径上不会因为持久化增加延迟
+- 重连时按会话ID懒加载会话与最近的消息
+- 历史查询：按 (session_id, id) 索引做键集分页；FTS5 全文检索（CJK 按字切分）；NDJSON 流式导出
+- 会话属于初始化它的用户（owner，与 conversation_store 相同按 quota.identify 识别），历史查询只返回
+  该用户的会话；迁移前没有 owner 的会话不出现在历史查询中，直到被重新初始化
+
+使用方法:
+    from session_store import session_store
+
+    session_store.save_session(session_id, models, system_prompts)
+    session_store.add_message(session_id, role, content, model_id, model_name)
+    data = await session_store.load_session(session_id)
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Callable, Deque, Dict, List, Optional, Tuple, Union
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# CJK统一表意文字、扩展A、兼容表意文字、日文假名、韩文（与 tokenizer_service 相同）
+_CJK_RE = re.compile(r'[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]')
+
+# 分页每页最大条数
+MAX_PAGE_SIZE = 200
+
+
+def segment_text(text: str) -> str:
+    """
+    全文索引的预切分：CJK字符前后加空格，unicode61 分词器因此把每个汉字作为一个词，
+    中文按短语（相邻字）匹配，英文等仍按单词匹配
+    """
+    return _CJK_RE.sub(lambda m: f' {m.group(0)} ', text or '')
+
+
+def build_match_query(query: str) -> str:
+    """
+    把用户输入转换为 FTS5 MATCH 表达式：每个空格分隔的词作为一个短语，短语之间为 AND；
+    以非CJK字符结尾的短语按前缀匹配（输入 "py" 可以匹配 "python"）
+    """
+    phrases = []
+    for word in query.split():
+        tokens = segment_text(word).split()
+        if tokens:
+            phrase = ' '.join(tokens).replace('"', '""')
+            prefix = '' if _CJK_RE.fullmatch(tokens[-1]) else '*'
+            phrases.append(f'"{phrase}"{prefix}')
+    return ' AND '.join(phrases)
+
+
+def _backfill_fts(db: sqlite3.Connection):
+    """为迁移前已存在的消息建立全文索引"""
+    db.execute('INSERT INTO messages_fts (rowid, content) SELECT id, fts_segment(content) FROM messages')
+
+
+# 增量迁移脚本：下标 i 的脚本把 user_version 从 i 升级到 i+1（可以是SQL或接收连接的函数）
+MIGRATIONS: List[List[Union[str, Callable[[sqlite3.Connection], None]]]] = [
+    [
+        '''CREATE TABLE IF NOT EXISTS chat_sessions (
+            id TEXT PRIMARY KEY,
+            summary TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )''',
+        '''CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_id TEXT,
+            role TEXT,
+            content TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (session_id) REFERENCES chat_sessions (id)
+        )''',
+    ],
+    [
+        "ALTER TABLE chat_sessions ADD COLUMN kind TEXT DEFAULT 'group'",
+        'ALTER TABLE chat_sessions ADD COLUMN models TEXT',
+        'ALTER TABLE chat_sessions ADD COLUMN system_prompts TEXT',
+        'ALTER TABLE chat_sessions ADD COLUMN summary_end INTEGER DEFAULT 0',
+        'ALTER TABLE messages ADD COLUMN model_id TEXT',
+        'ALTER TABLE messages ADD COLUMN model_name TEXT',
+        'CREATE INDEX IF NOT EXISTS idx_messages_session_id ON messages(session_id, id)',
+    ],
+    [
+        # 无内容表：只存倒排索引，正文仍从 messages 表读取
+        "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(content, content='', tokenize='unicode61')",
+        _backfill_fts,
+        'CREATE INDEX IF NOT EXISTS idx_chat_sessions_updated ON chat_sessions(updated_at, id)',
+    ],
+    [
+        # 曾以时间戳（REAL）写入的时间统一为与 CURRENT_TIMESTAMP 相同的UTC文本
+        "UPDATE chat_sessions SET created_at = strftime('%Y-%m-%d %H:%M:%f', created_at, 'unixepoch') "
+        "WHERE typeof(created_at) IN ('real', 'integer')",
+        "UPDATE chat_sessions SET updated_at = strftime('%Y-%m-%d %H:%M:%f', updated_at, 'unixepoch') "
+        "WHERE typeof(updated_at) IN ('real', 'integer')",
+        "UPDATE messages SET created_at = strftime('%Y-%m-%d %H:%M:%f', created_at, 'unixepoch') "
+        "WHERE typeof(created_at) IN ('real', 'integer')",
+    ],
+    [
+        'ALTER TABLE chat_sessions ADD COLUMN owner TEXT',
+        'CREATE INDEX IF NOT EXISTS idx_chat_sessions_owner ON chat_sessions(owner, updated_at, id)',
+    ],
+]
+
+# 写操作类型
+_OP_SESSION = 'session'
+_OP_MESSAGE = 'message'
+_OP_SUMMARY = 'summary'
+_OP_DELETE = 'delete'
+
+
+def _page_size(limit: int) -> int:
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def _timestamp() -> str:
+    """
+    当前UTC时间，格式与 SQLite CURRENT_TIMESTAMP 相同并精确到毫秒（如 2025-05-04 17:35:30.123）：
+    与旧数据的时间文本按字符串比较即按时间先后，排序与键集分页不会混入数值类型
+    """
+    return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3]
+
+
+class SessionStore:
+    """会话存储：同步入队，后台批量写入"""
+
+    def __init__(self, db_path: str, flush_interval_ms: int = 200, batch_size: int = 500,
+                 load_messages: int = 100, enabled: bool = True, legacy_path: Optional[str] = None):
+        self.db_path = db_path
+        self.legacy_path = legacy_path
+        self.flush_interval = flush_interval_ms / 1000
+        self.batch_size = batch_size
+        self.load_messages = load_messages
+        self.enabled = enabled
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._pending: Deque[Tuple] = deque()
+        self._pending_event: Optional[asyncio.Event] = None
+        self._flush_lock: Optional[asyncio.Lock] = None
+        self._writer: Optional[asyncio.Task] = None
+        self.metrics = {
+            'enqueued': 0,
+            'written': 0,
+            'batches': 0,
+            'failed': 0,
+            'loads': 0
+        }
+
+    # ---------- 数据库 ----------
+
+    def _connect(self) -> sqlite3.Connection:
+        """延迟打开连接，启用WAL并执行迁移"""
+        if self._db is None:
+            directory = os.path.dirname(self.db_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._copy_legacy()
+            db = sqlite3.connect(self.db_path, check_same_thread=False)
+            db.create_function('fts_segment', 1, segment_text, deterministic=True)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self._migrate(db)
+            self._db = db
+        return self._db
+
+    def _copy_legacy(self):
+        """
+        数据库文件还不存在时，把旧路径的数据库复制过来（只发生一次）
+
+        用SQLite备份API复制（包含尚未检查点的WAL内容），先写到临时文件再硬链接到目标路径：
+        多个worker同时启动时只有一个复制结果生效，不会覆盖已经开始写入的数据库
+        """
+        legacy = self.legacy_path
+        if not legacy or os.path.exists(self.db_path) or not os.path.exists(legacy):
+            return
+        if os.path.abspath(legacy) == os.path.abspath(self.db_path):
+            return
+        temp_path = f"{self.db_path}.{os.getpid()}.tmp"
+        try:
+            source = sqlite3.connect(f"file:{legacy}?mode=ro", uri=True)
+            target = sqlite3.connect(temp_path)
+            try:
+                source.backup(target)
+            finally:
+                target.close()
+                source.close()
+            os.link(temp_path, self.db_path)
+            logger.info(f"已把旧会话数据库 {legacy} 复制到 {self.db_path}")
+        except FileExistsError:
+            pass
+        except Exception as e:
+            logger.error(f"复制旧会话数据库 {legacy} 失败: {e}")
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    @staticmethod
+    def _migrate(db: sqlite3.Connection):
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        for target in range(version, len(MIGRATIONS)):
+            for statement in MIGRATIONS[target]:
+                try:
+                    if callable(statement):
+                        statement(db)
+                    else:
+                        db.execute(statement)
+                except sqlite3.OperationalError as e:
+                    # 列已存在（例如手动升级过的库）时跳过
+                    if 'duplicate column' not in str(e):
+                        raise
+            db.execute(f'PRAGMA user_version = {target + 1}')
+            db.commit()
+            logger.info(f"会话数据库已迁移到版本 {target + 1}")
+
+    def _write_batch(self, batch: List[Tuple]):
+        """在一个事务中执行一批写操作（工作线程中运行）"""
+        with self._db_lock:
+            db = self._connect()
+            with db:
+                for op in batch:
+                    kind = op[0]
+                    if kind == _OP_MESSAGE:
+                        cursor = db.execute(
+                            'INSERT INTO messages (session_id, role, content, model_id, model_name, created_at) '
+                            'VALUES (?, ?, ?, ?, ?, ?)',
+                            op[1:]
+                        )
+                        db.execute(
+                            'INSERT INTO messages_fts (rowid, content) VALUES (?, ?)',
+                            (cursor.lastrowid, segment_text(op[3]))
+                        )
+                        db.execute('UPDATE chat_sessions SET updated_at = ? WHERE id = ?', (op[6], op[1]))
+                    elif kind == _OP_SESSION:
+                        session_id, session_kind, models, prompts, owner, now = op[1:]
+                        # 已有 owner 的会话不会转给其他用户
+                        db.execute(
+                            'INSERT INTO chat_sessions (id, kind, models, system_prompts, owner, created_at, updated_at) '
+                            'VALUES (?, ?, ?, ?, ?, ?, ?) '
+                            'ON CONFLICT(id) DO UPDATE SET kind = excluded.kind, models = excluded.models, '
+                            'system_prompts = excluded.system_prompts, updated_at = excluded.updated_at, '
+                            "owner = COALESCE(NULLIF(chat_sessions.owner, ''), excluded.owner)",
+                            (session_id, session_kind, models, prompts, owner or None, now, now)
+                        )
+                    elif kind == _OP_SUMMARY:
+                        db.execute(
+                            'UPDATE chat_sessions SET summary = ?, summary_end = ? WHERE id = ?',
+                            (op[2], op[3], op[1])
+                        )
+                    elif kind == _OP_DELETE:
+                        # 无内容表删除时需要提供与建索引时相同的内容
+                        db.execute(
+                            "INSERT INTO messages_fts (messages_fts, rowid, content) "
+                            "SELECT 'delete', id, fts_segment(content) FROM messages WHERE session_id = ?",
+                            (op[1],)
+                        )
+                        db.execute('DELETE FROM messages WHERE session_id = ?', (op[1],))
+                        db.execute('DELETE FROM chat_sessions WHERE id = ?', (op[1],))
+
+    def _read_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        with self._db_lock:
+            db = self._connect()
+            row = db.execute(
+                'SELECT kind, models, system_prompts, summary, summary_end, created_at, updated_at '
+                'FROM chat_sessions WHERE id = ?',
+                (session_id,)
+            ).fetchone()
+            if row is None:
+                return None
+            total = db.execute('SELECT COUNT(*) FROM messages WHERE session_id = ?', (session_id,)).fetchone()[0]
+            rows = db.execute(
+                'SELECT role, content, model_id, model_name, created_at FROM messages '
+                'WHERE session_id = ? ORDER BY id DESC LIMIT ?',
+                (session_id, self.load_messages)
+            ).fetchall()
+        kind, models, prompts, summary, summary_end, created_at, updated_at = row
+        rows.reverse()
+        return {
+            'session_id': session_id,
+            'kind': kind,
+            'models': json.loads(models) if models else [],
+            'system_prompts': json.loads(prompts) if prompts else {},
+            'summary': summary,
+            'summary_end': summary_end or 0,
+            'created_at': created_at,
+            'updated_at': updated_at,
+            # 第一条加载的消息在会话中的序号
+            'first_index': total - len(rows),
+            'messages': [
+                {
+                    'role': role,
+                    'content': content,
+                    'model_id': model_id,
+                    'model_name': model_name,
+                    'created_at': created
+                }
+                for role, content, model_id, model_name, created in rows
+            ]
+        }
+
+    @staticmethod
+    def _message_row(row: Tuple) -> Dict[str, Any]:
+        message_id, session_id, role, content, model_id, model_name, created_at = row
+        return {
+            'id': message_id,
+            'session_id': session_id,
+            'role': role,
+            'content': content,
+            'model_id': model_id,
+            'model_name': model_name,
+            'created_at': created_at
+        }
+
+    def _query(self, sql: str, params: Tuple) -> List[Tuple]:
+        with self._db_lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    def _owns(self, session_id: str, owner: str) -> bool:
+        return bool(owner) and bool(self._query(
+            'SELECT 1 FROM chat_sessions WHERE id = ? AND owner = ?', (session_id, owner)
+        ))
+
+    def _page_sessions(self, owner: str, before: Optional[Tuple[str, str]], limit: int) -> Dict[str, Any]:
+        sql = 'SELECT id, kind, models, summary, created_at, updated_at FROM chat_sessions WHERE owner = ?'
+        params: Tuple = (owner,)
+        if before:
+            sql += ' AND (updated_at, id) < (?, ?)'
+            params += before
+        rows = self._query(sql + ' ORDER BY updated_at DESC, id DESC LIMIT ?', params + (limit + 1,))
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        sessions = [
+            {
+                'session_id': session_id,
+                'kind': kind,
+                'models': json.loads(models) if models else [],
+                'summary': summary,
+                'created_at': created_at,
+                'updated_at': updated_at
+            }
+            for session_id, kind, models, summary, created_at, updated_at in rows
+        ]
+        return {
+            'sessions': sessions,
+            'has_more': has_more,
+            'next_cursor': {'updated_at': rows[-1][5], 'id': rows[-1][0]} if has_more else None
+        }
+
+    def _page_messages(self, session_id: str, before_id: Optional[int], after_id: Optional[int],
+                       limit: int) -> Dict[str, Any]:
+        columns = 'SELECT id, session_id, role, content, model_id, model_name, created_at FROM messages '
+        if after_id is not None:
+            rows = self._query(
+                columns + 'WHERE session_id = ? AND id > ? ORDER BY id ASC LIMIT ?',
+                (session_id, after_id, limit + 1)
+            )
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+        else:
+            rows = self._query(
+                columns + 'WHERE session_id = ? AND id < ? ORDER BY id DESC LIMIT ?',
+                (session_id, before_id if before_id is not None else 2 ** 63 - 1, limit + 1)
+            )
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            rows.reverse()
+        messages = [self._message_row(row) for row in rows]
+        return {
+            'messages': messages,
+            'has_more': has_more,
+            # 向前翻页用第一条的ID，向后翻页用最后一条的ID
+            'before_id': messages[0]['id'] if messages else before_id,
+            'after_id': messages[-1]['id'] if messages else after_id
+        }
+
+    def _search(self, match: str, owner: str, session_id: Optional[str], before_id: Optional[int],
+                limit: int) -> Dict[str, Any]:
+        sql = (
+            'SELECT m.id, m.session_id, m.role, m.content, m.model_id, m.model_name, m.created_at '
+            'FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid '
+            'JOIN chat_sessions s ON s.id = m.session_id '
+            'WHERE messages_fts MATCH ? AND s.owner = ?'
+        )
+        params: Tuple = (match, owner)
+        if before_id is not None:
+            sql += ' AND messages_fts.rowid < ?'
+            params += (before_id,)
+        if session_id:
+            sql += ' AND m.session_id = ?'
+            params += (session_id,)
+        rows = self._query(sql + ' ORDER BY messages_fts.rowid DESC LIMIT ?', params + (limit + 1,))
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        return {
+            'results': [self._message_row(row) for row in rows],
+            'has_more': has_more,
+            'next_before_id': rows[-1][0] if has_more else None
+        }
+
+    # ---------- 写入队列 ----------
+
+    def _enqueue(self, op: Tuple):
+        """放入写入队列并立即返回（首次调用时启动后台写入任务）"""
+        if not self.enabled:
+            return
+        if self._pending_event is None:
+            self._pending_event = asyncio.Event()
+            self._flush_lock = asyncio.Lock()
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.get_running_loop().create_task(self._run_writer())
+        self._pending.append(op)
+        self._pending_event.set()
+        self.metrics['enqueued'] += 1
+
+    async def _run_writer(self):
+        """后台写入任务：有待写操作时等待一个间隔，再把这段时间内的操作一次提交"""
+        while True:
+            await self._pending_event.wait()
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def _commit(self, batch: List[Tuple]):
+        try:
+            await asyncio.to_thread(self._write_batch, batch)
+            self.metrics['written'] += len(batch)
+            self.metrics['batches'] += 1
+        except Exception as e:
+            self.metrics['failed'] += len(batch)
+            logger.error(f"会话持久化写入失败（{len(batch)} 条）: {e}")
+
+    def save_session(self, session_id: str, models: List[Dict[str, Any]], system_prompts: Dict[str, Any],
+                     kind: str = 'group', owner: str = ''):
+        """保存（或更新）会话元数据，owner 为初始化会话的用户（会话已有 owner 时不变）"""
+        self._enqueue((
+            _OP_SESSION, session_id, kind,
+            json.dumps(models, ensure_ascii=False),
+            json.dumps(system_prompts, ensure_ascii=False),
+            owner,
+            _timestamp()
+        ))
+
+    def add_message(self, session_id: str, role: str, content: str,
+                    model_id: Optional[str] = None, model_name: Optional[str] = None):
+        """追加一条消息"""
+        self._enqueue((_OP_MESSAGE, session_id, role, content, model_id, model_name, _timestamp()))
+
+    def save_summary(self, session_id: str, summary: str, summary_end: int):
+        """保存滚动摘要及其覆盖到的消息序号"""
+        self._enqueue((_OP_SUMMARY, session_id, summary, summary_end))
+
+    def delete_session(self, session_id: str):
+        """删除会话及其消息"""
+        self._enqueue((_OP_DELETE, session_id))
+
+    async def flush(self):
+        """按入队顺序写入所有待写操作（后台任务、懒加载前与关闭时调用）"""
+        if self._flush_lock is None:
+            return
+        async with self._flush_lock:
+            while self._pending:
+                batch = []
+                while self._pending and len(batch) < self.batch_size:
+                    batch.append(self._pending.popleft())
+                await self._commit(batch)
+            self._pending_event.clear()
+
+    async def close(self):
+        """停止后台写入任务并写入剩余数据"""
+        if self._writer is not None:
+            self._writer.cancel()
+            try:
+                await self._writer
+            except asyncio.CancelledError:
+                pass
+            self._writer = None
+        await self.flush()
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    # ---------- 读取 ----------
+
+    async def load_session(self, session_id: str) -> Optional[Dict[str, Any]]:
+        """懒加载会话（先写入待提交的操作，保证读到最新数据）"""
+        if not self.enabled:
+            return None
+        await self.flush()
+        self.metrics['loads'] += 1
+        try:
+            return await asyncio.to_thread(self._read_session, session_id)
+        except Exception as e:
+            logger.error(f"加载会话 {session_id} 失败: {e}")
+            return None
+
+    async def owns(self, session_id: str, owner: str) -> bool:
+        """会话是否存在且属于 owner"""
+        await self.flush()
+        return await asyncio.to_thread(self._owns, session_id, owner)
+
+    async def list_sessions(self, owner: str, cursor: Optional[Tuple[str, str]] = None,
+                            limit: int = 20) -> Dict[str, Any]:
+        """
+        按最近更新时间倒序分页列出 owner 的会话（键集分页，cursor 为上一页返回的 (updated_at, id)）
+
+        时间均为UTC文本（见 _timestamp），created_at / updated_at 原样返回
+        """
+        await self.flush()
+        return await asyncio.to_thread(self._page_sessions, owner, cursor, _page_size(limit))
+
+    async def get_messages(self, session_id: str, before_id: Optional[int] = None,
+                           after_id: Optional[int] = None, limit: int = 50) -> Dict[str, Any]:
+        """
+        键集分页读取会话消息（按时间顺序返回，调用方先用 owns 检查会话归属）
+
+        默认返回最新一页；before_id 向前翻页取更早的消息，after_id 向后取更新的消息。
+        """
+        await self.flush()
+        return await asyncio.to_thread(self._page_messages, session_id, before_id, after_id, _page_size(limit))
+
+    async def search_messages(self, query: str, owner: str, session_id: Optional[str] = None,
+                              before_id: Optional[int] = None, limit: int = 20) -> Dict[str, Any]:
+        """在 owner 的会话中全文检索消息，按时间倒序分页（before_id 为上一页返回的 next_before_id）"""
+        match = build_match_query(query)
+        if not match:
+            return {'results': [], 'has_more': False, 'next_before_id': None}
+        await self.flush()
+        return await asyncio.to_thread(self._search, match, owner, session_id, before_id, _page_size(limit))
+
+    async def export_messages(self, session_id: str, chunk_size: int = 1000) -> AsyncIterator[str]:
+        """按ID顺序分块读取会话全部消息，逐行生成NDJSON（每块单独加锁，不阻塞写入；调用方先检查归属）"""
+        await self.flush()
+        last_id = 0
+        while True:
+            page = await asyncio.to_thread(self._page_messages, session_id, None, last_id, chunk_size)
+            for message in page['messages']:
+                yield json.dumps(message, ensure_ascii=False) + '\n'
+            if not page['has_more']:
+                break
+            last_id = page['after_id']
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'enabled': self.enabled,
+            'path': self.db_path,
+            'pending': len(self._pending),
+            **self.metrics
+        }
+
+
+# 全局会话存储实例
+session_store = SessionStore(
+    db_path=config.session_store_db,
+    flush_interval_ms=config.session_store_flush_ms,
+    batch_size=config.session_store_batch_size,
+    enabled=config.session_store_enabled,
+    legacy_path=config.session_store_legacy_db
+)
@@ -0,0 +1,528 @@
+"""
+跨进程共享状态
+
+多个 worker 进程之间共享会话、统计与限流计数，并提供跨进程发布/订阅：
+- memory: 进程内字典（单进程默认，不跨进程）
+- sqlite: 同一主机上的多个进程共享一个 SQLite 文件（WAL），发布/订阅通过事件表轮询
+- shm:    与 sqlite 相同，但数据库文件放在 /dev/shm（内存文件系统），不落盘、重启即清空
+- redis:  任意 Redis 兼容服务（需安装 redis 包），未安装时回退为 sqlite；
+          本机没有Redis时可运行 local_redis.py 作为替身
+
+所有值以JSON序列化存储。发布的消息先直接投递给本进程的订阅者，
+其他进程通过各自后端的监听任务收到（跳过本进程自己发布的消息）。
+
+使用方法:
+    from shared_state import shared_state
+
+    await shared_state.set('key', {'a': 1}, ttl=60)
+    count = await shared_state.incr('ratelimit:user:1', ttl=60)
+    await shared_state.subscribe('group_chat', handler)
+    await shared_state.publish('group_chat', {'session_id': 's1'})
+"""
+
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import defaultdict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# 订阅回调：收到消息时调用（可以是协程函数）
+Subscriber = Callable[[Any], Optional[Awaitable[None]]]
+
+
+def _dumps(value: Any) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+
+
+class SharedStateBackend(ABC):
+    """共享状态后端基类"""
+
+    name = 'base'
+    # 是否在进程之间共享（memory 后端为 False，调用方可据此跳过多余的同步）
+    shared = True
+
+    def __init__(self, namespace: str = 'avatar'):
+        self.namespace = namespace
+        # 当前进程的标识，用于跳过自己发布的消息
+        self.worker_id = f'{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self._subscribers: Dict[str, List[Subscriber]] = defaultdict(list)
+        self._tasks: Set[asyncio.Task] = set()
+        self.metrics = {
+            'published': 0,
+            'delivered_local': 0,
+            'received_remote': 0,
+            'errors': 0
+        }
+
+    def _key(self, key: str) -> str:
+        return f'{self.namespace}:{key}'
+
+    # ---------- 键值 ----------
+
+    @abstractmethod
+    async def get(self, key: str, default: Any = None) -> Any:
+        pass
+
+    @abstractmethod
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        pass
+
+    @abstractmethod
+    async def delete(self, key: str):
+        pass
+
+    @abstractmethod
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        """原子自增并返回新值；键不存在或已过期时从0开始，ttl 只在创建时设置"""
+        pass
+
+    # ---------- 有界列表 ----------
+
+    @abstractmethod
+    async def push(self, key: str, value: Any, max_len: int = 100):
+        """追加到列表末尾，只保留最近 max_len 个元素"""
+        pass
+
+    @abstractmethod
+    async def range(self, key: str, count: int) -> List[Any]:
+        """最近 count 个元素（按追加顺序）"""
+        pass
+
+    @abstractmethod
+    async def length(self, key: str) -> int:
+        pass
+
+    # ---------- 发布/订阅 ----------
+
+    async def subscribe(self, channel: str, callback: Subscriber):
+        """订阅频道（本进程和其他进程发布的消息都会收到）"""
+        self._subscribers[channel].append(callback)
+        await self._start_listener()
+
+    async def unsubscribe(self, channel: str, callback: Subscriber):
+        callbacks = self._subscribers.get(channel, [])
+        if callback in callbacks:
+            callbacks.remove(callback)
+
+    async def publish(self, channel: str, message: Any):
+        """发布消息：先投递给本进程订阅者，再发送给其他进程"""
+        self.metrics['published'] += 1
+        await self._dispatch(channel, message)
+        if self.shared:
+            await self._publish_remote(channel, _dumps({'origin': self.worker_id, 'data': message}))
+
+    async def _dispatch(self, channel: str, message: Any, remote: bool = False):
+        for callback in list(self._subscribers.get(channel, [])):
+            try:
+                result = callback(message)
+                if asyncio.iscoroutine(result):
+                    await result
+                self.metrics['received_remote' if remote else 'delivered_local'] += 1
+            except Exception as e:
+                self.metrics['errors'] += 1
+                logger.error(f"共享状态订阅回调失败 ({channel}): {e}")
+
+    async def _receive(self, channel: str, raw: str):
+        """监听任务收到其他进程的消息"""
+        envelope = json.loads(raw)
+        if envelope.get('origin') == self.worker_id:
+            return
+        await self._dispatch(channel, envelope.get('data'), remote=True)
+
+    async def _publish_remote(self, channel: str, raw: str):
+        pass
+
+    async def _start_listener(self):
+        pass
+
+    # ---------- 其他 ----------
+
+    def spawn(self, coro: Awaitable) -> Optional[asyncio.Task]:
+        """在同步代码中提交写操作，不等待完成（没有运行中的事件循环时丢弃）"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            coro.close()
+            return None
+        task = loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def close(self):
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'backend': self.name,
+            'shared': self.shared,
+            'worker_id': self.worker_id,
+            'channels': {channel: len(callbacks) for channel, callbacks in self._subscribers.items() if callbacks},
+            **self.metrics
+        }
+
+
+class MemoryStateBackend(SharedStateBackend):
+    """进程内后端（单进程运行时使用）"""
+
+    name = 'memory'
+    shared = False
+
+    def __init__(self, namespace: str = 'avatar'):
+        super().__init__(namespace)
+        self._values: Dict[str, Any] = {}
+        self._expires: Dict[str, float] = {}
+        self._lists: Dict[str, List[Any]] = defaultdict(list)
+
+    def _alive(self, key: str) -> bool:
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at <= time.time():
+            self._values.pop(key, None)
+            self._expires.pop(key, None)
+            return False
+        return key in self._values
+
+    async def get(self, key: str, default: Any = None) -> Any:
+        return self._values[key] if self._alive(key) else default
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        self._values[key] = value
+        if ttl:
+            self._expires[key] = time.time() + ttl
+        else:
+            self._expires.pop(key, None)
+
+    async def delete(self, key: str):
+        self._values.pop(key, None)
+        self._expires.pop(key, None)
+        self._lists.pop(key, None)
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        if not self._alive(key):
+            await self.set(key, 0, ttl)
+        self._values[key] += amount
+        return self._values[key]
+
+    async def push(self, key: str, value: Any, max_len: int = 100):
+        items = self._lists[key]
+        items.append(value)
+        if len(items) > max_len:
+            del items[:-max_len]
+
+    async def range(self, key: str, count: int) -> List[Any]:
+        return list(self._lists.get(key, [])[-count:]) if count > 0 else []
+
+    async def length(self, key: str) -> int:
+        return len(self._lists.get(key, []))
+
+
+class SQLiteStateBackend(SharedStateBackend):
+    """
+    SQLite 后端：同一主机上的多个进程共享一个数据库文件
+
+    每个进程一个连接，操作在线程中执行；发布的消息写入事件表，
+    各进程的监听任务按间隔轮询新事件，过期事件定期清理。
+    """
+
+    name = 'sqlite'
+    # 事件保留时间（秒）
+    EVENT_RETENTION = 60
+
+    SCHEMA = [
+        'CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT, expires_at REAL)',
+        'CREATE TABLE IF NOT EXISTS lists (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT, value TEXT)',
+        'CREATE INDEX IF NOT EXISTS idx_lists_key ON lists(key, id)',
+        '''CREATE TABLE IF NOT EXISTS events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            channel TEXT,
+            payload TEXT,
+            created_at REAL
+        )''',
+    ]
+
+    def __init__(self, path: str, namespace: str = 'avatar', poll_interval_ms: int = 50):
+        super().__init__(namespace)
+        self.path = path
+        self.poll_interval = poll_interval_ms / 1000
+        self._db: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._listener: Optional[asyncio.Task] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._db is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # isolation_level=None：每条语句自动提交，多进程间不持有长事务
+            db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, timeout=5)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            for statement in self.SCHEMA:
+                db.execute(statement)
+            self._db = db
+        return self._db
+
+    def _execute(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    async def _run(self, sql: str, params: tuple = ()) -> List[tuple]:
+        return await asyncio.to_thread(self._execute, sql, params)
+
+    async def get(self, key: str, default: Any = None) -> Any:
+        rows = await self._run(
+            'SELECT value FROM kv WHERE key = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (self._key(key), time.time())
+        )
+        return json.loads(rows[0][0]) if rows else default
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        await self._run(
+            'INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)',
+            (self._key(key), _dumps(value), time.time() + ttl if ttl else None)
+        )
+
+    async def delete(self, key: str):
+        full_key = self._key(key)
+        await self._run('DELETE FROM kv WHERE key = ?', (full_key,))
+        await self._run('DELETE FROM lists WHERE key = ?', (full_key,))
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        # 单条语句完成，多进程并发自增也是原子的
+        rows = await self._run(
+            'INSERT INTO kv (key, value, expires_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(key) DO UPDATE SET '
+            'value = CASE WHEN expires_at IS NOT NULL AND expires_at <= ? '
+            'THEN excluded.value ELSE CAST(value AS INTEGER) + ? END, '
+            'expires_at = CASE WHEN expires_at IS NOT NULL AND expires_at <= ? '
+            'THEN excluded.expires_at ELSE expires_at END '
+            'RETURNING value',
+            (self._key(key), amount, expires_at, now, amount, now)
+        )
+        return int(rows[0][0])
+
+    async def push(self, key: str, value: Any, max_len: int = 100):
+        full_key = self._key(key)
+        await self._run('INSERT INTO lists (key, value) VALUES (?, ?)', (full_key, _dumps(value)))
+        await self._run(
+            'DELETE FROM lists WHERE key = ? AND id <= '
+            '(SELECT id FROM lists WHERE key = ? ORDER BY id DESC LIMIT 1 OFFSET ?)',
+            (full_key, full_key, max_len)
+        )
+
+    async def range(self, key: str, count: int) -> List[Any]:
+        if count <= 0:
+            return []
+        rows = await self._run(
+            'SELECT value FROM lists WHERE key = ? ORDER BY id DESC LIMIT ?',
+            (self._key(key), count)
+        )
+        return [json.loads(row[0]) for row in reversed(rows)]
+
+    async def length(self, key: str) -> int:
+        rows = await self._run('SELECT COUNT(*) FROM lists WHERE key = ?', (self._key(key),))
+        return rows[0][0]
+
+    async def _publish_remote(self, channel: str, raw: str):
+        await self._run(
+            'INSERT INTO events (channel, payload, created_at) VALUES (?, ?, ?)',
+            (self._key(channel), raw, time.time())
+        )
+
+    async def _start_listener(self):
+        if self._listener is None or self._listener.done():
+            rows = await self._run('SELECT COALESCE(MAX(id), 0) FROM events')
+            self._listener = asyncio.create_task(self._listen(rows[0][0]))
+
+    async def _listen(self, last_id: int):
+        """轮询事件表，投递其他进程发布的消息"""
+        prefix_len = len(self.namespace) + 1
+        last_cleanup = time.time()
+        while True:
+            try:
+                rows = await self._run(
+                    'SELECT id, channel, payload FROM events WHERE id > ? ORDER BY id', (last_id,)
+                )
+                for event_id, channel, payload in rows:
+                    last_id = event_id
+                    channel = channel[prefix_len:]
+                    if self._subscribers.get(channel):
+                        await self._receive(channel, payload)
+                now = time.time()
+                if now - last_cleanup > self.EVENT_RETENTION:
+                    last_cleanup = now
+                    await self._run('DELETE FROM events WHERE created_at < ?', (now - self.EVENT_RETENTION,))
+                    await self._run(
+                        'DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?', (now,)
+                    )
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.metrics['errors'] += 1
+                logger.error(f"共享状态事件轮询失败: {e}")
+            await asyncio.sleep(self.poll_interval)
+
+    async def close(self):
+        await super().close()
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**super().get_stats(), 'path': self.path}
+
+
+class RedisStateBackend(SharedStateBackend):
+    """Redis 兼容服务后端（redis.asyncio）"""
+
+    name = 'redis'
+
+    # 自增并只在新建时设置过期时间
+    _INCR_SCRIPT = (
+        "local v = redis.call('INCRBY', KEYS[1], ARGV[1]) "
+        "if tonumber(ARGV[2]) > 0 and redis.call('TTL', KEYS[1]) < 0 then "
+        "redis.call('PEXPIRE', KEYS[1], ARGV[2]) end "
+        "return v"
+    )
+
+    def __init__(self, url: str, namespace: str = 'avatar'):
+        super().__init__(namespace)
+        import redis.asyncio as redis
+        self.url = url
+        self._client = redis.from_url(url, decode_responses=True)
+        self._pubsub = None
+        self._listener: Optional[asyncio.Task] = None
+
+    async def get(self, key: str, default: Any = None) -> Any:
+        raw = await self._client.get(self._key(key))
+        return json.loads(raw) if raw is not None else default
+
+    async def set(self, key: str, value: Any, ttl: Optional[float] = None):
+        await self._client.set(self._key(key), _dumps(value), px=int(ttl * 1000) if ttl else None)
+
+    async def delete(self, key: str):
+        await self._client.delete(self._key(key))
+
+    async def incr(self, key: str, amount: int = 1, ttl: Optional[float] = None) -> int:
+        return int(await self._client.eval(
+            self._INCR_SCRIPT, 1, self._key(key), amount, int(ttl * 1000) if ttl else 0
+        ))
+
+    async def push(self, key: str, value: Any, max_len: int = 100):
+        full_key = self._key(key)
+        async with self._client.pipeline(transaction=True) as pipe:
+            pipe.rpush(full_key, _dumps(value))
+            pipe.ltrim(full_key, -max_len, -1)
+            await pipe.execute()
+
+    async def range(self, key: str, count: int) -> List[Any]:
+        if count <= 0:
+            return []
+        return [json.loads(raw) for raw in await self._client.lrange(self._key(key), -count, -1)]
+
+    async def length(self, key: str) -> int:
+        return await self._client.llen(self._key(key))
+
+    async def _publish_remote(self, channel: str, raw: str):
+        await self._client.publish(self._key(channel), raw)
+
+    async def subscribe(self, channel: str, callback: Subscriber):
+        await super().subscribe(channel, callback)
+        await self._pubsub.subscribe(self._key(channel))
+
+    async def _start_listener(self):
+        if self._pubsub is None:
+            self._pubsub = self._client.pubsub()
+        if self._listener is None or self._listener.done():
+            self._listener = asyncio.create_task(self._listen())
+
+    async def _listen(self):
+        prefix_len = len(self.namespace) + 1
+        while True:
+            try:
+                if not self._pubsub.subscribed:
+                    await asyncio.sleep(0.1)
+                    continue
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+                if message:
+                    await self._receive(message['channel'][prefix_len:], message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.metrics['errors'] += 1
+                logger.error(f"Redis订阅接收失败: {e}")
+                await asyncio.sleep(1)
+
+    async def close(self):
+        await super().close()
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+        if self._pubsub is not None:
+            await self._pubsub.close()
+        await self._client.close()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {**super().get_stats(), 'url': self.url}
+
+
+def _shm_path(name: str) -> str:
+    """内存文件系统中的数据库路径（没有 /dev/shm 时使用临时目录）"""
+    directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, name)
+
+
+def create_shared_state(backend: str, path: str = '', redis_url: str = '', namespace: str = 'avatar',
+                        poll_interval_ms: int = 50) -> SharedStateBackend:
+    """按名称创建共享状态后端"""
+    backend = (backend or 'memory').lower()
+    if backend == 'redis':
+        try:
+            return RedisStateBackend(redis_url, namespace)
+        except ImportError:
+            logger.warning("未安装 redis 包，共享状态回退为 sqlite 后端")
+            backend = 'sqlite'
+    if backend == 'shm':
+        state = SQLiteStateBackend(_shm_path(f'{namespace}_shared_state.db'), namespace, poll_interval_ms)
+        state.name = 'shm'
+        return state
+    if backend == 'sqlite':
+        return SQLiteStateBackend(path, namespace, poll_interval_ms)
+    if backend != 'memory':
+        logger.warning(f"未知的共享状态后端 {backend}，使用 memory")
+    return MemoryStateBackend(namespace)
+
+
+# 全局共享状态实例
+shared_state = create_shared_state(
+    config.shared_state_backend,
+    path=config.shared_state_path,
+    redis_url=config.shared_state_redis_url,
+    namespace=config.shared_state_namespace,
+    poll_interval_ms=config.shared_state_poll_ms
+)
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+生产环境启动入口
+
+与 start_server.py（开发模式：单进程、reload、debug日志）不同：
+- 主进程创建监听socket，启动N个worker进程共享该socket（默认1个，WORKERS=0 表示CPU核数）
+- 安装了 uvloop / httptools 时自动使用
+- 可调整 keep-alive、backlog、并发上限
+- 可把各worker绑定到不同CPU（Linux）
+- worker异常退出后自动重启；收到 SIGTERM/SIGINT 时所有worker进入排空模式，
+  进行中的流完成（或到达 --graceful-timeout）后退出
+- 收到 SIGHUP 时滚动重启：在同一个监听socket上启动新一组worker，全部就绪后
+  旧worker停止接受连接并排空退出，期间不拒绝任何连接（新代码与配置随新worker生效）
+- --fd 可接收上级进程（如 systemd socket activation）传入的已监听socket
+
+多worker的限制：可续传的流（Last-Event-ID 续传、Idempotency-Key 重放）、重放缓冲和
+/watch 观看都保存在创建它们的worker进程内，而各worker共享同一个监听socket，由内核
+分配连接，前端代理无法按流ID把请求固定到某个worker。续传或观看请求落到其他worker时
+会返回404（或找不到流），因此默认只启动1个worker；只有不依赖这些功能时才应调大 WORKERS。
+
+使用方法:
+    python start_production.py --workers 4 --port 8008 --pin-cpus --pid-file /tmp/avatar.pid
+    kill -HUP $(cat /tmp/avatar.pid)    # 零停机重启worker
+
+所有参数也可以通过环境变量设置（HOST、PORT、WORKERS、BACKLOG、KEEP_ALIVE、
+LIMIT_CONCURRENCY、PIN_WORKERS、LOG_LEVEL、DRAIN_TIMEOUT、LISTEN_FD、PID_FILE、WS_PER_MESSAGE_DEFLATE、
+FORWARDED_ALLOW_IPS）。
+"""
+
+import argparse
+import importlib.util
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import sys
+import time
+from typing import Dict, List, Optional
+
+logger = logging.getLogger("start_production")
+
+# 没有运行中的worker时，重启worker的最短间隔（秒），避免启动即崩溃时空转
+RESTART_BACKOFF = 1.0
+
+# 滚动重启时等待新worker就绪的最长时间（秒）
+READY_TIMEOUT = 60
+
+
+def detect_loop() -> str:
+    """安装了 uvloop 时使用 uvloop"""
+    return "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+
+
+def detect_http() -> str:
+    """安装了 httptools 时使用 httptools 解析HTTP"""
+    return "httptools" if importlib.util.find_spec("httptools") else "h11"
+
+
+def available_cpus() -> List[int]:
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    env = os.environ.get
+    parser = argparse.ArgumentParser(description="生产环境启动（多worker）")
+    parser.add_argument("--app", default=env("APP", "fastapi_stream:app"), help="ASGI应用")
+    parser.add_argument("--host", default=env("HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(env("PORT", 8008)))
+    parser.add_argument("--workers", type=int, default=int(env("WORKERS", 1)),
+                        help="worker进程数，0表示CPU核数；续传与观看的流只在本worker内，多worker时会404")
+    parser.add_argument("--backlog", type=int, default=int(env("BACKLOG", 2048)),
+                        help="监听队列长度")
+    parser.add_argument("--keep-alive", type=int, default=int(env("KEEP_ALIVE", 75)),
+                        help="HTTP keep-alive超时（秒），应大于前端代理的keep-alive")
+    parser.add_argument("--limit-concurrency", type=int, default=int(env("LIMIT_CONCURRENCY", 0)),
+                        help="每个worker的最大并发连接数，超出返回503，0表示不限制")
+    parser.add_argument("--pin-cpus", action="store_true",
+                        default=env("PIN_WORKERS", "false").lower() == "true",
+                        help="把各worker绑定到不同CPU（仅Linux）")
+    parser.add_argument("--log-level", default=env("LOG_LEVEL", "info"))
+    parser.add_argument("--graceful-timeout", type=int, default=int(env("DRAIN_TIMEOUT", 60)),
+                        help="退出时等待进行中的流完成的秒数")
+    parser.add_argument("--fd", type=int, default=int(env("LISTEN_FD", -1)),
+                        help="使用继承的已监听socket文件描述符，而不是自己绑定端口")
+    parser.add_argument("--pid-file", default=env("PID_FILE", ""), help="写入主进程PID的文件")
+    parser.add_argument("--ws-deflate", action=argparse.BooleanOptionalAction,
+                        default=env("WS_PER_MESSAGE_DEFLATE", "true").lower() == "true",
+                        help="客户端提出时协商WebSocket帧压缩（permessage-deflate），压缩率与CPU开销见 bench_ws_codec.py")
+    parser.add_argument("--forwarded-allow-ips", default=env("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+                        help="信任其 X-Forwarded-For/X-Forwarded-Proto 的代理地址或网段（逗号分隔，如 172.28.0.0/16），"
+                             "只应填写前端代理，填 * 时任何客户端都能伪造来源IP；"
+                             "默认127.0.0.1只适用于代理与后端在同一主机的部署，容器中需设为nginx所在网络")
+    args = parser.parse_args(argv)
+    if args.workers <= 0:
+        args.workers = len(available_cpus())
+    return args
+
+
+def create_socket(host: str, port: int, backlog: int, fd: int = -1) -> socket.socket:
+    """创建所有worker共享的监听socket（传入fd时直接使用继承的socket）"""
+    if fd >= 0:
+        sock = socket.socket(fileno=fd)
+        sock.set_inheritable(True)
+        return sock
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(args: argparse.Namespace, sock: socket.socket, index: int, cpu: Optional[int],
+               ready=None):
+    """worker进程入口"""
+    import uvicorn
+
+    class DrainingServer(uvicorn.Server):
+        """退出时先停止接受连接并排空进行中的流，再执行uvicorn的关闭流程"""
+
+        async def startup(self, sockets=None):
+            await super().startup(sockets=sockets)
+            if ready is not None and self.started:
+                ready.set()
+
+        async def shutdown(self, sockets=None):
+            # 关闭本进程的监听（socket仍由主进程和其他worker持有，新连接由它们接收）
+            for server in self.servers:
+                server.close()
+            try:
+                from lifecycle import drain_controller
+                await drain_controller.drain(self.config.timeout_graceful_shutdown, cancellable=False)
+            except Exception as e:
+                print(f"worker {index} 排空失败: {e}", file=sys.stderr)
+            await super().shutdown(sockets=sockets)
+
+    if cpu is not None:
+        try:
+            os.sched_setaffinity(0, {cpu})
+        except (AttributeError, OSError) as e:
+            print(f"worker {index} 绑定CPU {cpu} 失败: {e}", file=sys.stderr)
+    os.environ["WORKER_INDEX"] = str(index)
+
+    config = uvicorn.Config(
+        args.app,
+        loop=detect_loop(),
+        http=detect_http(),
+        timeout_keep_alive=args.keep_alive,
+        backlog=args.backlog,
+        limit_concurrency=args.limit_concurrency or None,
+        ws_per_message_deflate=args.ws_deflate,
+        # 排空的最长等待时间，排空后uvicorn关闭剩余连接时也以此为上限
+        timeout_graceful_shutdown=args.graceful_timeout,
+        log_level=args.log_level,
+        access_log=False,
+        proxy_headers=True,
+        forwarded_allow_ips=args.forwarded_allow_ips,
+    )
+    DrainingServer(config).run(sockets=[sock])
+
+
+class Supervisor:
+    """管理worker进程：启动、异常重启、滚动重启与优雅退出"""
+
+    def __init__(self, args: argparse.Namespace, sock: socket.socket):
+        self.args = args
+        self.sock = sock
+        self.cpus = available_cpus() if args.pin_cpus else []
+        self.context = multiprocessing.get_context("spawn")
+        self.workers: Dict[int, multiprocessing.Process] = {}
+        # 滚动重启后正在排空的旧worker及其强制结束时间
+        self.retiring: List[tuple] = []
+        self.should_exit = False
+        self.reload_requested = False
+
+    def spawn(self, index: int):
+        cpu = self.cpus[index % len(self.cpus)] if self.cpus else None
+        ready = self.context.Event()
+        process = self.context.Process(
+            target=run_worker, args=(self.args, self.sock, index, cpu, ready), name=f"worker-{index}"
+        )
+        process.start()
+        process.ready = ready
+        logger.info(f"worker {index} 已启动 (pid={process.pid}{f', cpu={cpu}' if cpu is not None else ''})")
+        return process
+
+    def handle_exit(self, signum, frame):
+        self.should_exit = True
+
+    def handle_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.handle_exit)
+        signal.signal(signal.SIGTERM, self.handle_exit)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, self.handle_reload)
+        for index in range(self.args.workers):
+            self.workers[index] = self.spawn(index)
+
+        while not self.should_exit:
+            time.sleep(0.5)
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            self.reap_retiring()
+            for index, process in list(self.workers.items()):
+                if not process.is_alive() and not self.should_exit:
+                    logger.warning(f"worker {index} 已退出 (exitcode={process.exitcode})，正在重启")
+                    if not any(p.is_alive() for p in self.workers.values()):
+                        time.sleep(RESTART_BACKOFF)
+                    self.workers[index] = self.spawn(index)
+
+        self.stop()
+
+    def reload(self):
+        """滚动重启：新worker全部就绪后，旧worker才开始排空退出"""
+        logger.info("收到重启信号，启动新一组worker...")
+        new_workers = {index: self.spawn(index) for index in range(self.args.workers)}
+        deadline = time.time() + READY_TIMEOUT
+        for process in new_workers.values():
+            if not process.ready.wait(max(0.0, deadline - time.time())) or not process.is_alive():
+                logger.error("新worker未能在超时内就绪，取消重启，保留旧worker")
+                for new_process in new_workers.values():
+                    new_process.kill()
+                    new_process.join()
+                return
+        old_workers = self.workers
+        self.workers = new_workers
+        kill_at = time.time() + self.args.graceful_timeout + 5
+        for process in old_workers.values():
+            if process.is_alive():
+                process.terminate()
+                self.retiring.append((process, kill_at))
+        logger.info(f"新worker已就绪，{len(self.retiring)} 个旧worker正在排空")
+
+    def reap_retiring(self):
+        """回收已退出的旧worker，超时未退出的强制结束"""
+        remaining = []
+        for process, kill_at in self.retiring:
+            if not process.is_alive():
+                process.join()
+                continue
+            if time.time() > kill_at:
+                logger.warning(f"{process.name} (pid={process.pid}) 排空超时，强制结束")
+                process.kill()
+                process.join()
+                continue
+            remaining.append((process, kill_at))
+        self.retiring = remaining
+
+    def stop(self):
+        """所有worker进入排空模式，进行中的流完成后退出，超时后强制结束"""
+        logger.info("正在停止所有worker...")
+        processes = list(self.workers.values()) + [process for process, _ in self.retiring]
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+        deadline = time.time() + self.args.graceful_timeout + 5
+        for process in processes:
+            process.join(max(0.0, deadline - time.time()))
+            if process.is_alive():
+                logger.warning(f"{process.name} 未在超时内退出，强制结束")
+                process.kill()
+                process.join()
+        self.sock.close()
+        if self.args.pid_file and os.path.exists(self.args.pid_file):
+            os.remove(self.args.pid_file)
+        logger.info("所有worker已停止")
+
+
+def main(argv: Optional[List[str]] = None):
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    args = parse_args(argv)
+
+    # 多worker时进程内存状态不能共享，未显式配置时改用SQLite共享状态
+    if args.workers > 1 and not os.environ.get("SHARED_STATE_BACKEND"):
+        os.environ["SHARED_STATE_BACKEND"] = "sqlite"
+    if args.workers > 1:
+        logger.warning(
+            f"workers={args.workers}: 可续传的流、重放缓冲和观看仍在各worker进程内，"
+            f"续传/观看请求落到其他worker时会返回404"
+        )
+
+    sock = create_socket(args.host, args.port, args.backlog, args.fd)
+    if args.pid_file:
+        with open(args.pid_file, "w") as f:
+            f.write(str(os.getpid()))
+    logger.info(
+        f"生产模式启动: {args.host}:{args.port}, workers={args.workers}, loop={detect_loop()}, "
+        f"http={detect_http()}, backlog={args.backlog}, keep-alive={args.keep_alive}s, "
+        f"shared_state={os.environ.get('SHARED_STATE_BACKEND', 'memory')}"
+    )
+    Supervisor(args, sock).run()
+
+
+if __name__ == "__main__":
+    multiprocessing.freeze_support()
+    main()
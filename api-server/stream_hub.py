@@ -0,0 +1,161 @@
+"""
+一次生成扇出给多个订阅者
+
+多人同时观看同一个群聊会话（如在会议室演示数字人）时，观看者不应各自触发模型调用。
+StreamHub 按主题（如群聊会话）管理只读订阅者：
+- 发布方每条消息只生成一次：写入主题的重放缓冲后发布，上游调用次数与观看人数无关
+- 每个订阅者有独立的有界队列，发布从不等待（与广播相同）：队列满时先合并状态消息，
+  仍放不下则丢弃该订阅者，客户端带最后收到的序号重新订阅即可从缓冲补齐
+- 新加入的订阅者先收到缓冲中已有的消息，再接收实时消息（取缓冲快照与注册队列之间没有await，
+  不会遗漏或重复）
+
+单聊与群聊的SSE生成（见 resumable_stream.py）本身支持多个订阅者，
+观看者通过 /api/chat/stream/{stream_id}/watch 加入。
+
+使用方法:
+    hub = StreamHub(maxsize=256, max_subscribers=100, coalesce=coalesce_status_messages)
+    hub.publish(topic, seq, payload, key)
+    subscription = hub.subscribe(topic, buffer, after_seq)
+    async for seq, payload in subscription:
+        ...
+"""
+
+import json
+import logging
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
+
+from backpressure import (
+    BoundedChannel, ChannelClosed, Coalescer, POLICY_BLOCK, POLICY_COALESCE, CLOSE_DISCONNECTED, CLOSE_OVERFLOW
+)
+from resumable_stream import ReplayBuffer
+
+logger = logging.getLogger(__name__)
+
+
+class HubFull(Exception):
+    """主题的订阅者已达上限"""
+
+
+class Subscription:
+    """一个只读订阅者：迭代得到 (序号, 消息)，控制消息（如 pong）的序号为None"""
+
+    def __init__(self, hub: 'StreamHub', topic: str, channel: BoundedChannel,
+                 gap: Optional[Tuple[int, int]], backlog: List[Tuple[int, str]]):
+        self.hub = hub
+        self.topic = topic
+        self.channel = channel
+        self.gap = gap
+        self.backlog = backlog
+
+    @property
+    def close_reason(self) -> Optional[str]:
+        return self.channel.close_reason
+
+    def send_nowait(self, payload: str) -> bool:
+        """向该订阅者单独发送控制消息（心跳ping、pong）"""
+        return self.channel.put_nowait((None, None, payload))
+
+    def __aiter__(self) -> AsyncIterator[Tuple[Optional[int], str]]:
+        return self._iterate()
+
+    async def _iterate(self):
+        try:
+            if self.gap:
+                yield None, json.dumps({'type': 'replay_gap', 'from': self.gap[0], 'to': self.gap[1]})
+            backlog, self.backlog = self.backlog, []
+            for seq, payload in backlog:
+                yield seq, payload
+            while True:
+                try:
+                    _, seq, payload = await self.channel.get()
+                except ChannelClosed:
+                    return
+                yield seq, payload
+        finally:
+            self.close()
+
+    def close(self, reason: str = CLOSE_DISCONNECTED):
+        self.hub._unsubscribe(self, reason)
+
+
+class StreamHub:
+    """按主题把消息扇出给任意数量的只读订阅者"""
+
+    def __init__(self, maxsize: int = 256, max_subscribers: int = 100, coalesce: Optional[Coalescer] = None):
+        """
+        Args:
+            coalesce: 订阅者队列已满时的合并函数，队列中的元素为 (合并键, 序号, 消息)
+        """
+        self.maxsize = maxsize
+        self.max_subscribers = max_subscribers
+        self.coalesce = coalesce
+        self.topics: Dict[str, Set[Subscription]] = {}
+        self.metrics = {
+            'subscribed': 0,
+            'published': 0,
+            'delivered': 0,
+            'dropped_subscribers': 0
+        }
+
+    def subscribe(self, topic: str, buffer: Optional[ReplayBuffer] = None, after_seq: int = 0,
+                  name: Optional[str] = None) -> Subscription:
+        """
+        订阅主题：先补齐缓冲中序号大于 after_seq 的消息，再接收实时消息
+
+        Raises:
+            HubFull: 主题的订阅者已达上限
+        """
+        subscribers = self.topics.setdefault(topic, set())
+        if len(subscribers) >= self.max_subscribers:
+            raise HubFull(f"{topic} 的订阅者已达上限 {self.max_subscribers}")
+        gap, backlog = buffer.since(after_seq) if buffer else (None, [])
+        channel = BoundedChannel(
+            name or f"hub:{topic}:{self.metrics['subscribed']}", self.maxsize,
+            POLICY_COALESCE if self.coalesce else POLICY_BLOCK, self.coalesce
+        )
+        subscription = Subscription(self, topic, channel, gap, backlog)
+        subscribers.add(subscription)
+        self.metrics['subscribed'] += 1
+        logger.info(f"{topic} 新增订阅者，当前 {len(subscribers)} 个")
+        return subscription
+
+    def publish(self, topic: str, seq: Optional[int], payload: str, key: Any = None) -> int:
+        """
+        发布一条消息（不等待）
+
+        Returns:
+            接收该消息的订阅者数（队列已满且无法合并的订阅者被丢弃）
+        """
+        subscribers = self.topics.get(topic)
+        if not subscribers:
+            return 0
+        self.metrics['published'] += 1
+        delivered = 0
+        for subscription in list(subscribers):
+            if subscription.channel.put_nowait((key, seq, payload)):
+                delivered += 1
+            else:
+                self.metrics['dropped_subscribers'] += 1
+                self._unsubscribe(subscription, CLOSE_OVERFLOW)
+        self.metrics['delivered'] += delivered
+        return delivered
+
+    def subscribers(self, topic: str) -> int:
+        return len(self.topics.get(topic, ()))
+
+    def _unsubscribe(self, subscription: Subscription, reason: str):
+        subscription.channel.close(reason)
+        subscribers = self.topics.get(subscription.topic)
+        if subscribers is None or subscription not in subscribers:
+            return
+        subscribers.discard(subscription)
+        if not subscribers:
+            del self.topics[subscription.topic]
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'topics': len(self.topics),
+            'subscribers': sum(len(subscribers) for subscribers in self.topics.values()),
+            **self.metrics
+        }
+
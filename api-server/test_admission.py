@@ -0,0 +1,129 @@
+"""准入控制：名额上限、按优先级出队、排队超时与队列满时的降级"""
+
+import asyncio
+
+import pytest
+
+from admission import (
+    PRIORITY_BATCH, PRIORITY_CODE_ASSIST, PRIORITY_HEALTH, PRIORITY_INTERACTIVE, REJECT_QUEUE_FULL,
+    REJECT_SHED, REJECT_TIMEOUT, AdmissionController, AdmissionRejected, lower_priority
+)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_disabled_controller_admits_everything():
+    async def scenario():
+        controller = AdmissionController(max_inflight=0)
+        tickets = [await controller.acquire() for _ in range(10)]
+        assert controller.inflight == 10
+        for ticket in tickets:
+            ticket.release()
+        assert controller.inflight == 0
+    run(scenario())
+
+
+def test_waiters_are_admitted_in_priority_order():
+    async def scenario():
+        controller = AdmissionController(max_inflight=1, queue_size=10, queue_timeout=5)
+        first = await controller.acquire()
+        order = []
+
+        async def wait(priority):
+            ticket = await controller.acquire(priority)
+            order.append(priority)
+            await asyncio.sleep(0)
+            ticket.release()
+
+        tasks = [asyncio.create_task(wait(priority)) for priority in
+                 (PRIORITY_HEALTH, PRIORITY_BATCH, PRIORITY_INTERACTIVE, PRIORITY_CODE_ASSIST)]
+        await asyncio.sleep(0.01)
+        assert controller.waiting == 4
+        first.release()
+        await asyncio.gather(*tasks)
+        assert order == [PRIORITY_INTERACTIVE, PRIORITY_CODE_ASSIST, PRIORITY_BATCH, PRIORITY_HEALTH]
+        assert controller.inflight == 0 and controller.waiting == 0
+    run(scenario())
+
+
+def test_queue_timeout_rejects_and_leaves_no_waiter():
+    async def scenario():
+        controller = AdmissionController(max_inflight=1, queue_size=10, queue_timeout=5)
+        held = await controller.acquire()
+        with pytest.raises(AdmissionRejected) as info:
+            await controller.acquire(PRIORITY_INTERACTIVE, timeout=0.05)
+        assert info.value.reason == REJECT_TIMEOUT
+        assert controller.waiting == 0
+        held.release()
+        assert controller.inflight == 0
+    run(scenario())
+
+
+def test_full_queue_sheds_lowest_priority_for_higher_priority():
+    async def scenario():
+        controller = AdmissionController(max_inflight=1, queue_size=1, queue_timeout=5)
+        held = await controller.acquire()
+        batch = asyncio.create_task(controller.acquire(PRIORITY_BATCH))
+        await asyncio.sleep(0.01)
+        interactive = asyncio.create_task(controller.acquire(PRIORITY_INTERACTIVE))
+        await asyncio.sleep(0.01)
+        with pytest.raises(AdmissionRejected) as info:
+            await batch
+        assert info.value.reason == REJECT_SHED
+        held.release()
+        (await interactive).release()
+        assert controller.metrics[PRIORITY_BATCH][REJECT_SHED] == 1
+        assert controller.inflight == 0
+    run(scenario())
+
+
+def test_full_queue_rejects_equal_or_lower_priority():
+    async def scenario():
+        controller = AdmissionController(max_inflight=1, queue_size=1, queue_timeout=5)
+        held = await controller.acquire()
+        waiting = asyncio.create_task(controller.acquire(PRIORITY_INTERACTIVE))
+        await asyncio.sleep(0.01)
+        for priority in (PRIORITY_INTERACTIVE, PRIORITY_BATCH):
+            with pytest.raises(AdmissionRejected) as info:
+                await controller.acquire(priority)
+            assert info.value.reason == REJECT_QUEUE_FULL
+        held.release()
+        (await waiting).release()
+        assert controller.inflight == 0
+    run(scenario())
+
+
+def test_cancelled_waiter_does_not_leak_a_slot():
+    async def scenario():
+        controller = AdmissionController(max_inflight=1, queue_size=10, queue_timeout=5)
+        held = await controller.acquire()
+        waiter = asyncio.create_task(controller.acquire())
+        await asyncio.sleep(0.01)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        held.release()
+        assert controller.inflight == 0 and controller.waiting == 0
+    run(scenario())
+
+
+def test_retained_ticket_holds_slot_until_last_release():
+    async def scenario():
+        controller = AdmissionController(max_inflight=1, queue_size=0)
+        async with controller.slot() as ticket:
+            background = controller.retain_current()
+            assert background is ticket
+        assert controller.inflight == 1
+        with pytest.raises(AdmissionRejected):
+            await controller.acquire()
+        background.release()
+        assert controller.inflight == 0
+    run(scenario())
+
+
+def test_clients_can_only_lower_their_priority():
+    assert lower_priority('batch', PRIORITY_INTERACTIVE) == PRIORITY_BATCH
+    assert lower_priority('interactive', PRIORITY_BATCH) == PRIORITY_BATCH
+    assert lower_priority('unknown', PRIORITY_CODE_ASSIST) == PRIORITY_CODE_ASSIST
@@ -0,0 +1,128 @@
+"""BoundedChannel 的 block / coalesce / drop 策略与 ConnectionWriter"""
+
+import asyncio
+
+from backpressure import (
+    CLOSE_FINISHED, CLOSE_OVERFLOW, CLOSE_TIMEOUT, POLICY_BLOCK, POLICY_COALESCE, POLICY_DROP,
+    BoundedChannel, ChannelClosed, ConnectionWriter
+)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def _join(items, item) -> bool:
+    """测试用合并函数：把字符串拼接到队尾"""
+    items[-1] += item
+    return True
+
+
+async def _drain(channel: BoundedChannel):
+    items = []
+    while True:
+        try:
+            items.append(await channel.get())
+        except ChannelClosed:
+            return items
+
+
+def test_block_policy_waits_for_consumer_and_loses_nothing():
+    async def scenario():
+        channel = BoundedChannel('test', maxsize=2, policy=POLICY_BLOCK)
+
+        async def produce():
+            for i in range(10):
+                assert await channel.put(i)
+            channel.close()
+
+        producer = asyncio.create_task(produce())
+        await asyncio.sleep(0.01)
+        # 消费者还没开始读，生产者停在第3条
+        assert channel.depth == 2 and not producer.done()
+        assert await _drain(channel) == list(range(10))
+        await producer
+        assert channel.stats['blocked'] > 0
+        assert channel.close_reason == CLOSE_FINISHED
+    run(scenario())
+
+
+def test_coalesce_policy_merges_instead_of_blocking():
+    async def scenario():
+        channel = BoundedChannel('test', maxsize=2, policy=POLICY_COALESCE, coalesce=_join)
+        for item in 'abcdef':
+            assert await channel.put(item)
+        channel.close()
+        assert ''.join(await _drain(channel)) == 'abcdef'
+        assert channel.stats['coalesced'] == 4 and channel.stats['blocked'] == 0
+    run(scenario())
+
+
+def test_drop_policy_closes_slow_consumer():
+    async def scenario():
+        channel = BoundedChannel('test', maxsize=2, policy=POLICY_DROP)
+        assert await channel.put(1)
+        assert await channel.put(2)
+        assert not await channel.put(3)
+        assert channel.closed and channel.close_reason == CLOSE_OVERFLOW
+        assert await _drain(channel) == []
+        assert not await channel.put(4)
+    run(scenario())
+
+
+def test_put_nowait_never_waits_even_with_block_policy():
+    async def scenario():
+        channel = BoundedChannel('test', maxsize=1, policy=POLICY_BLOCK)
+        assert channel.put_nowait('a')
+        assert not channel.put_nowait('b')
+        assert channel.close_reason == CLOSE_OVERFLOW
+    run(scenario())
+
+
+def test_drop_wakes_a_blocked_producer():
+    async def scenario():
+        channel = BoundedChannel('test', maxsize=1, policy=POLICY_BLOCK)
+        await channel.put('a')
+        blocked = asyncio.create_task(channel.put('b'))
+        await asyncio.sleep(0.01)
+        assert not blocked.done()
+        channel.drop()
+        assert await asyncio.wait_for(blocked, 1) is False
+    run(scenario())
+
+
+def test_connection_writer_sends_in_order():
+    async def scenario():
+        sent = []
+
+        async def send(item):
+            await asyncio.sleep(0)
+            sent.append(item)
+
+        writer = ConnectionWriter('test', send, maxsize=4)
+        writer.start()
+        for i in range(20):
+            await writer.send(i)
+        while len(sent) < 20:
+            await asyncio.sleep(0.001)
+        writer.close()
+        assert sent == list(range(20))
+    run(scenario())
+
+
+def test_connection_writer_gives_up_on_a_stuck_peer():
+    async def scenario():
+        closed = asyncio.get_running_loop().create_future()
+
+        async def send(item):
+            await asyncio.sleep(10)
+
+        async def on_close(reason):
+            closed.set_result(reason)
+
+        writer = ConnectionWriter('test', send, maxsize=4, on_close=on_close, send_timeout=0.05)
+        writer.start()
+        await writer.send('x')
+        assert await asyncio.wait_for(closed, 1) == CLOSE_TIMEOUT
+        assert not await writer.send('y')
+    run(scenario())
@@ -0,0 +1,201 @@
+"""离线批量任务：JSONL校验、重试、按提供商限制并发与中断后续传"""
+
+import asyncio
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from batch_jobs import (
+    STATUS_COMPLETED, STATUS_FAILED, STATUS_INTERRUPTED, BatchInputError, BatchRunner, parse_items, parse_targets
+)
+from providers.base import ProviderModelNotFoundError, StreamChunk
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class FakeProvider:
+    """按提示词返回结果的假提供商：failures 中的提示词先失败指定次数，hold 中的提示词等待放行"""
+
+    def __init__(self, name: str, calls: list, failures=None, hold=None):
+        self.name = name
+        self.config = SimpleNamespace(default_model=f'{name}-model')
+        self.calls = calls
+        self.failures = failures if failures is not None else {}
+        self.hold = hold or {}
+        self.active = 0
+        self.peak = 0
+
+    async def chat_completion(self, messages, model, stream=False, **params):
+        prompt = messages[-1]['content']
+        self.calls.append((self.name, prompt))
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            await asyncio.sleep(0.005)
+            if prompt in self.hold:
+                await self.hold[prompt].wait()
+            if self.failures.get(prompt):
+                self.failures[prompt] -= 1
+                raise RuntimeError(f"上游错误: {prompt}")
+            if prompt == 'missing-model':
+                raise ProviderModelNotFoundError('模型不存在', self.name)
+        finally:
+            self.active -= 1
+        yield StreamChunk(content=f"answer:{prompt}", chunk_id=0, request_id='r', timestamp=time.time(),
+                          model=model, provider=self.name,
+                          usage={'prompt_tokens': 3, 'completion_tokens': 5, 'total_tokens': 8})
+
+
+class FakeProviderManager:
+    def __init__(self, *providers: FakeProvider):
+        self.providers = {provider.name: provider for provider in providers}
+
+    def get_provider(self, name):
+        return self.providers.get(name)
+
+
+def _jsonl(*prompts: str, **extra) -> bytes:
+    return ''.join(json.dumps({'id': f'q{i}', 'prompt': prompt, **extra}) + '\n'
+                   for i, prompt in enumerate(prompts)).encode('utf-8')
+
+
+def _runner(tmp_path, manager, **kwargs) -> BatchRunner:
+    options = dict(directory=str(tmp_path), concurrency={'default': 2}, max_retries=2, retry_base_delay=0)
+    options.update(kwargs)
+    return BatchRunner(manager, **options)
+
+
+def _results(job):
+    with open(job.results_path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+# ---------- 输入校验 ----------
+
+def test_parse_items_accepts_prompts_and_messages_and_assigns_ids():
+    data = b'\xef\xbb\xbf{"prompt": "a"}\n\n{"id": "x", "messages": [{"role": "user", "content": "b"}]}\n'
+    items = parse_items(data, max_items=10)
+    assert [item['id'] for item in items] == ['1', 'x']
+
+
+@pytest.mark.parametrize('data, message', [
+    ('{"prompt": "a"}\nnot json\n'.encode(), '第 2 行不是有效的JSON'),
+    (b'{"id": "q"}\n', '缺少 prompt 或 messages'),
+    (b'{"id": "q", "prompt": "a"}\n{"id": "q", "prompt": "b"}\n', 'id 重复'),
+    (b'\n\n', '没有任何条目'),
+    (_jsonl('a', 'b', 'c'), '条目数超过上限'),
+    ('{"prompt": "中文"}'.encode('gbk'), '不是UTF-8编码'),
+])
+def test_parse_items_rejects_invalid_input(data, message):
+    with pytest.raises(BatchInputError, match=message):
+        parse_items(data, max_items=2)
+
+
+def test_parse_targets_accepts_string_and_json_forms():
+    assert parse_targets('openrouter:deepseek/deepseek-chat, glm') == [
+        {'provider': 'openrouter', 'model': 'deepseek/deepseek-chat'}, {'provider': 'glm', 'model': None}
+    ]
+    assert parse_targets('[{"provider": "deepseek"}]') == [{'provider': 'deepseek', 'model': None}]
+    with pytest.raises(BatchInputError):
+        parse_targets([{'model': 'x'}])
+
+
+def test_submit_requires_targets_for_items_without_provider(tmp_path):
+    async def scenario():
+        runner = _runner(tmp_path, FakeProviderManager())
+        with pytest.raises(BatchInputError):
+            await runner.submit(_jsonl('a'))
+    run(scenario())
+
+
+# ---------- 运行 ----------
+
+def test_each_item_runs_once_per_target_with_retries(tmp_path):
+    async def scenario():
+        calls = []
+        alpha = FakeProvider('alpha', calls, failures={'flaky': 1})
+        beta = FakeProvider('beta', calls)
+        runner = _runner(tmp_path, FakeProviderManager(alpha, beta))
+        job = await runner.submit(_jsonl('one', 'flaky', 'missing-model'), targets='alpha,beta:custom')
+        await job.task
+        assert job.total == 6
+        assert (job.status, job.succeeded, job.failed, job.retries) == (STATUS_FAILED, 4, 2, 1)
+        results = {record['key']: record for record in _results(job)}
+        assert results['q0|beta|custom']['model'] == 'custom'
+        assert results['q1|alpha|']['attempts'] == 2
+        # 模型不存在不重试
+        assert results['q2|alpha|']['status'] == 'error' and results['q2|alpha|']['attempts'] == 1
+        assert job.tokens == 4 * 8
+    run(scenario())
+
+
+def test_provider_concurrency_limit_is_respected(tmp_path):
+    async def scenario():
+        calls = []
+        alpha, beta = FakeProvider('alpha', calls), FakeProvider('beta', calls)
+        runner = _runner(tmp_path, FakeProviderManager(alpha, beta), concurrency={'alpha': 1, 'default': 3})
+        job = await runner.submit(_jsonl(*[f'p{i}' for i in range(12)]), targets='alpha,beta')
+        await job.task
+        assert job.status == STATUS_COMPLETED and job.succeeded == 24
+        assert alpha.peak == 1 and beta.peak == 3
+    run(scenario())
+
+
+def test_resume_skips_succeeded_units_and_retries_failed_ones(tmp_path):
+    async def scenario():
+        calls = []
+        alpha = FakeProvider('alpha', calls, failures={'bad': 10})
+        runner = _runner(tmp_path, FakeProviderManager(alpha), max_retries=0)
+        job = await runner.submit(_jsonl('good', 'bad', 'fine'), targets='alpha')
+        await job.task
+        assert (job.status, job.succeeded, job.failed) == (STATUS_FAILED, 2, 1)
+        alpha.failures.clear()
+        calls.clear()
+        await runner.resume(job.job_id)
+        await job.task
+        assert calls == [('alpha', 'bad')]
+        assert (job.status, job.succeeded, job.failed, job.runs) == (STATUS_COMPLETED, 3, 0, 2)
+    run(scenario())
+
+
+def test_interrupted_job_resumes_in_a_new_process(tmp_path):
+    async def scenario():
+        calls = []
+        release = asyncio.Event()
+        alpha = FakeProvider('alpha', calls, hold={'slow': release})
+        runner = _runner(tmp_path, FakeProviderManager(alpha), concurrency={'default': 1})
+        job = await runner.submit(_jsonl('a', 'b', 'slow', 'c'), targets='alpha')
+        while ('alpha', 'slow') not in calls:
+            await asyncio.sleep(0.005)
+        # 进程退出：中断运行中的任务，已完成的结果写入 results.jsonl
+        await runner.close()
+        assert job.status == STATUS_INTERRUPTED
+        assert {record['id'] for record in _results(job)} == {'q0', 'q1'}
+
+        # 新进程从任务目录加载并续传，只执行未完成的条目
+        calls.clear()
+        restarted = _runner(tmp_path, FakeProviderManager(FakeProvider('alpha', calls)))
+        loaded = restarted.get(job.job_id)
+        assert loaded is not job and loaded.status == STATUS_INTERRUPTED
+        await restarted.resume(job.job_id)
+        await loaded.task
+        assert calls == [('alpha', 'slow'), ('alpha', 'c')]
+        assert (loaded.status, loaded.succeeded, loaded.total) == (STATUS_COMPLETED, 4, 4)
+    run(scenario())
+
+
+def test_load_results_drops_a_half_written_last_line(tmp_path):
+    async def scenario():
+        calls = []
+        runner = _runner(tmp_path, FakeProviderManager(FakeProvider('alpha', calls)))
+        job = await runner.submit(_jsonl('a', 'b'), targets='alpha')
+        await job.task
+        with open(job.results_path, 'a', encoding='utf-8') as f:
+            f.write('{"key": "q9|alpha|", "sta')
+        assert set(job.load_results()) == {'q0|alpha|', 'q1|alpha|'}
+        assert len(_results(job)) == 2
+    run(scenario())
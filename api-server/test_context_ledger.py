@@ -0,0 +1,71 @@
+"""ContextLedger：增量前缀和与逐条重新统计的结果一致"""
+
+import random
+from datetime import datetime
+
+from tokenizer_service import tokenizer_service
+from websocket_handler import ChatMessage, ContextLedger
+
+MODELS = ['deepseek-chat', 'gpt-4o-mini', None]
+
+
+def _message(i: int) -> ChatMessage:
+    role = 'user' if i % 2 == 0 else 'assistant'
+    content = f"第{i}条消息 message {i} " + '内容' * (i % 7) + 'words ' * (i % 5)
+    return ChatMessage(role=role, content=content, timestamp=datetime.now())
+
+
+def _recount(ledger: ContextLedger, model):
+    return tokenizer_service.count_each_message([msg.record for msg in ledger.messages], model)
+
+
+def _naive_suffix(counts, budget):
+    """从最新消息向前累加，返回 (第一条保留消息的下标, 保留的token数)"""
+    total, first = 0, len(counts)
+    for index in range(len(counts) - 1, -1, -1):
+        if total + counts[index] > budget:
+            break
+        total += counts[index]
+        first = index
+    return first, total
+
+
+def test_totals_match_full_recount_through_appends_and_truncation():
+    rng = random.Random(7)
+    ledger = ContextLedger()
+    for i in range(300):
+        ledger.append(_message(i))
+        if rng.random() < 0.1:
+            ledger.truncate(rng.randint(5, 40))
+        if rng.random() < 0.3:
+            model = rng.choice(MODELS)
+            assert ledger.total_tokens(model) == sum(_recount(ledger, model))
+    # 起始下标多次越过压缩阈值后仍一致
+    for model in MODELS:
+        assert ledger.total_tokens(model) == sum(_recount(ledger, model))
+
+
+def test_select_suffix_matches_naive_scan():
+    ledger = ContextLedger()
+    for i in range(120):
+        ledger.append(_message(i))
+    ledger.truncate(90)
+    for model in MODELS:
+        counts = _recount(ledger, model)
+        for budget in (0, 1, 50, 333, 1000, sum(counts), sum(counts) + 10):
+            expected = _naive_suffix(counts, budget) if budget > 0 else (len(counts), 0)
+            assert ledger.select_suffix(model, budget) == expected
+
+
+def test_summary_moves_covered_messages_out_of_window():
+    ledger = ContextLedger()
+    for i in range(20):
+        ledger.append(_message(i))
+    start, records = ledger.compaction_span(keep_recent=6, max_messages=10)
+    assert start == 0 and len(records) == 10
+    assert ledger.set_summary('摘要', start, start + len(records))
+    assert len(ledger) == 10
+    assert ledger.records()[0] is ledger.messages[0].record
+    assert ledger.total_tokens('deepseek-chat') == sum(_recount(ledger, 'deepseek-chat'))
+    # 覆盖范围没有前进的摘要被忽略
+    assert not ledger.set_summary('旧摘要', 0, 5)
@@ -0,0 +1,62 @@
+"""聊天历史API：只能查询、检索、导出和删除自己的会话"""
+
+import asyncio
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import history_api
+from quota import register_token
+from session_store import SessionStore
+
+ALICE = {'Authorization': 'Bearer alice-token'}
+BOB = {'Authorization': 'Bearer bob-token'}
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    path = str(tmp_path / 'chat_history.db')
+
+    async def seed():
+        await register_token('alice-token', {'id': 1, 'username': 'alice'})
+        await register_token('bob-token', {'id': 2, 'username': 'bob'})
+        store = SessionStore(path)
+        store.save_session('alice-session', [], {}, owner='1')
+        store.add_message('alice-session', 'user', '量子纠缠是什么')
+        store.save_session('bob-session', [], {}, owner='2')
+        store.add_message('bob-session', 'user', '量子纠缠的应用')
+        await store.close()
+
+    asyncio.run(seed())
+    monkeypatch.setattr(history_api, 'session_store', SessionStore(path))
+    app = FastAPI()
+    app.include_router(history_api.router)
+    with TestClient(app) as client:
+        yield client
+
+
+def test_list_and_search_only_return_own_sessions(client):
+    sessions = client.get('/api/history/sessions', headers=ALICE).json()['sessions']
+    assert [session['session_id'] for session in sessions] == ['alice-session']
+    results = client.get('/api/history/search', params={'q': '量子'}, headers=BOB).json()['results']
+    assert [result['session_id'] for result in results] == ['bob-session']
+    # 未登录的请求按客户端IP识别，看不到登录用户的会话
+    assert client.get('/api/history/sessions').json()['sessions'] == []
+
+
+def test_other_users_sessions_are_not_found(client):
+    for method, path in (('get', '/api/history/sessions/alice-session/messages'),
+                         ('get', '/api/history/sessions/alice-session/export'),
+                         ('delete', '/api/history/sessions/alice-session')):
+        assert client.request(method, path, headers=BOB).status_code == 404
+    messages = client.get('/api/history/sessions/alice-session/messages', headers=ALICE).json()['messages']
+    assert [message['content'] for message in messages] == ['量子纠缠是什么']
+
+
+def test_owner_can_export_and_delete(client):
+    export = client.get('/api/history/sessions/bob-session/export', headers=BOB)
+    assert export.status_code == 200 and '量子纠缠的应用' in export.text
+    assert client.delete('/api/history/sessions/bob-session', headers=BOB).json()['success']
+    assert client.get('/api/history/sessions', headers=BOB).json()['sessions'] == []
+    assert client.get('/api/history/sessions/bob-session/messages', headers=BOB).status_code == 404
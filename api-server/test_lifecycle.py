@@ -0,0 +1,59 @@
+"""排空模式：重连提示经连接的发送队列按协商的编码发送，发完后以1012关闭"""
+
+import pytest
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi.testclient import TestClient
+
+import websocket_handler
+from lifecycle import WS_CLOSE_SERVICE_RESTART, DrainController, DrainMiddleware
+from ws_codec import MsgpackCodec
+
+
+@pytest.fixture
+def controller(monkeypatch):
+    controller = DrainController(retry_after=3)
+    monkeypatch.setattr(websocket_handler, 'drain_controller', controller)
+    return controller
+
+
+def _app(controller: DrainController) -> FastAPI:
+    manager = websocket_handler.ConnectionManager()
+    app = FastAPI()
+
+    @app.websocket('/ws/{session_id}')
+    async def endpoint(websocket: WebSocket, session_id: str):
+        codec = await manager.connect(websocket, session_id)
+        try:
+            while True:
+                message = await codec.receive(websocket)
+                await manager.send_control(session_id, {'type': 'echo', 'data': message})
+        except WebSocketDisconnect:
+            manager.disconnect(session_id, websocket)
+
+    app.add_middleware(DrainMiddleware, controller=controller)
+    return app
+
+
+def test_drain_hint_uses_the_negotiated_codec_and_closes_after_queued_messages(controller):
+    codec = MsgpackCodec()
+    with TestClient(_app(controller)) as client:
+        with client.websocket_connect('/ws/s1', subprotocols=['chat-msgpack.v1']) as ws:
+            ws.send_text('{"type": "ping"}')
+            assert codec.decode(ws.receive_bytes())['type'] == 'echo'
+            assert client.portal.call(controller.drain, 1)
+            hint = codec.decode(ws.receive_bytes())
+            assert hint['type'] == 'server_draining' and hint['reconnect'] and hint['retryAfter'] == 3
+            with pytest.raises(WebSocketDisconnect) as closed:
+                ws.receive_bytes()
+            assert closed.value.code == WS_CLOSE_SERVICE_RESTART
+        assert controller.get_status()['websockets'] == 0
+
+
+def test_new_websockets_are_rejected_while_draining(controller):
+    with TestClient(_app(controller)) as client:
+        client.portal.call(controller.drain, 1)
+        with pytest.raises(WebSocketDisconnect) as closed:
+            with client.websocket_connect('/ws/s2'):
+                pass
+        assert closed.value.code == WS_CLOSE_SERVICE_RESTART
+        assert controller.metrics['rejected_websockets'] == 1
@@ -0,0 +1,65 @@
+"""LRUCache：按条目数与字节数淘汰、TTL过期"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from utils import lru_cache
+from utils.lru_cache import LRUCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = SimpleNamespace(now=1_000_000.0)
+    monkeypatch.setattr(lru_cache, 'time', SimpleNamespace(time=lambda: clock.now))
+    return clock
+
+
+def test_evicts_least_recently_used_by_count():
+    cache = LRUCache(max_entries=3)
+    for key in 'abc':
+        cache.set(key, key.upper())
+    # 读取 a 后 b 成为最久未使用的条目
+    assert cache.get('a') == 'A'
+    cache.set('d', 'D')
+    assert 'b' not in cache
+    assert [cache.get(key) for key in 'acd'] == ['A', 'C', 'D']
+    assert cache.evictions == 1 and len(cache) == 3
+
+
+def test_evicts_by_total_bytes_and_rejects_oversized_values():
+    cache = LRUCache(max_entries=100, max_bytes=10, sizeof=len)
+    assert cache.set('a', 'xxxx') and cache.set('b', 'yyyy')
+    assert cache.set('c', 'zzzz')
+    assert 'a' not in cache and cache.total_bytes == 8
+    # 单个值超过上限时拒绝写入，不淘汰已有条目
+    assert not cache.set('big', 'x' * 11)
+    assert len(cache) == 2 and cache.total_bytes == 8
+    # 覆盖写入按新的大小重新计算
+    cache.set('b', 'y')
+    assert cache.total_bytes == 5
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = LRUCache(max_entries=10, ttl=60)
+    cache.set('default', 1)
+    cache.set('short', 2, ttl=5)
+    cache.set('forever', 3, ttl=0)
+    clock.now += 10
+    assert 'short' not in cache and cache.get('short') is None
+    assert cache.get('default') == 1
+    clock.now += 60
+    assert cache.get('default', 'gone') == 'gone'
+    assert cache.get('forever') == 3
+    assert len(cache) == 1
+    assert cache.stats()['hits'] == 2 and cache.stats()['misses'] == 2
+
+
+def test_pop_and_clear_release_bytes():
+    cache = LRUCache(max_entries=10, max_bytes=100, sizeof=len)
+    cache.set('a', 'abc')
+    cache.set('b', 'de')
+    assert cache.pop('a') == 'abc' and cache.pop('a', 'none') == 'none'
+    assert cache.total_bytes == 2
+    cache.clear()
+    assert len(cache) == 0 and cache.total_bytes == 0
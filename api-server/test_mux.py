@@ -0,0 +1,108 @@
+"""多路复用协议：按流的credit流量控制与无效帧的处理"""
+
+import asyncio
+
+import pytest
+
+import mux
+from mux import MuxConnection, parse_credit, valid_stream_id
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class RecordingConnection(MuxConnection):
+    """不经WebSocket，记录发出的帧"""
+
+    def __init__(self):
+        super().__init__(websocket=None)
+        self.frames = []
+
+    async def send_frame(self, frame):
+        self.frames.append(frame)
+
+
+async def _count(stream, params):
+    for i in range(params.get('count', 3)):
+        await stream.emit(i)
+
+
+@pytest.fixture(autouse=True)
+def count_kind(monkeypatch):
+    monkeypatch.setitem(mux.mux_kinds, 'count', _count)
+
+
+def _data(connection, stream_id):
+    return [frame['data'] for frame in connection.frames if frame['op'] == 'data' and frame['stream'] == stream_id]
+
+
+def _errors(connection):
+    return [frame for frame in connection.frames if frame['op'] == 'error']
+
+
+def test_parse_credit_and_stream_id():
+    assert [parse_credit(value) for value in (0, 5, '7', 3.0)] == [0, 5, 7, 3]
+    assert [parse_credit(value) for value in (-1, 'x', None, True, [1], float('inf'))] == [None] * 6
+    assert valid_stream_id(1) and valid_stream_id('a')
+    assert not any(valid_stream_id(value) for value in (None, True, 1.5, [1], {'a': 1}))
+
+
+def test_stream_pauses_without_credit_and_others_keep_going():
+    async def scenario():
+        connection = RecordingConnection()
+        await connection.dispatch('open', {'op': 'open', 'stream': 1, 'kind': 'count', 'credit': 2, 'params': {'count': 5}})
+        await connection.dispatch('open', {'op': 'open', 'stream': 2, 'kind': 'count', 'credit': 10, 'params': {'count': 5}})
+        await asyncio.sleep(0.01)
+        assert _data(connection, 1) == [0, 1]
+        assert _data(connection, 2) == [0, 1, 2, 3, 4]
+        await connection.dispatch('credit', {'op': 'credit', 'stream': 1, 'n': '10'})
+        await asyncio.sleep(0.01)
+        assert _data(connection, 1) == [0, 1, 2, 3, 4]
+        closes = [frame for frame in connection.frames if frame['op'] == 'close']
+        assert [frame['reason'] for frame in closes] == ['end', 'end'] and not connection.streams
+    run(scenario())
+
+
+def test_cancel_stops_only_that_stream():
+    async def scenario():
+        connection = RecordingConnection()
+        await connection.dispatch('open', {'op': 'open', 'stream': 'a', 'kind': 'count', 'credit': 0})
+        await asyncio.sleep(0.01)
+        await connection.dispatch('cancel', {'op': 'cancel', 'stream': 'a'})
+        await asyncio.sleep(0.01)
+        assert connection.frames[-1] == {'op': 'close', 'stream': 'a', 'reason': 'cancelled'}
+        # 流结束后迟到的 credit/cancel 被忽略
+        await connection.dispatch('credit', {'op': 'credit', 'stream': 'a', 'n': 1})
+        assert not _errors(connection)
+    run(scenario())
+
+
+@pytest.mark.parametrize('op, frame', [
+    ('open', {'stream': [1], 'kind': 'count'}),
+    ('open', {'stream': 1, 'kind': 'unknown'}),
+    ('open', {'stream': 1, 'kind': ['count']}),
+    ('open', {'stream': 1, 'kind': 'count', 'credit': 'lots'}),
+    ('open', {'stream': 1, 'kind': 'count', 'credit': -3}),
+    ('data', {'stream': 9, 'data': {}}),
+    ('bogus', {'stream': None}),
+])
+def test_malformed_frames_get_an_error_frame(op, frame):
+    async def scenario():
+        connection = RecordingConnection()
+        await connection.dispatch(op, {'op': op, **frame})
+        assert len(_errors(connection)) == 1 and not connection.streams
+    run(scenario())
+
+
+def test_invalid_credit_grant_keeps_the_stream_open():
+    async def scenario():
+        connection = RecordingConnection()
+        await connection.dispatch('open', {'op': 'open', 'stream': 1, 'kind': 'count', 'credit': 0})
+        await asyncio.sleep(0.01)
+        await connection.dispatch('credit', {'op': 'credit', 'stream': 1, 'n': {'x': 1}})
+        assert len(_errors(connection)) == 1 and 1 in connection.streams
+        await connection.dispatch('credit', {'op': 'credit', 'stream': 1, 'n': 3})
+        await asyncio.sleep(0.01)
+        assert _data(connection, 1) == [0, 1, 2]
+    run(scenario())
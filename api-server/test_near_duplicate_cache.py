@@ -0,0 +1,78 @@
+"""近似重复缓存：改写后的提示词命中，不同问题、不同上文与数字不同时不命中"""
+
+from near_duplicate_cache import NearDuplicateCache, normalize_text
+
+QUESTION = "请用三句话解释一下什么是量子纠缠，以及它为什么不能用来超光速通信"
+ANSWER = {'content': '量子纠缠是……'}
+
+
+def _cache(**kwargs) -> NearDuplicateCache:
+    options = dict(endpoints=['chat_stream'], thresholds={'default': 0.8}, max_hamming=16)
+    options.update(kwargs)
+    return NearDuplicateCache(**options)
+
+
+def _messages(text: str, history=()):
+    return list(history) + [{'role': 'user', 'content': text}]
+
+
+def test_normalize_ignores_whitespace_punctuation_and_case():
+    assert normalize_text("Hello,  World！") == normalize_text("hello world")
+
+
+def test_hit_on_whitespace_and_punctuation_variant():
+    cache = _cache()
+    entry_id = cache.add('deepseek', 'deepseek-chat', _messages(QUESTION), ANSWER, temperature=0.7)
+    hit = cache.lookup('deepseek', 'deepseek-chat', _messages(" 请用三句话，解释一下什么是量子纠缠 以及它为什么不能用来超光速通信？"),
+                       temperature=0.7)
+    assert hit is not None
+    assert hit['entry_id'] == entry_id and hit['content'] == ANSWER['content']
+    assert hit['similarity'] >= 0.8
+    assert cache.get_stats()['hits'] == 1
+
+
+def test_miss_on_different_question():
+    cache = _cache()
+    cache.add('deepseek', 'deepseek-chat', _messages(QUESTION), ANSWER)
+    assert cache.lookup('deepseek', 'deepseek-chat', _messages("写一首关于秋天的七言绝句")) is None
+    assert cache.get_stats()['misses'] == 1
+
+
+def test_miss_when_digits_differ():
+    cache = _cache()
+    cache.add('deepseek', 'deepseek-chat', _messages("计算 1234 乘以 5678 的结果并给出步骤"), ANSWER)
+    assert cache.lookup('deepseek', 'deepseek-chat', _messages("计算 1234 乘以 5679 的结果并给出步骤")) is None
+
+
+def test_partitioned_by_model_params_and_context():
+    cache = _cache()
+    history = [{'role': 'user', 'content': '你好'}, {'role': 'assistant', 'content': '你好！'}]
+    cache.add('deepseek', 'deepseek-chat', _messages(QUESTION, history), ANSWER, temperature=0.7)
+    assert cache.lookup('deepseek', 'deepseek-reasoner', _messages(QUESTION, history), temperature=0.7) is None
+    assert cache.lookup('deepseek', 'deepseek-chat', _messages(QUESTION, history), temperature=0.2) is None
+    assert cache.lookup('deepseek', 'deepseek-chat', _messages(QUESTION), temperature=0.7) is None
+    assert cache.lookup('deepseek', 'deepseek-chat', _messages(QUESTION, history), temperature=0.7) is not None
+
+
+def test_per_model_threshold_can_reject_a_variant():
+    text = "帮我把下面这段话翻译成英文：今天天气很好，我们去公园散步吧"
+    variant = "帮我把下面这段话翻译成英文：今天天气不错，我们去公园跑步吧"
+    strict = _cache(thresholds={'default': 0.8, 'strict-model': 0.99})
+    strict.add('p', 'strict-model', _messages(text), ANSWER)
+    assert strict.lookup('p', 'strict-model', _messages(variant)) is None
+    assert strict.lookup('p', 'strict-model', _messages(text)) is not None
+
+
+def test_reported_false_hit_is_removed():
+    cache = _cache()
+    entry_id = cache.add('deepseek', 'deepseek-chat', _messages(QUESTION), ANSWER)
+    assert cache.report_false_hit(entry_id)
+    assert cache.lookup('deepseek', 'deepseek-chat', _messages(QUESTION)) is None
+    assert not cache.report_false_hit(entry_id)
+    assert cache.get_stats()['false_hits'] == 1
+
+
+def test_expired_entries_do_not_hit():
+    cache = _cache(ttl=-1)
+    cache.add('deepseek', 'deepseek-chat', _messages(QUESTION), ANSWER)
+    assert cache.lookup('deepseek', 'deepseek-chat', _messages(QUESTION)) is None
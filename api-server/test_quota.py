@@ -0,0 +1,185 @@
+"""用户与租户配额：滑动窗口衰减、Retry-After、token记账与中间件的豁免"""
+
+import asyncio
+
+import pytest
+
+import quota
+from quota import Identity, QuotaExceeded, QuotaManager, QuotaMiddleware
+
+# 某个窗口的起点，便于按窗口内的位置推算衰减
+START = 60 * 30_000_000
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+class Clock:
+    def __init__(self, now: float = START):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(quota.time, 'time', clock)
+    return clock
+
+
+def _user(name: str, tenant: str = 'default') -> Identity:
+    return Identity(name, name, tenant)
+
+
+def test_requests_over_the_user_limit_are_rejected(clock):
+    async def scenario():
+        manager = QuotaManager({'user': {'requests_per_min': 3}}, {})
+        alice = _user('alice')
+        for _ in range(3):
+            await manager.admit(alice)
+        with pytest.raises(QuotaExceeded) as info:
+            await manager.admit(alice)
+        assert (info.value.scope, info.value.metric, info.value.limit) == ('user', 'requests', 3)
+        # 其他用户不受影响
+        await manager.admit(_user('bob'))
+        assert manager.metrics['rejected_requests'] == 1
+    run(scenario())
+
+
+def test_previous_window_decays_instead_of_resetting_at_the_boundary(clock):
+    async def scenario():
+        manager = QuotaManager({'user': {'requests_per_min': 4}}, {})
+        alice = _user('alice')
+        for _ in range(4):
+            await manager.admit(alice)
+        # 下一窗口刚开始时上一窗口的计数几乎没有衰减
+        clock.now = START + 60
+        with pytest.raises(QuotaExceeded) as info:
+            await manager.admit(alice)
+        # 上一窗口4次按每15秒1次衰减，超出1次需要等15秒
+        assert info.value.retry_after == 15
+        clock.now += info.value.retry_after
+        await manager.admit(alice)
+        with pytest.raises(QuotaExceeded):
+            await manager.admit(alice)
+    run(scenario())
+
+
+def test_counts_expire_after_two_idle_windows(clock):
+    async def scenario():
+        manager = QuotaManager({'user': {'requests_per_min': 2}}, {})
+        alice = _user('alice')
+        await manager.admit(alice)
+        await manager.admit(alice)
+        clock.now = START + 120
+        usage = await manager.admit(alice)
+        assert usage['user_usage']['requests'] == {'used': 1, 'limit': 2, 'remaining': 1}
+    run(scenario())
+
+
+def test_recorded_tokens_count_against_the_token_limit(clock):
+    async def scenario():
+        manager = QuotaManager({'user': {'tokens_per_min': 1000}}, {})
+        alice = _user('alice')
+        await manager.admit(alice, estimated_tokens=600)
+        usage = await manager.record(alice, 800)
+        assert usage['user_usage']['tokens']['remaining'] == 200
+        # 带预估值的调用按预估值检查
+        with pytest.raises(QuotaExceeded) as info:
+            await manager.ensure_tokens(alice, estimated_tokens=300)
+        assert info.value.metric == 'tokens'
+        await manager.ensure_tokens(alice, estimated_tokens=200)
+        await manager.record(alice, 200)
+        # 用量达到上限后，没有预估值的请求同样被拒绝
+        with pytest.raises(QuotaExceeded):
+            await manager.admit(alice)
+    run(scenario())
+
+
+def test_tenant_limit_is_shared_by_its_users_and_overrides_apply(clock):
+    async def scenario():
+        limits = {
+            'user': {'requests_per_min': 10},
+            'tenant': {'requests_per_min': 2},
+            'tenant:vip': {'requests_per_min': 0},
+            'user:carol': {'requests_per_min': 1},
+        }
+        manager = QuotaManager(limits, {'alice': 'acme', 'bob': 'acme', 'carol': 'vip'})
+        assert manager.tenant_of('alice') == 'acme' and manager.tenant_of('dave') == 'default'
+        alice, bob = _user('alice', 'acme'), _user('bob', 'acme')
+        await manager.admit(alice)
+        await manager.admit(bob)
+        with pytest.raises(QuotaExceeded) as info:
+            await manager.admit(bob)
+        assert (info.value.scope, info.value.subject) == ('tenant', 'acme')
+        # 租户不限制时按用户覆盖值检查
+        carol = _user('carol', 'vip')
+        await manager.admit(carol)
+        with pytest.raises(QuotaExceeded) as info:
+            await manager.admit(carol)
+        assert info.value.scope == 'user'
+    run(scenario())
+
+
+def test_disabled_manager_admits_everything(clock):
+    async def scenario():
+        manager = QuotaManager({'user': {'requests_per_min': 1}}, {}, enabled=False)
+        for _ in range(5):
+            assert await manager.admit(_user('alice')) == {}
+    run(scenario())
+
+
+def test_shared_counter_is_summed_across_managers(clock):
+    async def scenario():
+        # 两个管理器模拟两个worker进程，共享状态为测试配置的内存后端
+        limits = {'user': {'requests_per_min': 3}}
+        first, second = QuotaManager(limits, {}, shared=True), QuotaManager(limits, {}, shared=True)
+        erin = _user('erin-shared')
+        await first.admit(erin)
+        await second.admit(erin)
+        await first.admit(erin)
+        with pytest.raises(QuotaExceeded):
+            await second.admit(erin)
+    run(scenario())
+
+
+# ---------- QuotaMiddleware ----------
+
+async def _call(middleware, path: str = '/api/chat/stream', headers=()):
+    scope = {
+        'type': 'http', 'method': 'POST', 'path': path, 'query_string': b'', 'client': ('10.0.0.1', 1234),
+        'headers': [(name.encode(), value.encode()) for name, value in headers],
+    }
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        messages.append(message)
+
+    await middleware(scope, receive, send)
+    return messages[0]['status'], dict(messages[0]['headers'])
+
+
+async def _app(scope, receive, send):
+    await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def test_middleware_rejects_with_429_and_skips_exempt_requests(clock):
+    async def scenario():
+        manager = QuotaManager({'user': {'requests_per_min': 1}}, {})
+        middleware = QuotaMiddleware(_app, manager, exempt=lambda headers: 'idempotency-key' in headers)
+        status, headers = await _call(middleware)
+        assert status == 200 and headers[b'x-ratelimit-remaining-requests'] == b'0'
+        status, headers = await _call(middleware)
+        assert status == 429 and int(headers[b'retry-after']) >= 1
+        # 豁免的请求（续传、幂等重放）与非生成端点不计入配额
+        assert (await _call(middleware, headers=[('idempotency-key', 'k')]))[0] == 200
+        assert (await _call(middleware, path='/api/models'))[0] == 200
+        assert manager.metrics['checked'] == 2
+    run(scenario())
@@ -0,0 +1,160 @@
+"""精确匹配响应缓存：缓存键、内存层与磁盘层、过期"""
+
+import asyncio
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import response_cache as response_cache_module
+from providers.base import BaseModelProvider, ProviderConfig, ProviderType
+from providers.openai import OpenAIProvider
+from response_cache import ResponseCache, build_cache_hit_stats
+from utils import lru_cache
+
+MESSAGES = [{'role': 'system', 'content': '你是助手'}, {'role': 'user', 'content': '什么是量子纠缠？'}]
+ENTRY = {
+    'content': '量子纠缠是……',
+    'provider': 'deepseek',
+    'model': 'deepseek-chat',
+    'tokens': {'total_tokens': 120, 'total_cost_cny': 0.002}
+}
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def _cache(tmp_path, **kwargs) -> ResponseCache:
+    return ResponseCache(db_path=str(tmp_path / 'response_cache.db'), **kwargs)
+
+
+def _key(**params) -> str:
+    options = dict(temperature=0.7, max_tokens=2000)
+    options.update(params)
+    return ResponseCache.make_key('deepseek', 'deepseek-chat', MESSAGES, **options)
+
+
+def test_key_depends_on_every_sent_param():
+    base = _key()
+    assert len({base, _key(temperature=0.2), _key(max_tokens=1000), _key(top_p=0.9),
+                _key(base_url='https://other')}) == 5
+    assert ResponseCache.make_key('openrouter', 'deepseek-chat', MESSAGES, temperature=0.7, max_tokens=2000) != base
+    assert ResponseCache.make_key('deepseek', 'deepseek-reasoner', MESSAGES, temperature=0.7, max_tokens=2000) != base
+    changed = MESSAGES[:1] + [{'role': 'user', 'content': '什么是量子隧穿？'}]
+    assert ResponseCache.make_key('deepseek', 'deepseek-chat', changed, temperature=0.7, max_tokens=2000) != base
+
+
+def test_key_ignores_param_order_unset_params_and_extra_message_fields():
+    base = _key()
+    assert ResponseCache.make_key('deepseek', 'deepseek-chat', MESSAGES, max_tokens=2000, temperature=0.7) == base
+    assert _key(top_p=None) == base
+    decorated = [dict(message, timestamp='2026-01-01', id=i) for i, message in enumerate(MESSAGES)]
+    assert ResponseCache.make_key('deepseek', 'deepseek-chat', decorated, temperature=0.7, max_tokens=2000) == base
+
+
+def test_memory_hit_records_savings(tmp_path):
+    async def scenario():
+        cache = _cache(tmp_path)
+        key = _key()
+        assert await cache.get(key) is None
+        await cache.set(key, ENTRY)
+        hit = await cache.get(key)
+        assert hit['content'] == ENTRY['content'] and 'cached_at' in hit
+        assert cache.disk_hits == 0 and cache.saved_tokens == 120
+        stats = build_cache_hit_stats(hit, 0.01)
+        assert stats['cache_hit'] and stats['saved']['tokens'] == 120
+    run(scenario())
+
+
+def test_disk_hit_backfills_memory(tmp_path):
+    async def scenario():
+        key = _key()
+        await _cache(tmp_path).set(key, ENTRY)
+        # 新实例（如重启后的进程）内存层为空，从磁盘层读取并回填
+        cache = _cache(tmp_path)
+        assert key not in cache.memory
+        assert (await cache.get(key))['content'] == ENTRY['content']
+        assert cache.disk_hits == 1 and key in cache.memory
+        await cache.get(key)
+        assert cache.disk_hits == 1
+        assert (await cache.get_stats())['disk']['entries'] == 1
+    run(scenario())
+
+
+def test_expired_entries_miss_in_both_tiers(tmp_path, monkeypatch):
+    async def scenario():
+        clock = SimpleNamespace(now=time.time())
+        fake_time = SimpleNamespace(time=lambda: clock.now)
+        monkeypatch.setattr(lru_cache, 'time', fake_time)
+        monkeypatch.setattr(response_cache_module, 'time', fake_time)
+        cache = _cache(tmp_path, ttl=60)
+        key = _key()
+        await cache.set(key, ENTRY)
+        clock.now += 61
+        assert await cache.get(key) is None
+        # 磁盘层的过期条目在读取时删除
+        assert (await cache.get_stats())['disk']['entries'] == 0
+    run(scenario())
+
+
+@pytest.mark.parametrize('entry', [{'content': ''}, {'tokens': {}}])
+def test_empty_responses_are_not_cached(tmp_path, entry):
+    async def scenario():
+        cache = _cache(tmp_path)
+        await cache.set(_key(), entry)
+        assert await cache.get(_key()) is None
+    run(scenario())
+
+
+def test_disabled_cache_never_hits(tmp_path):
+    async def scenario():
+        cache = _cache(tmp_path, enabled=False)
+        await cache.set(_key(), ENTRY)
+        assert await cache.get(_key()) is None
+    run(scenario())
+
+
+def test_memory_tier_is_bounded_by_entries(tmp_path):
+    async def scenario():
+        cache = _cache(tmp_path, max_entries=2)
+        keys = [_key(temperature=t / 10) for t in range(3)]
+        for key in keys:
+            await cache.set(key, ENTRY)
+        assert keys[0] not in cache.memory and len(cache.memory) == 2
+        # 被内存层淘汰的条目仍可从磁盘层读取
+        assert await cache.get(keys[0]) is not None and cache.disk_hits == 1
+    run(scenario())
+
+
+class _Provider(BaseModelProvider):
+    """默认采样参数与内置提供商不同的提供商"""
+
+    async def chat_completion(self, messages, model, stream=True, temperature=1.0, max_tokens=4096, **kwargs):
+        yield None
+
+    def validate_config(self):
+        return True
+
+    async def get_supported_models(self):
+        return []
+
+    async def test_connection(self):
+        return True
+
+
+def _provider(cls) -> BaseModelProvider:
+    return cls(ProviderConfig(provider_type=ProviderType.OPENAI, api_key='k', base_url='https://api.example.com'))
+
+
+def test_key_uses_each_providers_own_defaults_for_omitted_params():
+    builtin, custom = _provider(OpenAIProvider), _provider(_Provider)
+    assert builtin.completion_params() == {'temperature': 0.7, 'max_tokens': 2000}
+    assert custom.completion_params(max_tokens=None) == {'temperature': 1.0, 'max_tokens': 4096}
+    assert custom.completion_params(temperature=0.2, top_p=0.9) == {'temperature': 0.2, 'max_tokens': 4096, 'top_p': 0.9}
+    # 都省略采样参数的两次请求，上游实际收到的参数不同，缓存键也不同
+    keys = {ResponseCache.make_key('p', 'm', MESSAGES, **provider.completion_params()) for provider in (builtin, custom)}
+    assert len(keys) == 2
+    # 显式写出默认值与省略时命中同一条目
+    assert ResponseCache.make_key('p', 'm', MESSAGES, **builtin.completion_params()) == \
+        ResponseCache.make_key('p', 'm', MESSAGES, **builtin.completion_params(temperature=0.7, max_tokens=2000))
@@ -0,0 +1,199 @@
+"""可续传生成：重放缓冲的断点与缺口、续传、多订阅者扇出与幂等重放"""
+
+import asyncio
+import json
+from collections import deque
+
+from backpressure import POLICY_BLOCK
+from config import config
+from resumable_stream import ReplayBuffer, StreamRegistry, coalesce_content_events, parse_last_event_id
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def _event(i: int) -> str:
+    return f"data: {json.dumps({'type': 'content', 'content': str(i)})}\n\n"
+
+
+async def _source(count: int, delay: float = 0):
+    for i in range(1, count + 1):
+        yield _event(i)
+        if delay:
+            await asyncio.sleep(delay)
+
+
+def _seqs(events):
+    """SSE事件中的序号（跳过没有id的控制事件）"""
+    return [int(event.split('\n', 1)[0].rsplit(':', 1)[1]) for event in events if event.startswith('id: ')]
+
+
+def _payloads(events):
+    return [json.loads(event.split('data: ', 1)[1]) for event in events]
+
+
+async def _collect(iterator):
+    return [event async for event in iterator]
+
+
+# ---------- ReplayBuffer ----------
+
+def test_since_returns_events_after_the_breakpoint():
+    buffer = ReplayBuffer(max_events=100)
+    for i in range(1, 11):
+        assert buffer.append(_event(i)) == i
+    gap, events = buffer.since(7)
+    assert gap is None
+    assert [seq for seq, _ in events] == [8, 9, 10]
+    assert buffer.since(10) == (None, [])
+
+
+def test_since_reports_gap_when_breakpoint_was_evicted():
+    buffer = ReplayBuffer(max_events=5)
+    for i in range(1, 13):
+        buffer.append(_event(i))
+    assert buffer.first_seq == 8 and buffer.dropped == 7
+    gap, events = buffer.since(3)
+    assert gap == (4, 7)
+    assert [seq for seq, _ in events] == [8, 9, 10, 11, 12]
+    # 断点恰好在最后一个被丢弃的事件上时没有缺口
+    assert buffer.since(7)[0] is None
+
+
+def test_byte_limit_evicts_but_keeps_latest_event():
+    buffer = ReplayBuffer(max_events=100, max_bytes=10)
+    buffer.append('x' * 8)
+    buffer.append('y' * 8)
+    assert [payload for _, payload in buffer.events] == ['y' * 8]
+    buffer.append('z' * 50)
+    assert [payload for _, payload in buffer.events] == ['z' * 50]
+
+
+def test_non_contiguous_sequences_are_compared_one_by_one():
+    buffer = ReplayBuffer(max_events=100)
+    for seq in (1, 2, 5, 9):
+        buffer.append(_event(seq), seq)
+    assert [seq for seq, _ in buffer.since(2)[1]] == [5, 9]
+
+
+def test_parse_last_event_id():
+    assert parse_last_event_id('abc:12') == ('abc', 12)
+    assert parse_last_event_id('a:b:3') == ('a:b', 3)
+    for value in (None, '', 'abc', 'abc:', ':3', 'abc:-1'):
+        assert parse_last_event_id(value) is None
+
+
+def test_coalesce_merges_adjacent_content_events_only():
+    items = deque([(1, _event(1))])
+    assert coalesce_content_events(items, (2, _event(2)))
+    assert items[-1][0] == 2 and _payloads([items[-1][1]])[0]['content'] == '12'
+    stats = f"data: {json.dumps({'type': 'stats'})}\n\n"
+    assert not coalesce_content_events(items, (3, stats))
+
+
+# ---------- ResumableStream / StreamRegistry ----------
+
+def test_resume_continues_after_last_event_id():
+    async def scenario():
+        registry = StreamRegistry(grace=30)
+        stream = registry.start(_source(20))
+        await stream.task
+        first = await _collect(stream.events(0))
+        assert _seqs(first) == list(range(1, 21))
+        resumed = await _collect(registry.resume(f"{stream.stream_id}:15").body_iterator)
+        assert _seqs(resumed) == [16, 17, 18, 19, 20]
+        assert registry.resume('unknown:3') is None
+    run(scenario())
+
+
+def test_resume_after_eviction_sends_replay_gap_first():
+    async def scenario():
+        registry = StreamRegistry(grace=30, max_events=5)
+        stream = registry.start(_source(20))
+        await stream.task
+        events = await _collect(stream.events(2))
+        assert _payloads(events[:1]) == [{'type': 'replay_gap', 'from': 3, 'to': 15}]
+        assert _seqs(events) == [16, 17, 18, 19, 20]
+    run(scenario())
+
+
+def test_live_subscriber_gets_every_event_exactly_once():
+    async def scenario():
+        registry = StreamRegistry(grace=30)
+        stream = registry.start(_source(50, delay=0.001))
+        events = await _collect(stream.events(0))
+        assert _seqs(events) == list(range(1, 51))
+        assert stream.done
+    run(scenario())
+
+
+def test_generation_continues_after_client_disconnects():
+    async def scenario():
+        registry = StreamRegistry(grace=30)
+        stream = registry.start(_source(30, delay=0.001))
+        events = stream.events(0)
+        assert _seqs([await events.__anext__()]) == [1]
+        await events.aclose()
+        assert stream.subscribers == 0 and stream.detached_at is not None
+        await stream.task
+        assert stream.buffer.last_seq == 30
+    run(scenario())
+
+
+def test_slow_watcher_is_dropped_without_stalling_other_subscriber(monkeypatch):
+    async def scenario():
+        monkeypatch.setattr(config, 'stream_queue_size', 4)
+        monkeypatch.setattr(config, 'stream_backpressure_policy', POLICY_BLOCK)
+        registry = StreamRegistry(grace=30)
+        stream = registry.start(_source(40, delay=0.002))
+        fast = asyncio.create_task(_collect(stream.events(0)))
+        slow = stream.events(0)
+        seen = _seqs([await slow.__anext__()])
+        # 慢订阅者不再读取，生成与快订阅者照常进行
+        fast_events = await asyncio.wait_for(fast, 2)
+        assert _seqs(fast_events) == list(range(1, 41))
+        assert stream.done
+        rest = await _collect(slow)
+        assert _payloads(rest[-1:]) == [{'type': 'slow_consumer', 'reconnect': True}]
+        # 被断开的订阅者从最后收到的序号续传，补齐全部事件
+        seen += _seqs(rest)
+        resumed = await _collect(stream.events(seen[-1]))
+        assert seen + _seqs(resumed) == list(range(1, 41))
+    run(scenario())
+
+
+def test_idempotency_key_reuses_the_same_generation():
+    async def scenario():
+        registry = StreamRegistry(grace=30)
+        stream = registry.start(_source(5), idempotency_key='key-1', fingerprint='fp')
+        await stream.task
+        assert registry.find('key-1') is stream
+        replayed = await _collect(registry.replay(stream).body_iterator)
+        assert _seqs(replayed) == [1, 2, 3, 4, 5]
+        assert registry.metrics['started'] == 1
+    run(scenario())
+
+
+def test_serves_only_requests_backed_by_a_buffered_generation():
+    async def scenario():
+        registry = StreamRegistry(grace=30)
+        stream = registry.start(_source(3), idempotency_key='key-1')
+        await stream.task
+        assert registry.serves({'last-event-id': f"{stream.stream_id}:2"})
+        assert registry.serves({'idempotency-key': 'key-1'})
+        assert not registry.serves({'last-event-id': 'gone:2'})
+        assert not registry.serves({'idempotency-key': 'other'})
+        assert not registry.serves({})
+    run(scenario())
+
+
+def test_sweep_expires_detached_streams_after_grace():
+    async def scenario():
+        registry = StreamRegistry(grace=0)
+        stream = registry.start(_source(3), idempotency_key='key-1')
+        await stream.task
+        registry.sweep()
+        assert registry.get(stream.stream_id) is None
+        assert registry.find('key-1') is None
+    run(scenario())
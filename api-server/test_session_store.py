@@ -0,0 +1,162 @@
+"""群聊会话持久化：旧数据库迁移、批量写入与分页"""
+
+import asyncio
+import sqlite3
+
+from session_store import SessionStore
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def _legacy_db(path: str):
+    """旧版本创建的 chat_history.db：时间为 CURRENT_TIMESTAMP 文本，user_version 为0"""
+    db = sqlite3.connect(path)
+    db.execute('CREATE TABLE chat_sessions (id TEXT PRIMARY KEY, summary TEXT, '
+               'created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)')
+    db.execute('CREATE TABLE messages (id INTEGER PRIMARY KEY AUTOINCREMENT, session_id TEXT, role TEXT, '
+               'content TEXT, created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)')
+    db.execute("INSERT INTO chat_sessions (id, created_at, updated_at) "
+               "VALUES ('legacy', '2025-05-04 17:35:30', '2025-05-08 14:51:31')")
+    db.execute("INSERT INTO messages (session_id, role, content, created_at) "
+               "VALUES ('legacy', 'user', '旧的消息', '2025-05-04 17:35:30')")
+    db.commit()
+    db.close()
+
+
+def _claim(path: str, owner: str):
+    """把没有 owner 的（迁移前的）会话归给 owner"""
+    db = sqlite3.connect(path)
+    db.execute('UPDATE chat_sessions SET owner = ? WHERE owner IS NULL', (owner,))
+    db.commit()
+    db.close()
+
+
+def test_legacy_database_is_copied_once(tmp_path):
+    async def scenario():
+        legacy = str(tmp_path / 'chat_history.db')
+        target = str(tmp_path / 'cache' / 'chat_history.db')
+        _legacy_db(legacy)
+        store = SessionStore(target, legacy_path=legacy)
+        session = await store.load_session('legacy')
+        assert [message['content'] for message in session['messages']] == ['旧的消息']
+        await store.close()
+        # 旧文件保持不变（未迁移），之后不再复制
+        db = sqlite3.connect(legacy)
+        assert db.execute('PRAGMA user_version').fetchone()[0] == 0
+        db.execute('DELETE FROM messages')
+        db.commit()
+        db.close()
+        store = SessionStore(target, legacy_path=legacy)
+        assert len((await store.load_session('legacy'))['messages']) == 1
+        await store.close()
+    run(scenario())
+
+
+def test_missing_legacy_database_starts_empty(tmp_path):
+    async def scenario():
+        store = SessionStore(str(tmp_path / 'cache' / 'chat_history.db'), legacy_path=str(tmp_path / 'none.db'))
+        assert await store.load_session('legacy') is None
+        assert (await store.list_sessions('alice'))['sessions'] == []
+        await store.close()
+    run(scenario())
+
+
+def test_writes_are_batched_and_read_back_in_order(tmp_path):
+    async def scenario():
+        store = SessionStore(str(tmp_path / 'chat_history.db'), flush_interval_ms=10_000)
+        store.save_session('s1', [{'id': 'deepseek-chat'}], {'deepseek-chat': '你是助手'}, owner='alice')
+        for i in range(5):
+            store.add_message('s1', 'user' if i % 2 == 0 else 'assistant', f'消息{i}', 'deepseek-chat')
+        assert store.metrics['batches'] == 0
+        session = await store.load_session('s1')
+        assert store.metrics['batches'] == 1
+        assert [message['content'] for message in session['messages']] == [f'消息{i}' for i in range(5)]
+        assert session['system_prompts'] == {'deepseek-chat': '你是助手'}
+        page = await store.get_messages('s1', limit=2)
+        assert [message['content'] for message in page['messages']] == ['消息3', '消息4'] and page['has_more']
+        older = await store.get_messages('s1', before_id=page['before_id'], limit=10)
+        assert [message['content'] for message in older['messages']] == ['消息0', '消息1', '消息2']
+        assert (await store.search_messages('消息3', 'alice'))['results'][0]['content'] == '消息3'
+        store.delete_session('s1')
+        assert await store.load_session('s1') is None
+        assert (await store.search_messages('消息3', 'alice'))['results'] == []
+        await store.close()
+    run(scenario())
+
+
+def test_new_sessions_sort_after_legacy_rows(tmp_path):
+    async def scenario():
+        path = str(tmp_path / 'chat_history.db')
+        _legacy_db(path)
+        db = sqlite3.connect(path)
+        db.execute("INSERT INTO chat_sessions (id, created_at, updated_at) "
+                   "VALUES ('older', '2025-05-01 08:00:00', '2025-05-01 08:00:00')")
+        db.commit()
+        db.close()
+        store = SessionStore(path, legacy_path=None)
+        await store.load_session('legacy')
+        _claim(path, 'alice')
+        store.save_session('fresh', [], {}, owner='alice')
+        store.add_message('fresh', 'user', '新的消息')
+        first = await store.list_sessions('alice', limit=2)
+        # 新会话排在最前，旧数据按原有时间排在后面
+        assert [session['session_id'] for session in first['sessions']] == ['fresh', 'legacy']
+        assert all(isinstance(session['updated_at'], str) for session in first['sessions'])
+        assert first['sessions'][0]['updated_at'] > '2025-05-08 14:51:31'
+        cursor = first['next_cursor']
+        second = await store.list_sessions('alice', (cursor['updated_at'], cursor['id']), limit=2)
+        assert [session['session_id'] for session in second['sessions']] == ['older'] and not second['has_more']
+        messages = (await store.get_messages('fresh'))['messages']
+        assert isinstance(messages[0]['created_at'], str)
+        await store.close()
+    run(scenario())
+
+
+def test_migration_converts_epoch_timestamps_to_text(tmp_path):
+    async def scenario():
+        path = str(tmp_path / 'chat_history.db')
+        _legacy_db(path)
+        store = SessionStore(path)
+        await store.load_session('legacy')
+        await store.close()
+        # 模拟旧版本以时间戳写入的行，并回退到转换之前的版本
+        db = sqlite3.connect(path)
+        db.execute("INSERT INTO chat_sessions (id, created_at, updated_at) VALUES ('epoch', 1746700000.25, 1746800000.5)")
+        db.execute("INSERT INTO messages (session_id, role, content, created_at) VALUES ('epoch', 'user', 'x', 1746800000.5)")
+        db.execute('PRAGMA user_version = 3')
+        db.commit()
+        db.close()
+        store = SessionStore(path)
+        session = await store.load_session('epoch')
+        _claim(path, 'alice')
+        assert session['created_at'] == '2025-05-08 10:26:40.250'
+        assert session['updated_at'] == '2025-05-09 14:13:20.500'
+        assert session['messages'][0]['created_at'] == '2025-05-09 14:13:20.500'
+        sessions = (await store.list_sessions('alice'))['sessions']
+        assert [session['session_id'] for session in sessions] == ['epoch', 'legacy']
+        await store.close()
+    run(scenario())
+
+
+def test_queries_are_scoped_to_the_owner(tmp_path):
+    async def scenario():
+        path = str(tmp_path / 'chat_history.db')
+        _legacy_db(path)
+        store = SessionStore(path)
+        store.save_session('a1', [], {}, owner='alice')
+        store.add_message('a1', 'user', '量子纠缠是什么')
+        store.save_session('b1', [], {}, owner='bob')
+        store.add_message('b1', 'user', '量子纠缠的应用')
+        assert [s['session_id'] for s in (await store.list_sessions('alice'))['sessions']] == ['a1']
+        assert [r['session_id'] for r in (await store.search_messages('量子', 'bob'))['results']] == ['b1']
+        assert (await store.search_messages('量子', 'bob', session_id='a1'))['results'] == []
+        assert await store.owns('a1', 'alice') and not await store.owns('a1', 'bob')
+        # 没有 owner 的旧会话不属于任何人；重新初始化时归属初始化的用户，之后不会转给其他用户
+        assert not await store.owns('legacy', 'alice') and not await store.owns('legacy', '')
+        store.save_session('legacy', [], {}, owner='alice')
+        store.save_session('legacy', [], {}, owner='bob')
+        assert await store.owns('legacy', 'alice') and not await store.owns('legacy', 'bob')
+        await store.close()
+    run(scenario())
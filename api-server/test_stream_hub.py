@@ -0,0 +1,100 @@
+"""StreamHub：一次发布扇出给多个观看者，慢观看者被丢弃后可按序号补齐"""
+
+import asyncio
+
+import pytest
+
+from backpressure import CLOSE_OVERFLOW
+from resumable_stream import ReplayBuffer
+from stream_hub import HubFull, StreamHub
+from websocket_handler import coalesce_status_messages
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def _publish(hub: StreamHub, buffer: ReplayBuffer, topic: str, payload: str, key=None) -> int:
+    seq = buffer.append(payload)
+    hub.publish(topic, seq, payload, key)
+    return seq
+
+
+async def _take(subscription, count: int):
+    received = []
+    async for seq, payload in subscription:
+        received.append((seq, payload))
+        if len(received) == count:
+            break
+    return received
+
+
+def test_new_subscriber_gets_backlog_then_live_messages_once():
+    async def scenario():
+        hub, buffer = StreamHub(maxsize=8), ReplayBuffer(max_events=100)
+        for i in range(1, 4):
+            _publish(hub, buffer, 'room', f'm{i}')
+        subscription = hub.subscribe('room', buffer, after_seq=1)
+        for i in range(4, 6):
+            _publish(hub, buffer, 'room', f'm{i}')
+        assert [seq for seq, _ in await _take(subscription, 4)] == [2, 3, 4, 5]
+        subscription.close()
+        assert hub.subscribers('room') == 0
+    run(scenario())
+
+
+def test_slow_subscriber_is_dropped_and_catches_up_from_buffer():
+    async def scenario():
+        hub, buffer = StreamHub(maxsize=4), ReplayBuffer(max_events=100)
+        fast, slow = hub.subscribe('room', buffer), hub.subscribe('room', buffer)
+        received = []
+        for i in range(1, 11):
+            _publish(hub, buffer, 'room', f'm{i}')
+            received += await _take(fast, 1)
+        assert [seq for seq, _ in received] == list(range(1, 11))
+        assert slow.close_reason == CLOSE_OVERFLOW and hub.metrics['dropped_subscribers'] == 1
+        # 被丢弃的订阅者的迭代结束，按最后收到的序号重新订阅即可从缓冲补齐
+        assert [seq async for seq, _ in slow] == []
+        again = hub.subscribe('room', buffer, after_seq=0)
+        assert [seq for seq, _ in await _take(again, 10)] == list(range(1, 11))
+    run(scenario())
+
+
+def test_status_messages_are_coalesced_instead_of_dropping():
+    async def scenario():
+        hub = StreamHub(maxsize=2, coalesce=coalesce_status_messages)
+        subscription = hub.subscribe('job')
+        # 队列满时新的进度替换队列中的旧进度
+        for i in range(9):
+            assert hub.publish('job', None, f'progress {i}', 'progress') == 1
+        assert hub.publish('job', None, 'item', None) == 1
+        assert [payload for _, payload in await _take(subscription, 2)] == ['progress 8', 'item']
+        # 没有合并键的消息放不下时丢弃订阅者
+        hub.publish('job', None, 'item 2', None)
+        hub.publish('job', None, 'item 3', None)
+        assert hub.publish('job', None, 'item 4', None) == 0
+        assert subscription.close_reason == CLOSE_OVERFLOW
+    run(scenario())
+
+
+def test_gap_is_reported_when_backlog_was_evicted():
+    async def scenario():
+        hub, buffer = StreamHub(maxsize=8), ReplayBuffer(max_events=3)
+        for i in range(1, 7):
+            _publish(hub, buffer, 'room', f'm{i}')
+        received = await _take(hub.subscribe('room', buffer, after_seq=1), 4)
+        assert received[0] == (None, '{"type": "replay_gap", "from": 2, "to": 3}')
+        assert [seq for seq, _ in received[1:]] == [4, 5, 6]
+    run(scenario())
+
+
+def test_subscriber_limit_per_topic():
+    hub = StreamHub(max_subscribers=2)
+    hub.subscribe('room')
+    second = hub.subscribe('room')
+    with pytest.raises(HubFull):
+        hub.subscribe('room')
+    hub.subscribe('other')
+    second.close()
+    hub.subscribe('room')
+    assert hub.get_stats()['subscribers'] == 3
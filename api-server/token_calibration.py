@@ -0,0 +1,326 @@
+"""
+Token估算校准
+
+提供商返回真实 usage 时，用 (CJK字符数, 其他字符数) -> token数 的样本
+按模型在线拟合估算系数（有界滑动窗口上的加权最小二乘），
+持久化到本地JSON，并下发给 tokenizer_service 中的估算器。
+流式调用不返回 usage 的提供商，其费用与上下文预算估算因此更接近真实值。
+
+使用方法:
+    from token_calibration import token_calibrator
+
+    token_calibrator.observe_usage(model, messages, response_text, usage)
+"""
+
+import asyncio
+import json
+import logging
+import os
+import threading
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from config import config
+from tokenizer_service import (
+    DEFAULT_ESTIMATOR_COEFFICIENTS,
+    MESSAGE_OVERHEAD_TOKENS,
+    REPLY_PRIMING_TOKENS,
+    text_features,
+    tokenizer_service,
+)
+
+logger = logging.getLogger(__name__)
+
+# 系数的合理范围：(CJK下限, CJK上限), (其他字符下限, 其他字符上限)
+CJK_RATIO_RANGE = (0.1, 3.0)
+OTHER_RATIO_RANGE = (0.05, 1.5)
+
+# 样本与当前估算相差超过该倍数视为异常（如推理模型的隐藏思考token），不参与拟合
+OUTLIER_FACTOR = 3.0
+
+# 两个特征几乎共线（如窗口内全是英文）时改为单特征拟合
+_COLLINEAR_EPS = 1e-6
+
+# 新系数与已下发系数的相对差异不超过该值时不下发（下发会更换分词器名称，使计数缓存失效）
+COEFFICIENT_TOLERANCE = 0.02
+
+Sample = Tuple[int, int, int]
+
+
+def _clamp(value: float, bounds: Tuple[float, float]) -> float:
+    return min(max(value, bounds[0]), bounds[1])
+
+
+def _changed(new: Tuple[float, float], old: Optional[Tuple[float, float]]) -> bool:
+    """系数相对已下发的值是否有实质变化"""
+    if old is None:
+        return True
+    return any(abs(n - o) > COEFFICIENT_TOLERANCE * o for n, o in zip(new, old))
+
+
+def fit_coefficients(samples: List[Sample], prior: Tuple[float, float]) -> Tuple[float, float]:
+    """
+    拟合 tokens ≈ a × cjk + b × other（无截距）
+
+    每个样本按 1/字符数 加权，使长短文本的相对误差同等重要；
+    某一特征在窗口内几乎不出现时，该系数保留先验值，只拟合另一个。
+    """
+    scc = soo = sco = scy = soy = 0.0
+    for cjk, other, tokens in samples:
+        weight = 1.0 / max(1, cjk + other)
+        scc += weight * cjk * cjk
+        soo += weight * other * other
+        sco += weight * cjk * other
+        scy += weight * cjk * tokens
+        soy += weight * other * tokens
+
+    a, b = prior
+    det = scc * soo - sco * sco
+    if scc > 0 and soo > 0 and det > _COLLINEAR_EPS * scc * soo:
+        a = (scy * soo - soy * sco) / det
+        b = (soy * scc - scy * sco) / det
+    elif soo >= scc and soo > 0:
+        b = (soy - a * sco) / soo
+    elif scc > 0:
+        a = (scy - b * sco) / scc
+    return _clamp(a, CJK_RATIO_RANGE), _clamp(b, OTHER_RATIO_RANGE)
+
+
+class _ModelCalibration:
+    """单个模型的样本窗口与当前系数"""
+
+    def __init__(self, model: str, family: str, window: int):
+        self.model = model
+        self.family = family
+        self.samples: Deque[Sample] = deque(maxlen=window)
+        self.coefficients: Optional[Tuple[float, float]] = None
+        self.version = 0
+        self.observed = 0
+        self.rejected = 0
+        # 上次拟合之后新采纳的样本数
+        self.pending = 0
+
+
+class TokenCalibrator:
+    """根据真实usage在线校准各模型的token估算系数"""
+
+    def __init__(self, path: str, window: int = 500, min_samples: int = 20,
+                 save_every: int = 20, refit_every: int = 20, enabled: bool = True):
+        self.path = path
+        self.window = window
+        self.min_samples = min_samples
+        self.save_every = save_every
+        self.refit_every = max(1, refit_every)
+        self.enabled = enabled
+        self._models: Dict[str, _ModelCalibration] = {}
+        # 各模型族已下发的系数与版本
+        self._family_coefficients: Dict[str, Tuple[float, float]] = {}
+        self._family_versions: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._unsaved = 0
+        if enabled:
+            self._load()
+
+    @staticmethod
+    def _prior(family: str) -> Tuple[float, float]:
+        return DEFAULT_ESTIMATOR_COEFFICIENTS.get(family, DEFAULT_ESTIMATOR_COEFFICIENTS['default'])
+
+    def _calibration_for(self, model: str) -> _ModelCalibration:
+        calibration = self._models.get(model)
+        if calibration is None:
+            calibration = _ModelCalibration(model, tokenizer_service.family_for(model), self.window)
+            self._models[model] = calibration
+        return calibration
+
+    def observe(self, model: str, cjk: int, other: int, tokens: int) -> bool:
+        """记录一个样本，返回是否被采纳"""
+        if not self.enabled or not model or tokens <= 0 or cjk + other <= 0:
+            return False
+        with self._lock:
+            calibration = self._calibration_for(model)
+            calibration.observed += 1
+            a, b = calibration.coefficients or self._prior(calibration.family)
+            predicted = max(1.0, a * cjk + b * other)
+            if len(calibration.samples) >= self.min_samples and not (
+                predicted / OUTLIER_FACTOR <= tokens <= predicted * OUTLIER_FACTOR
+            ):
+                calibration.rejected += 1
+                return False
+            calibration.samples.append((cjk, other, tokens))
+            calibration.pending += 1
+            # 达到最少样本数时首次拟合，之后每 refit_every 个样本重新拟合一次
+            if calibration.coefficients is None or calibration.pending >= self.refit_every:
+                self._refit(calibration)
+            self._unsaved += 1
+            should_save = self._unsaved >= self.save_every
+            if should_save:
+                self._unsaved = 0
+        if should_save:
+            self._schedule_save()
+        return True
+
+    def _schedule_save(self):
+        """在事件循环中调用时在线程池里保存，不阻塞请求"""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()
+            return
+        loop.run_in_executor(None, self.save)
+
+    def observe_usage(self, model: str, messages: List[Dict[str, Any]], response_text: str,
+                      usage: Optional[Dict[str, Any]]):
+        """根据一次调用的真实usage记录输入、输出两个样本"""
+        if not usage or not model:
+            return
+        prompt_tokens = usage.get('prompt_tokens') or 0
+        if messages and prompt_tokens:
+            cjk = other = 0
+            for message in messages:
+                message_cjk, message_other = text_features(message.get('content') or '')
+                cjk += message_cjk
+                other += message_other
+            overhead = MESSAGE_OVERHEAD_TOKENS * len(messages) + REPLY_PRIMING_TOKENS
+            self.observe(model, cjk, other, prompt_tokens - overhead)
+
+        completion_tokens = usage.get('completion_tokens') or 0
+        # 推理模型的思考token计入completion但不在返回文本中，需要扣除
+        details = usage.get('completion_tokens_details') or {}
+        completion_tokens -= details.get('reasoning_tokens') or 0
+        if response_text and completion_tokens > 0:
+            cjk, other = text_features(response_text)
+            self.observe(model, cjk, other, completion_tokens)
+
+    def _refit(self, calibration: _ModelCalibration):
+        """
+        样本足够时重新拟合模型系数，并更新所属模型族的系数
+
+        只有系数变化超过 COEFFICIENT_TOLERANCE 时才下发新版本（版本号参与分词器名称，
+        每次下发都会使该模型已缓存的token计数失效）
+        """
+        if len(calibration.samples) < self.min_samples:
+            return
+        calibration.pending = 0
+        prior = self._prior(calibration.family)
+        coefficients = fit_coefficients(list(calibration.samples), prior)
+        if _changed(coefficients, calibration.coefficients):
+            calibration.coefficients = coefficients
+            calibration.version += 1
+            tokenizer_service.set_coefficients(
+                calibration.coefficients, model=calibration.model, version=calibration.version
+            )
+
+        family_samples = [
+            sample
+            for item in self._models.values() if item.family == calibration.family
+            for sample in item.samples
+        ]
+        family_coefficients = fit_coefficients(family_samples, prior)
+        if _changed(family_coefficients, self._family_coefficients.get(calibration.family)):
+            version = self._family_versions.get(calibration.family, 0) + 1
+            self._family_coefficients[calibration.family] = family_coefficients
+            self._family_versions[calibration.family] = version
+            tokenizer_service.set_coefficients(family_coefficients, family=calibration.family, version=version)
+
+    def _load(self):
+        """从JSON文件恢复样本窗口并重新拟合"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            logger.warning(f"加载token校准数据失败: {e}")
+            return
+        with self._lock:
+            for model, item in data.get('models', {}).items():
+                calibration = self._calibration_for(model)
+                calibration.samples.extend(tuple(sample) for sample in item.get('samples', []))
+                calibration.observed = item.get('observed', len(calibration.samples))
+                calibration.rejected = item.get('rejected', 0)
+                self._refit(calibration)
+        logger.info(f"已加载token校准数据: {len(self._models)} 个模型")
+
+    def save(self):
+        """原子写入校准数据（先写临时文件再替换；文件IO会阻塞，在事件循环中经 _schedule_save 放到线程池执行）"""
+        with self._lock:
+            data = {
+                'models': {
+                    model: {
+                        'family': calibration.family,
+                        'coefficients': calibration.coefficients,
+                        'observed': calibration.observed,
+                        'rejected': calibration.rejected,
+                        'samples': list(calibration.samples)
+                    }
+                    for model, calibration in self._models.items()
+                }
+            }
+            self._unsaved = 0
+        try:
+            self._write(data)
+        except Exception as e:
+            logger.warning(f"保存token校准数据失败: {e}")
+
+    def _write(self, data: Dict[str, Any]):
+        with self._save_lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+
+    def get_coefficients(self, model: str) -> Tuple[float, float]:
+        """获取模型当前使用的估算系数（未校准时返回模型族默认值）"""
+        calibration = self._models.get(model)
+        if calibration and calibration.coefficients:
+            return calibration.coefficients
+        return self._prior(tokenizer_service.family_for(model))
+
+    @staticmethod
+    def _mean_error(samples: List[Sample], coefficients: Tuple[float, float]) -> Optional[float]:
+        """窗口内样本的平均相对误差"""
+        if not samples:
+            return None
+        a, b = coefficients
+        return sum(abs(a * cjk + b * other - tokens) / tokens for cjk, other, tokens in samples) / len(samples)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """各模型的校准系数、样本数与校准前后的平均相对误差"""
+        with self._lock:
+            models = {}
+            for model, calibration in self._models.items():
+                samples = list(calibration.samples)
+                prior = self._prior(calibration.family)
+                calibrated_error = (
+                    self._mean_error(samples, calibration.coefficients) if calibration.coefficients else None
+                )
+                models[model] = {
+                    'family': calibration.family,
+                    'coefficients': calibration.coefficients,
+                    'default_coefficients': prior,
+                    'samples': len(samples),
+                    'observed': calibration.observed,
+                    'rejected': calibration.rejected,
+                    'default_error': self._mean_error(samples, prior),
+                    'calibrated_error': calibrated_error
+                }
+        return {
+            'enabled': self.enabled,
+            'window': self.window,
+            'min_samples': self.min_samples,
+            'models': models
+        }
+
+
+# 全局Token校准实例
+token_calibrator = TokenCalibrator(
+    path=config.token_calibration_file,
+    window=config.token_calibration_window,
+    min_samples=config.token_calibration_min_samples,
+    refit_every=config.token_calibration_refit_every,
+    enabled=config.token_calibration_enabled
+)
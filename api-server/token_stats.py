@@ -1,14 +1,19 @@
 import time
 import json
 
+from tokenizer_service import tokenizer_service
+from utils.exchange_rate import get_current_usd_to_cny_rate
+
 class TokenStatsCollector:
     """Token统计收集器"""
     
-    def __init__(self):
+    def __init__(self, model: str = None):
+        self.model = model
         self.start_time = None
         self.first_token_time = None
         self.total_tokens = 0
         self.content_length = 0
+        self._chunks = []
         
     def start_timing(self):
         """开始计时"""
@@ -20,27 +25,28 @@ class TokenStatsCollector:
             self.first_token_time = time.time() - self.start_time
             
         self.content_length += len(content)
-        # 粗略估算token数量（中文约2-3字符/token，英文约4字符/token）
-        estimated_tokens = len(content) // 2 if any('\u4e00' <= c <= '\u9fff' for c in content) else len(content) // 4
-        self.total_tokens += max(1, estimated_tokens)
+        self._chunks.append(content)
         
-    def get_stats(self, messages):
-        """获取统计数据"""
+    def get_stats(self, messages, usage=None):
+        """获取统计数据（提供商在流式最后一块返回了usage时使用真实token数）"""
         total_time = time.time() - self.start_time
+        if usage:
+            self.total_tokens = usage.get('completion_tokens', 0)
+            input_tokens = usage.get('prompt_tokens', 0)
+        else:
+            # 按完整输出统计token（逐块统计会放大分词边界误差）
+            self.total_tokens = tokenizer_service.count_text(''.join(self._chunks), self.model)
+            # 统计输入token数量
+            input_tokens = tokenizer_service.count_messages(messages, self.model)
         tokens_per_second = self.total_tokens / total_time if total_time > 0 else 0
         
-        # 估算输入token数量
-        input_text = ' '.join([msg['content'] for msg in messages])
-        input_tokens = len(input_text) // 2 if any('\u4e00' <= c <= '\u9fff' for c in input_text) else len(input_text) // 4
-        input_tokens = max(10, input_tokens)  # 最少10个token
-        
         total_all_tokens = input_tokens + self.total_tokens
         
         # 费用计算（以DeepSeek为例：输入¥0.0014/1K tokens，输出¥0.0028/1K tokens）
         input_cost = (input_tokens / 1000) * 0.0014
         output_cost = (self.total_tokens / 1000) * 0.0028
         total_cost_usd = input_cost + output_cost
-        total_cost_cny = total_cost_usd * 7.2  # 美元转人民币汇率
+        total_cost_cny = total_cost_usd * get_current_usd_to_cny_rate()  # 美元转人民币汇率
         
         return {
             "type": "stats",
@@ -53,6 +59,8 @@ class TokenStatsCollector:
                 "input_tokens": input_tokens,
                 "output_tokens": self.total_tokens,
                 "total_tokens": total_all_tokens,
+                "cache_read_input_tokens": (usage or {}).get('cache_read_input_tokens', 0),
+                "source": "provider" if usage else "estimate",
                 "total_cost_usd": total_cost_usd,
                 "total_cost_cny": total_cost_cny
             }
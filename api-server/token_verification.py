@@ -9,19 +9,27 @@ import json
 from datetime import datetime
 from typing import Dict, Any, List
 
+from tokenizer_service import tokenizer_service
+from token_calibration import token_calibrator
+
 logger = logging.getLogger(__name__)
 
 class TokenVerificationLogger:
     """Token验证日志记录器"""
     
+    # 最多保留的调用记录数
+    MAX_CALLS = 200
+
     def __init__(self):
         self.api_calls = []
+        # 等待响应的请求消息（用于校准输入token系数）
+        self._pending_messages: Dict[str, List[Dict]] = {}
         
     def log_api_request(self, provider: str, model: str, messages: List[Dict], request_id: str):
         """记录API请求信息"""
         # 估算输入token
         input_text = ' '.join([msg.get('content', '') for msg in messages])
-        estimated_input_tokens = self._estimate_tokens(input_text)
+        estimated_input_tokens = tokenizer_service.count_messages(messages, model)
         
         call_info = {
             'request_id': request_id,
@@ -34,14 +42,20 @@ class TokenVerificationLogger:
         }
         
         self.api_calls.append(call_info)
-        logger.info(f"🔍 API请求记录: {json.dumps(call_info, ensure_ascii=False, indent=2)}")
+        self._pending_messages[request_id] = messages
+        if len(self.api_calls) > self.MAX_CALLS:
+            for old_call in self.api_calls[:-self.MAX_CALLS]:
+                self._pending_messages.pop(old_call['request_id'], None)
+            del self.api_calls[:-self.MAX_CALLS]
+        logger.debug(f"🔍 API请求记录: {json.dumps(call_info, ensure_ascii=False)}")
         
     def log_api_response(self, request_id: str, response_text: str, actual_tokens: Dict = None):
         """记录API响应信息"""
+        messages = self._pending_messages.pop(request_id, None)
         # 找到对应的请求记录
-        for call in self.api_calls:
+        for call in reversed(self.api_calls):
             if call['request_id'] == request_id:
-                estimated_output_tokens = self._estimate_tokens(response_text)
+                estimated_output_tokens = self._estimate_tokens(response_text, call.get('model'))
                 
                 call.update({
                     'response_text_length': len(response_text),
@@ -61,16 +75,15 @@ class TokenVerificationLogger:
                         'input_accuracy': 1 - (input_diff / max(actual_tokens.get('prompt_tokens', 1), 1)),
                         'output_accuracy': 1 - (output_diff / max(actual_tokens.get('completion_tokens', 1), 1))
                     }
+                    # 用真实usage校准估算系数
+                    token_calibrator.observe_usage(call.get('model'), messages, response_text, actual_tokens)
                 
-                logger.info(f"📊 API响应记录: {json.dumps(call, ensure_ascii=False, indent=2)}")
+                logger.debug(f"📊 API响应记录: {json.dumps(call, ensure_ascii=False)}")
                 break
                 
-    def _estimate_tokens(self, text: str) -> int:
-        """估算token数量（与前端逻辑保持一致）"""
-        if not text:
-            return 0
-        # 中文约2-3字符/token，英文约4字符/token
-        return len(text) // 2 if any('\u4e00' <= c <= '\u9fff' for c in text) else len(text) // 4
+    def _estimate_tokens(self, text: str, model: str = None) -> int:
+        """估算token数量（使用统一Token计数服务）"""
+        return tokenizer_service.count_text(text, model)
         
     def get_verification_report(self) -> Dict[str, Any]:
         """生成验证报告"""
@@ -0,0 +1,335 @@
+"""
+统一Token计数服务
+
+按模型族选择分词器，替代各处基于字符数的粗略估算：
+- 本地词表：从 TOKENIZER_VOCAB_DIR/<模型族>/ 加载 tokenizer.json（需要 tokenizers 库）
+  或 *.tiktoken 文件（需要 tiktoken 库），不访问网络
+- 校准估算：没有词表或依赖时，按 CJK 字符数与其他字符数分别乘以系数估算
+- 对较长文本（如重复使用的系统提示词）按内容哈希做LRU缓存
+- 提供批量接口，一次统计多条消息
+
+使用方法:
+    from tokenizer_service import tokenizer_service
+
+    tokens = tokenizer_service.count_text(text, model='deepseek-chat')
+    tokens = tokenizer_service.count_messages(messages, model='glm-4')
+"""
+
+import hashlib
+import logging
+import os
+import re
+import threading
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, Optional, Tuple
+
+from utils.lru_cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# CJK统一表意文字、扩展A、兼容表意文字、日文假名、韩文
+_CJK_RE = re.compile(r'[㐀-䶿一-鿿豈-﫿぀-ヿ가-힯]')
+_SPACE_RE = re.compile(r'\s+')
+
+# tiktoken cl100k 的预分词正则（词表文件旁可放 pattern.txt 覆盖）
+_CL100K_PATTERN = (
+    r"""'(?i:[sdmt]|ll|ve|re)|[^\r\n\p{L}\p{N}]?+\p{L}+|\p{N}{1,3}| ?[^\s\p{L}\p{N}]++[\r\n]*|\s*[\r\n]|\s+(?!\S)|\s+"""
+)
+
+# 模型名关键字 -> 模型族（按顺序匹配）
+MODEL_FAMILY_PATTERNS: List[Tuple[str, str]] = [
+    ('deepseek', 'deepseek'),
+    ('glm', 'glm'),
+    ('chatglm', 'glm'),
+    ('qwen', 'qwen'),
+    ('qwq', 'qwen'),
+    ('moonshot', 'moonshot'),
+    ('kimi', 'moonshot'),
+    ('claude', 'anthropic'),
+    ('gemini', 'gemini'),
+    ('gemma', 'gemini'),
+    ('llama', 'llama'),
+    ('mistral', 'mistral'),
+    ('mixtral', 'mistral'),
+    ('devstral', 'mistral'),
+    ('gpt', 'openai'),
+    ('openai/', 'openai'),
+]
+
+# 各模型族的估算系数：(每个CJK字符的token数, 每个其他非空白字符的token数)
+DEFAULT_ESTIMATOR_COEFFICIENTS: Dict[str, Tuple[float, float]] = {
+    'default': (0.75, 0.28),
+    'openai': (1.0, 0.26),
+    'deepseek': (0.6, 0.28),
+    'glm': (0.55, 0.28),
+    'qwen': (0.65, 0.27),
+    'moonshot': (0.6, 0.28),
+    'anthropic': (1.1, 0.3),
+    'gemini': (0.8, 0.27),
+    'llama': (1.2, 0.27),
+    'mistral': (1.3, 0.3),
+}
+
+# 聊天格式开销：每条消息的角色/分隔符token，以及回复起始token
+MESSAGE_OVERHEAD_TOKENS = 4
+REPLY_PRIMING_TOKENS = 3
+
+# 超过该长度的文本才进入LRU缓存（短文本直接计数比哈希更快）
+CACHE_MIN_CHARS = 128
+
+
+def text_features(text: str) -> Tuple[int, int]:
+    """返回 (CJK字符数, 其他非空白字符数)，供估算与校准使用"""
+    if not text:
+        return 0, 0
+    cjk = len(_CJK_RE.findall(text))
+    non_space = len(_SPACE_RE.sub('', text))
+    return cjk, max(0, non_space - cjk)
+
+
+class BaseTokenizer(ABC):
+    """分词器接口"""
+
+    name: str = 'base'
+    exact: bool = False
+
+    @abstractmethod
+    def count(self, text: str) -> int:
+        """统计单段文本的token数"""
+        pass
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        """批量统计，子类可覆盖为真正的批量实现"""
+        return [self.count(text) for text in texts]
+
+
+class EstimatorTokenizer(BaseTokenizer):
+    """校准估算器：tokens ≈ a × CJK字符数 + b × 其他字符数"""
+
+    def __init__(self, family: str, coefficients: Optional[Tuple[float, float]] = None):
+        self.family = family
+        self.name = f'estimator:{family}'
+        self.coefficients = coefficients or DEFAULT_ESTIMATOR_COEFFICIENTS.get(
+            family, DEFAULT_ESTIMATOR_COEFFICIENTS['default']
+        )
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        cjk, other = text_features(text)
+        cjk_ratio, other_ratio = self.coefficients
+        return max(1, round(cjk * cjk_ratio + other * other_ratio))
+
+
+class HFTokenizer(BaseTokenizer):
+    """HuggingFace tokenizer.json 分词器"""
+
+    exact = True
+
+    def __init__(self, family: str, path: str):
+        from tokenizers import Tokenizer
+        self.name = f'hf:{family}'
+        self._tokenizer = Tokenizer.from_file(path)
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        return len(self._tokenizer.encode(text, add_special_tokens=False).ids)
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        encodings = self._tokenizer.encode_batch(list(texts), add_special_tokens=False)
+        return [len(encoding.ids) for encoding in encodings]
+
+
+class TiktokenTokenizer(BaseTokenizer):
+    """tiktoken BPE词表分词器（从本地 .tiktoken 文件加载）"""
+
+    exact = True
+
+    def __init__(self, family: str, path: str, pattern: Optional[str] = None):
+        import tiktoken
+        from tiktoken.load import load_tiktoken_bpe
+        self.name = f'tiktoken:{family}'
+        self._encoding = tiktoken.Encoding(
+            name=f'local-{family}',
+            pat_str=pattern or _CL100K_PATTERN,
+            mergeable_ranks=load_tiktoken_bpe(path),
+            special_tokens={}
+        )
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        return len(self._encoding.encode_ordinary(text))
+
+    def count_batch(self, texts: List[str]) -> List[int]:
+        return [len(tokens) for tokens in self._encoding.encode_ordinary_batch(list(texts))]
+
+
+class TokenizerService:
+    """Token计数服务"""
+
+    def __init__(self, vocab_dir: str = 'vocab', cache_entries: int = 4096):
+        self.vocab_dir = vocab_dir
+        self._tokenizers: Dict[str, BaseTokenizer] = {}
+        # 按模型校准的估算器（仅在该模型族没有本地词表时生效）
+        self._model_estimators: Dict[str, EstimatorTokenizer] = {}
+        self._lock = threading.Lock()
+        self._cache = LRUCache(max_entries=cache_entries)
+
+    @staticmethod
+    def family_for(model: Optional[str]) -> str:
+        """根据模型名推断模型族，如 'openrouter:deepseek/deepseek-r1' -> 'deepseek'"""
+        if not model:
+            return 'default'
+        name = model.lower()
+        for keyword, family in MODEL_FAMILY_PATTERNS:
+            if keyword in name:
+                return family
+        return 'default'
+
+    def register(self, family: str, tokenizer: BaseTokenizer):
+        """注册（或替换）某个模型族的分词器"""
+        with self._lock:
+            self._tokenizers[family] = tokenizer
+        self._cache.clear()
+
+    def set_coefficients(self, coefficients: Tuple[float, float], model: Optional[str] = None,
+                         family: Optional[str] = None, version: int = 0):
+        """
+        更新估算系数（由token_calibration根据真实usage调用）
+
+        指定model时只影响该模型，否则更新整个模型族的默认估算器；
+        已加载本地词表的模型族不受影响。version参与分词器名称，旧的计数缓存自然失效。
+        """
+        family = family or self.family_for(model)
+        suffix = f'@v{version}' if version else ''
+        with self._lock:
+            if model:
+                estimator = EstimatorTokenizer(family, coefficients)
+                estimator.name = f'estimator:{model}{suffix}'
+                self._model_estimators[model] = estimator
+            else:
+                current = self._tokenizers.get(family) or self._load(family)
+                self._tokenizers[family] = current
+                if current.exact:
+                    return
+                estimator = EstimatorTokenizer(family, coefficients)
+                estimator.name = f'estimator:{family}{suffix}'
+                self._tokenizers[family] = estimator
+
+    def get_tokenizer(self, model: Optional[str] = None) -> BaseTokenizer:
+        """获取模型对应的分词器，首次使用时从本地词表加载"""
+        family = self.family_for(model)
+        tokenizer = self._tokenizers.get(family)
+        if tokenizer is None:
+            with self._lock:
+                tokenizer = self._tokenizers.get(family)
+                if tokenizer is None:
+                    tokenizer = self._load(family)
+                    self._tokenizers[family] = tokenizer
+        if not tokenizer.exact and model in self._model_estimators:
+            return self._model_estimators[model]
+        return tokenizer
+
+    def _load(self, family: str) -> BaseTokenizer:
+        """按优先级加载：tokenizer.json > *.tiktoken > 校准估算"""
+        family_dir = os.path.join(self.vocab_dir, family)
+        if os.path.isdir(family_dir):
+            hf_path = os.path.join(family_dir, 'tokenizer.json')
+            try:
+                if os.path.exists(hf_path):
+                    tokenizer = HFTokenizer(family, hf_path)
+                    logger.info(f"已加载本地分词器: {tokenizer.name} ({hf_path})")
+                    return tokenizer
+                for filename in sorted(os.listdir(family_dir)):
+                    if filename.endswith('.tiktoken'):
+                        pattern_path = os.path.join(family_dir, 'pattern.txt')
+                        pattern = None
+                        if os.path.exists(pattern_path):
+                            with open(pattern_path, 'r', encoding='utf-8') as f:
+                                pattern = f.read().strip()
+                        tokenizer = TiktokenTokenizer(family, os.path.join(family_dir, filename), pattern)
+                        logger.info(f"已加载本地分词器: {tokenizer.name} ({filename})")
+                        return tokenizer
+            except ImportError as e:
+                logger.warning(f"分词器依赖未安装，{family} 使用校准估算: {e}")
+            except Exception as e:
+                logger.warning(f"加载 {family} 词表失败，使用校准估算: {e}")
+        return EstimatorTokenizer(family)
+
+    def count_text(self, text: str, model: Optional[str] = None) -> int:
+        """统计单段文本的token数"""
+        if not text:
+            return 0
+        tokenizer = self.get_tokenizer(model)
+        if len(text) < CACHE_MIN_CHARS:
+            return tokenizer.count(text)
+        key = (tokenizer.name, hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest())
+        count = self._cache.get(key)
+        if count is None:
+            count = tokenizer.count(text)
+            self._cache.set(key, count)
+        return count
+
+    def count_batch(self, texts: List[str], model: Optional[str] = None) -> List[int]:
+        """批量统计多段文本，缓存命中的直接返回，其余一次性交给分词器"""
+        tokenizer = self.get_tokenizer(model)
+        results: List[Optional[int]] = [None] * len(texts)
+        pending_index: List[int] = []
+        pending_keys = []
+        for i, text in enumerate(texts):
+            if not text:
+                results[i] = 0
+                continue
+            key = None
+            if len(text) >= CACHE_MIN_CHARS:
+                key = (tokenizer.name, hashlib.blake2b(text.encode('utf-8'), digest_size=16).digest())
+                cached = self._cache.get(key)
+                if cached is not None:
+                    results[i] = cached
+                    continue
+            pending_index.append(i)
+            pending_keys.append(key)
+        if pending_index:
+            counts = tokenizer.count_batch([texts[i] for i in pending_index])
+            for i, key, count in zip(pending_index, pending_keys, counts):
+                results[i] = count
+                if key is not None:
+                    self._cache.set(key, count)
+        return results
+
+    def count_each_message(self, messages: List[Dict[str, str]], model: Optional[str] = None) -> List[int]:
+        """逐条统计消息的token数（含每条消息的格式开销）"""
+        counts = self.count_batch([msg.get('content') or '' for msg in messages], model)
+        return [count + MESSAGE_OVERHEAD_TOKENS for count in counts]
+
+    def count_messages(self, messages: List[Dict[str, str]], model: Optional[str] = None) -> int:
+        """统计整个对话请求的输入token数"""
+        if not messages:
+            return 0
+        return sum(self.count_each_message(messages, model)) + REPLY_PRIMING_TOKENS
+
+    def truncate_text(self, text: str, max_tokens: int, model: Optional[str] = None) -> str:
+        """截取文本开头不超过 max_tokens 个token的部分（结果只取决于文本与模型，可重复得到相同前缀）"""
+        if not text or self.count_text(text, model) <= max_tokens:
+            return text
+        low, high = 0, len(text)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.count_text(text[:mid], model) <= max_tokens:
+                low = mid
+            else:
+                high = mid - 1
+        return text[:low]
+
+    def get_info(self) -> Dict[str, Any]:
+        """各模型族及已校准模型当前使用的分词器"""
+        return {
+            'families': {family: tokenizer.name for family, tokenizer in self._tokenizers.items()},
+            'models': {model: tokenizer.name for model, tokenizer in self._model_estimators.items()}
+        }
+
+
+# 全局Token计数服务实例
+tokenizer_service = TokenizerService(vocab_dir=os.getenv('TOKENIZER_VOCAB_DIR', 'vocab'))
@@ -17,6 +17,8 @@ class ExchangeRateService:
     _usd_to_cny_rate: float = 7.2  # 默认汇率
     _last_update_time: float = 0
     _update_interval: float = 3600  # 1小时更新一次
+    # 共享状态中的汇率键
+    SHARED_STATE_KEY = 'exchange_rate:usd_cny'
     
     def __new__(cls):
         if cls._instance is None:
@@ -138,10 +140,43 @@ class ExchangeRateService:
         # 检查是否需要更新
         current_time = time.time()
         if current_time - self._last_update_time > self._update_interval:
-            await self._fetch_latest_rate()
+            # 多worker时先看其他进程是否已经获取过，避免每个进程都请求汇率API
+            if not await self._load_shared_rate():
+                await self._fetch_latest_rate()
+                await self._save_shared_rate()
         
         return self._usd_to_cny_rate
     
+    async def _load_shared_rate(self) -> bool:
+        """从共享状态读取未过期的汇率"""
+        from shared_state import shared_state
+        if not shared_state.shared:
+            return False
+        try:
+            data = await shared_state.get(self.SHARED_STATE_KEY)
+        except Exception as e:
+            logger.warning(f"读取共享汇率失败: {e}")
+            return False
+        if data and time.time() - data.get('timestamp', 0) < self._update_interval:
+            self._usd_to_cny_rate = data['rate']
+            self._last_update_time = data['timestamp']
+            return True
+        return False
+    
+    async def _save_shared_rate(self):
+        """把获取到的汇率写入共享状态"""
+        from shared_state import shared_state
+        if not shared_state.shared or not self._last_update_time:
+            return
+        try:
+            await shared_state.set(
+                self.SHARED_STATE_KEY,
+                {'rate': self._usd_to_cny_rate, 'timestamp': self._last_update_time},
+                ttl=self._update_interval
+            )
+        except Exception as e:
+            logger.warning(f"写入共享汇率失败: {e}")
+    
     def get_current_rate(self) -> float:
         """获取当前汇率（同步方法）"""
         return self._usd_to_cny_rate
@@ -149,6 +184,7 @@ class ExchangeRateService:
     async def force_update(self) -> float:
         """强制更新汇率"""
         await self._fetch_latest_rate()
+        await self._save_shared_rate()
         return self._usd_to_cny_rate
 
 # 全局实例
@@ -0,0 +1,123 @@
+"""
+带TTL与容量限制的LRU缓存
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+
+class LRUCache:
+    """线程安全的LRU缓存，同时限制条目数、总字节数与存活时间
+
+    Args:
+        max_entries: 最大条目数
+        max_bytes: 最大总字节数（按 sizeof 估算），0 表示不限制
+        ttl: 条目存活秒数，0 表示永不过期
+        sizeof: 计算单个值字节数的函数
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 1024,
+        max_bytes: int = 0,
+        ttl: float = 0,
+        sizeof: Optional[Callable[[Any], int]] = None
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._sizeof = sizeof or (lambda value: 1)
+        # key -> (value, size, expires_at)
+        self._data: "OrderedDict[Hashable, Tuple[Any, int, float]]" = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """读取缓存，命中时移动到队尾"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            value, size, expires_at = item
+            if expires_at and expires_at < time.time():
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> bool:
+        """写入缓存，单个值超过字节上限时拒绝写入"""
+        size = self._sizeof(value)
+        if self.max_bytes and size > self.max_bytes:
+            return False
+        ttl = self.ttl if ttl is None else ttl
+        expires_at = time.time() + ttl if ttl else 0
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (value, size, expires_at)
+            self._bytes += size
+            self._evict()
+        return True
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        """删除并返回条目"""
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            self._remove(key)
+            return item[0]
+
+    def clear(self):
+        """清空缓存"""
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def __contains__(self, key: Hashable) -> bool:
+        with self._lock:
+            item = self._data.get(key)
+            return item is not None and not (item[2] and item[2] < time.time())
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def total_bytes(self) -> int:
+        return self._bytes
+
+    def stats(self) -> Dict[str, Any]:
+        """缓存统计"""
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self._data),
+            'bytes': self._bytes,
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0
+        }
+
+    def _remove(self, key: Hashable):
+        _, size, _ = self._data.pop(key)
+        self._bytes -= size
+
+    def _evict(self):
+        """按LRU顺序淘汰，直到满足条目数和字节数限制"""
+        while self._data and (
+            len(self._data) > self.max_entries
+            or (self.max_bytes and self._bytes > self.max_bytes)
+        ):
+            key = next(iter(self._data))
+            self._remove(key)
+            self.evictions += 1
@@ -10,13 +10,17 @@ import logging
 import json
 from datetime import datetime
 
+from shared_state import shared_state
+
 logger = logging.getLogger(__name__)
 
 # 创建验证路由
 verify_router = APIRouter(prefix="/api/verify", tags=["verification"])
 
-# 存储API调用记录
-api_call_logs = []
+# API调用记录保存在共享状态中（多worker时各进程的记录汇总在一起）
+API_CALL_LOGS_KEY = 'verify:api_calls'
+# 只保留最近的记录数
+MAX_API_CALL_LOGS = 50
 
 def log_api_call(provider: str, model: str, input_text: str, output_text: str, 
                 estimated_input_tokens: int, estimated_output_tokens: int,
@@ -35,11 +39,7 @@ def log_api_call(provider: str, model: str, input_text: str, output_text: str,
         "output_text_preview": output_text[:100] + "..." if len(output_text) > 100 else output_text
     }
     
-    api_call_logs.append(call_log)
-    
-    # 只保留最近50条记录
-    if len(api_call_logs) > 50:
-        api_call_logs.pop(0)
+    shared_state.spawn(shared_state.push(API_CALL_LOGS_KEY, call_log, MAX_API_CALL_LOGS))
     
     logger.info(f"🔍 Token验证记录: {json.dumps(call_log, ensure_ascii=False)}")
 
@@ -47,8 +47,8 @@ def log_api_call(provider: str, model: str, input_text: str, output_text: str,
 async def get_token_logs():
     """获取token验证日志"""
     return JSONResponse({
-        "total_calls": len(api_call_logs),
-        "recent_calls": api_call_logs[-10:],  # 最近10条
+        "total_calls": await shared_state.length(API_CALL_LOGS_KEY),
+        "recent_calls": await shared_state.range(API_CALL_LOGS_KEY, 10),  # 最近10条
         "verification_guide": {
             "如何验证token正确性": [
                 "1. 查看后端日志中的'Token验证记录'",
@@ -57,9 +57,9 @@ async def get_token_logs():
                 "4. 验证费用计算是否基于正确的模型价格"
             ],
             "token估算逻辑": {
-                "中文": "约2字符/token",
-                "英文": "约4字符/token",
-                "说明": "这是粗略估算，实际token数量可能有差异"
+                "本地词表": "按模型族从本地词表加载分词器（tokenizer.json / .tiktoken）",
+                "校准估算": "缺少词表时按CJK字符数与其他字符数分别乘以系数，系数根据提供商返回的真实usage按模型在线校准",
+                "说明": "估算值与实际API返回可能仍有差异"
             },
             "费用计算": {
                 "DeepSeek": {
@@ -71,13 +71,24 @@ async def get_token_logs():
         }
     })
 
+@verify_router.get("/calibration")
+async def get_calibration():
+    """获取根据真实usage校准的token估算系数"""
+    from token_calibration import token_calibrator
+    from tokenizer_service import tokenizer_service
+    return JSONResponse({
+        "calibration": token_calibrator.get_stats(),
+        "tokenizers": tokenizer_service.get_info()
+    })
+
 @verify_router.get("/latest-call")
 async def get_latest_call():
     """获取最新的API调用记录"""
-    if not api_call_logs:
+    recent = await shared_state.range(API_CALL_LOGS_KEY, 1)
+    if not recent:
         return JSONResponse({"message": "暂无API调用记录"})
     
-    latest = api_call_logs[-1]
+    latest = recent[-1]
     return JSONResponse({
         "latest_call": latest,
         "verification_details": {
@@ -86,13 +97,12 @@ async def get_latest_call():
             "估算输入tokens": latest["estimated_input_tokens"],
             "估算输出tokens": latest["estimated_output_tokens"],
             "实际响应时间": f"{latest['actual_response_time']:.3f}秒",
-            "token估算准确性": "基于字符长度的粗略估算，与实际API返回可能有10-20%差异"
+            "token估算准确性": "基于本地分词器或校准估算，与实际API返回可能仍有差异"
         }
     })
 
 @verify_router.post("/clear-logs")
 async def clear_logs():
     """清空验证日志"""
-    global api_call_logs
-    api_call_logs.clear()
+    await shared_state.delete(API_CALL_LOGS_KEY)
     return JSONResponse({"message": "验证日志已清空"})
\ No newline at end of file
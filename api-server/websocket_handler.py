@@ -4,14 +4,32 @@
 import asyncio
 import json
 import logging
+import time
 import uuid
-from typing import Dict, List, Set, Optional, Any
-from datetime import datetime
-from dataclasses import dataclass, asdict
+from bisect import bisect_left
+from collections import OrderedDict
+from typing import Callable, Dict, List, Set, Optional, Any, Tuple
+from datetime import datetime, timezone
+from dataclasses import dataclass, asdict, field
 from fastapi import WebSocket, WebSocketDisconnect
 
 # 导入提供商管理器
 from providers import ProviderManager, ProviderError
+from tokenizer_service import tokenizer_service, MESSAGE_OVERHEAD_TOKENS, REPLY_PRIMING_TOKENS
+from context_compaction import ContextCompactor, create_context_compactor
+from config import config
+from session_store import SessionStore, session_store
+from shared_state import SharedStateBackend, shared_state
+from lifecycle import WS_CLOSE_SERVICE_RESTART, drain_controller
+from admission import admission_controller
+from quota import QuotaExceeded, admit_current, check_tokens, identify, record_usage
+from heartbeat import heartbeat_monitor
+from ws_codec import accept_websocket, json_codec
+from stream_hub import StreamHub, Subscription, HubFull
+from resumable_stream import ReplayBuffer
+from backpressure import (
+    ConnectionWriter, CLOSE_DISCONNECTED, CLOSE_DRAINING, CLOSE_OVERFLOW, CLOSE_TIMEOUT, WS_CLOSE_TRY_AGAIN_LATER
+)
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +41,13 @@ class ChatMessage:
     timestamp: datetime
     model_id: Optional[str] = None
     model_name: Optional[str] = None
+    # 发给模型的消息字典，创建后由各模型的上下文视图共享，不应修改
+    record: Dict[str, str] = field(init=False, repr=False, compare=False)
+    # 按模型缓存的token数（含消息格式开销），消息加入上下文后只统计一次
+    token_counts: Dict[str, int] = field(default_factory=dict, init=False, repr=False, compare=False)
+    
+    def __post_init__(self):
+        self.record = {'role': self.role, 'content': self.content}
 
 @dataclass
 class GroupChatSession:
@@ -32,50 +57,426 @@ class GroupChatSession:
     system_prompts: Dict[str, Any]
     created_at: datetime
     messages: List[ChatMessage] = None
+    # 最近使用时间（time.time()），用于按空闲时间淘汰内存中的会话
+    last_active: float = field(default_factory=time.time)
     
     def __post_init__(self):
         if self.messages is None:
             self.messages = []
 
+def _coalesce_key(message: dict) -> Optional[tuple]:
+    """状态类消息的合并键：同一键只需保留最新一条"""
+    message_type = message.get('type')
+    if message_type == 'context_update':
+        return (message_type,)
+    if message_type == 'model_status':
+        return (message_type, message.get('modelId'))
+    return None
+
+def coalesce_status_messages(items, item) -> bool:
+    """发送队列已满时，用新的状态消息替换队列中同一键的所有旧消息"""
+    key = item[0]
+    if key is None:
+        return False
+    kept = [queued for queued in items if queued[0] != key]
+    if len(kept) == len(items):
+        return False
+    items.clear()
+    items.extend(kept)
+    items.append(item)
+    return True
+
 class ConnectionManager:
-    """WebSocket连接管理器"""
+    """
+    WebSocket连接管理器
+
+    多worker运行时，会话的WebSocket可能连接在其他进程上（例如客户端在一轮回答
+    进行中重连到了另一个worker），此时消息通过共享状态的发布/订阅转发给持有连接的进程。
+
+    发给会话的每条消息带有递增的 seq 并写入该会话的重放缓冲；客户端重连后发送
+    {"type": "resume", "data": {"last_seq": N}} 即可收到断开期间错过的消息。
+
+    每个连接有独立的发送任务与有界队列，队列满时按 WS_BACKPRESSURE_POLICY 处理
+    （block：等待；coalesce：合并状态消息，无法合并时等待；drop：以1013断开该客户端）。
+    队列中的消息为 (合并键, JSON文本, 消息)，发送时按连接协商的编码（见 ws_codec.py）编码。
+    """
     
-    def __init__(self):
+    # 跨进程转发消息的频道
+    CHANNEL = 'group_chat'
+    
+    def __init__(self, state: Optional[SharedStateBackend] = None):
+        self.state = state
+        self._subscribed = False
         self.active_connections: Dict[str, WebSocket] = {}
-        self.group_sessions: Dict[str, GroupChatSession] = {}
+        # 按最近使用排序；断开连接后会话仍保留在内存中，超出上限时由处理器淘汰
+        self.group_sessions: "OrderedDict[str, GroupChatSession]" = OrderedDict()
+        # 各会话最近发送的消息（断线重连后重放）
+        self.replay_buffers: Dict[str, ReplayBuffer] = {}
+        self._last_seq: Dict[str, int] = {}
+        # 各连接的发送任务：发送方只入队，慢客户端不会阻塞同一会话其他模型的回答
+        self.writers: Dict[str, ConnectionWriter] = {}
+        # 只读观看者：会话的每条消息只生成一次，扇出给所有观看者（每个观看者独立的有界队列）
+        self.hub = StreamHub(config.stream_hub_queue_size, config.stream_hub_max_subscribers, coalesce_status_messages)
     
-    async def connect(self, websocket: WebSocket, session_id: str):
-        """建立WebSocket连接"""
-        await websocket.accept()
+    async def connect(self, websocket: WebSocket, session_id: str, multiplexed: bool = False):
+        """
+        建立WebSocket连接（同一会话的旧连接不再接收消息）
+
+        Args:
+            multiplexed: websocket 是多路复用连接上的一个流，心跳、发送超时与编码由所在的连接负责
+
+        Returns:
+            协商的消息编码（见 ws_codec.py）
+        """
+        codec = json_codec if multiplexed else await accept_websocket(websocket)
+        if multiplexed:
+            await websocket.accept()
+        old_writer = self.writers.pop(session_id, None)
+        if old_writer:
+            old_writer.close()
         self.active_connections[session_id] = websocket
-        logger.info(f"WebSocket连接建立: {session_id}")
+        writer = ConnectionWriter(
+            f"ws:{session_id}", lambda item: codec.send_frame(websocket, codec.encode(item[2], item[1])),
+            config.ws_queue_size, config.ws_backpressure_policy, coalesce_status_messages,
+            on_close=lambda reason: self._writer_closed(session_id, websocket, reason),
+            send_timeout=None if multiplexed else config.ws_send_timeout
+        )
+        self.writers[session_id] = writer
+        writer.start()
+        if not multiplexed:
+            heartbeat_monitor.register(
+                websocket, 'group_chat',
+                lambda text: writer.send_nowait((None, text, None)),
+                lambda: self._reaped(session_id, websocket)
+            )
+            drain_controller.on_drain(
+                lambda hint: writer.send_nowait((None, None, hint)),
+                lambda: writer.channel.close(CLOSE_DRAINING)
+            )
+        if self.state and self.state.shared and not self._subscribed:
+            self._subscribed = True
+            await self.state.subscribe(self.CHANNEL, self._deliver_forwarded)
+        logger.info(f"WebSocket连接建立: {session_id} ({codec.name})")
+        return codec
     
-    def disconnect(self, session_id: str):
-        """断开WebSocket连接"""
+    def disconnect(self, session_id: str, websocket: Optional[WebSocket] = None):
+        """断开WebSocket连接（传入 websocket 时，会话已换成新连接则不处理）"""
+        if websocket is not None:
+            heartbeat_monitor.unregister(websocket)
+            if self.active_connections.get(session_id) is not websocket:
+                return
         if session_id in self.active_connections:
-            del self.active_connections[session_id]
-        if session_id in self.group_sessions:
-            del self.group_sessions[session_id]
+            heartbeat_monitor.unregister(self.active_connections.pop(session_id))
+        writer = self.writers.pop(session_id, None)
+        if writer:
+            writer.close()
         logger.info(f"WebSocket连接断开: {session_id}")
     
+    async def _reaped(self, session_id: str, websocket: WebSocket):
+        """心跳判定连接失效并关闭后，从连接表移除"""
+        self.disconnect(session_id, websocket)
+    
+    async def _writer_closed(self, session_id: str, websocket: WebSocket, reason: str):
+        """发送任务结束：客户端过慢或发送超时时以1013关闭连接（客户端重连后发送resume续传），排空时以1012关闭"""
+        if reason in (CLOSE_OVERFLOW, CLOSE_TIMEOUT, CLOSE_DRAINING):
+            code = WS_CLOSE_SERVICE_RESTART if reason == CLOSE_DRAINING else WS_CLOSE_TRY_AGAIN_LATER
+            try:
+                await asyncio.wait_for(websocket.close(code=code), 1)
+            except Exception:
+                pass
+        if reason != CLOSE_DISCONNECTED or self.active_connections.get(session_id) is websocket:
+            self.disconnect(session_id, websocket)
+    
+    def replay_buffer(self, session_id: str) -> ReplayBuffer:
+        buffer = self.replay_buffers.get(session_id)
+        if buffer is None:
+            buffer = ReplayBuffer(config.ws_replay_max_messages, config.stream_replay_max_bytes)
+            self.replay_buffers[session_id] = buffer
+        return buffer
+    
+    def watch(self, session_id: str, last_seq: int = 0, name: Optional[str] = None) -> Subscription:
+        """
+        以只读观看者订阅会话：先补齐重放缓冲中序号大于 last_seq 的消息，再接收实时消息
+
+        观看者只能收到本进程生成的消息，多worker部署时需按会话粘性路由（与续传相同）
+
+        Raises:
+            HubFull: 会话的观看者已达上限
+        """
+        return self.hub.subscribe(session_id, self.replay_buffers.get(session_id), last_seq, name)
+    
+    def clear_replay(self, session_id: str):
+        self.replay_buffers.pop(session_id, None)
+        self._last_seq.pop(session_id, None)
+    
+    async def _next_seq(self, session_id: str) -> int:
+        """
+        会话内递增的消息序号
+
+        多worker时由共享状态计数；单进程时以毫秒时间戳为下限，进程重启后序号仍大于重启前的序号
+        """
+        if self.state and self.state.shared:
+            return await self.state.incr(f'group_chat:seq:{session_id}', ttl=86400)
+        seq = max(self._last_seq.get(session_id, 0) + 1, int(time.time() * 1000))
+        self._last_seq[session_id] = seq
+        return seq
+    
     async def send_message(self, session_id: str, message: dict):
-        """发送消息到指定会话"""
+        """发送消息到指定会话（带序号并写入重放缓冲；连接不在本进程时转发给其他worker）"""
+        message = dict(message, seq=await self._next_seq(session_id))
+        text = json.dumps(message, ensure_ascii=False)
+        self.replay_buffer(session_id).append(text, message['seq'])
+        self.hub.publish(session_id, message['seq'], text, _coalesce_key(message))
+        await self._deliver(session_id, text, message)
+    
+    async def _deliver(self, session_id: str, text: str, message: dict):
+        """放入本进程连接的发送队列（不等待发送完成），连接不在本进程时转发"""
+        writer = self.writers.get(session_id)
+        if writer:
+            await writer.send((_coalesce_key(message), text, message))
+        elif self.state and self.state.shared:
+            await self.state.publish(self.CHANNEL, {'session_id': session_id, 'message': message})
+    
+    async def send_control(self, session_id: str, message: dict):
+        """发送不带序号、不写入重放缓冲的控制消息（仅本进程的连接）"""
+        writer = self.writers.get(session_id)
+        if writer:
+            await writer.send((None, None, message))
+    
+    async def replay(self, session_id: str, last_seq: int) -> int:
+        """
+        向会话重放序号大于 last_seq 的消息
+
+        多worker时同时请求其他worker重放它们发送过的消息（经转发送达）
+
+        Returns:
+            本进程重放的消息数
+        """
+        writer = self.writers.get(session_id)
+        if writer is None:
+            return 0
+        gap, events = self.replay_buffer(session_id).since(last_seq)
+        if gap:
+            await self.send_control(session_id, {'type': 'replay_gap', 'from': gap[0], 'to': gap[1]})
+        for _, text in events:
+            await writer.send((None, text, None))
+        if self.state and self.state.shared:
+            await self.state.publish(self.CHANNEL, {'session_id': session_id, 'resume_after': last_seq})
+        return len(events)
+    
+    async def _deliver_forwarded(self, payload: dict):
+        """收到其他worker转发的消息，只投递给本进程持有的连接"""
+        session_id = payload.get('session_id')
+        if 'resume_after' in payload:
+            # 连接在其他worker上：把本进程发送过的消息转发过去
+            buffer = self.replay_buffers.get(session_id)
+            if buffer and session_id not in self.active_connections:
+                for _, text in buffer.since(payload['resume_after'])[1]:
+                    await self.state.publish(self.CHANNEL, {'session_id': session_id, 'message': json.loads(text)})
+            return
         if session_id in self.active_connections:
-            websocket = self.active_connections[session_id]
-            try:
-                await websocket.send_text(json.dumps(message, ensure_ascii=False))
-            except Exception as e:
-                logger.error(f"发送消息失败 {session_id}: {e}")
-                self.disconnect(session_id)
+            message = payload.get('message')
+            await self._deliver(session_id, json.dumps(message, ensure_ascii=False), message)
+
+class ContextLedger:
+    """
+    单个会话的共享上下文与token账本
+
+    按模型维护token数的前缀和：prefix[i] 为前i条消息的token总数。
+    新消息只统计一次，任意区间的token数为两个前缀和之差，
+    裁剪时用二分查找定位预算内能保留的最早消息。
+    清理旧消息只移动起始下标，累积到一定数量后再整体压缩。
+    后台压缩生成的滚动摘要覆盖的消息直接移出窗口，由摘要代替。
+    """
+    
+    # 起始下标超过该值时压缩消息列表与前缀和
+    COMPACT_THRESHOLD = 64
+    
+    def __init__(self):
+        self._messages: List[ChatMessage] = []
+        self._start = 0
+        # 已从列表中删除的消息数，_base + 列表下标 为消息的绝对序号
+        self._base = 0
+        self._prefix: Dict[str, List[int]] = {}
+        # 滚动摘要及其覆盖到的绝对序号（不含）
+        self.summary: Optional[ChatMessage] = None
+        self.summary_end = 0
+        # 摘要更新回调 (摘要内容, 覆盖到的绝对序号)，用于持久化
+        self.on_summary: Optional[Callable[[str, int], None]] = None
+    
+    def __len__(self) -> int:
+        return len(self._messages) - self._start
+    
+    @property
+    def messages(self) -> List[ChatMessage]:
+        """当前窗口内的消息"""
+        return self._messages[self._start:]
+    
+    def append(self, message: ChatMessage):
+        """追加消息（前缀和在下次查询时增量补齐）"""
+        self._messages.append(message)
+    
+    def truncate(self, max_messages: int):
+        """只保留最近的 max_messages 条消息"""
+        excess = len(self) - max_messages
+        if excess <= 0:
+            return
+        self._start += excess
+        self._compact_storage()
+    
+    def _compact_storage(self):
+        """起始下标累积到阈值时删除窗口之前的消息与前缀和"""
+        if self._start >= self.COMPACT_THRESHOLD:
+            drop = self._start
+            del self._messages[:drop]
+            for key in list(self._prefix):
+                prefix = self._prefix[key]
+                if len(prefix) > drop:
+                    del prefix[:drop]
+                else:
+                    del self._prefix[key]
+            self._base += drop
+            self._start = 0
+    
+    @property
+    def summary_text(self) -> str:
+        """当前滚动摘要内容"""
+        return self.summary.content if self.summary else ''
+    
+    def uncovered_tokens(self) -> int:
+        """尚未被摘要覆盖的消息token数（窗口内的消息都未被覆盖）"""
+        return self.total_tokens()
+    
+    def compaction_span(self, keep_recent: int, max_messages: int) -> Tuple[int, List[dict]]:
+        """
+        取出待压缩的最早一段消息（保留最近 keep_recent 条不压缩）
+
+        Returns:
+            (片段第一条消息的绝对序号, 片段消息字典列表，助手消息带模型名)
+        """
+        end = min(len(self) - keep_recent, max_messages)
+        if end <= 0:
+            return self._base + self._start, []
+        span = self._messages[self._start:self._start + end]
+        records = [
+            {'role': msg.role, 'name': msg.model_name, 'content': msg.content}
+            for msg in span
+        ]
+        return self._base + self._start, records
+    
+    def set_summary(self, text: str, start: int, end: int) -> bool:
+        """设置覆盖到绝对序号 end 的滚动摘要，并把被覆盖的消息移出窗口"""
+        if end <= self.summary_end:
+            return False
+        self._apply_summary(text, end)
+        self._start = max(self._start, min(end - self._base, len(self._messages)))
+        self._compact_storage()
+        if self.on_summary:
+            self.on_summary(text, end)
+        return True
+    
+    def _apply_summary(self, text: str, end: int):
+        self.summary = ChatMessage(
+            role='system',
+            content=f"以下是较早对话的摘要：\n{text}",
+            timestamp=datetime.now()
+        )
+        self.summary_end = end
+    
+    def restore(self, messages: List[ChatMessage], first_index: int, summary_text: str = '',
+                summary_end: int = 0):
+        """
+        从持久化数据恢复账本
+
+        Args:
+            messages: 加载的最近消息（按时间顺序）
+            first_index: 第一条消息在会话中的绝对序号
+            summary_text: 滚动摘要（不含前缀）
+            summary_end: 摘要覆盖到的绝对序号
+        """
+        self._messages = list(messages)
+        self._base = first_index
+        self._start = 0
+        self._prefix = {}
+        self.summary = None
+        self.summary_end = 0
+        if summary_text and summary_end > 0:
+            self._apply_summary(summary_text, summary_end)
+            self._start = max(0, min(summary_end - first_index, len(self._messages)))
+    
+    def summary_context(self, model_id: Optional[str]) -> Tuple[List[dict], int]:
+        """摘要消息及其token数（没有摘要时为空）"""
+        if self.summary is None:
+            return [], 0
+        return [self.summary.record], self._count([self.summary], model_id)[0]
+    
+    def records(self, offset: int = 0) -> List[dict]:
+        """从窗口内第 offset 条开始的消息字典（共享对象，不复制）"""
+        return [msg.record for msg in self._messages[self._start + offset:]]
+    
+    @staticmethod
+    def _count(messages: List[ChatMessage], model_id: Optional[str]) -> List[int]:
+        """读取消息缓存的token数，未统计过的批量统计一次"""
+        key = model_id or ''
+        pending = [msg for msg in messages if key not in msg.token_counts]
+        if pending:
+            counts = tokenizer_service.count_each_message([msg.record for msg in pending], model_id)
+            for msg, count in zip(pending, counts):
+                msg.token_counts[key] = count
+        return [msg.token_counts[key] for msg in messages]
+    
+    def _prefix_for(self, model_id: Optional[str]) -> List[int]:
+        """获取模型的前缀和，只为新增消息补齐"""
+        key = model_id or ''
+        prefix = self._prefix.get(key)
+        if prefix is None:
+            # 起始下标之前的消息已被清理，不需要统计
+            prefix = [0] * (self._start + 1)
+            self._prefix[key] = prefix
+        missing = self._messages[len(prefix) - 1:]
+        if missing:
+            total = prefix[-1]
+            for count in self._count(missing, model_id):
+                total += count
+                prefix.append(total)
+        return prefix
+    
+    def total_tokens(self, model_id: Optional[str] = None) -> int:
+        """窗口内消息的token总数（含每条消息的格式开销）"""
+        prefix = self._prefix_for(model_id)
+        return prefix[-1] - prefix[self._start]
+    
+    def select_suffix(self, model_id: Optional[str], budget: int) -> Tuple[int, int]:
+        """
+        在预算内保留尽可能多的最近消息
+
+        Returns:
+            (窗口内第一条保留消息的下标, 保留消息的token数)
+        """
+        if budget <= 0:
+            return len(self), 0
+        prefix = self._prefix_for(model_id)
+        end = len(prefix) - 1
+        first = bisect_left(prefix, prefix[end] - budget, self._start, end + 1)
+        return first - self._start, prefix[end] - prefix[first]
 
 class ContextService:
     """上下文管理服务"""
     
-    def __init__(self):
-        # 存储会话的共享上下文
-        self.shared_contexts: Dict[str, List[ChatMessage]] = {}
+    # 为模型回复预留的token数
+    RESPONSE_RESERVE_TOKENS = 500
+    
+    def __init__(self, compactor: Optional[ContextCompactor] = None, store: Optional[SessionStore] = None):
+        # 后台上下文压缩器（未配置摘要模型时为空）
+        self.compactor = compactor
+        # 会话持久化（只入队，不等待写入）
+        self.store = store
+        # 存储会话的共享上下文（含token账本）
+        self.shared_contexts: Dict[str, ContextLedger] = {}
         # 存储各模型的系统提示词
         self.model_system_prompts: Dict[str, Dict[str, str]] = {}
+        # 缓存各模型的系统消息及其token数
+        self._system_messages: Dict[str, Dict[str, Tuple[List[dict], int]]] = {}
         # 存储模型的上下文限制
         self.model_limits: Dict[str, int] = {
             'gpt-4': 8192,
@@ -86,10 +487,19 @@ class ContextService:
             'qwen-turbo': 8192,
         }
     
+    def _ledger(self, session_id: str) -> ContextLedger:
+        """获取会话的上下文账本，不存在时创建"""
+        ledger = self.shared_contexts.get(session_id)
+        if ledger is None:
+            ledger = ContextLedger()
+            if self.store:
+                ledger.on_summary = lambda text, end: self.store.save_summary(session_id, text, end)
+            self.shared_contexts[session_id] = ledger
+        return ledger
+    
     async def initialize_model_context(self, session_id: str, model_id: str, system_prompts: dict):
         """初始化模型上下文"""
-        if session_id not in self.shared_contexts:
-            self.shared_contexts[session_id] = []
+        self._ledger(session_id)
         
         if session_id not in self.model_system_prompts:
             self.model_system_prompts[session_id] = {}
@@ -101,95 +511,104 @@ class ContextService:
             prompt = system_prompts.get('prompts', {}).get(model_id, '')
         
         self.model_system_prompts[session_id][model_id] = prompt
+        self._system_messages.get(session_id, {}).pop(model_id, None)
     
     async def add_message(self, session_id: str, message: ChatMessage):
         """添加消息到共享上下文"""
-        if session_id not in self.shared_contexts:
-            self.shared_contexts[session_id] = []
-        
-        self.shared_contexts[session_id].append(message)
+        self._ledger(session_id).append(message)
+        if self.store:
+            self.store.add_message(session_id, message.role, message.content, message.model_id, message.model_name)
         
         # 清理过长的上下文（保留最近的消息）
         await self.cleanup_context(session_id)
+        
+        # 未被摘要覆盖的消息过多时在后台压缩，不阻塞当前轮次
+        if self.compactor:
+            self.compactor.schedule(session_id, self.shared_contexts[session_id])
+    
+    def _system_context(self, session_id: str, model_id: str) -> Tuple[List[dict], int]:
+        """获取模型的系统消息及其token数（按会话与模型缓存）"""
+        cached = self._system_messages.setdefault(session_id, {}).get(model_id)
+        if cached is None:
+            system_prompt = self.model_system_prompts.get(session_id, {}).get(model_id, '')
+            system_messages = [{'role': 'system', 'content': system_prompt}] if system_prompt else []
+            system_tokens = sum(tokenizer_service.count_each_message(system_messages, model_id))
+            cached = (system_messages, system_tokens)
+            self._system_messages[session_id][model_id] = cached
+        return cached
+    
+    def _select_context(self, session_id: str, model_id: str) -> Tuple[List[dict], int, int]:
+        """
+        按模型限制选出上下文窗口
+
+        Returns:
+            (系统消息与摘要, 第一条保留的共享消息下标, 上下文token数)
+        """
+        ledger = self.shared_contexts[session_id]
+        system_messages, system_tokens = self._system_context(session_id, model_id)
+        summary_messages, summary_tokens = ledger.summary_context(model_id)
+        max_tokens = self.model_limits.get(model_id, 4096)
+        available_tokens = max_tokens - system_tokens - summary_tokens - self.RESPONSE_RESERVE_TOKENS
+        first, selected_tokens = ledger.select_suffix(model_id, available_tokens)
+        return system_messages + summary_messages, first, system_tokens + summary_tokens + selected_tokens
     
     async def get_model_context(self, session_id: str, model_id: str) -> List[dict]:
-        """获取特定模型的上下文"""
+        """获取特定模型的上下文（消息字典在各模型之间共享，调用方不应修改）"""
         if session_id not in self.shared_contexts:
             return []
         
-        messages = []
-        
-        # 添加系统提示词
-        system_prompt = self.model_system_prompts.get(session_id, {}).get(model_id, '')
-        if system_prompt:
-            messages.append({
-                'role': 'system',
-                'content': system_prompt
-            })
-        
-        # 添加共享上下文消息
-        shared_messages = self.shared_contexts[session_id]
-        for msg in shared_messages:
-            messages.append({
-                'role': msg.role,
-                'content': msg.content
-            })
-        
-        # 根据模型限制裁剪上下文
-        return await self.trim_context_for_model(model_id, messages)
+        system_messages, first, _ = self._select_context(session_id, model_id)
+        return system_messages + self.shared_contexts[session_id].records(first)
     
     async def trim_context_for_model(self, model_id: str, messages: List[dict]) -> List[dict]:
-        """根据模型限制裁剪上下文"""
+        """根据模型限制裁剪任意消息列表（会话上下文请使用 get_model_context）"""
         max_tokens = self.model_limits.get(model_id, 4096)
         
         # 保留系统消息
         system_messages = [msg for msg in messages if msg['role'] == 'system']
         other_messages = [msg for msg in messages if msg['role'] != 'system']
         
-        # 简单的token计算（实际应该使用tokenizer）
-        def count_tokens(text: str) -> int:
-            return len(text.split()) * 1.3  # 粗略估算
-        
         # 计算系统消息的token数
-        system_tokens = sum(count_tokens(msg['content']) for msg in system_messages)
-        available_tokens = max_tokens - system_tokens - 500  # 预留500tokens给响应
+        system_tokens = sum(tokenizer_service.count_each_message(system_messages, model_id))
+        available_tokens = max_tokens - system_tokens - self.RESPONSE_RESERVE_TOKENS
         
         if available_tokens <= 0:
             return system_messages
         
-        # 从最新消息开始，逐步添加到上下文中
-        selected_messages = []
+        # 从最新消息开始累加，找到预算内最早能保留的消息
+        other_tokens = tokenizer_service.count_each_message(other_messages, model_id)
+        first = len(other_messages)
         current_tokens = 0
+        while first > 0 and current_tokens + other_tokens[first - 1] <= available_tokens:
+            first -= 1
+            current_tokens += other_tokens[first]
         
-        for msg in reversed(other_messages):
-            msg_tokens = count_tokens(msg['content'])
-            if current_tokens + msg_tokens <= available_tokens:
-                selected_messages.insert(0, msg)
-                current_tokens += msg_tokens
-            else:
-                break
-        
-        return system_messages + selected_messages
+        return system_messages + other_messages[first:]
     
     async def get_context_info(self, session_id: str) -> dict:
         """获取上下文信息"""
         if session_id not in self.shared_contexts:
             return {'total_tokens': 0, 'message_count': 0}
         
-        messages = self.shared_contexts[session_id]
-        # 简单的token计算
-        total_tokens = sum(len(msg.content.split()) * 1.3 for msg in messages)
+        ledger = self.shared_contexts[session_id]
+        message_count = len(ledger)
+        # 账本中的计数含消息格式开销，这里只报告内容token数
+        total_tokens = ledger.total_tokens() - MESSAGE_OVERHEAD_TOKENS * message_count
         
         return {
             'total_tokens': int(total_tokens),
-            'message_count': len(messages)
+            'message_count': message_count,
+            'summarized_messages': ledger.summary_end
         }
     
     async def get_model_context_usage(self, session_id: str, model_id: str) -> dict:
         """获取模型的上下文使用情况"""
-        context = await self.get_model_context(session_id, model_id)
-        used_tokens = sum(len(msg['content'].split()) * 1.3 for msg in context)
         max_tokens = self.model_limits.get(model_id, 4096)
+        used_tokens = 0
+        if session_id in self.shared_contexts:
+            system_messages, first, context_tokens = self._select_context(session_id, model_id)
+            if system_messages or first < len(self.shared_contexts[session_id]):
+                used_tokens = context_tokens + REPLY_PRIMING_TOKENS
         
         return {
             'used_tokens': int(used_tokens),
@@ -202,10 +621,14 @@ class ContextService:
         if session_id not in self.shared_contexts:
             return
         
-        messages = self.shared_contexts[session_id]
-        if len(messages) > max_messages:
-            # 保留最近的消息
-            self.shared_contexts[session_id] = messages[-max_messages:]
+        # 保留最近的消息
+        self.shared_contexts[session_id].truncate(max_messages)
+    
+    def restore_context(self, session_id: str, messages: List[ChatMessage], first_index: int,
+                        summary_text: str = '', summary_end: int = 0):
+        """用持久化数据重建会话的共享上下文"""
+        self._ledger(session_id).restore(messages, first_index, summary_text, summary_end)
+        self._system_messages.pop(session_id, None)
     
     def clear_session_context(self, session_id: str):
         """清除会话上下文"""
@@ -213,47 +636,290 @@ class ContextService:
             del self.shared_contexts[session_id]
         if session_id in self.model_system_prompts:
             del self.model_system_prompts[session_id]
+        self._system_messages.pop(session_id, None)
+
+def _to_datetime(value: Any) -> datetime:
+    """持久化的时间（SQLite的UTC时间文本）转为本地时间"""
+    try:
+        return datetime.fromisoformat(str(value)).replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+    except ValueError:
+        return datetime.now()
 
 class GroupChatHandler:
     """群聊处理器"""
     
+    # 每个会话记住的 clientMessageId 数量
+    MAX_CLIENT_TURNS = 100
+    
     def __init__(self, provider_manager: ProviderManager):
-        self.connection_manager = ConnectionManager()
-        self.context_service = ContextService()
+        self.connection_manager = ConnectionManager(shared_state)
+        self.context_service = ContextService(create_context_compactor(provider_manager), session_store)
         self.provider_manager = provider_manager
+        self.store = session_store
+        self.max_sessions = config.session_memory_max
+        # 各会话最近的 clientMessageId -> 该轮开始前的消息序号（识别客户端重试）
+        self.client_turns: Dict[str, "OrderedDict[str, int]"] = {}
+        self.session_idle_ttl = config.session_idle_ttl
+        self.metrics = {'evicted_sessions': 0}
+        heartbeat_monitor.add_sweeper(self.evict_expired_sessions)
     
     async def handle_websocket(self, websocket: WebSocket, session_id: str):
         """处理WebSocket连接"""
-        await self.connection_manager.connect(websocket, session_id)
+        codec = await self.connection_manager.connect(websocket, session_id)
+        # 连接的用户（初始化会话时记为会话的 owner）
+        owner = (await identify(websocket.scope)).user_id
         
         try:
+            await self.restore_session(session_id)
+            
+
             while True:
                 # 接收消息
-                data = await websocket.receive_text()
-                message = json.loads(data)
+                message = await codec.receive(websocket)
+                message_type = message.get('type')
+                heartbeat_monitor.touch(websocket, activity=message_type not in ('ping', 'pong'))
                 
                 # 处理不同类型的消息
-                await self.handle_message(session_id, message)
+                if message_type == 'ping':
+                    await self.connection_manager.send_control(session_id, {'type': 'pong', 'timestamp': time.time()})
+                elif message_type != 'pong':
+                    async with heartbeat_monitor.busy(websocket):
+                        await self.handle_message(session_id, message, owner)
                 
         except WebSocketDisconnect:
             logger.info(f"WebSocket客户端断开连接: {session_id}")
-            self.connection_manager.disconnect(session_id)
+            self.connection_manager.disconnect(session_id, websocket)
         except Exception as e:
             logger.error(f"WebSocket错误 {session_id}: {e}")
-            self.connection_manager.disconnect(session_id)
+            self.connection_manager.disconnect(session_id, websocket)
+        self.evict_idle_sessions()
+    
+    async def handle_mux_stream(self, stream, session_id: str):
+        """
+        处理多路复用连接（/ws/mux）上的群聊流，stream 充当该会话的WebSocket
+
+        连接断开时进行中的一轮回答继续完成并写入重放缓冲（与单独的WebSocket一致），
+        客户端取消该流时同时取消本轮回答
+        """
+        await self.connection_manager.connect(stream, session_id, multiplexed=True)
+        owner = (await identify(stream.connection.websocket.scope)).user_id
+        try:
+            await self.restore_session(session_id)
+            while True:
+                message = await stream.receive()
+                if not isinstance(message, dict) or message.get('type') in ('ping', 'pong'):
+                    continue
+                turn = asyncio.ensure_future(self.handle_message(session_id, message, owner))
+                try:
+                    await asyncio.shield(turn)
+                except asyncio.CancelledError:
+                    if stream.cancelled:
+                        turn.cancel()
+                    raise
+        finally:
+            self.connection_manager.disconnect(session_id, stream)
+            self.evict_idle_sessions()
+    
+    async def handle_watch_websocket(self, websocket: WebSocket, session_id: str, last_seq: int = 0):
+        """
+        只读观看会话（/ws/group-chat/{session_id}/watch）：不触发模型调用，先补齐缓冲中已有的消息再实时接收
+
+        观看者跟不上时先合并状态消息，仍跟不上则以1013断开（带 last_seq 重连补齐），不影响会话与其他观看者
+        """
+        codec = await accept_websocket(websocket)
+        try:
+            subscription = self.connection_manager.watch(session_id, last_seq, f"watch:{session_id}:{id(websocket)}")
+        except HubFull as e:
+            await websocket.close(code=WS_CLOSE_TRY_AGAIN_LATER, reason=str(e))
+            return
+        async def reaped():
+            subscription.close()
+        
+        heartbeat_monitor.register(websocket, 'group_watch', subscription.send_nowait, reaped)
+        drain_controller.on_drain(
+            lambda hint: subscription.send_nowait(json.dumps(hint, ensure_ascii=False)),
+            lambda: subscription.close(CLOSE_DRAINING)
+        )
+        reader = asyncio.create_task(self._read_watcher(websocket, codec, subscription))
+        try:
+            async for _, payload in subscription:
+                await asyncio.wait_for(codec.send_frame(websocket, codec.encode(text=payload)), config.ws_send_timeout)
+            if subscription.close_reason == CLOSE_OVERFLOW:
+                await asyncio.wait_for(websocket.close(code=WS_CLOSE_TRY_AGAIN_LATER), 1)
+            elif subscription.close_reason == CLOSE_DRAINING:
+                await asyncio.wait_for(websocket.close(code=WS_CLOSE_SERVICE_RESTART), 1)
+        except Exception as e:
+            logger.info(f"观看者断开 {session_id}: {e or type(e).__name__}")
+        finally:
+            reader.cancel()
+            heartbeat_monitor.unregister(websocket)
+            subscription.close()
+    
+    async def _read_watcher(self, websocket: WebSocket, codec, subscription: Subscription):
+        """观看者的接收循环：只处理心跳，连接断开时结束订阅"""
+        try:
+            while True:
+                message = await codec.receive(websocket)
+                heartbeat_monitor.touch(websocket, activity=False)
+                if isinstance(message, dict) and message.get('type') == 'ping':
+                    subscription.send_nowait(json.dumps({'type': 'pong', 'timestamp': time.time()}))
+        except Exception:
+            pass
+        finally:
+            subscription.close()
+    
+    async def handle_mux_watch(self, stream, session_id: str, last_seq: int = 0):
+        """多路复用连接上的只读观看流，data 帧与 /ws/group-chat/{session_id}/watch 的消息相同"""
+        subscription = self.connection_manager.watch(session_id, last_seq, f"mux-watch:{session_id}:{id(stream)}")
+        try:
+            async for _, payload in subscription:
+                await stream.emit(json.loads(payload))
+            if subscription.close_reason == CLOSE_OVERFLOW:
+                await stream.emit({'type': 'slow_consumer', 'reconnect': True})
+        finally:
+            subscription.close()
+    
+    def touch_session(self, session_id: str, session: Optional[GroupChatSession] = None):
+        """标记会话为最近使用（传入 session 时同时注册）"""
+        sessions = self.connection_manager.group_sessions
+        if session is not None:
+            sessions[session_id] = session
+        if session_id in sessions:
+            sessions.move_to_end(session_id)
+            sessions[session_id].last_active = time.time()
     
-    async def handle_message(self, session_id: str, message: dict):
-        """处理接收到的消息"""
+    def evict_idle_sessions(self):
+        """内存中的会话超过上限时，淘汰最久未使用且没有连接的会话（数据已持久化，重连时再加载）"""
+        sessions = self.connection_manager.group_sessions
+        excess = len(sessions) - self.max_sessions
+        if excess <= 0:
+            return
+        for session_id in list(sessions):
+            if excess <= 0:
+                break
+            if session_id in self.connection_manager.active_connections:
+                continue
+            self._evict_session(session_id)
+            excess -= 1
+    
+    async def evict_expired_sessions(self):
+        """淘汰超过 SESSION_IDLE_TTL 没有使用且没有连接的会话（由心跳检查循环定期调用）"""
+        if self.session_idle_ttl <= 0:
+            return
+        cutoff = time.time() - self.session_idle_ttl
+        expired = [
+            session_id for session_id, session in self.connection_manager.group_sessions.items()
+            if session.last_active < cutoff and session_id not in self.connection_manager.active_connections
+        ]
+        if not expired:
+            return
+        if config.session_persist_on_evict and self.store.enabled:
+            # 先写入尚未提交的消息，重连时从存储加载的数据是完整的
+            await self.store.flush()
+        for session_id in expired:
+            # flush期间会话可能重新连接
+            if session_id not in self.connection_manager.active_connections:
+                self._evict_session(session_id)
+        logger.info(f"淘汰 {len(expired)} 个空闲群聊会话，内存中剩余 {len(self.connection_manager.group_sessions)} 个")
+    
+    def _evict_session(self, session_id: str):
+        self.connection_manager.group_sessions.pop(session_id, None)
+        self.context_service.clear_session_context(session_id)
+        self.connection_manager.clear_replay(session_id)
+        self.client_turns.pop(session_id, None)
+        self.metrics['evicted_sessions'] += 1
+    
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'sessions_in_memory': len(self.connection_manager.group_sessions),
+            'connections': len(self.connection_manager.active_connections),
+            'watchers': self.connection_manager.hub.get_stats(),
+            **self.metrics
+        }
+    
+    async def restore_session(self, session_id: str):
+        """连接时若会话不在内存中，从持久化存储懒加载会话与最近的消息"""
+        if session_id in self.connection_manager.group_sessions:
+            self.touch_session(session_id)
+            return
+        data = await self.store.load_session(session_id)
+        if not data or not data['models']:
+            return
+        
+        messages = [
+            ChatMessage(
+                role=item['role'],
+                content=item['content'],
+                timestamp=_to_datetime(item['created_at']),
+                model_id=item['model_id'],
+                model_name=item['model_name']
+            )
+            for item in data['messages']
+        ]
+        session = GroupChatSession(
+            session_id=session_id,
+            models=data['models'],
+            system_prompts=data['system_prompts'],
+            created_at=_to_datetime(data['created_at']),
+            messages=messages
+        )
+        self.touch_session(session_id, session)
+        for model in session.models:
+            await self.context_service.initialize_model_context(session_id, model['id'], session.system_prompts)
+        self.context_service.restore_context(
+            session_id, messages, data['first_index'], data['summary'] or '', data['summary_end']
+        )
+        self.evict_idle_sessions()
+        logger.info(f"已恢复群聊会话 {session_id}: {len(messages)} 条消息")
+        
+        await self.connection_manager.send_message(session_id, {
+            'type': 'session_restored',
+            'data': {
+                'session_id': session_id,
+                'models': session.models,
+                'messages': [
+                    {
+                        'role': msg.role,
+                        'content': msg.content,
+                        'modelId': msg.model_id,
+                        'modelName': msg.model_name,
+                        'timestamp': msg.timestamp.isoformat()
+                    }
+                    for msg in messages
+                ]
+            }
+        })
+        await self.send_context_update(session_id)
+    
+    async def handle_message(self, session_id: str, message: dict, owner: str = ''):
+        """处理接收到的消息（owner 为发送消息的用户）"""
         message_type = message.get('type')
         data = message.get('data', {})
         
         try:
             if message_type == 'initialize_group_chat':
-                await self.initialize_group_chat(session_id, data)
+                await self.initialize_group_chat(session_id, data, owner)
             elif message_type == 'user_message':
-                await self.handle_user_message(session_id, data)
+                # 客户端重试（相同 clientMessageId）时不重新生成，重放该轮已发送的消息
+                client_message_id = data.get('clientMessageId')
+                if client_message_id and await self.replay_duplicate(session_id, client_message_id):
+                    return
+                # 每轮计入连接用户的请求配额
+                await admit_current()
+                # 排空时等待本轮所有模型回答完成后再关闭连接
+                async with drain_controller.turn():
+                    await self.handle_user_message(session_id, data)
+            elif message_type == 'resume':
+                await self.resume(session_id, data)
             else:
                 logger.warning(f"未知消息类型: {message_type}")
+        except QuotaExceeded as e:
+            await self.connection_manager.send_message(session_id, {
+                'type': 'error',
+                'message': str(e),
+                'reason': e.reason,
+                'retryAfter': e.retry_after
+            })
         except Exception as e:
             logger.error(f"处理消息失败: {e}")
             await self.connection_manager.send_message(session_id, {
@@ -261,8 +927,35 @@ class GroupChatHandler:
                 'message': f'处理消息失败: {str(e)}'
             })
     
-    async def initialize_group_chat(self, session_id: str, data: dict):
-        """初始化群聊会话"""
+    async def resume(self, session_id: str, data: dict):
+        """断线重连：重放序号大于 last_seq 的消息（进行中的一轮回答之后的消息照常实时送达）"""
+        last_seq = int(data.get('last_seq') or 0)
+        replayed = await self.connection_manager.replay(session_id, last_seq)
+        logger.info(f"会话 {session_id} 续传: 从序号 {last_seq} 之后重放 {replayed} 条消息")
+        await self.connection_manager.send_control(session_id, {
+            'type': 'replay_complete',
+            'replayed': replayed
+        })
+    
+    async def replay_duplicate(self, session_id: str, client_message_id: str) -> bool:
+        """
+        记录本轮的 clientMessageId；重复的消息改为重放该轮开始之后的消息
+
+        Returns:
+            是否为重复消息
+        """
+        turns = self.client_turns.setdefault(session_id, OrderedDict())
+        if client_message_id in turns:
+            logger.info(f"会话 {session_id} 收到重复消息 {client_message_id}，重放而不重新生成")
+            await self.connection_manager.replay(session_id, turns[client_message_id])
+            return True
+        turns[client_message_id] = self.connection_manager.replay_buffer(session_id).last_seq
+        while len(turns) > self.MAX_CLIENT_TURNS:
+            turns.popitem(last=False)
+        return False
+    
+    async def initialize_group_chat(self, session_id: str, data: dict, owner: str = ''):
+        """初始化群聊会话（持久化的会话属于 owner，历史API只向其返回）"""
         try:
             models = data.get('models', [])
             system_prompts = data.get('systemPrompts', {})
@@ -275,7 +968,9 @@ class GroupChatHandler:
                 created_at=datetime.now()
             )
             
-            self.connection_manager.group_sessions[session_id] = session
+            self.touch_session(session_id, session)
+            self.store.save_session(session_id, models, system_prompts, owner=owner)
+            self.evict_idle_sessions()
             
             # 初始化各个模型的上下文
             for model in models:
@@ -312,6 +1007,7 @@ class GroupChatHandler:
                 return
             
             session = self.connection_manager.group_sessions.get(session_id)
+            self.touch_session(session_id)
             if not session:
                 await self.connection_manager.send_message(session_id, {
                     'type': 'error',
@@ -363,8 +1059,13 @@ class GroupChatHandler:
             # 获取模型的上下文
             context = await self.context_service.get_model_context(session_id, model_id)
             
-            # 调用模型生成响应
-            response_content = await self.call_model_api(provider, model_id, context)
+            # 调用前检查token配额（计入预估的输入token），超出或未准入时该模型报错
+            input_tokens = tokenizer_service.count_messages(context, model_id)
+            await check_tokens(input_tokens)
+            # 调用模型生成响应（每个模型的调用各占一个准入名额）
+            async with admission_controller.slot():
+                response_content = await self.call_model_api(provider, model_id, context)
+            await record_usage(input_tokens + tokenizer_service.count_text(response_content or '', model_id))
             
             if response_content:
                 # 创建AI响应消息
@@ -467,7 +1168,8 @@ class GroupChatHandler:
             await self.connection_manager.send_message(session_id, {
                 'type': 'context_update',
                 'contextSize': context_info['total_tokens'],
-                'messageCount': context_info['message_count']
+                'messageCount': context_info['message_count'],
+                'summarizedMessages': context_info.get('summarized_messages', 0)
             })
             
         except Exception as e:
@@ -0,0 +1,170 @@
+"""
+WebSocket消息编码
+
+默认每条消息是 json.dumps(..., ensure_ascii=False) 的文本帧，modelId、modelName、timestamp、
+usedContext 等键在每帧中重复出现。客户端可以在握手时通过子协议（Sec-WebSocket-Protocol）
+协商二进制编码：
+
+- chat-msgpack.v1：MessagePack二进制帧，FIELD_IDS 中的键编码为整数（字段表随版本号固定，
+  可通过 GET /api/ws/codecs 获取），其他键保持字符串。需要安装 msgpack 包
+- chat-json：JSON文本帧（未提供子协议时同样使用JSON）
+
+服务端按客户端给出的子协议顺序选择第一个可用的编码，都不可用时回退为JSON。
+客户端在二进制连接上仍可以发送JSON文本帧。
+
+帧压缩（permessage-deflate）由uvicorn在握手时协商，见 start_production.py 的 --ws-deflate。
+
+使用方法:
+    codec = await accept_websocket(websocket)
+    frame = codec.encode(message)           # 文本或二进制帧，可放入发送队列
+    await codec.send_frame(websocket, frame)
+    message = await codec.receive(websocket)
+"""
+
+import json
+from typing import Any, Dict, List, Optional, Union
+
+from fastapi import WebSocket, WebSocketDisconnect
+
+from config import config
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+Frame = Union[str, bytes]
+
+# chat-msgpack.v1 的字段表：下标即字段id（只能在末尾追加，修改已有字段需要新版本号）
+FIELD_IDS: List[str] = [
+    'type', 'data', 'content', 'seq', 'timestamp', 'modelId', 'modelName', 'status',
+    'usedContext', 'maxContext', 'contextSize', 'messageCount', 'summarizedMessages', 'error',
+    'message', 'op', 'stream', 'id', 'kind', 'reason', 'credit', 'n', 'session_id', 'models',
+    'messages', 'role', 'model_id', 'model_name', 'clientMessageId', 'last_seq', 'replayed',
+    'from', 'to', 'cache_hit', 'tokens', 'usage', 'provider', 'model', 'name'
+]
+_FIELD_INDEX: Dict[str, int] = {name: index for index, name in enumerate(FIELD_IDS)}
+
+
+def intern_fields(value: Any) -> Any:
+    """把字段表中的键替换为整数id（递归处理嵌套的字典与列表）"""
+    if isinstance(value, dict):
+        return {_FIELD_INDEX.get(key, key): intern_fields(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [intern_fields(item) for item in value]
+    return value
+
+
+def restore_fields(value: Any) -> Any:
+    """intern_fields 的逆操作"""
+    if isinstance(value, dict):
+        return {
+            FIELD_IDS[key] if isinstance(key, int) and 0 <= key < len(FIELD_IDS) else key: restore_fields(item)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [restore_fields(item) for item in value]
+    return value
+
+
+class WireCodec:
+    """JSON文本帧"""
+
+    name = 'json'
+    subprotocol = 'chat-json'
+    binary = False
+
+    def encode(self, message: Any = None, text: Optional[str] = None) -> Frame:
+        """
+        编码一条消息
+
+        Args:
+            message: 消息对象
+            text: 已序列化的JSON（调用方已有时传入，JSON编码直接复用）
+        """
+        if text is not None:
+            return text
+        return json.dumps(message, ensure_ascii=False)
+
+    def decode(self, frame: Frame) -> Any:
+        return json.loads(frame)
+
+    async def send_frame(self, websocket: WebSocket, frame: Frame):
+        """发送已编码的帧"""
+        if isinstance(frame, bytes):
+            await websocket.send_bytes(frame)
+        else:
+            await websocket.send_text(frame)
+
+    async def receive(self, websocket: WebSocket) -> Any:
+        """接收一条消息（文本帧按JSON解析，二进制帧按本编码解析）"""
+        message = await websocket.receive()
+        if message['type'] == 'websocket.disconnect':
+            raise WebSocketDisconnect(message.get('code', 1000), message.get('reason'))
+        if message.get('bytes') is not None:
+            return self.decode(message['bytes'])
+        return json.loads(message['text'])
+
+
+class MsgpackCodec(WireCodec):
+    """MessagePack二进制帧，常用字段编码为整数id"""
+
+    name = 'msgpack'
+    subprotocol = 'chat-msgpack.v1'
+    binary = True
+
+    def encode(self, message: Any = None, text: Optional[str] = None) -> Frame:
+        if message is None and text is not None:
+            message = json.loads(text)
+        return msgpack.packb(intern_fields(message), use_bin_type=True)
+
+    def decode(self, frame: Frame) -> Any:
+        return restore_fields(msgpack.unpackb(frame, raw=False, strict_map_key=False))
+
+    async def send_frame(self, websocket: WebSocket, frame: Frame):
+        # 放入队列的JSON文本（如心跳ping）在发送时转为本编码
+        if isinstance(frame, str):
+            frame = self.encode(text=frame)
+        await websocket.send_bytes(frame)
+
+
+json_codec = WireCodec()
+
+# 可用的编码（未安装 msgpack 时只有JSON）
+CODECS: Dict[str, WireCodec] = {json_codec.subprotocol: json_codec}
+if msgpack is not None:
+    msgpack_codec = MsgpackCodec()
+    CODECS[msgpack_codec.subprotocol] = msgpack_codec
+
+
+def enabled_codecs() -> List[WireCodec]:
+    """WS_CODECS 中启用且可用的编码"""
+    return [codec for codec in CODECS.values() if codec.name in config.ws_codecs]
+
+
+def negotiate_codec(websocket: WebSocket) -> WireCodec:
+    """按客户端提供的子协议顺序选择编码，没有可用的编码时使用JSON"""
+    enabled = {codec.subprotocol: codec for codec in enabled_codecs()}
+    for subprotocol in websocket.scope.get('subprotocols') or []:
+        if subprotocol in enabled:
+            return enabled[subprotocol]
+    return json_codec
+
+
+async def accept_websocket(websocket: WebSocket) -> WireCodec:
+    """协商编码并接受连接（只在客户端提供了该子协议时在握手响应中返回）"""
+    codec = negotiate_codec(websocket)
+    offered = websocket.scope.get('subprotocols') or []
+    await websocket.accept(subprotocol=codec.subprotocol if codec.subprotocol in offered else None)
+    return codec
+
+
+def get_codec_info() -> Dict[str, Any]:
+    return {
+        'codecs': [
+            {'name': codec.name, 'subprotocol': codec.subprotocol, 'binary': codec.binary}
+            for codec in enabled_codecs()
+        ],
+        'msgpack_installed': msgpack is not None,
+        'fields': {'version': 1, 'ids': FIELD_IDS}
+    }
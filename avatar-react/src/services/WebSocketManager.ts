@@ -72,6 +72,11 @@ class WebSocketManager {
       this.ws.onmessage = (event) => {
         try {
           const message = JSON.parse(event.data);
+          // 服务端心跳：立即回复，超时未回复的连接会被服务端回收
+          if (message.type === 'ping') {
+            this.ws?.send(JSON.stringify({ type: 'pong', timestamp: message.timestamp }));
+            return;
+          }
           console.log('收到WebSocket消息:', message);
           this.onMessage(message);
         } catch (error) {
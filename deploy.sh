@@ -159,15 +159,15 @@ check_env_files() {
 deploy_services() {
     log_info "构建和启动服务..."
     
-    # 停止现有服务
-    docker-compose down 2>/dev/null || true
-    
-    # 构建镜像
+    # 构建镜像（构建期间已有服务继续运行）
     log_info "构建Docker镜像..."
     docker-compose build --no-cache
     
-    # 启动服务
+    # 启动服务：已有容器会被重建，旧后端先排空进行中的回答再退出。
+    # 这不是零停机发布：旧后端排空期间新的生成请求返回503，旧容器退出到新容器启动完成之间
+    # nginx对 /api 返回502（container_name 固定、nginx只有一个上游，新旧容器无法并存）
     log_info "启动服务..."
+    log_warn "重建已有容器期间服务暂时不可用，客户端需要重试/重连"
     docker-compose up -d
     
     # 等待服务启动
@@ -209,6 +209,8 @@ show_deployment_info() {
     echo "🔧 管理命令："
     echo "  - 查看日志: docker-compose logs -f"
     echo "  - 重启服务: docker-compose restart"
+    echo "  - 滚动重启后端worker（只加载 .env 变更，不使用新镜像）: ./update.sh reload"
+    echo "  - 更新代码（重建容器，期间短暂不可用）: ./update.sh"
     echo "  - 停止服务: docker-compose down"
     echo "  - 更新部署: ./deploy.sh"
     echo
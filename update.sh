@@ -1,9 +1,25 @@
 #!/bin/bash
 
 # 项目更新脚本
+#
+# 用法: ./update.sh [reload]
+#   （无参数）  备份配置、拉取代码、重新构建镜像并重建容器
+#   reload      只在运行中的后端容器内滚动重启worker
+#
+# 注意：两种方式都不是新版本的零停机发布
+#   - 完整更新会重建后端容器（container_name 固定、nginx只有一个上游，无法新旧容器并存）。
+#     旧容器排空期间（最长 DRAIN_TIMEOUT 秒）新的生成请求返回503，旧容器退出到新容器
+#     启动完成之间nginx对 /api 返回502，客户端需要重试/重连
+#   - reload（SIGHUP）不中断连接，但只重新加载容器内已有的代码和挂载的 api-server/.env，
+#     不会使用新构建的镜像；代码更新必须使用完整更新
 
 set -e
 
+if [[ "$1" == "-h" || "$1" == "--help" ]]; then
+    sed -n '3,14p' "$0" | sed 's/^# \{0,1\}//'
+    exit 0
+fi
+
 echo "🔄 开始更新项目..."
 
 # 颜色定义
@@ -47,18 +63,17 @@ pull_latest() {
 rebuild_deploy() {
     log_info "重新构建和部署..."
     
-    # 停止服务
-    docker-compose down
-    
-    # 清理旧镜像
-    docker system prune -f
-    
-    # 重新构建
+    # 先构建新镜像，构建期间旧容器继续提供服务
     docker-compose build --no-cache
     
-    # 启动服务
+    # 重建容器：旧后端收到SIGTERM后进入排空模式，进行中的回答在 stop_grace_period 内完成，
+    # WebSocket客户端收到重连提示。旧容器退出到新容器就绪之间后端不可用（见脚本开头的说明）
+    log_warn "重建后端容器期间 /api 暂时不可用，客户端需要重试/重连"
     docker-compose up -d
     
+    # 清理旧镜像
+    docker system prune -f
+    
     # 等待启动
     sleep 30
     
@@ -66,8 +81,22 @@ rebuild_deploy() {
     docker-compose ps
 }
 
+# 只重启后端worker（api-server/.env 等配置变更）：同一监听socket上滚动重启，不中断连接。
+# 新worker仍运行当前容器中的代码，不会使用新构建的镜像
+reload_workers() {
+    log_info "滚动重启后端worker..."
+    log_warn "reload 只重新加载容器内已有的代码与 .env，不使用新镜像；代码更新请运行不带参数的 ./update.sh"
+    docker-compose kill -s HUP backend
+}
+
 # 主函数
 main() {
+    if [[ "$1" == "reload" ]]; then
+        reload_workers
+        log_info "🎉 后端worker已滚动重启！"
+        return
+    fi
+    
     backup_current
     pull_latest
     rebuild_deploy